@@ -2,33 +2,342 @@
 import socket
 import json
 import sys
+import csv
+import time
 
-# Função para enviar um comando e receber a resposta
+from protocolo import LeitorMensagens, codificar, negociar_binario, ler_endereco, ler_enderecos, descobrir_papeis
+from protocolo import com_id_pedido, espera_repeticao
+
+TEMPO_RESPOSTA = 10.0  # segundos à espera de uma resposta antes de voltar a ligar e repetir
+TENTATIVAS_PEDIDO = 4  # envios de um mesmo comando (o primeiro e as repetições)
+
+# Função para enviar um comando e receber a resposta. Sem resposta a
+# tempo, volta a ligar, retoma a sessão e repete o comando: as alterações
+# levam um id_pedido, por isso o servidor não as aplica duas vezes.
 def send_command(sock, command_dict):
+    sock = ligacao_atual(sock)
+    command_dict = com_id_pedido(command_dict)
+    for tentativa in range(TENTATIVAS_PEDIDO):
+        if tentativa:
+            time.sleep(espera_repeticao(tentativa - 1))
+        try:
+            enviar(sock, command_dict)
+            resposta = receber(sock)
+            if resposta is not None:
+                return resposta
+            erro = "Erro: O servidor fechou a ligação"
+        except socket.timeout:
+            erro = "Erro: O servidor não respondeu a tempo"
+        except socket.error as e:
+            erro = f"Erro de rede: {e}"
+        except json.JSONDecodeError:
+            print("*** Erro: Servidor enviou resposta inválida ***")
+            return None
+        if command_dict.get("tipo") == "SAIR":
+            break
+        novo, retomou = religar(sock)
+        if novo is None:
+            break
+        sock = novo
+        if "id_pedido" in command_dict and not retomou:
+            # Outro servidor (ou o mesmo, reiniciado): não guarda a resposta
+            print(f"*** {erro}; a ligação foi refeita, confirme se o comando foi aplicado ***")
+            return None
+    print(f"*** {erro} ***")
+    perdidas.add(sock)
+    return None
+
+def enviar(sock, command_dict):
+    codec = codecs.get(sock)
+    sock.sendall(codec.codificar(command_dict) if codec else codificar(command_dict))
+
+def receber(sock):
+    codec = codecs.get(sock)
+    if codec:
+        recebido = leitor_de(sock).ler_quadro()
+        return codec.decodificar(*recebido) if recebido else None
+    return leitor_de(sock).ler()
+
+# --- (IMPORTAÇÃO / EXPORTAÇÃO CSV) ---
+# O CSV é lido aos poucos e enviado em blocos de BULK_SET. Vários blocos
+# ficam "em voo" ao mesmo tempo (pipelining), para não esperar a ida e
+# volta de cada um.
+LINHAS_POR_BLOCO = 1000
+BLOCOS_EM_VOO = 8
+
+def _blocos_csv(arquivo):
+    """Devolve (número da primeira linha, linhas) para cada bloco do CSV.
+    A primeira linha é ignorada se for um cabeçalho (quantidade não numérica)."""
+    bloco, inicio = [], 1
+    for numero, linha in enumerate(csv.reader(arquivo), start=1):
+        if not linha:
+            continue
+        if numero == 1 and len(linha) >= 2 and not linha[1].strip().lstrip("-").isdigit():
+            inicio = 2
+            continue
+        bloco.append(linha[:2] if len(linha) >= 2 else linha)
+        if len(bloco) >= LINHAS_POR_BLOCO:
+            yield inicio, bloco
+            bloco, inicio = [], numero + 1
+    if bloco:
+        yield inicio, bloco
+
+def importar_csv(sock, caminho):
+    inicio_tempo = time.perf_counter()
+    em_voo = []  # (número da primeira linha, linhas) dos blocos sem resposta
+    linhas = aplicadas = 0
+    erros = []
+
+    def esperar_um():
+        nonlocal aplicadas
+        primeira, bloco = em_voo.pop(0)
+        resposta = receber(sock)
+        if resposta is None:
+            raise ConnectionError("O servidor fechou a ligação")
+        payload = resposta.get("payload", {})
+        if resposta.get("tipo") == "SOBRECARGA":
+            # Bloco recusado pelo limite de pedidos: nenhuma linha foi aplicada
+            erros.extend((primeira + i, linha, payload.get("mensagem")) for i, linha in enumerate(bloco))
+            return
+        aplicadas += payload.get("aplicados", 0)
+        for erro in payload.get("erros", []):
+            # O índice do erro é relativo ao bloco; o número da linha é só
+            # aproximado se o bloco tinha linhas vazias
+            erros.append((primeira + erro["indice"], bloco[erro["indice"]], erro["mensagem"]))
+
+    with open(caminho, newline="", encoding="utf-8") as arquivo:
+        for primeira, bloco in _blocos_csv(arquivo):
+            enviar(sock, {"tipo": "BULK_SET", "payload": {"itens": bloco}})
+            em_voo.append((primeira, bloco))
+            linhas += len(bloco)
+            if len(em_voo) >= BLOCOS_EM_VOO:
+                esperar_um()
+    while em_voo:
+        esperar_um()
+
+    duracao = time.perf_counter() - inicio_tempo
+    print(f"Importadas {linhas} linhas ({aplicadas} produtos atualizados) em {duracao:.2f}s "
+          f"-> {linhas / duracao if duracao else 0:,.0f} linhas/s")
+    for numero, linha, mensagem in erros[:20]:
+        print(f"  linha {numero}: {linha} -> {mensagem}")
+    if len(erros) > 20:
+        print(f"  ... e mais {len(erros) - 20} linhas com erro")
+
+def exportar_csv(sock, caminho):
+    """Devolve False se o servidor recusou (réplica atrasada)."""
+    inicio_tempo = time.perf_counter()
+    enviar(sock, {"tipo": "EXPORT_ESTOQUE", "payload": {"bloco": LINHAS_POR_BLOCO}})
+    linhas = 0
+    with open(caminho, "w", newline="", encoding="utf-8") as arquivo:
+        escritor = csv.writer(arquivo)
+        escritor.writerow(["produto", "quantidade"])
+        while True:
+            resposta = receber(sock)
+            if resposta is None:
+                raise ConnectionError("O servidor fechou a ligação")
+            if resposta.get("tipo") in ("REPLICA_ATRASADA", "NAO_PRIMARIO"):
+                return False
+            if resposta.get("tipo") == "EXPORT_PARTE":
+                itens = resposta["payload"]["itens"]
+                escritor.writerows(itens)
+                linhas += len(itens)
+            elif resposta.get("tipo") == "EXPORT_FIM":
+                break
+            # Outras mensagens (eventos) não interessam aqui
+
+    duracao = time.perf_counter() - inicio_tempo
+    print(f"Exportados {linhas} produtos (versão {resposta.get('versao')}) para '{caminho}' em {duracao:.2f}s "
+          f"-> {linhas / duracao if duracao else 0:,.0f} linhas/s")
+    return True
+
+# --- (PRIMÁRIO E RÉPLICAS) ---
+# O admin aceita uma lista de endereços: os comandos vão para o primário
+# e a exportação (só leitura) vai para uma réplica, se houver.
+def ligar(endereco, enderecos, token=None):
+    """Liga a 'endereco' e abre uma sessão (a do token, se ainda existir).
+    'enderecos' é a lista de servidores, para voltar a ligar se cair."""
+    sock = socket.create_connection(endereco, timeout=TEMPO_RESPOSTA)
+    if "--binario" in sys.argv:
+        codec = negociar_binario(sock, leitor_de(sock))
+        if codec:
+            codecs[sock] = codec
+    comando = {"tipo": "SESSAO"}
+    if token is not None:
+        comando["payload"] = {"token": token}
+    enviar(sock, comando)
+    payload = (receber(sock) or {}).get("payload", {})
+    sessoes[sock] = (enderecos, payload.get("token"), payload.get("instancia"), payload.get("retomada", False))
+    return sock
+
+def religar(sock):
+    """A ligação 'sock' caiu ou não respondeu: liga de novo (ao primário
+    atual, com vários servidores) e retoma a sessão. Devolve (socket novo,
+    se a sessão foi retomada na mesma instância do servidor), ou (None, False)."""
+    enderecos, token, instancia, _ = sessoes.pop(sock, ([], None, None, False))
+    _leitores.pop(sock, None)
+    codecs.pop(sock, None)
+    sock.close()
+    primario = descobrir_papeis(enderecos)[0] if len(enderecos) > 1 else (enderecos[0] if enderecos else None)
+    if primario is None:
+        return None, False
     try:
-        json_string = json.dumps(command_dict)
-        sock.sendall(json_string.encode())
-        
-        resposta_raw = sock.recv(4096).decode()
-        return json.loads(resposta_raw)
-        
-    except socket.error as e:
-        print(f"*** Erro de rede: {e} ***")
-        return None
-    except json.JSONDecodeError:
-        print("*** Erro: Servidor enviou resposta inválida ***")
+        novo = ligar(primario, enderecos, token)
+    except (OSError, ValueError):
+        return None, False
+    trocas[sock] = novo
+    _, _, instancia_nova, retomada = sessoes[novo]
+    return novo, retomada and instancia is not None and instancia_nova == instancia
+
+def ligacao_atual(sock):
+    while sock in trocas:
+        sock = trocas.pop(sock)
+    return sock
+
+def pedir_a(endereco, comando):
+    """Um comando numa ligação curta a 'endereco' (None se não respondeu)."""
+    try:
+        with socket.create_connection(endereco, timeout=5) as sock:
+            sock.sendall(codificar(comando) + codificar({"tipo": "SAIR"}))
+            return LeitorMensagens(sock).ler()
+    except (OSError, ValueError):
         return None
 
+def exportar_da_replica(replicas, caminho):
+    """EXPORTAR lido de uma réplica; False se nenhuma o pôde servir."""
+    for endereco in replicas:
+        try:
+            sock = socket.create_connection(endereco, timeout=30)
+        except OSError:
+            continue
+        try:
+            if exportar_csv(sock, caminho):
+                print(f"(lido da réplica {endereco[0]}:{endereco[1]})")
+                return True
+        except (ConnectionError, socket.timeout, ValueError):
+            pass
+        finally:
+            _leitores.pop(sock, None)
+            sock.close()
+    return False
+
+def mostrar_replicacao(enderecos):
+    for host, porta in enderecos:
+        resposta = pedir_a((host, porta), {"tipo": "GET_REPLICACAO"})
+        if resposta is None:
+            print(f"  {host}:{porta}: não responde")
+            continue
+        estado = resposta.get("payload", {})
+        if estado.get("papel") == "replica":
+            atraso = "nunca esteve em dia" if estado.get("atraso") is None else f"atraso {estado['atraso']} s"
+            print(f"  {host}:{porta}: réplica de {estado.get('primario')} (seq {estado.get('seq')}, {atraso})")
+        else:
+            print(f"  {host}:{porta}: primário (seq {estado.get('seq')}, {len(estado.get('replicas') or {})} réplicas ligadas)")
+
+def promover(enderecos, novo):
+    """Promove a réplica 'novo' e põe as outras réplicas a segui-la."""
+    resposta = pedir_a(novo, {"tipo": "PROMOVER"})
+    if resposta is None or resposta.get("tipo") != "PROMOVIDO":
+        print(f"Erro: {resposta.get('payload', {}).get('mensagem') if resposta else 'o servidor não respondeu'}")
+        return False
+    print(f"{novo[0]}:{novo[1]} é agora o primário ({resposta['payload']['sessoes']} carrinhos à espera dos clientes).")
+    for endereco in enderecos:
+        if endereco != novo:
+            resposta = pedir_a(endereco, {"tipo": "SEGUIR", "payload": {"primario": f"{novo[0]}:{novo[1]}"}})
+            if resposta is not None and resposta.get("tipo") == "SEGUINDO":
+                print(f"  {endereco[0]}:{endereco[1]} segue o novo primário")
+    return True
+
+# Um leitor com buffer por socket: bytes que chegaram "a mais" numa leitura
+# pertencem à próxima resposta e não podem ser descartados.
+_leitores = {}
+
+# --- (LIVRO DE MOVIMENTOS) ---
+# Consultas sobre os totais por minuto que o servidor mantém (GET_TOP_RESERVADOS,
+# GET_DEMANDA, GET_RUPTURAS). Os instantes vêm em segundos desde a época.
+def _hora(instante):
+    return time.strftime("%d/%m %H:%M:%S", time.localtime(instante))
+
+def mostrar_movimentos(sock, cmd, args):
+    if cmd == "TOP":
+        n = int(args[0]) if args else 10
+        horas = float(args[1]) if len(args) > 1 else 1
+        resposta = send_command(sock, {"tipo": "GET_TOP_RESERVADOS", "payload": {"n": n, "ultimos": horas * 3600}})
+    elif cmd == "DEMANDA":
+        horas = float(args[1]) if len(args) > 1 else 24
+        resposta = send_command(sock, {"tipo": "GET_DEMANDA", "payload": {"produto": args[0].lower(), "ultimos": horas * 3600}})
+    else:
+        horas = float(args[0]) if args else 24
+        payload = {"ultimos": horas * 3600}
+        if len(args) > 1:
+            payload["produto"] = args[1].lower()
+        resposta = send_command(sock, {"tipo": "GET_RUPTURAS", "payload": payload})
+    if not resposta:
+        return
+    tipo, payload = resposta.get("tipo"), resposta.get("payload", {})
+    if tipo == "TOP_RESERVADOS":
+        if not payload["itens"]:
+            print("Nenhuma reserva nesse período.")
+        for i, item in enumerate(payload["itens"], 1):
+            print(f"  {i:>3}. {item['produto']}: reservado {item['reservado']}, "
+                  f"cancelado {item['cancelado']}, devolvido {item['devolvido']}")
+    elif tipo == "DEMANDA":
+        if not payload["janelas"]:
+            print(f"Nenhum movimento de '{payload['produto']}' nesse período.")
+        for janela in payload["janelas"]:
+            print(f"  {_hora(janela['inicio'])}  reservado {janela['reservado']:>6}  cancelado {janela['cancelado']:>6}  "
+                  f"devolvido {janela['devolvido']:>6}  ajustado {janela['ajustado']:>+7}")
+    elif tipo == "RUPTURAS":
+        if not payload["intervalos"]:
+            print("Nenhum produto esgotou nesse período.")
+        for intervalo in payload["intervalos"]:
+            fim = _hora(intervalo["fim"]) if intervalo["fim"] is not None else "ainda esgotado"
+            print(f"  {intervalo['produto']}: {_hora(intervalo['inicio'])} -> {fim} ({intervalo['segundos']:.0f} s)")
+    else:
+        print(f"Servidor: {payload.get('mensagem') or tipo}")
+
+def leitor_de(sock):
+    if sock not in _leitores:
+        _leitores[sock] = LeitorMensagens(sock)
+    return _leitores[sock]
+
+# Sockets que negociaram a codificação binária (python admin.py.py --binario)
+codecs = {}
+# Sockets cuja ligação caiu: com vários servidores, o admin procura o primário de novo
+perdidas = set()
+# (servidores, token, instância, retomada) da sessão de cada ligação, e o
+# socket que substituiu cada ligação refeita por send_command
+sessoes = {}
+trocas = {}
+
 def main():
-    HOST = input("Digite o IP do servidor (ex: 127.0.0.1): ")
-    PORT = 5050
+    # Com réplicas: a lista de servidores, ex.: 127.0.0.1:5050,127.0.0.1:5051
+    enderecos = ler_enderecos(input("Digite o IP do servidor (ex: 127.0.0.1 ou 127.0.0.1:5050,127.0.0.1:5051): "))
+    if not enderecos:
+        return
+    primario, replicas = descobrir_papeis(enderecos) if len(enderecos) > 1 else (enderecos[0], [])
+    if primario is None:
+        print("Nenhum dos servidores é um primário que responda.")
+        return
+    HOST, PORT = primario
 
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((HOST, PORT))
+        sock = ligar(primario, enderecos)
         print(f"--- Conectado ao servidor {HOST}:{PORT} como ADMIN ---")
+        if replicas:
+            print(f"--- Réplicas: {', '.join(f'{h}:{p}' for h, p in replicas)} ---")
         print("Use os comandos:")
         print("  SET <produto> <quantidade>   (Ex: SET maca 50)")
+        print("  SET <produto> <qtd> total    (Define o total em loja; o disponível desconta as reservas)")
+        print("  RESERVADO [produto]          (Quanto está reservado, e por quem)")
+        print("  IMPORTAR <arquivo.csv>       (Define o estoque a partir de um CSV produto,quantidade)")
+        print("  EXPORTAR <arquivo.csv>       (Grava o estoque atual num CSV)")
+        print("  METRICAS [prometheus]        (Métricas do servidor)")
+        print("  TOP [n] [horas]              (Produtos mais reservados nas últimas horas; padrão 10 e 1)")
+        print("  DEMANDA <produto> [horas]    (Reservas do produto hora a hora; padrão 24 horas)")
+        print("  RUPTURAS [horas] [produto]   (Quando é que os produtos esgotaram; padrão 24 horas)")
+        print("  REPLICACAO                   (Papel e atraso de cada servidor da lista)")
+        print("  PROMOVER <host:porta>        (Promove uma réplica a primário)")
+        print("  SEGUIR <réplica> <primário>  (Põe uma réplica a seguir outro primário)")
         print("  SAIR                         (Para fechar)")
         print("-" * 50)
     except socket.error as e:
@@ -42,6 +351,16 @@ def main():
             if not user_input:
                 continue
 
+            sock = ligacao_atual(sock)
+            if sock in perdidas and len(enderecos) > 1:
+                # O primário caiu: talvez uma réplica já tenha sido promovida
+                novo, replicas = descobrir_papeis(enderecos)
+                if novo is not None:
+                    sock.close()
+                    sock = ligar(novo, enderecos)
+                    HOST, PORT = novo
+                    print(f"--- Ligado ao primário {HOST}:{PORT} ---")
+
             parts = user_input.split()
             cmd = parts[0].upper()
 
@@ -49,7 +368,7 @@ def main():
                 send_command(sock, {"tipo": "SAIR"})
                 break # Sai do loop while
             
-            elif cmd == "SET" and len(parts) == 3:
+            elif cmd == "SET" and (len(parts) == 3 or (len(parts) == 4 and parts[3].lower() == "total")):
                 # Comando para definir estoque
                 produto = parts[1].lower()
                 try:
@@ -63,6 +382,8 @@ def main():
                             "quantidade": quantidade
                         }
                     }
+                    if len(parts) == 4:
+                        comando["payload"]["total"] = True
                     
                     # Envia e imprime a resposta
                     resposta = send_command(sock, comando)
@@ -72,8 +393,73 @@ def main():
                 except ValueError:
                     print("Erro: A quantidade deve ser um número.")
             
+            elif cmd in ("IMPORTAR", "EXPORTAR") and len(parts) == 2:
+                try:
+                    if cmd == "IMPORTAR":
+                        importar_csv(sock, parts[1])
+                    elif not replicas or not exportar_da_replica(replicas, parts[1]):
+                        exportar_csv(sock, parts[1])
+                except OSError as e:
+                    print(f"Erro: {e}")
+                    if isinstance(e, (ConnectionError, socket.timeout)):
+                        perdidas.add(sock)
+
+            elif cmd == "RESERVADO" and len(parts) <= 2:
+                comando = {"tipo": "GET_RESERVADO"}
+                if len(parts) == 2:
+                    comando["payload"] = {"produto": parts[1].lower()}
+                resposta = send_command(sock, comando)
+                if resposta:
+                    payload = resposta.get("payload", {})
+                    if "totais" in payload:
+                        if not payload["totais"]:
+                            print("Não há reservas.")
+                        for produto, quantidade in sorted(payload["totais"].items()):
+                            print(f"  {produto}: {quantidade}")
+                    elif not payload.get("existe"):
+                        print(f"Produto '{payload.get('produto')}' não existe.")
+                    else:
+                        print(f"  {payload['produto']}: disponível {payload['disponivel']}, "
+                              f"reservado {payload['reservado']}, total {payload['total']}")
+                        for id_cliente, quantidade in payload["clientes"].items():
+                            print(f"    cliente {id_cliente}: {quantidade}")
+
+            elif cmd == "METRICAS":
+                comando = {"tipo": "GET_METRICS"}
+                if len(parts) > 1 and parts[1].lower() == "prometheus":
+                    comando["payload"] = {"formato": "prometheus"}
+                resposta = send_command(sock, comando)
+                if resposta:
+                    payload = resposta.get("payload", {})
+                    print(payload["texto"] if "texto" in payload else json.dumps(payload, indent=2, ensure_ascii=False))
+
+            elif cmd in ("TOP", "DEMANDA", "RUPTURAS"):
+                try:
+                    mostrar_movimentos(sock, cmd, parts[1:])
+                except (ValueError, IndexError):
+                    print("Erro: use TOP [n] [horas], DEMANDA <produto> [horas] ou RUPTURAS [horas] [produto].")
+
+            elif cmd == "REPLICACAO":
+                mostrar_replicacao(enderecos)
+
+            elif cmd == "PROMOVER" and len(parts) == 2:
+                novo = ler_endereco(parts[1])
+                if novo not in enderecos:
+                    enderecos.append(novo)
+                if promover(enderecos, novo):
+                    sock.close()
+                    sock = ligar(novo, enderecos)
+                    replicas = [e for e in enderecos if e != novo and e != (HOST, PORT)]
+                    HOST, PORT = novo
+
+            elif cmd == "SEGUIR" and len(parts) == 3:
+                resposta = pedir_a(ler_endereco(parts[1]), {"tipo": "SEGUIR", "payload": {"primario": parts[2]}})
+                if resposta:
+                    print(f"Servidor: {resposta.get('payload', {}).get('mensagem') or resposta.get('tipo')}")
+
             else:
-                print("Comando inválido. Use: SET <produto> <quantidade> ou SAIR")
+                print("Comando inválido. Use: SET <produto> <quantidade> [total], RESERVADO [produto], IMPORTAR/EXPORTAR <arquivo.csv>, "
+                      "METRICAS, TOP, DEMANDA <produto>, RUPTURAS, REPLICACAO, PROMOVER <host:porta>, SEGUIR <réplica> <primário> ou SAIR")
 
         except KeyboardInterrupt:
             # Se o admin der Ctrl+C
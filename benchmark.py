@@ -0,0 +1,1389 @@
+# benchmark.py
+# Benchmarks do servidor do Mercadinho.
+# Uso: python benchmark.py modos --conexoes 2000 --duracao 5
+import argparse
+import asyncio
+import json
+import multiprocessing
+import queue
+import socket
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from protocolo import LeitorMensagens, codificar, negociar_binario, com_id_pedido, espera_repeticao
+
+
+# --- Utilitários ---
+
+def iniciar_servidor(porta, *args_extra):
+    """Sobe o servidor.py num subprocesso e espera ele aceitar conexões."""
+    cmd = [sys.executable, "servidor.py", "--host", "127.0.0.1", "--porta", str(porta), *args_extra]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    limite = time.time() + 10
+    while time.time() < limite:
+        try:
+            socket.create_connection(("127.0.0.1", porta), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("O servidor não subiu a tempo.")
+
+def parar_servidor(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+# --- Cliente de carga (asyncio) ---
+
+async def _cliente(porta, comando, fim, contador):
+    reader, writer = await asyncio.open_connection("127.0.0.1", porta, limit=2**26)
+    contador["conectados"] += 1
+    # Um comando ou uma lista de comandos, enviados em sequência
+    comandos = comando if isinstance(comando, list) else [comando]
+    dados = [codificar(c) for c in comandos]
+    i = 0
+    try:
+        # Espera todas as conexões subirem antes de medir
+        while not contador["inicio"].is_set():
+            await contador["inicio"].wait()
+        while time.time() < fim[0]:
+            writer.write(dados[i % len(dados)])
+            i += 1
+            await writer.drain()
+            resposta = await reader.readline()
+            if not resposta:
+                break
+            contador["requisicoes"] += 1
+    finally:
+        writer.close()
+
+async def _carga(porta, conexoes, duracao, comando):
+    contador = {"conectados": 0, "requisicoes": 0, "inicio": asyncio.Event()}
+    fim = [float("inf")]
+    tarefas = [asyncio.create_task(_cliente(porta, comando, fim, contador)) for _ in range(conexoes)]
+
+    # Dá tempo para todos conectarem
+    limite = time.time() + 30
+    while contador["conectados"] < conexoes and time.time() < limite:
+        await asyncio.sleep(0.05)
+
+    conectados = contador["conectados"]
+    inicio = time.time()
+    fim[0] = inicio + duracao
+    contador["inicio"].set()
+    await asyncio.gather(*tarefas, return_exceptions=True)
+    decorrido = time.time() - inicio
+    return conectados, contador["requisicoes"] / decorrido
+
+
+# --- Cenários ---
+
+def bench_modos(args):
+    """Compara o modo threads com o modo asyncio: conexões mantidas e req/s."""
+    comando = {"tipo": "GET_ESTOQUE"}
+    print(f"{'modo':<10} {'conexões':>10} {'req/s':>12}")
+    for i, modo in enumerate(["threads", "asyncio"]):
+        porta = args.porta + i
+        proc = iniciar_servidor(porta, "--modo", modo)
+        try:
+            conectados, rps = asyncio.run(_carga(porta, args.conexoes, args.duracao, comando))
+        finally:
+            parar_servidor(proc)
+        print(f"{modo:<10} {conectados:>10} {rps:>12.0f}")
+
+
+def bench_contencao(args):
+    """Contenção de locks: N threads fazendo RESERVAR/CANCELAR sobre M produtos,
+    chamando process_json_command diretamente (sem rede)."""
+    import servidor
+
+    print(f"{'fatias':>7} {'threads':>8} {'produtos':>9} {'ops/s':>12}")
+    for fatias in args.fatias:
+        servidor.configurar_fatias(fatias)
+        servidor.estoque_disponivel.clear()
+        for i in range(args.produtos):
+            servidor.estoque_disponivel[f"p{i}"] = 10**9
+
+        fim = time.time() + args.duracao
+        totais = []
+
+        def trabalhador(n):
+            conn = object()  # chave do carrinho, como o socket no servidor real
+            servidor.registrar_cliente(conn)
+            rnd = random.Random(n)
+            ops = 0
+            while time.time() < fim:
+                produto = f"p{rnd.randrange(args.produtos)}"
+                carga = '{"produto": "%s", "quantidade": 1}' % produto
+                servidor.process_json_command('{"tipo": "RESERVAR", "payload": %s}' % carga, conn)
+                servidor.process_json_command('{"tipo": "CANCELAR_RESERVA", "payload": %s}' % carga, conn)
+                ops += 2
+            totais.append(ops)
+
+        threads = [threading.Thread(target=trabalhador, args=(n,)) for n in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        print(f"{fatias:>7} {args.threads:>8} {args.produtos:>9} {sum(totais) / args.duracao:>12.0f}")
+
+
+def bench_lote(args):
+    """Carrinho de K itens: K RESERVAR/CANCELAR_RESERVA individuais vs um
+    RESERVAR_LOTE + um CANCELAR_LOTE."""
+    proc = iniciar_servidor(args.porta)
+    try:
+        sock = socket.create_connection(("127.0.0.1", args.porta))
+        leitor = LeitorMensagens(sock)
+
+        def enviar(comando):
+            sock.sendall(codificar(comando))
+            return leitor.ler()
+
+        produtos = [f"item{i}" for i in range(args.itens)]
+        for produto in produtos:
+            enviar({"tipo": "SET_ESTOQUE", "payload": {"produto": produto, "quantidade": 10**9}})
+
+        def por_item():
+            for produto in produtos:
+                enviar({"tipo": "RESERVAR", "payload": {"produto": produto, "quantidade": 1}})
+            for produto in produtos:
+                enviar({"tipo": "CANCELAR_RESERVA", "payload": {"produto": produto, "quantidade": 1}})
+
+        itens = [{"produto": produto, "quantidade": 1} for produto in produtos]
+        def em_lote():
+            enviar({"tipo": "RESERVAR_LOTE", "payload": {"itens": itens}})
+            enviar({"tipo": "CANCELAR_LOTE", "payload": {"itens": itens}})
+
+        print(f"{'modo':<10} {'itens':>6} {'carrinhos/s':>12} {'itens/s':>10}")
+        for nome, funcao in [("por item", por_item), ("lote", em_lote)]:
+            carrinhos = 0
+            inicio = time.time()
+            while time.time() - inicio < args.duracao:
+                funcao()
+                carrinhos += 1
+            decorrido = time.time() - inicio
+            print(f"{nome:<10} {args.itens:>6} {carrinhos / decorrido:>12.0f} {carrinhos * args.itens / decorrido:>10.0f}")
+        sock.close()
+    finally:
+        parar_servidor(proc)
+
+
+def bench_durabilidade(args):
+    """Alterações/s com o estoque só em memória vs. com o diário em disco
+    (cada thread espera o fsync antes de "responder", como no servidor)."""
+    import servidor
+    from persistencia import Diario
+
+    print(f"{'modo':<12} {'threads':>8} {'alterações/s':>14}")
+    for modo in ["memoria", "diario"]:
+        servidor.estoque_disponivel.clear()
+        for i in range(args.produtos):
+            servidor.estoque_disponivel[f"p{i}"] = 10**9
+        pasta = tempfile.mkdtemp(prefix="bench_diario_")
+        servidor.diario = None
+        if modo == "diario":
+            servidor.diario = Diario(pasta)
+            servidor.diario.recuperar()
+
+        fim = time.time() + args.duracao
+        totais = []
+
+        def trabalhador(n):
+            conn = object()
+            servidor.registrar_cliente(conn)
+            rnd = random.Random(n)
+            ops = 0
+            while time.time() < fim:
+                carga = '{"produto": "p%d", "quantidade": 1}' % rnd.randrange(args.produtos)
+                servidor.process_json_command('{"tipo": "RESERVAR", "payload": %s}' % carga, conn)
+                servidor.aguardar_durabilidade()
+                servidor.process_json_command('{"tipo": "CANCELAR_RESERVA", "payload": %s}' % carga, conn)
+                servidor.aguardar_durabilidade()
+                ops += 2
+            totais.append(ops)
+
+        threads = [threading.Thread(target=trabalhador, args=(n,)) for n in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        print(f"{modo:<12} {args.threads:>8} {sum(totais) / args.duracao:>14.0f}")
+    servidor.diario = None
+
+
+def bench_codificacao(args):
+    """JSON vs codificação binária: comandos/s numa ligação, em rajadas de
+    'pipeline' comandos (para medir CPU de codificação e não a latência)."""
+    proc = iniciar_servidor(args.porta)
+    try:
+        print(f"{'codificação':<12} {'comandos/s':>12} {'bytes/comando':>14}")
+        for nome in ["json", "binaria"]:
+            sock = socket.create_connection(("127.0.0.1", args.porta))
+            leitor = LeitorMensagens(sock)
+            codec = negociar_binario(sock, leitor) if nome == "binaria" else None
+            enviar = codec.codificar if codec else codificar
+
+            def rajada(comandos):
+                dados = b"".join(enviar(c) for c in comandos)
+                sock.sendall(dados)
+                for _ in comandos:
+                    if codec:
+                        codec.decodificar(*leitor.ler_quadro())
+                    else:
+                        leitor.ler()
+                return len(dados)
+
+            # Aprende os IDs dos produtos antes de medir
+            rajada([{"tipo": "GET_ESTOQUE"}])
+            carga = {"produto": "banana", "quantidade": 1}
+            comandos = [{"tipo": "RESERVAR", "payload": carga}, {"tipo": "CANCELAR_RESERVA", "payload": carga},
+                        {"tipo": "GET_MINHAS_RESERVAS"}] * (args.pipeline // 3)
+
+            total, enviados = 0, 0
+            inicio = time.time()
+            while time.time() - inicio < args.duracao:
+                enviados += rajada(comandos)
+                total += len(comandos)
+            decorrido = time.time() - inicio
+            print(f"{nome:<12} {total / decorrido:>12.0f} {enviados / total:>14.1f}")
+            sock.close()
+    finally:
+        parar_servidor(proc)
+
+
+def _processo_carga(porta, conexoes, duracao, comando):
+    return asyncio.run(_carga(porta, conexoes, duracao, comando))[1]
+
+def bench_workers(args):
+    """Servidor com 1..N processos (memória partilhada): RESERVAR/CANCELAR
+    vindos de vários processos clientes ao mesmo tempo."""
+    carga = {"produto": "banana", "quantidade": 1}
+    comando = [{"tipo": "RESERVAR", "payload": carga}, {"tipo": "CANCELAR_RESERVA", "payload": carga}]
+    print(f"{'workers':>8} {'clientes':>9} {'req/s':>12}")
+    for i, workers in enumerate(args.workers):
+        porta = args.porta + i
+        proc = iniciar_servidor(porta, "--workers", str(workers))
+        try:
+            with multiprocessing.Pool(args.processos) as pool:
+                parciais = pool.starmap(_processo_carga, [(porta, args.conexoes, args.duracao, comando)] * args.processos)
+        finally:
+            parar_servidor(proc)
+        print(f"{workers:>8} {args.conexoes * args.processos:>9} {sum(parciais):>12.0f}")
+
+
+def bench_catalogo(args):
+    """Catálogo grande: GET_ESTOQUE inteiro vs uma página de BUSCAR_ESTOQUE
+    (com e sem filtro), chamando process_json_command diretamente."""
+    import servidor
+
+    servidor.estoque_disponivel.clear()
+    rnd = random.Random(0)
+    for i in range(args.produtos):
+        servidor.estoque_disponivel[f"produto{i:07d}"] = rnd.choice([0, 0, 10])
+    conn = object()
+    servidor.registrar_cliente(conn)
+
+    casos = [
+        ("GET_ESTOQUE", {"tipo": "GET_ESTOQUE"}),
+        ("página", {"tipo": "BUSCAR_ESTOQUE", "payload": {"limite": args.limite}}),
+        ("página disponíveis", {"tipo": "BUSCAR_ESTOQUE", "payload": {"limite": args.limite, "so_disponiveis": True,
+                                                                       "cursor": f"produto{args.produtos // 2:07d}"}}),
+        ("prefixo", {"tipo": "BUSCAR_ESTOQUE", "payload": {"limite": args.limite, "prefixo": "produto00012"}}),
+        ("substring", {"tipo": "BUSCAR_ESTOQUE", "payload": {"limite": args.limite, "contem": "777"}}),
+    ]
+    # A primeira consulta constrói o índice
+    servidor.process_json_command(json.dumps(casos[1][1]), conn)
+    print(f"{args.produtos} produtos")
+    print(f"{'consulta':<20} {'ms':>10} {'bytes':>12}")
+    for nome, comando in casos:
+        texto = json.dumps(comando)
+        repeticoes, inicio = 0, time.perf_counter()
+        while time.perf_counter() - inicio < args.duracao:
+            resposta = servidor.process_json_command(texto, conn)
+            repeticoes += 1
+        decorrido = (time.perf_counter() - inicio) / repeticoes
+        print(f"{nome:<20} {decorrido * 1000:>10.3f} {len(resposta):>12}")
+
+
+def bench_leituras(args):
+    """GET_ESTOQUE de um catálogo grande: serializar a cada pedido (como
+    antes das fotografias) vs a fotografia em cache, com o catálogo parado
+    e com uma reserva entre cada leitura; e leitores concorrentes com um
+    escritor a reservar sem parar. Chama process_json_command diretamente."""
+    import servidor
+
+    servidor.estoque_disponivel.clear()
+    for i in range(args.produtos):
+        servidor.estoque_disponivel[f"produto{i:07d}"] = 10**9
+    conn, escritor = object(), object()
+    servidor.registrar_cliente(conn)
+    servidor.registrar_cliente(escritor)
+    pedido = json.dumps({"tipo": "GET_ESTOQUE"})
+    reserva = json.dumps({"tipo": "RESERVAR", "payload": {"produto": "produto0000000", "quantidade": 1}})
+
+    def sem_cache():
+        with servidor.travar_tudo():
+            versao, estoque = servidor.log_alteracoes.atual(), servidor.estoque_disponivel.copy()
+        json.dumps({"tipo": "ESTOQUE_ATUAL", "versao": versao, "payload": estoque}).encode()
+
+    def com_reserva():
+        servidor.process_json_command(reserva, escritor)
+        servidor.process_json_command(pedido, conn)
+
+    print(f"{args.produtos} produtos")
+    print(f"{'caso':<28} {'ms/leitura':>11}")
+    for nome, funcao in [("serializar sempre", sem_cache),
+                         ("fotografia (sem alterações)", lambda: servidor.process_json_command(pedido, conn)),
+                         ("fotografia (1 reserva antes)", com_reserva)]:
+        repeticoes, inicio = 0, time.perf_counter()
+        while time.perf_counter() - inicio < args.duracao:
+            funcao()
+            repeticoes += 1
+        print(f"{nome:<28} {(time.perf_counter() - inicio) / repeticoes * 1000:>11.3f}")
+
+    # Leitores concorrentes + um escritor: leituras/s e latência das reservas
+    for nome, ler in [("serializar sempre", sem_cache),
+                      ("fotografia", lambda: servidor.process_json_command(pedido, conn))]:
+        fim = time.perf_counter() + args.duracao
+        leituras = [0] * args.leitores
+        latencias = []
+
+        def leitor(n):
+            while time.perf_counter() < fim:
+                ler()
+                leituras[n] += 1
+
+        def escrever():
+            while time.perf_counter() < fim:
+                inicio = time.perf_counter()
+                servidor.process_json_command(reserva, escritor)
+                latencias.append(time.perf_counter() - inicio)
+                time.sleep(args.intervalo_escrita)
+
+        threads = [threading.Thread(target=leitor, args=(n,)) for n in range(args.leitores)]
+        threads.append(threading.Thread(target=escrever))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        latencias.sort()
+        print(f"{nome:<18} {args.leitores} leitores: {sum(leituras) / args.duracao:>8.0f} leituras/s, "
+              f"reserva p50 {percentil(latencias, 50) * 1000:.3f} ms, p99 {percentil(latencias, 99) * 1000:.3f} ms")
+
+
+def _proxy_lento(porta_servidor, porta, atraso, probabilidade=1.0):
+    """Proxy TCP que atrasa 'atraso' segundos cada bloco vindo do servidor
+    (ou só uma fração 'probabilidade' deles): simula um servidor lento (ou
+    uma rede com muita latência, ou que de vez em quando engasga)."""
+    ouvinte = socket.create_server(("127.0.0.1", porta))
+
+    def encaminhar(origem, destino, espera):
+        try:
+            while dados := origem.recv(65536):
+                if espera and random.random() < probabilidade:
+                    time.sleep(espera)
+                destino.sendall(dados)
+        except OSError:
+            pass
+        finally:
+            destino.close()
+
+    def aceitar():
+        while True:
+            cliente, _ = ouvinte.accept()
+            servidor = socket.create_connection(("127.0.0.1", porta_servidor))
+            threading.Thread(target=encaminhar, args=(cliente, servidor, 0), daemon=True).start()
+            threading.Thread(target=encaminhar, args=(servidor, cliente, atraso), daemon=True).start()
+
+    threading.Thread(target=aceitar, daemon=True).start()
+    return ouvinte
+
+def _simular_interface(modo, porta, args):
+    """Laço que faz o papel da thread do Tk: a cada tick corre os callbacks
+    recebidos e as ações do utilizador (atualizar a cada --atualizar s,
+    reservar/cancelar a cada --reservar s). Devolve quanto tempo cada tick
+    ocupou a thread e quantas atualizações chegaram a ir ao servidor."""
+    from cliente_gui import NetworkClient
+
+    rede = NetworkClient()
+    rede.ao_erro = lambda titulo, mensagem: print(f"  {titulo}: {mensagem}")
+    if not rede.connect("127.0.0.1", porta):
+        raise RuntimeError("Não foi possível ligar ao proxy.")
+    callbacks = queue.Queue()
+    if modo == "trabalhador":
+        rede.iniciar_trabalhador(lambda funcao, *a: callbacks.put((funcao, a)))
+        rede.ao_erro = lambda titulo, mensagem: print(f"  {titulo}: {mensagem}")
+
+    contagem = {"pedidas": 0, "enviadas": 0}
+    def trocar():
+        contagem["enviadas"] += 1
+        return rede.send_commands([{"tipo": "GET_ESTOQUE"}, {"tipo": "GET_MINHAS_RESERVAS"}])
+
+    def atualizar():
+        contagem["pedidas"] += 1
+        if modo == "trabalhador":
+            rede.executar(trocar, lambda respostas: None, chave="atualizar_listas")
+        else:
+            trocar()
+
+    tipos = ["RESERVAR", "CANCELAR_RESERVA"]
+    def reservar():
+        # Como no cliente: depois da resposta, atualiza as duas listas
+        comando = {"tipo": tipos[0], "payload": {"produto": "banana", "quantidade": 1}}
+        tipos.reverse()
+        if modo == "trabalhador":
+            rede.pedir(comando, lambda resposta: atualizar())
+        else:
+            rede.send_command(comando)
+            atualizar()
+
+    ocupado = []
+    ticks_atualizar = max(1, round(args.atualizar / args.tick))
+    ticks_reservar = max(1, round(args.reservar / args.tick))
+    proximo = time.perf_counter()
+    fim = proximo + args.duracao
+    tick = 0
+    while proximo < fim:
+        espera = proximo - time.perf_counter()
+        if espera > 0:
+            time.sleep(espera)
+        inicio = time.perf_counter()
+        while not callbacks.empty():
+            funcao, argumentos = callbacks.get()
+            funcao(*argumentos)
+        if tick % ticks_atualizar == 0:
+            atualizar()
+        if tick % ticks_reservar == 0:
+            reservar()
+        ocupado.append(time.perf_counter() - inicio)
+        tick += 1
+        proximo = max(proximo + args.tick, time.perf_counter())
+    if modo == "trabalhador":
+        rede.executar(rede.close).result(timeout=5)
+    else:
+        rede.close()
+    return sorted(ocupado), contagem
+
+def bench_interface(args):
+    """Teste sem janela do cliente_gui: quanto tempo a thread da interface
+    fica parada com um servidor lento, com as chamadas de rede feitas na
+    própria thread (como antes) vs pelo trabalhador de rede."""
+    proc = iniciar_servidor(args.porta)
+    proxy = _proxy_lento(args.porta, args.porta + 1, args.atraso)
+    try:
+        print(f"atraso do servidor {args.atraso * 1000:.0f} ms, tick da interface {args.tick * 1000:.0f} ms")
+        print(f"{'modo':<12} {'ticks':>6} {'p50 ms':>8} {'p99 ms':>8} {'máx ms':>8} {'parada s':>9} {'atualizações':>13}")
+        for modo in ("síncrono", "trabalhador"):
+            ocupado, contagem = _simular_interface(modo, args.porta + 1, args)
+            print(f"{modo:<12} {len(ocupado):>6} {percentil(ocupado, 50) * 1000:>8.2f} "
+                  f"{percentil(ocupado, 99) * 1000:>8.2f} {ocupado[-1] * 1000:>8.2f} {sum(ocupado):>9.2f} "
+                  f"{contagem['enviadas']:>6}/{contagem['pedidas']:<6}")
+    finally:
+        proxy.close()
+        parar_servidor(proc)
+
+
+def bench_importacao(args):
+    """Carregar N produtos: um SET_ESTOQUE por linha (como o SET do admin)
+    vs blocos de BULK_SET com vários blocos em voo; e a exportação com
+    EXPORT_ESTOQUE. Para o SET por linha usa só as primeiras --linhas-set."""
+    proc = iniciar_servidor(args.porta, *(["--dados", tempfile.mkdtemp()] if args.dados else []))
+    try:
+        sock = socket.create_connection(("127.0.0.1", args.porta))
+        leitor = LeitorMensagens(sock)
+        linhas = [[f"produto{i:07d}", i % 100] for i in range(args.produtos)]
+
+        print(f"{'modo':<22} {'linhas':>8} {'segundos':>9} {'linhas/s':>10}")
+        def mostrar(nome, n, decorrido):
+            print(f"{nome:<22} {n:>8} {decorrido:>9.2f} {n / decorrido:>10.0f}")
+
+        n_set = min(args.linhas_set, len(linhas))
+        inicio = time.perf_counter()
+        for produto, quantidade in linhas[:n_set]:
+            sock.sendall(codificar({"tipo": "SET_ESTOQUE", "payload": {"produto": produto, "quantidade": quantidade}}))
+            leitor.ler()
+        mostrar("SET por linha", n_set, time.perf_counter() - inicio)
+
+        inicio, em_voo = time.perf_counter(), 0
+        for i in range(0, len(linhas), args.bloco):
+            sock.sendall(codificar({"tipo": "BULK_SET", "payload": {"itens": linhas[i:i + args.bloco]}}))
+            em_voo += 1
+            if em_voo >= args.em_voo:
+                leitor.ler()
+                em_voo -= 1
+        for _ in range(em_voo):
+            leitor.ler()
+        mostrar(f"BULK_SET ({args.bloco}/bloco)", len(linhas), time.perf_counter() - inicio)
+
+        inicio, exportados = time.perf_counter(), 0
+        sock.sendall(codificar({"tipo": "EXPORT_ESTOQUE", "payload": {"bloco": args.bloco}}))
+        while True:
+            resposta = leitor.ler()
+            if resposta["tipo"] == "EXPORT_FIM":
+                break
+            exportados += len(resposta["payload"]["itens"])
+        mostrar("EXPORT_ESTOQUE", exportados, time.perf_counter() - inicio)
+        sock.close()
+    finally:
+        parar_servidor(proc)
+
+
+# --- Carga mista com latências (carga) ---
+
+MIX_PADRAO = "GET_ESTOQUE=30,GET_MINHAS_RESERVAS=20,RESERVAR=25,CANCELAR_RESERVA=20,SET_ESTOQUE=3,DESCONECTAR=2"
+TIPOS_MIX = ["GET_ESTOQUE", "GET_MINHAS_RESERVAS", "RESERVAR", "CANCELAR_RESERVA", "SET_ESTOQUE", "DESCONECTAR"]
+
+def ler_mix(texto):
+    """'GET_ESTOQUE=30,RESERVAR=10' -> {"GET_ESTOQUE": 30.0, "RESERVAR": 10.0}"""
+    mix = {}
+    for parte in texto.split(","):
+        tipo, _, peso = parte.partition("=")
+        tipo = tipo.strip().upper()
+        if tipo not in TIPOS_MIX:
+            raise argparse.ArgumentTypeError(f"tipo desconhecido no mix: {tipo}")
+        mix[tipo] = float(peso or 1)
+    return mix
+
+def percentil(ordenados, p):
+    if not ordenados:
+        return None
+    return ordenados[min(len(ordenados) - 1, int(p / 100 * len(ordenados)))]
+
+async def _conectar(porta, tentativas=50):
+    # Numa avalanche de conexões o backlog do servidor pode encher: tenta de novo
+    for _ in range(tentativas):
+        try:
+            return await asyncio.open_connection("127.0.0.1", porta, limit=2**26)
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("Não foi possível ligar ao servidor.")
+
+async def _pedir(reader, writer, comando):
+    writer.write(codificar(comando))
+    await writer.drain()
+    linha = await reader.readline()
+    return json.loads(linha) if linha else None
+
+async def _cliente_misto(n, porta, mix, produtos, estado):
+    """Um cliente simulado: sorteia comandos segundo o mix e mede cada um.
+    No fim deixa a ligação aberta e devolve o carrinho que o servidor lhe atribui."""
+    rnd = random.Random(n)
+    tipos, pesos = list(mix), list(mix.values())
+    reader, writer = await _conectar(porta)
+    estado["conectados"] += 1
+    carrinho = {}
+    while not estado["inicio"].is_set():
+        await estado["inicio"].wait()
+
+    while time.monotonic() < estado["fim"]:
+        tipo = rnd.choices(tipos, pesos)[0]
+        if tipo == "DESCONECTAR":
+            # Queda abrupta (sem SAIR): o servidor é que tem de devolver o carrinho
+            writer.transport.abort()
+            estado["desconexoes"] += 1
+            reader, writer = await _conectar(porta)
+            carrinho = {}
+            continue
+
+        if tipo in ("RESERVAR", "CANCELAR_RESERVA"):
+            if tipo == "CANCELAR_RESERVA" and carrinho:
+                produto = rnd.choice(list(carrinho))
+            else:
+                produto = rnd.choice(produtos)
+            comando = {"tipo": tipo, "payload": {"produto": produto, "quantidade": rnd.randint(1, 3)}}
+        elif tipo == "SET_ESTOQUE":
+            # Produtos à parte, para não estragar a conta da conservação
+            comando = {"tipo": tipo, "payload": {"produto": f"adm{rnd.randrange(10)}", "quantidade": rnd.randrange(1000)}}
+        else:
+            comando = {"tipo": tipo}
+
+        inicio = time.perf_counter()
+        try:
+            resposta = await _pedir(reader, writer, comando)
+        except (OSError, ValueError):
+            resposta = None
+        decorrido = time.perf_counter() - inicio
+
+        if resposta is None:
+            estado["erros"][tipo] += 1
+            reader, writer = await _conectar(porta)
+            carrinho = {}
+            continue
+        estado["latencias"][tipo].append(decorrido)
+        status = resposta.get("payload", {}).get("status") if isinstance(resposta.get("payload"), dict) else None
+        if resposta.get("tipo") in ("ERRO_GERAL", "RESPOSTA_ERRO"):
+            estado["erros"][tipo] += 1
+        elif status == "ERRO":
+            estado["recusados"][tipo] += 1
+        elif status == "SUCESSO" and tipo in ("RESERVAR", "CANCELAR_RESERVA"):
+            produto, quantidade = comando["payload"]["produto"], comando["payload"]["quantidade"]
+            carrinho[produto] = carrinho.get(produto, 0) + (quantidade if tipo == "RESERVAR" else -quantidade)
+            if not carrinho[produto]:
+                del carrinho[produto]
+
+    # Fim da medição: o carrinho segundo o servidor (confere com o nosso)
+    resposta = await _pedir(reader, writer, {"tipo": "GET_MINHAS_RESERVAS"})
+    carrinho_servidor = resposta["payload"] if resposta else {}
+    if carrinho_servidor != carrinho:
+        estado["carrinhos_divergentes"] += 1
+    return reader, writer, carrinho_servidor
+
+async def _carga_mista(args, porta):
+    mix = args.mix
+    produtos = [f"p{i}" for i in range(args.produtos)]
+    reader, writer = await _conectar(porta)
+    for produto in produtos:
+        await _pedir(reader, writer, {"tipo": "SET_ESTOQUE", "payload": {"produto": produto, "quantidade": args.estoque_inicial}})
+    total_inicial = args.produtos * args.estoque_inicial
+
+    estado = {
+        "conectados": 0, "desconexoes": 0, "carrinhos_divergentes": 0,
+        "inicio": asyncio.Event(), "fim": float("inf"),
+        "latencias": {tipo: [] for tipo in mix}, "erros": {tipo: 0 for tipo in mix},
+        "recusados": {tipo: 0 for tipo in mix},
+    }
+    tarefas = [asyncio.create_task(_cliente_misto(n, porta, mix, produtos, estado)) for n in range(args.clientes)]
+    limite = time.time() + 60
+    while estado["conectados"] < args.clientes and time.time() < limite:
+        await asyncio.sleep(0.05)
+
+    inicio = time.monotonic()
+    estado["fim"] = inicio + args.duracao
+    estado["inicio"].set()
+    finais = await asyncio.gather(*tarefas)
+    decorrido = time.monotonic() - inicio
+
+    # Carrinhos de quem caiu voltam ao estoque quando o tempo para retomar acaba
+    await asyncio.sleep(args.tempo_retomar + 0.5)
+    reservado = sum(q for _, _, carrinho in finais for q in carrinho.values())
+    estoque = (await _pedir(reader, writer, {"tipo": "GET_ESTOQUE"}))["payload"]
+    disponivel = sum(estoque.get(produto, 0) for produto in produtos)
+    # O índice de reservas do servidor tem de bater com os carrinhos dos clientes
+    totais = (await _pedir(reader, writer, {"tipo": "GET_RESERVADO"}))["payload"]["totais"]
+    reservado_servidor = sum(totais.get(produto, 0) for produto in produtos)
+    for _, w, _ in finais + [(reader, writer, None)]:
+        w.close()
+
+    por_comando = {}
+    total_respostas = 0
+    for tipo in mix:
+        if tipo == "DESCONECTAR":
+            continue
+        latencias = sorted(estado["latencias"][tipo])
+        total_respostas += len(latencias)
+        por_comando[tipo] = {
+            "n": len(latencias),
+            "por_segundo": len(latencias) / decorrido,
+            "recusados": estado["recusados"][tipo],
+            "erros": estado["erros"][tipo],
+            "p50_ms": _ms(percentil(latencias, 50)),
+            "p99_ms": _ms(percentil(latencias, 99)),
+            "p999_ms": _ms(percentil(latencias, 99.9)),
+            "max_ms": _ms(latencias[-1] if latencias else None),
+        }
+    return {
+        "clientes": estado["conectados"],
+        "duracao_s": decorrido,
+        "req_por_segundo": total_respostas / decorrido,
+        "desconexoes": estado["desconexoes"],
+        "comandos": por_comando,
+        "conservacao": {
+            "ok": (disponivel + reservado == total_inicial and reservado == reservado_servidor
+                   and not estado["carrinhos_divergentes"]),
+            "esperado": total_inicial,
+            "disponivel": disponivel,
+            "reservado": reservado,
+            "reservado_servidor": reservado_servidor,
+            "carrinhos_divergentes": estado["carrinhos_divergentes"],
+        },
+    }
+
+def _ms(segundos):
+    return None if segundos is None else round(segundos * 1000, 3)
+
+def _servidor_em_processo(porta, modo, tempo_retomar):
+    """Sobe o servidor numa thread deste processo (partilha o GIL com os clientes)."""
+    import servidor
+    servidor.HOST, servidor.PORT = "127.0.0.1", porta
+    servidor.TEMPO_RETOMAR = tempo_retomar
+    alvo = servidor.start_async if modo == "asyncio" else servidor.start
+    threading.Thread(target=alvo, daemon=True).start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", porta), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("O servidor não subiu a tempo.")
+
+def bench_carga(args):
+    """Milhares de clientes com um mix de comandos: vazão, latência
+    p50/p99/p999 por comando e conservação do estoque (disponível + reservado)."""
+    proc = None
+    if args.em_processo:
+        _servidor_em_processo(args.porta, args.modo, args.tempo_retomar)
+    else:
+        proc = iniciar_servidor(args.porta, "--modo", args.modo, "--tempo-retomar", str(args.tempo_retomar))
+    try:
+        resultado = asyncio.run(_carga_mista(args, args.porta))
+    finally:
+        if proc is not None:
+            parar_servidor(proc)
+    resultado["config"] = {
+        "modo": args.modo, "em_processo": args.em_processo, "clientes": args.clientes,
+        "duracao": args.duracao, "mix": args.mix, "produtos": args.produtos,
+        "estoque_inicial": args.estoque_inicial,
+    }
+
+    print(f"{resultado['clientes']} clientes, {resultado['req_por_segundo']:.0f} req/s, "
+          f"{resultado['desconexoes']} desconexões abruptas")
+    print(f"{'comando':<20} {'n':>8} {'recus.':>7} {'erros':>6} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8}")
+    for tipo, r in resultado["comandos"].items():
+        print(f"{tipo:<20} {r['n']:>8} {r['recusados']:>7} {r['erros']:>6} "
+              f"{r['p50_ms'] or 0:>8.2f} {r['p99_ms'] or 0:>8.2f} {r['p999_ms'] or 0:>8.2f}")
+    c = resultado["conservacao"]
+    print(f"conservação: {'OK' if c['ok'] else 'FALHOU'} (disponível {c['disponivel']} + reservado {c['reservado']}"
+          f" = {c['disponivel'] + c['reservado']}, esperado {c['esperado']}; servidor diz {c.get('reservado_servidor')} reservados)")
+
+    if args.saida:
+        with open(args.saida, "w") as f:
+            json.dump(resultado, f, indent=2)
+    if args.comparar:
+        with open(args.comparar) as f:
+            anterior = json.load(f)
+        print(f"\nvs. {args.comparar}:")
+        for tipo, r in resultado["comandos"].items():
+            antes = anterior.get("comandos", {}).get(tipo)
+            if not antes or not antes.get("p99_ms") or not r["p99_ms"]:
+                continue
+            print(f"{tipo:<20} p99 {antes['p99_ms']:.2f} -> {r['p99_ms']:.2f} ms ({(r['p99_ms'] / antes['p99_ms'] - 1) * 100:+.0f}%)")
+    if not resultado["conservacao"]["ok"]:
+        sys.exit(1)
+
+
+async def _tempestade(porta, conexoes, duracao, resultado):
+    """Abre 'conexoes' ligações de uma vez; cada uma faz RESERVAR/CANCELAR
+    sem pausa até ao fim. Conta as admitidas, recusadas e os SOBRECARGA."""
+    carga = {"produto": "banana", "quantidade": 1}
+    dados = codificar({"tipo": "RESERVAR", "payload": carga}) + codificar({"tipo": "CANCELAR_RESERVA", "payload": carga})
+    fim = time.time() + duracao
+
+    async def cliente():
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", porta)
+        except OSError:
+            resultado["falhas"] += 1
+            return
+        try:
+            writer.write(codificar({"tipo": "SESSAO"}))
+            resposta = json.loads(await reader.readline() or "{}")
+            if resposta.get("tipo") != "SESSAO_OK":
+                resultado["recusadas"] += 1
+                return
+            resultado["admitidas"] += 1
+            while time.time() < fim:
+                writer.write(dados)
+                for _ in range(2):
+                    linha = await reader.readline()
+                    if not linha:
+                        return
+                    if b'"SOBRECARGA"' in linha:
+                        resultado["sobrecarga"] += 1
+                    else:
+                        resultado["respostas"] += 1
+        except (OSError, ValueError):
+            resultado["falhas"] += 1
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(cliente() for _ in range(conexoes)), return_exceptions=True)
+
+def _processo_tempestade(porta, conexoes, duracao, fila):
+    resultado = {"admitidas": 0, "recusadas": 0, "falhas": 0, "respostas": 0, "sobrecarga": 0}
+    asyncio.run(_tempestade(porta, conexoes, duracao, resultado))
+    fila.put(resultado)
+
+def bench_tempestade(args):
+    """Clientes normais (RESERVAR/CANCELAR a ritmo fixo) medem a latência
+    antes, durante e depois de uma tempestade de conexões abusivas, com o
+    servidor sem limites e com controlo de admissão + limite de pedidos."""
+    carga = {"produto": "banana", "quantidade": 1}
+    pedidos = [codificar({"tipo": "RESERVAR", "payload": carga}), codificar({"tipo": "CANCELAR_RESERVA", "payload": carga})]
+    configuracoes = [
+        ("sem limites", ["--max-conexoes", "0"]),
+        ("com controlo", ["--max-conexoes", str(args.max_conexoes), "--limite-pedidos", str(args.limite_pedidos)]),
+    ]
+    fases = ("antes", "durante", "depois")
+    print(f"{args.clientes} clientes normais, tempestade de {args.tempestade} conexões durante {args.duracao:.0f}s "
+          f"(modo {args.modo})")
+    print(f"{'servidor':<14} {'fase':<8} {'n':>7} {'p50 ms':>8} {'p99 ms':>9} {'máx ms':>9} {'erros':>6}")
+    for i, (nome, opcoes) in enumerate(configuracoes):
+        porta = args.porta + i
+        proc = iniciar_servidor(porta, "--modo", args.modo, "--log-nivel", "WARNING", *opcoes)
+        latencias = {fase: [] for fase in fases}
+        erros = {fase: 0 for fase in fases}
+        fase_atual = ["antes"]
+        parar = threading.Event()
+
+        def normal():
+            sock = socket.create_connection(("127.0.0.1", porta))
+            leitor = LeitorMensagens(sock)
+            sock.sendall(codificar({"tipo": "SESSAO"}))
+            leitor.ler()
+            i = 0
+            while not parar.is_set():
+                fase = fase_atual[0]
+                inicio = time.perf_counter()
+                try:
+                    sock.sendall(pedidos[i % 2])
+                    resposta = leitor.ler()
+                except OSError:
+                    resposta = None
+                if resposta is None:
+                    erros[fase] += 1
+                    return
+                latencias[fase].append(time.perf_counter() - inicio)
+                if resposta.get("tipo") == "SOBRECARGA":
+                    erros[fase] += 1
+                i += 1
+                time.sleep(args.intervalo)
+            sock.close()
+
+        try:
+            threads = [threading.Thread(target=normal, daemon=True) for _ in range(args.clientes)]
+            for t in threads:
+                t.start()
+            time.sleep(args.duracao)
+            fase_atual[0] = "durante"
+            fila = multiprocessing.Queue()
+            tempestade = multiprocessing.Process(target=_processo_tempestade,
+                                                 args=(porta, args.tempestade, args.duracao, fila))
+            tempestade.start()
+            resultado = fila.get()
+            tempestade.join()
+            fase_atual[0] = "depois"
+            time.sleep(args.duracao)
+            parar.set()
+            for t in threads:
+                t.join(timeout=5)
+        finally:
+            parar_servidor(proc)
+
+        for fase in fases:
+            ordenadas = sorted(latencias[fase])
+            print(f"{nome:<14} {fase:<8} {len(ordenadas):>7} {_ms(percentil(ordenadas, 50)) or 0:>8.2f} "
+                  f"{_ms(percentil(ordenadas, 99)) or 0:>9.2f} {_ms(ordenadas[-1] if ordenadas else None) or 0:>9.2f} "
+                  f"{erros[fase]:>6}")
+        print(f"{'':<14} tempestade: {resultado['admitidas']} admitidas, {resultado['recusadas']} recusadas, "
+              f"{resultado['falhas']} falhas; {resultado['respostas']} respostas, {resultado['sobrecarga']} SOBRECARGA")
+
+
+def bench_cluster(args):
+    """Cluster com 1..N nós no localhost: clientes repartidos pelos nós a
+    fazer RESERVAR/CANCELAR sobre muitos produtos; com N nós, (N-1)/N dos
+    pedidos são encaminhados ao dono do produto. Mede a vazão total."""
+    rnd = random.Random(0)
+    produtos = [f"produto{i:05d}" for i in range(args.produtos)]
+    comando = []
+    for produto in rnd.sample(produtos, min(len(produtos), 200)):
+        carga = {"produto": produto, "quantidade": 1}
+        comando += [{"tipo": "RESERVAR", "payload": carga}, {"tipo": "CANCELAR_RESERVA", "payload": carga}]
+    print(f"{'nós':>4} {'clientes':>9} {'req/s':>12} {'encaminhados':>13}")
+    base = args.porta
+    for n in args.nos:
+        portas = [base + i for i in range(n)]
+        base += n
+        nos = ",".join(f"127.0.0.1:{porta}" for porta in portas)
+        procs = [iniciar_servidor(porta, "--cluster", nos, "--log-nivel", "WARNING") for porta in portas]
+        try:
+            sock = socket.create_connection(("127.0.0.1", portas[0]))
+            leitor = LeitorMensagens(sock)
+            sock.sendall(codificar({"tipo": "BULK_SET", "payload": {"itens": [[p, 10**6] for p in produtos]}}))
+            leitor.ler()
+            sock.close()
+            with multiprocessing.Pool(args.processos) as pool:
+                parciais = pool.starmap(_processo_carga, [(portas[i % n], args.conexoes, args.duracao, comando)
+                                                          for i in range(args.processos)])
+        finally:
+            for proc in procs:
+                parar_servidor(proc)
+        print(f"{n:>4} {args.conexoes * args.processos:>9} {sum(parciais):>12.0f} {(n - 1) / n:>12.0%}")
+
+
+def _pedir_a(porta, comando):
+    with socket.create_connection(("127.0.0.1", porta)) as sock:
+        sock.sendall(codificar(comando))
+        return LeitorMensagens(sock).ler()
+
+def _medir_atraso(primario, replica, amostras):
+    """Tempo (ms) entre um SET_ESTOQUE no primário e o valor aparecer na réplica."""
+    escrita = socket.create_connection(("127.0.0.1", primario))
+    leitura = socket.create_connection(("127.0.0.1", replica))
+    le_escrita, le_leitura = LeitorMensagens(escrita), LeitorMensagens(leitura)
+    atrasos = []
+    for valor in range(1, amostras + 1):
+        escrita.sendall(codificar({"tipo": "SET_ESTOQUE", "payload": {"produto": "zz_marca", "quantidade": valor}}))
+        le_escrita.ler()
+        inicio = time.perf_counter()
+        while True:
+            leitura.sendall(codificar({"tipo": "BUSCAR_ESTOQUE", "payload": {"prefixo": "zz_marca", "limite": 1}}))
+            itens = le_leitura.ler().get("payload", {}).get("itens") or [[None, 0]]
+            if itens[0][1] >= valor:
+                break
+        atrasos.append(time.perf_counter() - inicio)
+    escrita.close()
+    leitura.close()
+    atrasos.sort()
+    return percentil(atrasos, 50) * 1000, atrasos[-1] * 1000
+
+def _escritor(porta, parar, intervalo):
+    sock = socket.create_connection(("127.0.0.1", porta))
+    leitor = LeitorMensagens(sock)
+    carga = {"produto": "produto00000", "quantidade": 1}
+    while not parar.is_set():
+        sock.sendall(codificar({"tipo": "RESERVAR", "payload": carga}) + codificar({"tipo": "CANCELAR_RESERVA", "payload": carga}))
+        leitor.ler(), leitor.ler()
+        time.sleep(intervalo)
+    sock.close()
+
+def bench_replicacao(args):
+    """Primário com 0..N réplicas no localhost: processos clientes a ler
+    GET_ESTOQUE (das réplicas, ou do primário se não houver) enquanto um
+    escritor reserva e cancela no primário. Mede a vazão total de leituras
+    e quanto tempo uma escrita demora a aparecer nas réplicas. Com
+    --failover, no fim mata o primário e mede até a réplica promovida
+    aceitar escritas."""
+    produtos = [[f"produto{i:05d}", 1000] for i in range(args.produtos)]
+    comando = {"tipo": "GET_ESTOQUE"}
+    print(f"{'réplicas':>9} {'leitores':>9} {'leituras/s':>12} {'atraso p50':>11} {'atraso máx':>11}")
+    base = args.porta
+    for n in args.replicas:
+        primario, replicas = base, [base + 1 + i for i in range(n)]
+        base += n + 1
+        procs = [iniciar_servidor(primario, "--log-nivel", "WARNING")]
+        try:
+            _pedir_a(primario, {"tipo": "BULK_SET", "payload": {"itens": produtos}})
+            procs += [iniciar_servidor(porta, "--replica-de", f"127.0.0.1:{primario}", "--log-nivel", "WARNING")
+                      for porta in replicas]
+            time.sleep(1.0)  # Fotografia inicial
+            parar = threading.Event()
+            escritor = threading.Thread(target=_escritor, args=(primario, parar, args.intervalo_escrita))
+            escritor.start()
+            leitores = replicas or [primario]
+            with multiprocessing.Pool(args.processos) as pool:
+                parciais = pool.starmap(_processo_carga, [(leitores[i % len(leitores)], args.conexoes, args.duracao, comando)
+                                                          for i in range(args.processos)])
+            parar.set()
+            escritor.join()
+            atraso = _medir_atraso(primario, replicas[0], args.amostras) if replicas else None
+            if args.failover and replicas:
+                parar_servidor(procs[0])
+                inicio = time.perf_counter()
+                _pedir_a(replicas[0], {"tipo": "PROMOVER"})
+                resposta = _pedir_a(replicas[0], {"tipo": "SET_ESTOQUE", "payload": {"produto": "zz_marca", "quantidade": 0}})
+                failover = (time.perf_counter() - inicio) * 1000
+        finally:
+            for proc in procs:
+                parar_servidor(proc)
+        colunas = f"{atraso[0]:>9.1f}ms {atraso[1]:>9.1f}ms" if atraso else f"{'-':>11} {'-':>11}"
+        print(f"{n:>9} {args.conexoes * args.processos:>9} {sum(parciais):>12.0f} {colunas}")
+        if args.failover and replicas:
+            print(f"{'':>9} failover: PROMOVER + primeira escrita em {failover:.1f} ms ({resposta['payload']['status']})")
+
+
+def _medir_memoria(sessoes, produtos, itens, medir):
+    """Num processo novo: servidor importado, 'produtos' produtos no estoque
+    e 'sessoes' sessões com 'itens' reservas cada. 'medir' = "bytes"
+    (tracemalloc) ou "tempo" (sem tracemalloc, que atrasa tudo)."""
+    import tracemalloc
+    import servidor
+
+    rnd = random.Random(0)
+    nomes = [f"produto{i:07d}" for i in range(produtos)]
+    if medir == "bytes":
+        tracemalloc.start()
+    antes = tracemalloc.get_traced_memory()[0]
+    for nome in nomes:
+        servidor.estoque_disponivel[nome] = 10**9
+        servidor.id_do_produto(nome)  # Como depois de um GET_ESTOQUE binário
+    depois_produtos = tracemalloc.get_traced_memory()[0]
+    inicio = time.perf_counter()
+    for _ in range(sessoes):
+        conn = object()
+        servidor.registrar_cliente(conn)
+        for _ in range(itens):
+            servidor.reservar(conn, rnd.choice(nomes), 1)
+    decorrido = time.perf_counter() - inicio
+    depois_sessoes = tracemalloc.get_traced_memory()[0]
+    return {
+        "bytes_produto": (depois_produtos - antes) / produtos,
+        "bytes_cliente": (depois_sessoes - depois_produtos) / sessoes,
+        "us_cliente": decorrido / sessoes * 1e6,
+    }
+
+def bench_memoria(args):
+    """Memória por cliente ligado (sessão + carrinho com --itens reservas +
+    índices) e por produto do catálogo, com 10k e 100k sessões criadas
+    diretamente no servidor (sem sockets). Cada medição corre num processo
+    novo; o tempo é medido à parte, sem tracemalloc."""
+    print(f"{args.produtos} produtos, {args.itens} reservas por carrinho")
+    print(f"{'sessões':>9} {'bytes/cliente':>14} {'bytes/produto':>14} {'µs/cliente':>11}")
+    for sessoes in args.sessoes:
+        with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+            memoria = pool.apply(_medir_memoria, (sessoes, args.produtos, args.itens, "bytes"))
+            tempo = pool.apply(_medir_memoria, (sessoes, args.produtos, args.itens, "tempo"))
+        print(f"{sessoes:>9} {memoria['bytes_cliente']:>14.0f} {memoria['bytes_produto']:>14.0f} {tempo['us_cliente']:>11.1f}")
+
+
+def _top_varrendo(livro, inicio, fim, n):
+    """O que GET_TOP_RESERVADOS teria de fazer sem os resumos: percorrer os
+    movimentos (dos segmentos, por mmap, e os ainda em memória)."""
+    import heapq
+    from movimentos import RESERVA, Segmento
+
+    def somar(c):
+        for instante, id_produto, delta, tipo in zip(c["instantes"], c["produtos"], c["deltas"], c["tipos"]):
+            if tipo == RESERVA and inicio <= instante <= fim:
+                totais[id_produto] = totais.get(id_produto, 0) - delta
+
+    totais = {}
+    for caminho, _ in list(livro.segmentos):
+        with Segmento(caminho) as segmento:
+            somar(segmento.colunas)
+    somar(livro.colunas)
+    return heapq.nlargest(n, totais.items(), key=lambda t: t[1])
+
+def bench_movimentos(args):
+    """Livro de movimentos: custo por RESERVAR/CANCELAR_RESERVA (com e sem
+    o livro) e tempo das consultas de admin sobre --eventos movimentos
+    espalhados por --horas, a partir dos resumos por minuto vs a percorrer
+    os movimentos."""
+    import servidor
+    from movimentos import LivroMovimentos, RESERVA, CANCELAMENTO, AJUSTE
+
+    for i in range(args.produtos):
+        servidor.estoque_disponivel[f"produto{i:05d}"] = 1000
+    conn = object()
+    servidor.registrar_cliente(conn)
+    nomes = [f"produto{i:05d}" for i in range(args.produtos)]
+    livro = servidor.livro_movimentos
+    print(f"{'livro':<8} {'µs/comando':>11}")
+    for com_livro in (False, True):
+        servidor.livro_movimentos = livro if com_livro else None
+        inicio = time.perf_counter()
+        for i in range(args.comandos):
+            produto = nomes[i % len(nomes)]
+            servidor.reservar(conn, produto, 1)
+            servidor.cancelar_reserva(conn, produto, 1)
+        decorrido = time.perf_counter() - inicio
+        print(f"{'com' if com_livro else 'sem':<8} {decorrido / (2 * args.comandos) * 1e6:>11.2f}")
+
+    with tempfile.TemporaryDirectory() as pasta:
+        livro = LivroMovimentos(servidor.estoque_disponivel)
+        livro.abrir(pasta)
+        rnd = random.Random(0)
+        fim = time.time()
+        inicio = fim - args.horas * 3600
+        saldos = [50] * len(nomes)
+        comeco = time.perf_counter()
+        for i in range(args.eventos):
+            # Procura enviesada: poucos produtos concentram as reservas
+            j = min(int(rnd.paretovariate(1.2)) - 1, len(nomes) - 1)
+            instante = inicio + (fim - inicio) * i / args.eventos
+            if saldos[j] == 0:
+                if rnd.random() > 0.05:
+                    continue  # Esgotado: a reserva falha até o admin repor
+                tipo, delta = AJUSTE, 50
+            elif rnd.random() < 0.2:
+                tipo, delta = CANCELAMENTO, 1
+            else:
+                tipo, delta = RESERVA, -1
+            saldos[j] += delta
+            livro.registrar(nomes[j], tipo, delta, saldos[j], instante)
+        livro.rodar()  # Sem a thread do livro, os segmentos cheios esperam na fila
+        estado = livro.estado()
+        total = estado["eventos_em_segmentos"] + estado["em_memoria"]
+        gravar = (time.perf_counter() - comeco) / total * 1e6
+        print(f"\n{total} movimentos em {args.horas:g} h "
+              f"({gravar:.2f} µs/movimento, {estado['segmentos']} segmentos gravados)")
+
+        consultas = [
+            ("top 10 (resumos)", lambda: livro.mais_reservados(inicio, fim, 10)),
+            ("top 10 (varrer)", lambda: _top_varrendo(livro, inicio, fim, 10)),
+            ("top 10, última hora", lambda: livro.mais_reservados(fim - 3600, fim, 10)),
+            ("demanda por hora", lambda: livro.demanda(nomes[0], inicio, fim, 3600)),
+            ("rupturas", lambda: livro.rupturas_entre(inicio, fim)),
+        ]
+        print(f"{'consulta':<22} {'ms':>10}")
+        for nome, consulta in consultas:
+            repeticoes, comeco = 0, time.perf_counter()
+            while repeticoes < 3 or time.perf_counter() - comeco < 1.0:
+                consulta()
+                repeticoes += 1
+            print(f"{nome:<22} {(time.perf_counter() - comeco) / repeticoes * 1000:>10.3f}")
+
+
+TENTATIVAS_REPETICAO = 8
+
+async def _cliente_repetindo(porta, produtos, com_id, tempo_limite, estado):
+    """RESERVAR/CANCELAR_RESERVA sem pausa. Sem resposta em 'tempo_limite',
+    volta a ligar, retoma a sessão e repete o pedido (com o mesmo id_pedido,
+    se 'com_id'). Devolve o carrinho em que o cliente acredita."""
+    carrinho, token = {}, None
+    reader = writer = None
+
+    async def ligar():
+        nonlocal reader, writer, token
+        if writer is not None:
+            writer.close()
+        reader, writer = await _conectar(porta)
+        resposta = await _pedir(reader, writer, {"tipo": "SESSAO", "payload": {"token": token}})
+        token = resposta["payload"]["token"]
+        return resposta["payload"]["retomada"]
+
+    await ligar()
+    while time.monotonic() < estado["fim"]:
+        produto = random.choice(produtos)
+        tipo = "CANCELAR_RESERVA" if carrinho.get(produto) and random.random() < 0.5 else "RESERVAR"
+        comando = {"tipo": tipo, "payload": {"produto": produto, "quantidade": 1}}
+        if com_id:
+            comando = com_id_pedido(comando)
+        inicio = time.perf_counter()
+        for tentativa in range(TENTATIVAS_REPETICAO):
+            writer.write(codificar(comando))
+            try:
+                linha = await asyncio.wait_for(reader.readline(), tempo_limite)
+            except asyncio.TimeoutError:
+                estado["tempos_esgotados"] += 1
+                # A resposta pode ainda chegar: a ligação não serve mais
+                retomada = await ligar()
+                if com_id and not retomada:
+                    estado["abandonados"] += 1  # Sessão perdida: repetir não é seguro
+                    break
+                await asyncio.sleep(espera_repeticao(tentativa, base=0.005, maximo=0.1))
+                continue
+            resposta = json.loads(linha)
+            if resposta["payload"].get("status") == "SUCESSO":
+                carrinho[produto] = carrinho.get(produto, 0) + (1 if tipo == "RESERVAR" else -1)
+            estado["latencias"].append(time.perf_counter() - inicio)
+            break
+        else:
+            estado["abandonados"] += 1
+    writer.close()
+    return carrinho
+
+async def _repeticoes(args, porta, porta_clientes, com_id, tempo_limite):
+    produtos = [f"p{i}" for i in range(args.produtos)]
+    reader, writer = await _conectar(porta)
+    for produto in produtos:
+        await _pedir(reader, writer, {"tipo": "SET_ESTOQUE", "payload": {"produto": produto, "quantidade": args.estoque_inicial}})
+    estado = {"fim": time.monotonic() + args.duracao, "latencias": [], "tempos_esgotados": 0, "abandonados": 0}
+    inicio = time.monotonic()
+    carrinhos = await asyncio.gather(*(_cliente_repetindo(porta_clientes, produtos, com_id, tempo_limite, estado)
+                                        for _ in range(args.clientes)))
+    decorrido = time.monotonic() - inicio
+
+    # As ligações fechadas sem SAIR deixam as sessões à espera: o que
+    # os clientes acreditam ter tem de bater com o que o servidor reservou
+    acreditado = sum(q for carrinho in carrinhos for q in carrinho.values())
+    totais = (await _pedir(reader, writer, {"tipo": "GET_RESERVADO"}))["payload"]["totais"]
+    reservado = sum(totais.get(produto, 0) for produto in produtos)
+    estoque = (await _pedir(reader, writer, {"tipo": "GET_ESTOQUE"}))["payload"]
+    disponivel = sum(estoque.get(produto, 0) for produto in produtos)
+    metricas = (await _pedir(reader, writer, {"tipo": "GET_METRICS"}))["payload"]
+    writer.close()
+    latencias = sorted(estado["latencias"])
+    return {
+        "req_por_segundo": len(latencias) / decorrido,
+        "p99_ms": _ms(percentil(latencias, 99)),
+        "tempos_esgotados": estado["tempos_esgotados"],
+        "abandonados": estado["abandonados"],
+        "repetidos_servidor": metricas["contadores"].get("pedidos_repetidos_total", 0),
+        "conservado": disponivel + reservado == args.produtos * args.estoque_inicial,
+        "a_mais": reservado - acreditado,
+    }
+
+def bench_repeticoes(args):
+    """Clientes com um tempo limite agressivo que voltam a ligar e repetem
+    o pedido, atrás de um proxy que atrasa uma fração (--engasgos) das
+    respostas: sem id_pedido, repetir um pedido já aplicado reserva outra
+    vez ("a mais" = reservado no servidor - carrinhos dos clientes); com
+    id_pedido, o servidor devolve a resposta guardada. As fases sem tempo
+    limite (nem proxy) medem o custo da cache de respostas."""
+    fases = [(False, None), (True, None), (False, args.tempo_limite), (True, args.tempo_limite)]
+    proxy = _proxy_lento(args.porta, args.porta + 1, args.tempo_limite * 5, args.engasgos)
+    print(f"{'id_pedido':<10} {'limite ms':>10} {'req/s':>9} {'p99 ms':>8} {'esgotados':>10} "
+          f"{'repetidos':>10} {'abandon.':>9} {'a mais':>7} {'conserv.':>9}")
+    for com_id, tempo_limite in fases:
+        proc = iniciar_servidor(args.porta, "--modo", args.modo)
+        try:
+            porta_clientes = args.porta if tempo_limite is None else args.porta + 1
+            r = asyncio.run(_repeticoes(args, args.porta, porta_clientes, com_id, tempo_limite))
+        finally:
+            parar_servidor(proc)
+        limite = "-" if tempo_limite is None else f"{tempo_limite * 1000:g}"
+        print(f"{'com' if com_id else 'sem':<10} {limite:>10} {r['req_por_segundo']:>9.0f} {r['p99_ms'] or 0:>8.2f} "
+              f"{r['tempos_esgotados']:>10} {r['repetidos_servidor']:>10} {r['abandonados']:>9} {r['a_mais']:>7} "
+              f"{'OK' if r['conservado'] else 'FALHOU':>9}")
+    proxy.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks do Mercadinho")
+    sub = parser.add_subparsers(dest="cenario", required=True)
+
+    p = sub.add_parser("modos", help="threads vs asyncio")
+    p.add_argument("--conexoes", type=int, default=1000)
+    p.add_argument("--duracao", type=float, default=5.0)
+    p.add_argument("--porta", type=int, default=6050)
+    p.set_defaults(func=bench_modos)
+
+    p = sub.add_parser("contencao", help="lock global vs locks por produto")
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--produtos", type=int, default=100)
+    p.add_argument("--fatias", type=int, nargs="+", default=[1, 64])
+    p.add_argument("--duracao", type=float, default=3.0)
+    p.set_defaults(func=bench_contencao)
+
+    p = sub.add_parser("lote", help="RESERVAR por item vs RESERVAR_LOTE")
+    p.add_argument("--itens", type=int, default=30)
+    p.add_argument("--duracao", type=float, default=3.0)
+    p.add_argument("--porta", type=int, default=6050)
+    p.set_defaults(func=bench_lote)
+
+    p = sub.add_parser("durabilidade", help="estoque em memória vs. diário com group commit")
+    p.add_argument("--threads", type=int, default=32)
+    p.add_argument("--produtos", type=int, default=100)
+    p.add_argument("--duracao", type=float, default=3.0)
+    p.set_defaults(func=bench_durabilidade)
+
+    p = sub.add_parser("codificacao", help="JSON vs codificação binária")
+    p.add_argument("--pipeline", type=int, default=30)
+    p.add_argument("--duracao", type=float, default=3.0)
+    p.add_argument("--porta", type=int, default=6050)
+    p.set_defaults(func=bench_codificacao)
+
+    p = sub.add_parser("workers", help="1 processo vs vários processos com memória partilhada")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    p.add_argument("--processos", type=int, default=4, help="processos clientes gerando carga")
+    p.add_argument("--conexoes", type=int, default=50, help="conexões por processo cliente")
+    p.add_argument("--duracao", type=float, default=3.0)
+    p.add_argument("--porta", type=int, default=6050)
+    p.set_defaults(func=bench_workers)
+
+    p = sub.add_parser("cluster", help="vazão total com 1..N nós do cluster no localhost")
+    p.add_argument("--nos", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--processos", type=int, default=4, help="processos clientes gerando carga")
+    p.add_argument("--conexoes", type=int, default=50, help="conexões por processo cliente")
+    p.add_argument("--produtos", type=int, default=10000)
+    p.add_argument("--duracao", type=float, default=3.0)
+    p.add_argument("--porta", type=int, default=6050)
+    p.set_defaults(func=bench_cluster)
+
+    p = sub.add_parser("replicacao", help="leituras com 0..N réplicas, atraso da replicação e failover")
+    p.add_argument("--replicas", type=int, nargs="+", default=[0, 1, 2])
+    p.add_argument("--processos", type=int, default=4, help="processos clientes a ler")
+    p.add_argument("--conexoes", type=int, default=50, help="conexões por processo cliente")
+    p.add_argument("--produtos", type=int, default=1000)
+    p.add_argument("--intervalo-escrita", type=float, default=0.001, help="pausa (s) entre reservas do escritor")
+    p.add_argument("--amostras", type=int, default=50, help="escritas usadas para medir o atraso")
+    p.add_argument("--failover", action="store_true")
+    p.add_argument("--duracao", type=float, default=3.0)
+    p.add_argument("--porta", type=int, default=6050)
+    p.set_defaults(func=bench_replicacao)
+
+    p = sub.add_parser("memoria", help="bytes por cliente ligado e por produto, com 10k e 100k sessões")
+    p.add_argument("--sessoes", type=int, nargs="+", default=[10000, 100000])
+    p.add_argument("--produtos", type=int, default=10000)
+    p.add_argument("--itens", type=int, default=3, help="reservas no carrinho de cada cliente")
+    p.set_defaults(func=bench_memoria)
+
+    p = sub.add_parser("movimentos", help="custo do livro de movimentos e consultas de admin pelos resumos")
+    p.add_argument("--comandos", type=int, default=100000, help="pares RESERVAR/CANCELAR_RESERVA medidos")
+    p.add_argument("--eventos", type=int, default=2000000, help="movimentos sintéticos para as consultas")
+    p.add_argument("--horas", type=float, default=24)
+    p.add_argument("--produtos", type=int, default=10000)
+    p.set_defaults(func=bench_movimentos)
+
+    p = sub.add_parser("repeticoes", help="tempo limite agressivo e repetições, sem e com id_pedido")
+    p.add_argument("--clientes", type=int, default=200)
+    p.add_argument("--duracao", type=float, default=5.0, help="duração (s) de cada fase")
+    p.add_argument("--tempo-limite", type=float, default=0.1, help="segundos à espera de cada resposta")
+    p.add_argument("--engasgos", type=float, default=0.01, help="fração das respostas que o proxy atrasa 5x o tempo limite")
+    p.add_argument("--produtos", type=int, default=100)
+    p.add_argument("--estoque-inicial", type=int, default=100000)
+    p.add_argument("--modo", choices=["threads", "asyncio"], default="threads")
+    p.add_argument("--porta", type=int, default=6050)
+    p.set_defaults(func=bench_repeticoes)
+
+    p = sub.add_parser("catalogo", help="GET_ESTOQUE inteiro vs páginas de BUSCAR_ESTOQUE")
+    p.add_argument("--produtos", type=int, default=200000)
+    p.add_argument("--limite", type=int, default=100)
+    p.add_argument("--duracao", type=float, default=1.0)
+    p.set_defaults(func=bench_catalogo)
+
+    p = sub.add_parser("leituras", help="GET_ESTOQUE serializado a cada pedido vs fotografia em cache")
+    p.add_argument("--produtos", type=int, default=100000)
+    p.add_argument("--leitores", type=int, default=8)
+    p.add_argument("--intervalo-escrita", type=float, default=0.01, help="pausa (s) entre reservas do escritor")
+    p.add_argument("--duracao", type=float, default=2.0)
+    p.set_defaults(func=bench_leituras)
+
+    p = sub.add_parser("interface", help="tempo parado da thread da GUI com um servidor lento (sem janela)")
+    p.add_argument("--atraso", type=float, default=0.2, help="atraso (s) de cada resposta do servidor")
+    p.add_argument("--tick", type=float, default=0.02, help="intervalo (s) do laço da interface")
+    p.add_argument("--atualizar", type=float, default=0.1, help="intervalo (s) entre atualizações das listas")
+    p.add_argument("--reservar", type=float, default=0.5, help="intervalo (s) entre reservas")
+    p.add_argument("--duracao", type=float, default=5.0)
+    p.add_argument("--porta", type=int, default=6050)
+    p.set_defaults(func=bench_interface)
+
+    p = sub.add_parser("importacao", help="SET_ESTOQUE por linha vs BULK_SET em blocos, e EXPORT_ESTOQUE")
+    p.add_argument("--produtos", type=int, default=100000)
+    p.add_argument("--linhas-set", type=int, default=10000, help="linhas enviadas com SET_ESTOQUE")
+    p.add_argument("--bloco", type=int, default=1000)
+    p.add_argument("--em-voo", type=int, default=8, help="blocos de BULK_SET enviados sem esperar resposta")
+    p.add_argument("--dados", action="store_true", help="servidor com diário em disco")
+    p.add_argument("--porta", type=int, default=6050)
+    p.set_defaults(func=bench_importacao)
+
+    p = sub.add_parser("tempestade", help="latência dos clientes normais durante uma tempestade de conexões")
+    p.add_argument("--clientes", type=int, default=20, help="clientes normais (medidos)")
+    p.add_argument("--intervalo", type=float, default=0.05, help="pausa (s) entre pedidos de um cliente normal")
+    p.add_argument("--tempestade", type=int, default=2000, help="conexões abertas pela tempestade")
+    p.add_argument("--max-conexoes", type=int, default=200, help="repassado ao servidor com controlo")
+    p.add_argument("--limite-pedidos", type=float, default=50, help="repassado ao servidor com controlo")
+    p.add_argument("--modo", choices=["threads", "asyncio"], default="threads")
+    p.add_argument("--duracao", type=float, default=3.0, help="duração (s) de cada fase")
+    p.add_argument("--porta", type=int, default=6050)
+    p.set_defaults(func=bench_tempestade)
+
+    p = sub.add_parser("carga", help="mix de comandos com latências por comando e verificação de conservação")
+    p.add_argument("--clientes", type=int, default=1000)
+    p.add_argument("--duracao", type=float, default=10.0)
+    p.add_argument("--mix", type=ler_mix, default=ler_mix(MIX_PADRAO),
+                   help=f"pesos de cada comando (padrão: {MIX_PADRAO})")
+    p.add_argument("--produtos", type=int, default=100)
+    p.add_argument("--estoque-inicial", type=int, default=1000)
+    p.add_argument("--modo", choices=["threads", "asyncio"], default="threads")
+    p.add_argument("--em-processo", action="store_true", help="servidor numa thread deste processo, em vez de subprocesso")
+    p.add_argument("--tempo-retomar", type=float, default=1.0, help="repassado ao servidor")
+    p.add_argument("--saida", default=None, help="arquivo JSON com os resultados")
+    p.add_argument("--comparar", default=None, help="JSON de uma execução anterior para comparar")
+    p.add_argument("--porta", type=int, default=6050)
+    p.set_defaults(func=bench_carga)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# catalogo.py
+# Índice do catálogo de produtos, para pesquisa e paginação no servidor.
+#
+# Guarda duas listas ordenadas por nome: todos os produtos e só os que têm
+# estoque (índice secundário). Uma página começa onde a anterior acabou
+# (o "cursor" é o último nome devolvido), por isso produtos novos não
+# fazem saltar nem repetir itens entre páginas.
+#
+# O índice não é atualizado a cada reserva: antes de cada consulta, o
+# servidor aplica as alterações do log de alterações desde a última
+# versão vista (ver sincronizar_catalogo em servidor.py).
+import threading
+from bisect import bisect_left, bisect_right, insort
+
+LIMITE_PAGINA = 100
+LIMITE_PAGINA_MAXIMO = 1000
+# Uma pesquisa por substring percorre os nomes um a um; para não prender
+# o índice demasiado tempo, cada página examina no máximo isto
+MAXIMO_EXAMINADOS = 50000
+
+
+class IndiceCatalogo:
+    def __init__(self):
+        self.nomes = []        # Todos os produtos, ordenados
+        self.disponiveis = []  # Só os que têm estoque > 0, ordenados
+        self.conhecidos = set()
+        self.com_estoque = set()
+        self.versao = None     # Versão do estoque já aplicada (None = nunca)
+        self.lock = threading.Lock()
+
+    def reconstruir(self, estoque, versao):
+        self.nomes = sorted(estoque)
+        self.conhecidos = set(self.nomes)
+        self.disponiveis = [nome for nome in self.nomes if estoque[nome] > 0]
+        self.com_estoque = set(self.disponiveis)
+        self.versao = versao
+
+    def atualizar(self, produto, quantidade):
+        if produto not in self.conhecidos:
+            self.conhecidos.add(produto)
+            insort(self.nomes, produto)
+        if quantidade > 0:
+            if produto not in self.com_estoque:
+                self.com_estoque.add(produto)
+                insort(self.disponiveis, produto)
+        elif produto in self.com_estoque:
+            self.com_estoque.discard(produto)
+            del self.disponiveis[bisect_left(self.disponiveis, produto)]
+
+    def buscar(self, prefixo="", contem="", so_disponiveis=False, cursor=None, limite=LIMITE_PAGINA):
+        """Devolve (nomes da página, cursor da próxima página ou None se acabou)."""
+        lista = self.disponiveis if so_disponiveis else self.nomes
+        inicio = bisect_right(lista, cursor) if cursor is not None else 0
+        if prefixo:
+            inicio = max(inicio, bisect_left(lista, prefixo))
+
+        pagina = []
+        fim = min(len(lista), inicio + MAXIMO_EXAMINADOS)
+        i = inicio
+        while i < fim:
+            nome = lista[i]
+            if prefixo and not nome.startswith(prefixo):
+                return pagina, None  # Acabaram os nomes com este prefixo
+            i += 1
+            if contem and contem not in nome:
+                continue
+            pagina.append(nome)
+            if len(pagina) >= limite:
+                break
+        if i >= len(lista):
+            return pagina, None
+        # Parou pelo limite da página ou de nomes examinados: continua depois de lista[i-1]
+        return pagina, lista[i - 1]
@@ -1,51 +1,551 @@
 # cliente_gui.py
 import socket
+import threading
+import queue
+import random
+import time
+from bisect import bisect_left
+from concurrent.futures import Future
 import tkinter as tk
 from tkinter import simpledialog, messagebox, Listbox, END
 import json  # Importante: usaremos JSON
 
-# --- Classe NetworkClient (Sem alterações) ---
+from protocolo import LeitorMensagens, codificar, negociar_binario, MENSAGENS_NAO_SOLICITADAS
+from protocolo import LEITURAS_REPLICA, ler_enderecos, descobrir_papeis, com_id_pedido, espera_repeticao
+
+# Leituras de uma só resposta que podem ir para uma réplica
+LEITURAS_NA_REPLICA = tuple(t for t in LEITURAS_REPLICA if t != "EXPORT_ESTOQUE")
+# Respostas de uma réplica que mandam ler do primário
+RECUSAS_REPLICA = ("REPLICA_ATRASADA", "NAO_PRIMARIO", "SOBRECARGA")
+TENTATIVAS_RELIGAR = 10  # vezes (uma por segundo) que se procura um primário novo
+TEMPO_RESPOSTA = 10.0    # segundos à espera de uma resposta antes de voltar a ligar e repetir
+TENTATIVAS_PEDIDO = 4    # envios de um mesmo pedido (o primeiro e as repetições)
+
+# --- Trabalhador de rede ---
+class TrabalhadorRede:
+    """Thread que faz a E/S de rede do cliente, para que a thread do Tk nunca
+    fique à espera do servidor. Cada tarefa é uma função que corre aqui;
+    o resultado chega ao callback na thread do Tk, através de 'agendar'
+    (ex.: root.after(0, ...)).
+
+    Tarefas com a mesma 'chave' que ainda estão na fila juntam-se numa só:
+    cinco pedidos de "atualizar listas" seguidos custam uma ida ao servidor."""
+
+    def __init__(self, agendar):
+        self.agendar = agendar
+        self.fila = queue.Queue()
+        self.na_fila = {}  # chave -> Future da tarefa que ainda não começou
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def executar(self, funcao, ao_terminar=None, chave=None):
+        """Põe 'funcao' na fila. 'ao_terminar(resultado)' é chamado na thread
+        do Tk (resultado None se a função falhou). Devolve o Future."""
+        with self.lock:
+            futuro = self.na_fila.get(chave) if chave is not None else None
+            if futuro is None:
+                futuro = Future()
+                if chave is not None:
+                    self.na_fila[chave] = futuro
+                self.fila.put((futuro, funcao, chave))
+        if ao_terminar is not None:
+            futuro.add_done_callback(
+                lambda f: self.agendar(ao_terminar, None if f.exception() else f.result()))
+        return futuro
+
+    def _loop(self):
+        while True:
+            futuro, funcao, chave = self.fila.get()
+            with self.lock:
+                # A partir daqui um pedido igual já não se junta a este:
+                # a resposta pode ser anterior ao que motivou esse pedido
+                if chave is not None and self.na_fila.get(chave) is futuro:
+                    del self.na_fila[chave]
+            try:
+                futuro.set_result(funcao())
+            except Exception as e:
+                futuro.set_exception(e)
+
+
+# --- Classe NetworkClient ---
 class NetworkClient:
     def __init__(self):
         self.client_socket = None
+        self.leitor = None
+        # Depois do SUBSCRIBE, uma thread de fundo lê o socket: eventos vão
+        # para o callback e as respostas normais para esta fila.
+        self.receptor = None
+        self.respostas = queue.Queue()
+        self.ao_receber_evento = None
+        # CodecBinario se a ligação negociou a codificação binária (None = JSON)
+        self.codec = None
+        # Token da sessão no servidor: ao voltar a ligar, recupera o carrinho
+        self.token = None
+        # Instância do servidor que guarda as respostas da sessão, e se a
+        # sessão foi retomada na última ligação (ver _pode_repetir)
+        self.instancia = None
+        self.retomada = False
+        # Como mostrar erros; com o trabalhador de rede, os erros acontecem
+        # fora da thread do Tk e têm de ser passados para ela
+        self.ao_erro = messagebox.showerror
+        self.trabalhador = None
+        # Com vários servidores: a lista, uma ligação só de leitura a uma
+        # réplica, e o que é preciso para refazer a ligação ao primário
+        self.enderecos = []
+        self.binaria = False
+        self.leitura = None      # (socket, leitor) da réplica
+        self.assinatura = None   # Argumentos do último assinar()
+        self.geracao = 0         # Conta as ligações ao primário
+        self.religando = False
+        self.ao_religar = None   # Chamado (na thread de rede) depois de mudar de primário
+
+    def iniciar_trabalhador(self, agendar):
+        """Passa a fazer a E/S numa thread à parte (ver pedir/executar)."""
+        self.trabalhador = TrabalhadorRede(agendar)
+        self.ao_erro = lambda titulo, mensagem: agendar(messagebox.showerror, titulo, mensagem)
+
+    def executar(self, funcao, ao_terminar=None, chave=None):
+        """Corre 'funcao' (que pode usar os métodos síncronos abaixo) no trabalhador."""
+        return self.trabalhador.executar(funcao, ao_terminar, chave)
+
+    def pedir(self, comando, ao_responder=None, chave=None):
+        """Versão sem bloqueio de send_command (ou de send_commands, se
+        'comando' for uma lista): a resposta chega a 'ao_responder'."""
+        if isinstance(comando, list):
+            return self.executar(lambda: self.send_commands(comando), ao_responder, chave)
+        return self.executar(lambda: self.send_command(comando), ao_responder, chave)
+
+    def connect_enderecos(self, enderecos, binaria=False):
+        """Liga a uma lista de servidores (primário e réplicas): os comandos
+        vão para o primário e as leituras do catálogo para uma réplica."""
+        self.enderecos = enderecos
+        primario, replicas = descobrir_papeis(enderecos) if len(enderecos) > 1 else (enderecos[0], [])
+        if primario is None:
+            self.ao_erro("Erro de Rede", "Nenhum dos servidores respondeu como primário.")
+            return None
+        self._ligar_leitura(replicas)
+        return self.connect(*primario, binaria)
+
+    def _ligar_leitura(self, replicas):
+        if self.leitura is not None:
+            self.leitura[0].close()
+            self.leitura = None
+        # Cada cliente escolhe uma réplica ao acaso: a carga reparte-se
+        for endereco in random.sample(replicas, len(replicas)):
+            try:
+                sock = socket.create_connection(endereco, timeout=5)
+            except socket.error:
+                continue
+            sock.settimeout(TEMPO_RESPOSTA)
+            self.leitura = (sock, LeitorMensagens(sock))
+            return
 
-    def connect(self, host, port):
+    def connect(self, host, port, binaria=False):
+        self.binaria = binaria
+        self.geracao += 1
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.client_socket.settimeout(TEMPO_RESPOSTA)
             self.client_socket.connect((host, port))
+            self.leitor = LeitorMensagens(self.client_socket)
+            if binaria:
+                self.codec = negociar_binario(self.client_socket, self.leitor)
+            if self.abrir_sessao() is None:
+                return None  # Servidor cheio ou ligação perdida (o erro já foi mostrado)
             return True
         except socket.error as e:
-            messagebox.showerror("Erro de Rede", f"Não foi possível ligar ao servidor: {e}")
+            self.ao_erro("Erro de Rede", f"Não foi possível ligar ao servidor: {e}")
             return None
 
-    def send_command(self, command_dict):
-        try:
-            json_string = json.dumps(command_dict)
-            self.client_socket.sendall(json_string.encode())
-            
-            if command_dict.get("tipo") == "SAIR":
-                self.client_socket.close()
-                return {"tipo": "BYE"}
+    def send_command(self, command_dict, tentar_de_novo=True):
+        if self.leitura is not None and command_dict.get("tipo") in LEITURAS_NA_REPLICA:
+            resposta = self._ler_da_replica(command_dict)
+            if resposta is not None:
+                return resposta
+        # Uma alteração leva um id_pedido: repeti-la não a aplica duas vezes
+        command_dict = com_id_pedido(command_dict)
+        for tentativa in range(TENTATIVAS_PEDIDO if tentar_de_novo else 1):
+            if tentativa:
+                time.sleep(espera_repeticao(tentativa - 1))
+            try:
+                self.client_socket.sendall(self._codificar(command_dict))
+
+                if command_dict.get("tipo") == "SAIR":
+                    self.client_socket.close()
+                    if self.leitura is not None:
+                        self.leitura[0].close()
+                    return {"tipo": "BYE"}
+
+                resposta = self._ler_resposta()
+                erro = "O servidor desligou a ligação."
+            except socket.timeout:
+                resposta, erro = None, "O servidor não respondeu a tempo."
+            except socket.error as e:
+                resposta, erro = None, f"Ligação perdida: {e}"
+            except json.JSONDecodeError:
+                self.ao_erro("Erro de Protocolo", "O servidor enviou uma resposta JSON inválida.")
+                return None
 
-            resposta_raw = self.client_socket.recv(4096).decode()
-            if not resposta_raw:
-                messagebox.showerror("Erro de Rede", "O servidor desligou a ligação.")
+            if resposta is not None and resposta.get("tipo") == "SOBRECARGA":
+                payload = resposta.get("payload", {})
+                if payload.get("motivo") == "limite_taxa" and tentativa + 1 < TENTATIVAS_PEDIDO and tentar_de_novo:
+                    # Recusado sem ser executado: repete-se na mesma ligação
+                    time.sleep(payload.get("tentar_em", 0))
+                    continue
+                self.ao_erro("Servidor Ocupado", payload.get("mensagem", "Tente de novo daqui a pouco."))
                 return None
+            if resposta is not None and resposta.get("tipo") != "NAO_PRIMARIO":
+                return resposta
+
+            # Sem resposta (ou o servidor deixou de ser o primário): a ligação
+            # não serve mais, porque a resposta pode ainda chegar atrasada
+            instancia = self.instancia
+            if not self._religar():
+                self.ao_erro("Erro de Rede", erro)
+                return None
+            if not self._pode_repetir(command_dict, instancia):
+                self.ao_erro("Erro de Rede", "A ligação ao servidor caiu e foi refeita. Confirme se a operação foi feita e repita-a se preciso.")
+                return None
+        self.ao_erro("Erro de Rede", "O servidor não respondeu depois de várias tentativas.")
+        return None
 
-            return json.loads(resposta_raw)
+    def send_commands(self, lista_comandos):
+        """Envia vários comandos de uma vez (pipelining) e devolve as respostas
+        na mesma ordem. Custa uma única ida e volta ao servidor."""
+        try:
+            self.client_socket.sendall(b"".join(self._codificar(c) for c in lista_comandos))
+
+            respostas = []
+            for _ in lista_comandos:
+                resposta = self._ler_resposta()
+                if resposta is None:
+                    self._religar()  # Com vários servidores: liga-se ao primário atual
+                    self.ao_erro("Erro de Rede", "O servidor desligou a ligação.")
+                    return None
+                respostas.append(resposta)
+            return respostas
 
         except socket.error as e:
-            messagebox.showerror("Erro de Rede", f"Ligação perdida: {e}")
+            self._religar()
+            self.ao_erro("Erro de Rede", f"Ligação perdida: {e}")
             return None
         except json.JSONDecodeError:
-            messagebox.showerror("Erro de Protocolo", "O servidor enviou uma resposta JSON inválida.")
+            self.ao_erro("Erro de Protocolo", "O servidor enviou uma resposta JSON inválida.")
             return None
             
+    def _ler_da_replica(self, comando):
+        """Resposta da réplica, ou None se for preciso perguntar ao primário."""
+        if "desde_versao" in comando.get("payload", {}):
+            return None  # As versões são de cada servidor: os deltas vêm do primário
+        sock, leitor = self.leitura
+        try:
+            sock.sendall(codificar(comando))
+            resposta = leitor.ler()
+        except (socket.error, ValueError):
+            resposta = None
+        if resposta is None:
+            # A réplica caiu: daqui em diante lê do primário
+            sock.close()
+            self.leitura = None
+            return None
+        if resposta.get("tipo") in RECUSAS_REPLICA:
+            return None
+        # Não serve de base a deltas pedidos ao primário
+        resposta["versao"] = None
+        return resposta
+
+    def _religar(self):
+        """O primário caiu (ou deixou de o ser, ou não respondeu a tempo):
+        procura o primário atual na lista, liga-se a ele, recupera a sessão
+        pelo token e volta a assinar. Devolve True se conseguiu."""
+        if not self.enderecos or self.religando:
+            return False
+        self.religando = True
+        try:
+            for _ in range(TENTATIVAS_RELIGAR):
+                primario, replicas = descobrir_papeis(self.enderecos)
+                if primario is not None:
+                    break
+                time.sleep(1.0)  # Ainda ninguém promoveu uma réplica
+            else:
+                return False
+            try:
+                self.client_socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.client_socket.close()
+            if self.receptor is not None:
+                self.receptor.join(timeout=2.0)
+                self.receptor = None
+                self.respostas = queue.Queue()
+            self.codec = None
+            self._ligar_leitura(replicas)
+            if not self.connect(*primario, self.binaria):
+                return False
+            if self.assinatura is not None:
+                self.assinar(*self.assinatura)
+        finally:
+            self.religando = False
+        if self.ao_religar is not None:
+            self.ao_religar(primario)
+        return True
+
+    def _pode_repetir(self, comando, instancia):
+        """Depois de voltar a ligar: uma leitura pode repetir-se; uma
+        alteração só se tiver id_pedido e a sessão foi retomada na mesma
+        instância do servidor (a que guardou a resposta). Noutro servidor,
+        ou depois de ele reiniciar, não se sabe se a alteração foi feita."""
+        if comando.get("tipo") in LEITURAS_NA_REPLICA + ("GET_MINHAS_RESERVAS",):
+            return True
+        return "id_pedido" in comando and self.retomada and instancia is not None and self.instancia == instancia
+
+    def abrir_sessao(self):
+        """Envia SESSAO (com o token anterior, se houver) e guarda o token.
+        Devolve o carrinho recuperado ({} se a sessão é nova), ou None se a
+        ligação falhou (ex.: servidor cheio)."""
+        comando = {"tipo": "SESSAO"}
+        if self.token is not None:
+            comando["payload"] = {"token": self.token}
+        resposta = self.send_command(comando)
+        if resposta is None:
+            return None
+        if resposta.get("tipo") != "SESSAO_OK":
+            self.instancia, self.retomada = None, False
+            return {}  # Servidor sem sessões
+        self.token = resposta["payload"]["token"]
+        self.instancia = resposta["payload"].get("instancia")
+        self.retomada = resposta["payload"].get("retomada", False)
+        return resposta["payload"].get("carrinho", {})
+
+    def renovar(self):
+        """Adia o prazo das reservas do carrinho."""
+        return self.send_command({"tipo": "RENOVAR"})
+
+    def buscar_estoque(self, contem="", cursor=None, limite=200, so_disponiveis=True):
+        """Uma página do catálogo (BUSCAR_ESTOQUE), por ordem de nome."""
+        payload = {"contem": contem, "so_disponiveis": so_disponiveis, "limite": limite}
+        if cursor is not None:
+            payload["cursor"] = cursor
+        return self.send_command({"tipo": "BUSCAR_ESTOQUE", "payload": payload})
+
+    def reservar_lote(self, itens):
+        """Reserva uma lista de (produto, quantidade) de uma vez (tudo ou nada)."""
+        return self._enviar_lote("RESERVAR_LOTE", itens)
+
+    def cancelar_lote(self, itens):
+        """Cancela uma lista de (produto, quantidade) de uma vez (tudo ou nada)."""
+        return self._enviar_lote("CANCELAR_LOTE", itens)
+
+    def _enviar_lote(self, tipo, itens):
+        lista = [{"produto": produto, "quantidade": quantidade} for produto, quantidade in itens]
+        return self.send_command({"tipo": tipo, "payload": {"itens": lista}})
+
+    def _codificar(self, comando):
+        if self.codec is None:
+            return codificar(comando)
+        return self.codec.codificar(comando)
+
+    def _ler_mensagem(self):
+        if self.codec is None:
+            return self.leitor.ler()
+        recebido = self.leitor.ler_quadro()
+        if recebido is None:
+            return None
+        return self.codec.decodificar(*recebido)
+
+    def _ler_resposta(self):
+        if self.receptor is None:
+            return self._ler_mensagem()
+        try:
+            return self.respostas.get(timeout=TEMPO_RESPOSTA)
+        except queue.Empty:
+            raise socket.timeout("sem resposta do servidor") from None
+
+    def assinar(self, ao_receber_evento, janela=None, snapshot=True):
+        """Envia SUBSCRIBE e passa a receber os EVENTO_ESTOQUE do servidor.
+        'ao_receber_evento' é chamado na thread receptora, não na do Tk.
+        Com snapshot=False a resposta só traz a versão, sem o catálogo."""
+        comando = {"tipo": "SUBSCRIBE", "payload": {"snapshot": snapshot}}
+        if janela is not None:
+            comando["payload"]["janela"] = janela
+        resposta = self.send_command(comando)
+        if resposta is None or resposta.get("tipo") != "ASSINATURA_OK":
+            return None
+
+        self.ao_receber_evento = ao_receber_evento
+        self.assinatura = (ao_receber_evento, janela, snapshot)
+        # O receptor espera por eventos sem prazo; o prazo das respostas passa para a fila
+        self.client_socket.settimeout(None)
+        self.receptor = threading.Thread(target=self._receptor_loop, args=(self.respostas, self.geracao), daemon=True)
+        self.receptor.start()
+        return resposta
+
+    def _receptor_loop(self, respostas, geracao):
+        while True:
+            try:
+                mensagem = self._ler_mensagem()
+            except (socket.error, json.JSONDecodeError):
+                mensagem = None
+            if mensagem is None:
+                respostas.put(None)  # Acorda quem estiver à espera de resposta
+                if self.trabalhador is not None and self.enderecos:
+                    # Sem nenhum pedido em curso, ninguém mais daria pela queda
+                    # (e a lista deixava de se atualizar sem aviso)
+                    self.executar(lambda: geracao == self.geracao and self._religar())
+                return
+            if mensagem.get("tipo") in MENSAGENS_NAO_SOLICITADAS:
+                self.ao_receber_evento(mensagem)
+            else:
+                respostas.put(mensagem)
+
     def close(self):
         if self.client_socket:
+            self.geracao += 1  # A ligação fecha de propósito: o receptor não volta a ligar
             self.send_command({"tipo": "SAIR"})
 
 
+# --- Lista de produtos com atualização incremental ---
+class ListaProdutos:
+    """Mantém uma Listbox de "produto: qtd un." sincronizada com um dicionário,
+    alterando só as linhas que mudaram (sem apagar e redesenhar tudo)."""
+
+    def __init__(self, listbox, texto_vazio):
+        self.listbox = listbox
+        self.texto_vazio = texto_vazio
+        self.produtos = []  # Ordem das linhas exibidas
+        self.listbox.insert(END, texto_vazio)
+
+    def redesenhar(self, itens):
+        """Substitui o conteúdo inteiro (usado com snapshots completos)."""
+        self.listbox.delete(0, END)
+        self.produtos = [produto for produto, qtd in itens.items() if qtd > 0]
+        if not self.produtos:
+            self.listbox.insert(END, self.texto_vazio)
+            return
+        self.listbox.insert(END, *(f"{produto}: {itens[produto]} un." for produto in self.produtos))
+
+    def aplicar(self, alteracoes):
+        """Aplica {produto: nova_qtd}; qtd <= 0 remove a linha."""
+        for produto, qtd in alteracoes.items():
+            if produto in self.produtos:
+                indice = self.produtos.index(produto)
+                selecionado = self.listbox.selection_includes(indice)
+                self.listbox.delete(indice)
+                if qtd > 0:
+                    self.listbox.insert(indice, f"{produto}: {qtd} un.")
+                    if selecionado:
+                        self.listbox.selection_set(indice)
+                else:
+                    self.produtos.pop(indice)
+                    if not self.produtos:
+                        self.listbox.insert(END, self.texto_vazio)
+            elif qtd > 0:
+                if not self.produtos:
+                    self.listbox.delete(0, END)  # Tira o texto de lista vazia
+                self.produtos.append(produto)
+                self.listbox.insert(END, f"{produto}: {qtd} un.")
+
+
+# --- Lista do estoque carregada aos poucos ---
+class ListaVirtual:
+    """Listbox do estoque que só carrega o que o utilizador vê: pede ao
+    servidor uma página (BUSCAR_ESTOQUE) de cada vez, e a seguinte quando
+    a barra de rolagem chega perto do fim. Mantém as linhas por ordem de
+    nome e só mostra produtos com estoque que contenham o filtro."""
+
+    def __init__(self, listbox, scrollbar, texto_vazio, pedir_pagina):
+        self.listbox = listbox
+        self.scrollbar = scrollbar
+        self.texto_vazio = texto_vazio
+        # função(filtro, cursor, ao_responder): pede a página sem bloquear
+        self.pedir_pagina = pedir_pagina
+        self.filtro = ""
+        self.produtos = []      # Linhas carregadas, ordenadas
+        self.quantidades = {}
+        self.cursor = None      # Onde continua a próxima página
+        self.completa = False   # Já carregámos tudo o que o filtro encontra
+        self.carregando = False
+        self.geracao = 0        # Muda a cada recarregar: páginas pedidas antes são ignoradas
+        self.listbox.config(yscrollcommand=self._ao_rolar)
+        self.listbox.insert(END, texto_vazio)
+
+    def recarregar(self, filtro=None, ao_carregar=None):
+        """Esvazia a lista e pede a primeira página; 'ao_carregar(resposta)'
+        é chamado quando ela chegar."""
+        if filtro is not None:
+            self.filtro = filtro.strip().lower()
+        self.produtos, self.quantidades = [], {}
+        self.cursor, self.completa = None, False
+        self.geracao += 1
+        self.carregando = False
+        self.listbox.delete(0, END)
+        self.carregar_mais(ao_carregar)
+
+    def carregar_mais(self, ao_carregar=None):
+        if self.completa or self.carregando:
+            return
+        self.carregando = True
+        geracao = self.geracao
+        self.pedir_pagina(self.filtro, self.cursor,
+                          lambda resposta: self._receber_pagina(geracao, resposta, ao_carregar))
+
+    def _receber_pagina(self, geracao, resposta, ao_carregar):
+        if geracao != self.geracao:
+            return  # A lista foi recarregada (ex.: outro filtro) depois do pedido
+        self.carregando = False
+        if ao_carregar is not None:
+            ao_carregar(resposta)
+        if resposta is None or resposta.get("tipo") != "ESTOQUE_PAGINA":
+            return
+        if not self.produtos:
+            self.listbox.delete(0, END)  # Tira o texto de lista vazia
+        for produto, qtd in resposta["payload"]["itens"]:
+            # Um evento pode ter acrescentado o produto antes de a página chegar
+            if qtd > 0 and produto not in self.quantidades:
+                self._inserir(produto, qtd)
+        self.cursor = resposta["payload"]["proximo_cursor"]
+        self.completa = self.cursor is None
+        if not self.produtos:
+            self.listbox.insert(END, self.texto_vazio)
+
+    def _ao_rolar(self, primeiro, ultimo):
+        self.scrollbar.set(primeiro, ultimo)
+        if float(ultimo) > 0.9 and not self.completa:
+            self.listbox.after_idle(self.carregar_mais)
+
+    def _inserir(self, produto, qtd):
+        indice = bisect_left(self.produtos, produto)
+        self.produtos.insert(indice, produto)
+        self.quantidades[produto] = qtd
+        self.listbox.insert(indice, f"{produto}: {qtd} un.")
+
+    def aplicar(self, alteracoes):
+        """Aplica {produto: nova_qtd} às linhas já carregadas (qtd <= 0 remove)."""
+        for produto, qtd in alteracoes.items():
+            if self.filtro not in produto:
+                continue
+            if produto in self.quantidades:
+                indice = bisect_left(self.produtos, produto)
+                selecionado = self.listbox.selection_includes(indice)
+                self.listbox.delete(indice)
+                if qtd > 0:
+                    self.quantidades[produto] = qtd
+                    self.listbox.insert(indice, f"{produto}: {qtd} un.")
+                    if selecionado:
+                        self.listbox.selection_set(indice)
+                else:
+                    self.produtos.pop(indice)
+                    del self.quantidades[produto]
+                    if not self.produtos:
+                        self.listbox.insert(END, self.texto_vazio)
+            elif qtd > 0 and (self.completa or (self.cursor is not None and produto < self.cursor)):
+                # Só entra se cair na parte já carregada; o resto vem com a sua página
+                if not self.produtos:
+                    self.listbox.delete(0, END)
+                self._inserir(produto, qtd)
+
+
 # --- Configuração da Interface Gráfica (GUI) ---
 class App:
     def __init__(self, root):
@@ -55,6 +555,13 @@ class App:
         self.root.geometry("600x400") # Janela mais larga
         
         self.is_running = True 
+        # Toda a E/S de rede é feita numa thread à parte; as respostas
+        # voltam para a thread do Tk pelo root.after
+        self.network.iniciar_trabalhador(self._agendar)
+
+        # Última versão do estoque recebida (None = ainda não temos snapshot)
+        self.versao_estoque = None
+        self.reservas = {}
 
         self.status_label = tk.Label(root, text="Por favor, ligue-se ao servidor.", bd=1, relief=tk.SUNKEN, anchor=tk.W)
         self.status_label.pack(side=tk.BOTTOM, fill=tk.X)
@@ -67,13 +574,21 @@ class App:
         list_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
 
         tk.Label(list_frame, text="Estoque Disponível:").pack(anchor=tk.W)
+
+        # Pesquisa no servidor (por parte do nome), com um pequeno atraso
+        # para não fazer um pedido a cada tecla
+        self.busca = tk.StringVar()
+        self.busca_pendente = None
+        tk.Entry(list_frame, textvariable=self.busca).pack(fill=tk.X)
+        self.busca.trace_add("write", self._ao_digitar_busca)
         
         scrollbar_estoque = tk.Scrollbar(list_frame, orient=tk.VERTICAL)
-        self.estoque_listbox = Listbox(list_frame, yscrollcommand=scrollbar_estoque.set, height=15)
+        self.estoque_listbox = Listbox(list_frame, height=15)
         scrollbar_estoque.config(command=self.estoque_listbox.yview)
         
         scrollbar_estoque.pack(side=tk.RIGHT, fill=tk.Y)
         self.estoque_listbox.pack(fill=tk.BOTH, expand=True)
+        self.lista_estoque = ListaVirtual(self.estoque_listbox, scrollbar_estoque, "Estoque vazio.", self._pedir_pagina)
         # Evento de clique para o botão Reservar
         self.estoque_listbox.bind("<<ListboxSelect>>", self.on_select_estoque)
 
@@ -89,6 +604,8 @@ class App:
         self.btn_cancelar = tk.Button(button_frame, text="Cancelar", command=self.cancelar_reserva, bg="#F44336", fg="white", state=tk.DISABLED)
         self.btn_cancelar.pack(fill=tk.X, pady=5)
 
+        tk.Button(button_frame, text="Renovar Reservas", command=self.renovar_reservas).pack(fill=tk.X, pady=5)
+
 
         # --- (NOVO) Frame Minhas Reservas (Direita) ---
         reservas_frame = tk.Frame(main_frame)
@@ -102,6 +619,7 @@ class App:
         
         scrollbar_reservas.pack(side=tk.RIGHT, fill=tk.Y)
         self.reservas_listbox.pack(fill=tk.BOTH, expand=True)
+        self.lista_reservas = ListaProdutos(self.reservas_listbox, "Nenhum item reservado.")
         # Evento de clique para o botão Cancelar
         self.reservas_listbox.bind("<<ListboxSelect>>", self.on_select_reserva)
 
@@ -109,19 +627,61 @@ class App:
         self.root.protocol("WM_DELETE_WINDOW", self.ao_fechar)
         self.ligar_ao_servidor()
 
+    def _agendar(self, funcao, *args):
+        """Passa uma chamada para a thread do Tk (pode ser chamada de qualquer thread)."""
+        if self.is_running:
+            self.root.after(0, funcao, *args)
+
+    def _pedir_pagina(self, filtro, cursor, ao_responder):
+        self.network.executar(lambda: self.network.buscar_estoque(filtro, cursor), ao_responder,
+                              chave=("pagina", filtro, cursor))
+
     def ligar_ao_servidor(self):
-        host = simpledialog.askstring("Ligar ao Servidor", "Digite o IP do servidor:", initialvalue="127.0.0.1")
+        host = simpledialog.askstring("Ligar ao Servidor", "Digite o IP do servidor\n(com réplicas, a lista: 127.0.0.1:5050,127.0.0.1:5051):",
+                                      initialvalue="127.0.0.1")
         if not host:
             self.root.destroy()
             return
 
-        is_connected = self.network.connect(host, 5050)
-        
-        if is_connected:
-            self.status_label.config(text="Ligado a " + host)
-            self.auto_atualizar_loop()
-        else:
+        self.status_label.config(text=f"A ligar a {host}...")
+        self.network.executar(lambda: self._ligar(host), lambda resposta: self._ao_ligar(host, resposta))
+
+    def _ligar(self, host):
+        """Corre no trabalhador de rede. Devolve None se não ligou, a resposta
+        ao SUBSCRIBE, ou {} se o servidor não suporta assinaturas."""
+        enderecos = ler_enderecos(host)
+        if not enderecos or not self.network.connect_enderecos(enderecos):
+            return None
+        self.network.ao_religar = lambda primario: self._agendar(self._ao_religar, primario)
+        # Com a assinatura o servidor envia as alterações sozinho;
+        # o polling a cada 3 s fica para servidores sem SUBSCRIBE e para o
+        # cluster, onde os eventos só trazem os produtos do nó a que ligámos.
+        # O catálogo não vem na resposta: a lista carrega-o por páginas.
+        resposta = self.network.assinar(lambda evento: self._agendar(self._ao_receber_evento, evento),
+                                        snapshot=False)
+        return resposta or {}
+
+    def _ao_ligar(self, host, resposta):
+        if resposta is None:
             self.root.destroy()
+            return
+        self.status_label.config(text="Ligado a " + host)
+        if resposta:
+            self.versao_estoque = resposta.get("versao")
+            self.lista_estoque.recarregar()
+            self.atualizar_lista_reservas()
+            if resposta.get("cluster"):
+                self.auto_atualizar_loop()
+        else:
+            self.recarregar_estoque()
+            self.auto_atualizar_loop()
+
+    def _ao_religar(self, primario):
+        # O primário novo tem outras versões do estoque: recomeça do zero
+        self.status_label.config(text=f"Ligado ao novo primário {primario[0]}:{primario[1]}")
+        self.versao_estoque = None
+        self.lista_estoque.recarregar()
+        self.atualizar_lista_reservas()
 
     def auto_atualizar_loop(self):
         if not self.is_running:
@@ -132,42 +692,94 @@ class App:
     # --- Funções de Lógica ---
     
     def atualizar_listas(self):
-        """Pede ao servidor o estoque E as reservas."""
-        self.atualizar_lista_estoque()
-        self.atualizar_lista_reservas()
+        """Pede ao servidor o estoque E as reservas (numa única ida e volta).
+        Se já houver uma atualização na fila, esta junta-se a ela."""
+        self.network.executar(
+            lambda: self.network.send_commands([self._comando_estoque(), {"tipo": "GET_MINHAS_RESERVAS"}]),
+            self._ao_atualizar_listas, chave="atualizar_listas")
+
+    def _ao_atualizar_listas(self, respostas):
+        if respostas is None: return
+        self._mostrar_estoque(respostas[0])
+        self._mostrar_reservas(respostas[1])
+
+    def _ao_digitar_busca(self, *_):
+        if self.busca_pendente is not None:
+            self.root.after_cancel(self.busca_pendente)
+        self.busca_pendente = self.root.after(300, self._buscar)
+
+    def _buscar(self):
+        self.busca_pendente = None
+        self.lista_estoque.recarregar(self.busca.get())
+
+    def recarregar_estoque(self):
+        self.lista_estoque.recarregar(ao_carregar=self._ao_carregar_estoque)
+
+    def _ao_carregar_estoque(self, resposta):
+        # Sem assinatura, a versão da primeira página serve de base aos deltas
+        if resposta is not None and self.versao_estoque is None:
+            self.versao_estoque = resposta.get("versao")
+
+    def _comando_estoque(self):
+        # Se já temos uma versão, pedimos só o que mudou desde ela
+        if self.versao_estoque is None:
+            return {"tipo": "GET_ESTOQUE"}
+        return {"tipo": "GET_ESTOQUE", "payload": {"desde_versao": self.versao_estoque}}
     
     def atualizar_lista_estoque(self):
-        comando = {"tipo": "GET_ESTOQUE"}
-        resposta = self.network.send_command(comando)
+        self.network.executar(lambda: self.network.send_command(self._comando_estoque()),
+                              self._ao_atualizar_estoque, chave="estoque")
+
+    def _ao_atualizar_estoque(self, resposta):
         if resposta is None: return
+        self._mostrar_estoque(resposta)
 
-        if resposta.get("tipo") == "ESTOQUE_ATUAL":
-            self.estoque_listbox.delete(0, END)
-            estoque = resposta.get("payload", {})
-            if not estoque or all(v == 0 for v in estoque.values()):
-                self.estoque_listbox.insert(END, "Estoque vazio.")
-                return
+    def _ao_receber_evento(self, evento):
+        if evento.get("tipo") == "RESERVAS_EXPIRADAS":
+            # O prazo acabou e o servidor devolveu estes itens ao estoque
+            self.atualizar_lista_reservas()
+            self.status_label.config(text=f"Reservas expiradas: {', '.join(evento.get('payload', {}))}")
+        else:
+            self._mostrar_estoque(evento)
+
+    def _mostrar_estoque(self, resposta):
+        tipo = resposta.get("tipo")
+        versao = resposta.get("versao")
+        # Eventos e respostas podem cruzar-se: ignora o que for mais antigo
+        if self.versao_estoque is not None and versao is not None and versao < self.versao_estoque:
+            return
 
-            for produto, qtd in estoque.items():
-                if qtd > 0: # Só mostra itens com estoque > 0
-                    self.estoque_listbox.insert(END, f"{produto}: {qtd} un.")
+        if tipo == "ESTOQUE_ATUAL" and versao is None:
+            # Cluster: não há versões entre nós e vem sempre o estoque
+            # completo, por isso basta atualizar as linhas carregadas
+            self.lista_estoque.aplicar(resposta.get("payload", {}))
+        elif tipo in ("ESTOQUE_ATUAL", "ASSINATURA_OK") or (tipo == "EVENTO_ESTOQUE" and resposta.get("completo")):
+            # Ficámos para trás demais: recarrega a parte visível do início
+            self.versao_estoque = versao
+            self.lista_estoque.recarregar()
+        elif tipo in ("ESTOQUE_DELTA", "EVENTO_ESTOQUE"):
+            # Só os produtos alterados desde a nossa versão
+            self.versao_estoque = resposta.get("versao")
+            self.lista_estoque.aplicar(resposta.get("payload", {}))
         else:
             messagebox.showerror("Erro", f"Resposta inesperada do servidor: {resposta}")
 
     def atualizar_lista_reservas(self):
         comando = {"tipo": "GET_MINHAS_RESERVAS"}
-        resposta = self.network.send_command(comando)
+        self.network.pedir(comando, self._ao_receber_reservas, chave="reservas")
+
+    def _ao_receber_reservas(self, resposta):
         if resposta is None: return
-        
+        self._mostrar_reservas(resposta)
+
+    def _mostrar_reservas(self, resposta):
         if resposta.get("tipo") == "MINHAS_RESERVAS":
-            self.reservas_listbox.delete(0, END)
             reservas = resposta.get("payload", {})
-            if not reservas:
-                self.reservas_listbox.insert(END, "Nenhum item reservado.")
-                return
-
-            for produto, qtd in reservas.items():
-                self.reservas_listbox.insert(END, f"{produto}: {qtd} un.")
+            # Compara com o carrinho anterior e altera só o que mudou
+            alteracoes = {p: q for p, q in reservas.items() if self.reservas.get(p) != q}
+            alteracoes.update({p: 0 for p in self.reservas if p not in reservas})
+            self.reservas = reservas
+            self.lista_reservas.aplicar(alteracoes)
         else:
             messagebox.showerror("Erro", f"Resposta inesperada do servidor: {resposta}")
             
@@ -210,7 +822,9 @@ class App:
         if not quantidade or quantidade <= 0: return 
 
         comando = {"tipo": "RESERVAR", "payload": {"produto": produto, "quantidade": quantidade}}
-        resposta = self.network.send_command(comando)
+        self.network.pedir(comando, self._ao_reservar)
+
+    def _ao_reservar(self, resposta):
         if resposta is None: return
         
         if resposta.get("tipo") == "RESPOSTA_RESERVA":
@@ -219,8 +833,9 @@ class App:
             mensagem = payload.get("mensagem")
             
             if status == "SUCESSO":
-                messagebox.showinfo("Sucesso", mensagem)
+                # Pede a atualização antes do aviso: chega enquanto ele está aberto
                 self.atualizar_listas() # Atualiza ambas as listas
+                messagebox.showinfo("Sucesso", mensagem)
             else:
                 messagebox.showerror("Erro de Reserva", mensagem)
         else:
@@ -236,7 +851,9 @@ class App:
         if not quantidade or quantidade <= 0: return
 
         comando = {"tipo": "CANCELAR_RESERVA", "payload": {"produto": produto, "quantidade": quantidade}}
-        resposta = self.network.send_command(comando)
+        self.network.pedir(comando, self._ao_cancelar)
+
+    def _ao_cancelar(self, resposta):
         if resposta is None: return
         
         if resposta.get("tipo") == "RESPOSTA_CANCELAMENTO":
@@ -245,17 +862,33 @@ class App:
             mensagem = payload.get("mensagem")
             
             if status == "SUCESSO":
-                messagebox.showinfo("Sucesso", mensagem)
+                # Pede a atualização antes do aviso: chega enquanto ele está aberto
                 self.atualizar_listas() # Atualiza ambas as listas
+                messagebox.showinfo("Sucesso", mensagem)
             else:
                 messagebox.showerror("Erro de Cancelamento", mensagem)
         else:
              messagebox.showerror("Erro", f"Resposta inesperada do servidor: {resposta}")
     
+    def renovar_reservas(self):
+        self.network.executar(self.network.renovar, self._ao_renovar)
+
+    def _ao_renovar(self, resposta):
+        if resposta is None: return
+        payload = resposta.get("payload", {})
+        if payload.get("status") == "SUCESSO":
+            self.status_label.config(text=payload.get("mensagem"))
+        else:
+            messagebox.showerror("Erro", payload.get("mensagem", f"Resposta inesperada do servidor: {resposta}"))
+
     def ao_fechar(self):
         self.is_running = False 
         print("A fechar a ligação...")
-        self.network.close()
+        # O SAIR vai pela fila, depois dos pedidos pendentes: espera no máximo 1 s
+        try:
+            self.network.executar(self.network.close).result(timeout=1.0)
+        except Exception:
+            pass
         self.root.destroy()
 
 # --- Iniciar a Aplicação ---
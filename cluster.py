@@ -0,0 +1,92 @@
+# cluster.py
+# Peças do modo cluster: vários nós do servidor, cada um dono de uma parte
+# dos produtos.
+#
+# O dono de cada produto é escolhido por hashing consistente: cada nó
+# ocupa muitos pontos (nós virtuais) num anel de hashes e o produto
+# pertence ao primeiro ponto a seguir ao seu hash. Juntar ou tirar um nó
+# só muda o dono dos produtos que caem nos pontos desse nó.
+#
+# Os nós falam entre si pelo mesmo protocolo JSON dos clientes, em
+# ligações persistentes reaproveitadas de pedido para pedido (PoolConexoes).
+import bisect
+import hashlib
+import queue
+import socket
+import threading
+import time
+
+from protocolo import LeitorMensagens, codificar, ler_endereco
+
+NOS_VIRTUAIS = 128
+
+
+def _hash(texto):
+    return int.from_bytes(hashlib.blake2b(texto.encode(), digest_size=8).digest(), "big")
+
+
+class AnelConsistente:
+    def __init__(self, nos, nos_virtuais=NOS_VIRTUAIS):
+        pontos = sorted((_hash(f"{no}#{i}"), no) for no in nos for i in range(nos_virtuais))
+        self.nos = sorted(set(nos))
+        self.hashes = [h for h, _ in pontos]
+        self.donos = [no for _, no in pontos]
+
+    def dono(self, produto):
+        i = bisect.bisect(self.hashes, _hash(produto))
+        return self.donos[i % len(self.donos)]
+
+
+class PoolConexoes:
+    """Ligações persistentes a outro nó. Cada pedido usa uma ligação livre
+    (ou abre uma nova, até 'tamanho'); uma ligação parada há mais de
+    'tempo_ocioso' é fechada em vez de reaproveitada, para não apanhar uma
+    que o outro nó já fechou por inatividade."""
+
+    def __init__(self, no, tamanho=32, tempo_ocioso=60.0, timeout=10.0):
+        self.endereco = ler_endereco(no)
+        self.tempo_ocioso = tempo_ocioso
+        self.timeout = timeout
+        self.vagas = threading.BoundedSemaphore(tamanho)
+        self.livres = queue.LifoQueue()  # (sock, leitor, usada_em); LIFO mantém as quentes
+
+    def _obter(self):
+        while True:
+            try:
+                sock, leitor, usada_em = self.livres.get_nowait()
+            except queue.Empty:
+                break
+            if time.monotonic() - usada_em < self.tempo_ocioso:
+                return sock, leitor
+            sock.close()
+        sock = socket.create_connection(self.endereco, timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, LeitorMensagens(sock)
+
+    def pedir(self, comandos):
+        """Envia os comandos de uma vez (pipelining) e devolve as respostas
+        pela mesma ordem. Levanta OSError se o nó não responder; a ligação
+        é então descartada (o pedido pode ou não ter sido aplicado)."""
+        with self.vagas:
+            sock, leitor = self._obter()
+            try:
+                sock.sendall(b"".join(codificar(c) for c in comandos))
+                respostas = []
+                for _ in comandos:
+                    resposta = leitor.ler()
+                    if resposta is None:
+                        raise ConnectionError("o nó fechou a ligação")
+                    respostas.append(resposta)
+            except (OSError, ValueError):
+                sock.close()
+                raise
+            self.livres.put((sock, leitor, time.monotonic()))
+            return respostas
+
+    def fechar(self):
+        while True:
+            try:
+                sock, _, _ = self.livres.get_nowait()
+            except queue.Empty:
+                return
+            sock.close()
@@ -0,0 +1,224 @@
+# estoque_compacto.py
+# Representação compacta do estoque e dos carrinhos, num só processo.
+#
+# Cada produto recebe um ID fixo na primeira vez que aparece (a tabela de
+# nomes só cresce); a quantidade fica num array de inteiros indexado por
+# esse ID, em vez de um objeto int por produto num dicionário. O mesmo ID
+# serve para a codificação binária e para os carrinhos, que guardam pares
+# (ID, quantidade) num array em vez de um dicionário nome -> quantidade.
+#
+# A interface é a de um dicionário, igual à do EstoqueCompartilhado
+# (memoria_compartilhada.py), por isso o resto do servidor não muda.
+import threading
+from array import array
+
+AUSENTE = -1  # Quantidade de um ID que não está no estoque (ex.: produto removido)
+
+
+class EstoqueCompacto:
+    """Funciona como o dicionário 'estoque_disponivel' (nome -> quantidade)."""
+
+    def __init__(self, estoque=()):
+        self.ids = {}                  # nome -> id
+        self.nomes = []                # id -> nome
+        self.quantidades = array("q")  # id -> quantidade (AUSENTE = não existe)
+        self.existentes = 0
+        # Só para criar produtos novos e para o contador 'existentes', que é
+        # de todos os produtos (o lock de cada produto não chega para ele)
+        self.lock_catalogo = threading.Lock()
+        self.update(estoque)
+
+    # --- Catálogo de IDs ---
+
+    def id_do_produto(self, produto, criar=False):
+        id_produto = self.ids.get(produto)
+        if id_produto is None and criar:
+            with self.lock_catalogo:
+                id_produto = self.ids.get(produto)
+                if id_produto is None:
+                    id_produto = len(self.nomes)
+                    self.quantidades.append(AUSENTE)
+                    self.nomes.append(produto)
+                    self.ids[produto] = id_produto
+        return id_produto
+
+    # --- Interface de dicionário ---
+
+    # Estes métodos estão no caminho de cada RESERVAR: evitam chamar outros
+    # métodos (cada chamada em Python custa mais que o acesso ao array).
+
+    def __contains__(self, produto):
+        id_produto = self.ids.get(produto)
+        return id_produto is not None and self.quantidades[id_produto] != AUSENTE
+
+    def __getitem__(self, produto):
+        quantidade = self.quantidades[self.ids[produto]]
+        if quantidade == AUSENTE:
+            raise KeyError(produto)
+        return quantidade
+
+    def __setitem__(self, produto, quantidade):
+        id_produto = self.ids.get(produto)
+        if id_produto is None:
+            id_produto = self.id_do_produto(produto, criar=True)
+        if self.quantidades[id_produto] == AUSENTE:
+            with self.lock_catalogo:
+                if self.quantidades[id_produto] == AUSENTE:
+                    self.existentes += 1
+                self.quantidades[id_produto] = quantidade
+            return
+        self.quantidades[id_produto] = quantidade
+
+    def __delitem__(self, produto):
+        id_produto = self.ids.get(produto)
+        if id_produto is None or self.quantidades[id_produto] == AUSENTE:
+            raise KeyError(produto)
+        with self.lock_catalogo:
+            self.quantidades[id_produto] = AUSENTE
+            self.existentes -= 1
+
+    def get(self, produto, padrao=None):
+        id_produto = self.ids.get(produto)
+        if id_produto is None:
+            return padrao
+        quantidade = self.quantidades[id_produto]
+        return padrao if quantidade == AUSENTE else quantidade
+
+    def pop(self, produto, *padrao):
+        if produto not in self:
+            if padrao:
+                return padrao[0]
+            raise KeyError(produto)
+        quantidade = self[produto]
+        del self[produto]
+        return quantidade
+
+    def items(self):
+        return [(nome, qtd) for nome, qtd in zip(self.nomes, self.quantidades) if qtd != AUSENTE]
+
+    def keys(self):
+        return [nome for nome, qtd in zip(self.nomes, self.quantidades) if qtd != AUSENTE]
+
+    def values(self):
+        return [qtd for qtd in self.quantidades if qtd != AUSENTE]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.existentes
+
+    def copy(self):
+        return dict(self.items())
+
+    def update(self, outro):
+        for produto, quantidade in dict(outro).items():
+            self[produto] = quantidade
+
+    def clear(self):
+        # Os IDs continuam reservados: só as quantidades são apagadas
+        with self.lock_catalogo:
+            for i in range(len(self.quantidades)):
+                self.quantidades[i] = AUSENTE
+            self.existentes = 0
+
+
+class Carrinho:
+    """Carrinho de uma sessão: pares (ID do produto, quantidade) seguidos num
+    único array. Um carrinho tem poucos itens, por isso procurar um produto
+    é percorrer o array; vazio, não tem array nenhum. 'tabela' é o estoque
+    (EstoqueCompacto ou EstoqueCompartilhado), que traduz nomes <-> IDs.
+    Mesma interface do dicionário produto -> quantidade que substitui."""
+
+    __slots__ = ("tabela", "linhas")
+
+    def __init__(self, tabela):
+        self.tabela = tabela
+        self.linhas = None  # array("q"): id, qtd, id, qtd, ...
+
+    def _posicao(self, produto):
+        linhas = self.linhas
+        if linhas is None:
+            return -1
+        # Os IDs de um carrinho foram criados neste processo: basta a tabela local
+        id_produto = self.tabela.ids.get(produto)
+        ids = linhas[::2]  # Procurar num array (em C) é mais rápido que um ciclo em Python
+        if id_produto is None or id_produto not in ids:
+            return -1
+        return ids.index(id_produto) * 2
+
+    def get(self, produto, padrao=None):
+        i = self._posicao(produto)
+        return padrao if i < 0 else self.linhas[i + 1]
+
+    def __getitem__(self, produto):
+        i = self._posicao(produto)
+        if i < 0:
+            raise KeyError(produto)
+        return self.linhas[i + 1]
+
+    def __setitem__(self, produto, quantidade):
+        i = self._posicao(produto)
+        if i >= 0:
+            self.linhas[i + 1] = quantidade
+        elif self.linhas is None:
+            self.linhas = array("q", (self.tabela.id_do_produto(produto, criar=True), quantidade))
+        else:
+            self.linhas.extend((self.tabela.id_do_produto(produto, criar=True), quantidade))
+
+    def somar(self, produto, delta):
+        """Soma 'delta' à quantidade de 'produto' (tira o item se chegar a
+        zero) e devolve a nova quantidade. Uma só passagem pelo array: é o
+        que o índice de reservas faz a cada RESERVAR/CANCELAR_RESERVA."""
+        i = self._posicao(produto)
+        if i < 0:
+            if delta:
+                self[produto] = delta
+            return delta
+        quantidade = self.linhas[i + 1] + delta
+        if quantidade:
+            self.linhas[i + 1] = quantidade
+        else:
+            del self.linhas[i:i + 2]
+            if not self.linhas:
+                self.linhas = None
+        return quantidade
+
+    def pop(self, produto, *padrao):
+        i = self._posicao(produto)
+        if i < 0:
+            if padrao:
+                return padrao[0]
+            raise KeyError(produto)
+        quantidade = self.linhas[i + 1]
+        del self.linhas[i:i + 2]
+        if not self.linhas:
+            self.linhas = None
+        return quantidade
+
+    def __contains__(self, produto):
+        return self._posicao(produto) >= 0
+
+    def __len__(self):
+        return 0 if self.linhas is None else len(self.linhas) // 2
+
+    def __bool__(self):
+        return self.linhas is not None
+
+    def items(self):
+        if self.linhas is None:
+            return []
+        nomes = self.tabela.nomes
+        return [(nomes[id_produto], qtd) for id_produto, qtd in zip(self.linhas[::2], self.linhas[1::2])]
+
+    def keys(self):
+        return [nome for nome, _ in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.copy())
@@ -0,0 +1,184 @@
+# memoria_compartilhada.py
+# Estruturas do estoque em memória partilhada, para o modo com vários
+# processos (python servidor.py --workers N).
+#
+# Cada produto recebe um ID fixo; as quantidades ficam num array de
+# inteiros indexado por esse ID, visível por todos os processos. Os nomes
+# ficam numa tabela só de acréscimo (append-only), que cada processo vai
+# copiando para um dicionário local à medida que aparecem produtos novos.
+# Tudo é criado ANTES do fork, por isso os processos filhos herdam as
+# mesmas regiões de memória e os mesmos locks.
+import multiprocessing
+
+# Só existe em sistemas com fork (Linux, etc.)
+if "fork" in multiprocessing.get_all_start_methods():
+    contexto = multiprocessing.get_context("fork")
+else:
+    contexto = None
+
+
+class CatalogoCheio(Exception):
+    pass
+
+
+class EstoqueCompartilhado:
+    """Funciona como o dicionário 'estoque_disponivel' (nome -> quantidade),
+    mas guardado em memória partilhada entre os processos."""
+
+    def __init__(self, capacidade=100000, bytes_por_nome=32):
+        self.capacidade = capacidade
+        self.quantidades = contexto.RawArray("q", capacidade)
+        self.existe = contexto.RawArray("b", capacidade)
+        self.nomes_buffer = contexto.RawArray("c", capacidade * bytes_por_nome)
+        self.inicio_nome = contexto.RawArray("q", capacidade + 1)
+        self.total = contexto.RawValue("q", 0)
+        self.lock_catalogo = contexto.Lock()  # Só para criar produtos novos
+        # Cópia local (por processo) da tabela de nomes
+        self.ids = {}
+        self.nomes = []
+
+    # --- Catálogo de IDs ---
+
+    def _sincronizar(self):
+        while len(self.nomes) < self.total.value:
+            i = len(self.nomes)
+            nome = self.nomes_buffer[self.inicio_nome[i]:self.inicio_nome[i + 1]].decode()
+            self.nomes.append(nome)
+            self.ids[nome] = i
+
+    def id_do_produto(self, produto, criar=False):
+        id_produto = self.ids.get(produto)
+        if id_produto is None:
+            self._sincronizar()
+            id_produto = self.ids.get(produto)
+        if id_produto is None and criar:
+            with self.lock_catalogo:
+                self._sincronizar()
+                id_produto = self.ids.get(produto)
+                if id_produto is None:
+                    id_produto = self._acrescentar(produto)
+        return id_produto
+
+    def _acrescentar(self, produto):
+        i = self.total.value
+        dados = produto.encode()
+        inicio = self.inicio_nome[i]
+        if i >= self.capacidade or inicio + len(dados) > len(self.nomes_buffer):
+            raise CatalogoCheio("Não há espaço para mais produtos na memória partilhada.")
+        self.nomes_buffer[inicio:inicio + len(dados)] = dados
+        self.inicio_nome[i + 1] = inicio + len(dados)
+        self.total.value = i + 1
+        self._sincronizar()
+        return i
+
+    # --- Interface de dicionário ---
+
+    def __contains__(self, produto):
+        id_produto = self.id_do_produto(produto)
+        return id_produto is not None and bool(self.existe[id_produto])
+
+    def __getitem__(self, produto):
+        id_produto = self.id_do_produto(produto)
+        if id_produto is None or not self.existe[id_produto]:
+            raise KeyError(produto)
+        return self.quantidades[id_produto]
+
+    def __setitem__(self, produto, quantidade):
+        id_produto = self.id_do_produto(produto, criar=True)
+        self.quantidades[id_produto] = quantidade
+        self.existe[id_produto] = 1
+
+    def get(self, produto, padrao=None):
+        try:
+            return self[produto]
+        except KeyError:
+            return padrao
+
+    def items(self):
+        self._sincronizar()
+        return [(nome, self.quantidades[i]) for i, nome in enumerate(self.nomes) if self.existe[i]]
+
+    def keys(self):
+        return [nome for nome, _ in self.items()]
+
+    def values(self):
+        return [qtd for _, qtd in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.items())
+
+    def copy(self):
+        return dict(self.items())
+
+    def update(self, outro):
+        for produto, quantidade in dict(outro).items():
+            self[produto] = quantidade
+
+    def clear(self):
+        for i in range(self.total.value):
+            self.existe[i] = 0
+
+
+class LogAlteracoesCompartilhado:
+    """Versão do estoque e log de alterações limitado (anel), partilhados
+    entre os processos. Mesma interface do LogAlteracoes do servidor."""
+
+    def __init__(self, estoque, tamanho=10000):
+        self.estoque = estoque
+        self.tamanho = tamanho
+        self.versao = contexto.RawValue("q", 0)
+        self.versoes = contexto.RawArray("q", tamanho)
+        self.ids = contexto.RawArray("i", tamanho)
+        self.lock = contexto.Lock()
+
+    def registrar(self, produto):
+        id_produto = self.estoque.id_do_produto(produto, criar=True)
+        with self.lock:
+            versao = self.versao.value + 1
+            posicao = versao % self.tamanho
+            self.versoes[posicao] = versao
+            self.ids[posicao] = id_produto
+            self.versao.value = versao
+            return versao
+
+    def atual(self):
+        return self.versao.value
+
+    def desde(self, versao):
+        with self.lock:
+            atual = self.versao.value
+            if versao > atual or atual - versao > self.tamanho:
+                return None
+            ids = {self.ids[v % self.tamanho] for v in range(versao + 1, atual + 1)}
+        self.estoque._sincronizar()
+        return atual, {self.estoque.nomes[i] for i in ids}
+
+
+class TotaisCompartilhados:
+    """Um inteiro por produto (ex.: o total reservado), indexado pelo mesmo
+    ID do EstoqueCompartilhado. Alterar só com o lock da fatia do produto."""
+
+    def __init__(self, estoque):
+        self.estoque = estoque
+        self.valores = contexto.RawArray("q", estoque.capacidade)
+
+    def get(self, produto, padrao=0):
+        id_produto = self.estoque.id_do_produto(produto)
+        return padrao if id_produto is None else self.valores[id_produto]
+
+    def __setitem__(self, produto, valor):
+        self.valores[self.estoque.id_do_produto(produto, criar=True)] = valor
+
+    def pop(self, produto, padrao=0):
+        id_produto = self.estoque.id_do_produto(produto)
+        if id_produto is None:
+            return padrao
+        valor, self.valores[id_produto] = self.valores[id_produto], 0
+        return valor
+
+    def items(self):
+        self.estoque._sincronizar()
+        return [(nome, self.valores[i]) for i, nome in enumerate(self.estoque.nomes) if self.valores[i]]
@@ -0,0 +1,195 @@
+# metricas.py
+# Métricas do servidor: contadores e histogramas de latência.
+#
+# Para não pôr um lock global no caminho de cada pedido, os valores ficam
+# repartidos por "fatias", uma atribuída a cada thread na primeira vez que
+# ela mede alguma coisa (por ordem, a dar a volta); cada fatia tem o
+# seu lock (quase nunca disputado) e a leitura soma todas as fatias.
+# Um contador pode descer (ex.: conexões ativas), por isso também serve
+# de medidor.
+import bisect
+import itertools
+import os
+import threading
+import time
+
+# Limites superiores (em segundos) dos baldes dos histogramas
+LIMITES_LATENCIA = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+N_FATIAS_METRICAS = 16
+
+
+class Histograma:
+    __slots__ = ("baldes", "soma", "total")
+
+    def __init__(self):
+        self.baldes = [0] * (len(LIMITES_LATENCIA) + 1)  # o último é +Inf
+        self.soma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        self.baldes[bisect.bisect_left(LIMITES_LATENCIA, valor)] += 1
+        self.soma += valor
+        self.total += 1
+
+    def juntar(self, outro):
+        for i, n in enumerate(outro.baldes):
+            self.baldes[i] += n
+        self.soma += outro.soma
+        self.total += outro.total
+
+    def percentil(self, p):
+        """Estimativa: limite superior do balde onde cai o percentil p."""
+        if not self.total:
+            return None
+        alvo = p / 100 * self.total
+        acumulado = 0
+        for i, n in enumerate(self.baldes):
+            acumulado += n
+            if acumulado >= alvo:
+                return LIMITES_LATENCIA[i] if i < len(LIMITES_LATENCIA) else float("inf")
+
+
+class _Fatia:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contadores = {}   # (nome, rótulo) -> valor
+        self.histogramas = {}  # (nome, rótulo) -> Histograma
+
+
+class Metricas:
+    def __init__(self):
+        self.fatias = [_Fatia() for _ in range(N_FATIAS_METRICAS)]
+        self.inicio = time.time()
+        # O id da thread não serve para escolher a fatia: é um endereço
+        # alinhado, por isso o resto da divisão por 16 dá sempre 0.
+        self._local = threading.local()
+        self._proxima = itertools.count()
+
+    def _fatia(self):
+        try:
+            return self._local.fatia
+        except AttributeError:
+            fatia = self._local.fatia = self.fatias[next(self._proxima) % N_FATIAS_METRICAS]
+            return fatia
+
+    def contar(self, nome, rotulo=None, valor=1):
+        fatia = self._fatia()
+        chave = (nome, rotulo)
+        with fatia.lock:
+            fatia.contadores[chave] = fatia.contadores.get(chave, 0) + valor
+
+    def observar(self, nome, segundos, rotulo=None):
+        fatia = self._fatia()
+        chave = (nome, rotulo)
+        with fatia.lock:
+            histograma = fatia.histogramas.get(chave)
+            if histograma is None:
+                histograma = fatia.histogramas[chave] = Histograma()
+            histograma.observar(segundos)
+
+    def _somar(self):
+        contadores, histogramas = {}, {}
+        for fatia in self.fatias:
+            with fatia.lock:
+                for chave, valor in fatia.contadores.items():
+                    contadores[chave] = contadores.get(chave, 0) + valor
+                for chave, histograma in fatia.histogramas.items():
+                    histogramas.setdefault(chave, Histograma()).juntar(histograma)
+        return contadores, histogramas
+
+    def coletar(self):
+        """Resumo em dicionário (para o GET_METRICS)."""
+        contadores, histogramas = self._somar()
+        resumo = {"pid": os.getpid(), "uptime_s": round(time.time() - self.inicio, 1),
+                  "contadores": {}, "latencias_ms": {}}
+        for (nome, rotulo), valor in sorted(contadores.items(), key=_ordem):
+            resumo["contadores"][_nome_completo(nome, rotulo)] = valor
+        for (nome, rotulo), h in sorted(histogramas.items(), key=_ordem):
+            nome = nome.removesuffix("_segundos")
+            resumo["latencias_ms"][_nome_completo(nome, rotulo)] = {
+                "n": h.total,
+                "media": round(h.soma / h.total * 1000, 3),
+                "p50": _ms(h.percentil(50)),
+                "p99": _ms(h.percentil(99)),
+                "p999": _ms(h.percentil(99.9)),
+            }
+        return resumo
+
+    def prometheus(self, prefixo="mercadinho"):
+        """Texto no formato de exposição do Prometheus."""
+        contadores, histogramas = self._somar()
+        linhas = []
+        tipos_escritos = set()
+        for (nome, rotulo), valor in sorted(contadores.items(), key=_ordem):
+            metrica = f"{prefixo}_{nome}"
+            if metrica not in tipos_escritos:
+                tipos_escritos.add(metrica)
+                linhas.append(f"# TYPE {metrica} {'counter' if nome.endswith('_total') else 'gauge'}")
+            linhas.append(f"{metrica}{_rotulos(rotulo)} {valor}")
+        for (nome, rotulo), h in sorted(histogramas.items(), key=_ordem):
+            metrica = f"{prefixo}_{nome}"
+            if metrica not in tipos_escritos:
+                tipos_escritos.add(metrica)
+                linhas.append(f"# TYPE {metrica} histogram")
+            acumulado = 0
+            for limite, n in zip(LIMITES_LATENCIA + ("+Inf",), h.baldes):
+                acumulado += n
+                linhas.append(f"{metrica}_bucket{_rotulos(rotulo, le=limite)} {acumulado}")
+            linhas.append(f"{metrica}_sum{_rotulos(rotulo)} {h.soma}")
+            linhas.append(f"{metrica}_count{_rotulos(rotulo)} {h.total}")
+        return "\n".join(linhas) + "\n"
+
+
+def _ordem(item):
+    nome, rotulo = item[0]
+    return nome, rotulo or ""
+
+def _nome_completo(nome, rotulo):
+    return nome if rotulo is None else f"{nome}{{{rotulo}}}"
+
+def _rotulos(rotulo, le=None):
+    pares = []
+    if rotulo is not None:
+        pares.append(f'tipo="{rotulo}"')
+    if le is not None:
+        pares.append(f'le="{le}"')
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+def _ms(segundos):
+    if segundos is None:
+        return None
+    return "inf" if segundos == float("inf") else round(segundos * 1000, 3)
+
+
+class LockMedido:
+    """Envolve um lock e regista quanto tempo se esperou por ele e quanto
+    tempo ficou preso. Funciona com 'with' e com acquire()/release()."""
+
+    __slots__ = ("lock", "metricas", "adquirido_em")
+
+    def __init__(self, lock, metricas):
+        self.lock = lock
+        self.metricas = metricas
+        self.adquirido_em = 0.0
+
+    def acquire(self):
+        inicio = time.perf_counter()
+        self.lock.acquire()
+        # Só quem tem o lock escreve aqui, então não precisa de mais proteção
+        self.adquirido_em = time.perf_counter()
+        self.metricas.observar("lock_espera_segundos", self.adquirido_em - inicio)
+
+    def release(self):
+        posse = time.perf_counter() - self.adquirido_em
+        self.lock.release()
+        self.metricas.observar("lock_posse_segundos", posse)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *excecao):
+        self.release()
@@ -0,0 +1,355 @@
+# movimentos.py
+# Livro de movimentos do estoque: cada reserva, cancelamento, devolução
+# (SAIR, queda do cliente, reservas expiradas) e ajuste do admin fica
+# registado, só acrescentando, para se poder ver a procura de cada produto
+# ao longo do tempo e quando é que esgotou.
+#
+# Os movimentos ficam em colunas (arrays: instante, ID do produto, delta,
+# saldo depois do movimento, tipo) em vez de um objeto por movimento. Com
+# uma pasta, cada EVENTOS_POR_SEGMENTO movimentos (ou INTERVALO_SEGMENTO
+# segundos) as colunas são gravadas num arquivo de segmento; sem pasta,
+# são descartadas. Quem regista um movimento nunca grava: as colunas cheias
+# ficam numa fila e a thread do livro (iniciar) grava-as e faz fsync.
+# Os segmentos gravados não ficam abertos (só os resumos servem as
+# consultas) e os que saem da retenção são apagados, sempre depois de os
+# mais novos estarem em disco.
+#
+# As consultas não percorrem os movimentos: a cada movimento somam-se os
+# totais do minuto (ResumoMinuto, também em colunas) e abre-se ou fecha-se
+# o intervalo de ruptura do produto. No arranque, os segmentos da pasta são
+# lidos uma vez, por mmap, para reconstruir esses resumos.
+import heapq
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from collections import deque
+
+RESERVA, CANCELAMENTO, DEVOLUCAO, AJUSTE = 0, 1, 2, 3
+TIPOS = ("reserva", "cancelamento", "devolucao", "ajuste")
+
+EVENTOS_POR_SEGMENTO = 65536
+INTERVALO_SEGMENTO = 60.0    # segundos; um segmento meio cheio também é gravado
+RETENCAO = 7 * 24 * 3600     # segundos de resumos guardados em memória
+
+# Formato do segmento: CABECALHO, JSON (eventos, instantes, produtos) e as
+# colunas seguidas, cada uma alinhada a 8 bytes
+COLUNAS = (("instantes", "d"), ("produtos", "i"), ("deltas", "q"), ("saldos", "q"), ("tipos", "b"))
+CABECALHO = struct.Struct("<4sI")  # assinatura, tamanho do JSON
+ASSINATURA = b"MOV1"
+
+
+def _alinhar(n):
+    return (n + 7) & ~7
+
+
+def _sincronizar_pasta(pasta):
+    """fsync da pasta, para o nome de um arquivo acabado de criar não se perder."""
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(pasta, os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _apagar(caminho):
+    try:
+        os.remove(caminho)
+    except FileNotFoundError:
+        pass
+
+
+class ResumoMinuto:
+    """Soma dos deltas de cada tipo num minuto, por produto (uma linha por
+    produto que mexeu nesse minuto)."""
+
+    __slots__ = ("linha", "ids", "somas")
+
+    def __init__(self):
+        self.linha = {}                                   # id -> linha
+        self.ids = array("i")
+        self.somas = tuple(array("q") for _ in TIPOS)     # uma coluna por tipo
+
+    def somar(self, id_produto, tipo, delta):
+        i = self.linha.get(id_produto)
+        if i is None:
+            i = self.linha[id_produto] = len(self.ids)
+            self.ids.append(id_produto)
+            for coluna in self.somas:
+                coluna.append(0)
+        self.somas[tipo][i] += delta
+
+
+class Segmento:
+    """Segmento já gravado, lido por mmap (as colunas não são copiadas)."""
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        with open(caminho, "rb") as f:
+            self.mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        assinatura, tamanho = CABECALHO.unpack_from(self.mapa)
+        if assinatura != ASSINATURA:
+            raise ValueError(f"{caminho} não é um segmento de movimentos")
+        self.info = json.loads(self.mapa[CABECALHO.size:CABECALHO.size + tamanho])
+        eventos = self.info["eventos"]
+        posicao = _alinhar(CABECALHO.size + tamanho)
+        self.colunas = {}
+        for nome, formato in COLUNAS:
+            fim = posicao + eventos * array(formato).itemsize
+            self.colunas[nome] = memoryview(self.mapa)[posicao:fim].cast(formato)
+            posicao = _alinhar(fim)
+
+    def fechar(self):
+        """Liberta o mmap (e o descritor); as colunas deixam de se poder ler."""
+        for coluna in self.colunas.values():
+            coluna.release()
+        self.colunas = {}
+        self.mapa.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.fechar()
+
+    @staticmethod
+    def gravar(caminho, colunas, nomes):
+        """Grava as colunas (dicionário nome -> array) num segmento novo.
+        'nomes' traduz os IDs, que não são os mesmos depois de um reinício.
+        Devolve o cabeçalho (eventos, inicio, fim, produtos)."""
+        instantes = colunas["instantes"]
+        info = {
+            "eventos": len(instantes), "inicio": instantes[0], "fim": instantes[-1],
+            "produtos": {str(i): nomes[i] for i in set(colunas["produtos"])},
+        }
+        dados = json.dumps(info).encode()
+        temporario = caminho + ".tmp"
+        with open(temporario, "wb") as f:
+            f.write(CABECALHO.pack(ASSINATURA, len(dados)) + dados)
+            f.write(bytes(_alinhar(f.tell()) - f.tell()))
+            for nome, _ in COLUNAS:
+                f.write(colunas[nome].tobytes())
+                f.write(bytes(_alinhar(f.tell()) - f.tell()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporario, caminho)  # Nunca fica um segmento meio escrito
+        _sincronizar_pasta(os.path.dirname(caminho) or ".")
+        return info
+
+
+class LivroMovimentos:
+    def __init__(self, tabela, retencao=RETENCAO):
+        self.tabela = tabela        # O estoque: traduz nomes <-> IDs
+        self.retencao = retencao
+        self.pasta = None
+        self.lock = threading.Lock()
+        self.colunas = self._colunas_vazias()
+        self.por_gravar = deque()   # (caminho, colunas) fechados e ainda não gravados
+        self.cheio = threading.Event()  # Acorda a thread do livro
+        self.lock_gravacao = threading.Lock()  # Um só a gravar, pela ordem dos segmentos
+        self.segmentos = deque()    # (caminho, cabeçalho) dos gravados, do mais antigo ao mais recente
+        self.proximo_segmento = 1
+        self.minutos = {}           # minuto (instante // 60) -> ResumoMinuto
+        self.ordem_minutos = deque()
+        self.em_ruptura = {}        # id -> instante em que o saldo chegou a zero
+        self.rupturas = {}          # id -> deque de (inicio, fim) das rupturas já acabadas
+
+    @staticmethod
+    def _colunas_vazias():
+        return {nome: array(formato) for nome, formato in COLUNAS}
+
+    # --- Escrita ---
+
+    def registrar(self, produto, tipo, delta, saldo, instante=None):
+        """Acrescenta um movimento de 'delta' no estoque disponível de
+        'produto', que ficou com 'saldo'."""
+        instante = time.time() if instante is None else instante
+        id_produto = self.tabela.id_do_produto(produto, criar=True)
+        with self.lock:
+            colunas = self.colunas
+            colunas["instantes"].append(instante)
+            colunas["produtos"].append(id_produto)
+            colunas["deltas"].append(delta)
+            colunas["saldos"].append(saldo)
+            colunas["tipos"].append(tipo)
+            self._resumir(instante, id_produto, tipo, delta, saldo)
+            if len(colunas["instantes"]) >= EVENTOS_POR_SEGMENTO:
+                # Quem chama pode ter locks do estoque: a thread do livro é que grava
+                self._fechar_segmento()
+                self.cheio.set()
+
+    def _resumir(self, instante, id_produto, tipo, delta, saldo):
+        minuto = int(instante // 60)
+        resumo = self.minutos.get(minuto)
+        if resumo is None:
+            resumo = self.minutos[minuto] = ResumoMinuto()
+            self.ordem_minutos.append(minuto)
+            limite = minuto - self.retencao // 60
+            while self.ordem_minutos and self.ordem_minutos[0] < limite:
+                self.minutos.pop(self.ordem_minutos.popleft(), None)
+        resumo.somar(id_produto, tipo, delta)
+
+        inicio = self.em_ruptura.get(id_produto)
+        if saldo <= 0 and inicio is None:
+            self.em_ruptura[id_produto] = instante
+        elif saldo > 0 and inicio is not None:
+            del self.em_ruptura[id_produto]
+            acabadas = self.rupturas.setdefault(id_produto, deque())
+            acabadas.append((inicio, instante))
+            while acabadas[0][1] < instante - self.retencao:
+                acabadas.popleft()
+
+    def _fechar_segmento(self):
+        """Com self.lock: põe as colunas atuais na fila de gravação (ou
+        descarta-as, sem pasta) e começa outras."""
+        colunas = self.colunas
+        if not colunas["instantes"]:
+            return
+        self.colunas = self._colunas_vazias()
+        if self.pasta is None:
+            return
+        caminho = os.path.join(self.pasta, f"movimentos-{self.proximo_segmento:08d}.seg")
+        self.proximo_segmento += 1
+        self.por_gravar.append((caminho, colunas))
+
+    def gravar_pendentes(self):
+        """Grava os segmentos da fila e depois apaga os que saíram da retenção."""
+        with self.lock_gravacao:
+            while True:
+                with self.lock:
+                    if not self.por_gravar:
+                        break
+                    caminho, colunas = self.por_gravar[0]
+                # Gravado fora do lock: os outros movimentos já vão para as colunas novas
+                info = Segmento.gravar(caminho, colunas, self.tabela.nomes)
+                with self.lock:
+                    self.por_gravar.popleft()
+                    self.segmentos.append((caminho, info))
+            limite = time.time() - self.retencao
+            antigos = []
+            with self.lock:
+                while self.segmentos and self.segmentos[0][1]["fim"] < limite:
+                    antigos.append(self.segmentos.popleft()[0])
+            for caminho in antigos:
+                _apagar(caminho)
+
+    def rodar(self):
+        """Fecha o segmento atual e grava-o já, com os que estavam na fila
+        (ex.: ao desligar o servidor)."""
+        with self.lock:
+            self._fechar_segmento()
+        self.gravar_pendentes()
+
+    # --- Pasta e arranque ---
+
+    def abrir(self, pasta):
+        """Passa a gravar os segmentos em 'pasta' e reconstrói os resumos a
+        partir dos que lá estão; os que já saíram da retenção são apagados."""
+        os.makedirs(pasta, exist_ok=True)
+        nomes = sorted(n for n in os.listdir(pasta) if n.startswith("movimentos-") and n.endswith(".seg"))
+        limite = time.time() - self.retencao
+        with self.lock:
+            self.pasta = pasta
+            for nome in nomes:
+                self.proximo_segmento = int(nome[len("movimentos-"):-len(".seg")]) + 1
+                caminho = os.path.join(pasta, nome)
+                with Segmento(caminho) as segmento:
+                    if segmento.info["fim"] < limite:
+                        _apagar(caminho)
+                        continue
+                    self.segmentos.append((caminho, segmento.info))
+                    ids = {int(i): self.tabela.id_do_produto(p, criar=True) for i, p in segmento.info["produtos"].items()}
+                    c = segmento.colunas
+                    for instante, id_antigo, delta, saldo, tipo in zip(
+                            c["instantes"], c["produtos"], c["deltas"], c["saldos"], c["tipos"]):
+                        self._resumir(instante, ids[id_antigo], tipo, delta, saldo)
+        return sum(info["eventos"] for _, info in self.segmentos)
+
+    def iniciar(self):
+        """Thread que grava os segmentos cheios assim que fecham, e o
+        segmento atual a cada INTERVALO_SEGMENTO."""
+        def loop():
+            while True:
+                if self.cheio.wait(INTERVALO_SEGMENTO):
+                    self.cheio.clear()
+                    self.gravar_pendentes()
+                else:
+                    self.rodar()
+        threading.Thread(target=loop, daemon=True).start()
+
+    # --- Consultas (só sobre os resumos) ---
+
+    def _resumos(self, inicio, fim):
+        primeiro, ultimo = int(inicio // 60), int(fim // 60)
+        if ultimo - primeiro + 1 <= len(self.minutos):
+            return [r for m in range(primeiro, ultimo + 1) if (r := self.minutos.get(m)) is not None]
+        return [r for m, r in self.minutos.items() if primeiro <= m <= ultimo]
+
+    def mais_reservados(self, inicio, fim, n=10):
+        """Os 'n' produtos mais reservados entre 'inicio' e 'fim' (ao minuto):
+        [(produto, reservado, cancelado, devolvido)]."""
+        totais = {}
+        with self.lock:
+            for resumo in self._resumos(inicio, fim):
+                reservas, cancelamentos, devolucoes, _ = resumo.somas
+                for i, id_produto in enumerate(resumo.ids):
+                    t = totais.get(id_produto)
+                    if t is None:
+                        t = totais[id_produto] = [0, 0, 0]
+                    t[0] -= reservas[i]
+                    t[1] += cancelamentos[i]
+                    t[2] += devolucoes[i]
+        nomes = self.tabela.nomes
+        melhores = heapq.nlargest(n, ((t[0], id_produto) for id_produto, t in totais.items() if t[0] > 0))
+        return [(nomes[id_produto], *totais[id_produto]) for _, id_produto in melhores]
+
+    def demanda(self, produto, inicio, fim, passo=3600):
+        """Totais de 'produto' em janelas de 'passo' segundos (múltiplo de 60):
+        [(inicio da janela, reservado, cancelado, devolvido, ajustado)]."""
+        id_produto = self.tabela.id_do_produto(produto)
+        janelas = {}
+        if id_produto is not None:
+            primeiro, ultimo = int(inicio // 60), int(fim // 60)
+            with self.lock:
+                for minuto, resumo in self.minutos.items():
+                    i = resumo.linha.get(id_produto)
+                    if i is None or not primeiro <= minuto <= ultimo:
+                        continue
+                    janela = minuto * 60 // passo * passo
+                    t = janelas.setdefault(janela, [0, 0, 0, 0])
+                    for tipo, coluna in enumerate(resumo.somas):
+                        t[tipo] += coluna[i]
+        return [(janela, -t[RESERVA], t[CANCELAMENTO], t[DEVOLUCAO], t[AJUSTE]) for janela, t in sorted(janelas.items())]
+
+    def rupturas_entre(self, inicio, fim, produto=None):
+        """Intervalos em que o disponível esteve a zero e que tocam
+        [inicio, fim]: [(produto, inicio, fim ou None se ainda dura)]."""
+        if produto is not None:
+            ids = [self.tabela.id_do_produto(produto)]
+        resultado = []
+        with self.lock:
+            if produto is None:
+                ids = set(self.rupturas) | set(self.em_ruptura)
+            for id_produto in ids:
+                for comeco, acabou in self.rupturas.get(id_produto, ()):
+                    if comeco <= fim and acabou >= inicio:
+                        resultado.append((id_produto, comeco, acabou))
+                comeco = self.em_ruptura.get(id_produto)
+                if comeco is not None and comeco <= fim:
+                    resultado.append((id_produto, comeco, None))
+        nomes = self.tabela.nomes
+        return sorted(((nomes[i], comeco, acabou) for i, comeco, acabou in resultado), key=lambda r: r[1])
+
+    def estado(self):
+        with self.lock:
+            return {
+                "em_memoria": len(self.colunas["instantes"]) + sum(len(c["instantes"]) for _, c in self.por_gravar),
+                "segmentos": len(self.segmentos),
+                "eventos_em_segmentos": sum(info["eventos"] for _, info in self.segmentos),
+                "minutos": len(self.minutos),
+                "em_ruptura": len(self.em_ruptura),
+            }
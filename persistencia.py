@@ -0,0 +1,185 @@
+# persistencia.py
+# Persistência do estoque e das reservas: diário (write-ahead log) com
+# group commit + snapshot compacto.
+#
+# Cada alteração é registada com valores ABSOLUTOS ("banana agora tem 7",
+# "o cliente 12 agora tem 3 banana no carrinho"), por isso reaplicar o
+# diário na ordem em que foi escrito reconstrói o estado final, e aplicar
+# um registo duas vezes não faz mal.
+#
+# Formato de cada linha do diário:  [seq, [registo, registo, ...]]
+#   ["E", produto, qtd_disponivel]
+#   ["C", id_cliente, produto, qtd_no_carrinho]
+#
+# Group commit: quem altera o estoque só põe a linha num buffer; uma
+# thread gravadora escreve tudo o que se acumulou de uma vez e faz UM
+# fsync para o grupo inteiro. Quem precisa de durabilidade espera com
+# aguardar(seq) antes de responder ao cliente.
+import json
+import os
+import threading
+
+ARQUIVO_DIARIO = "estoque.wal"
+ARQUIVO_DIARIO_ANTIGO = "estoque.wal.old"
+ARQUIVO_SNAPSHOT = "estoque.snap"
+
+
+def aplicar_registro(estoque, carrinhos, registro):
+    if registro[0] == "E":
+        _, produto, qtd = registro
+        estoque[produto] = qtd
+    elif registro[0] == "C":
+        _, id_cliente, produto, qtd = registro
+        carrinho = carrinhos.setdefault(id_cliente, {})
+        if qtd > 0:
+            carrinho[produto] = qtd
+        else:
+            carrinho.pop(produto, None)
+            if not carrinho:
+                del carrinhos[id_cliente]
+
+
+class Diario:
+    def __init__(self, pasta, fsync=True):
+        self.pasta = pasta
+        self.fsync = fsync
+        os.makedirs(pasta, exist_ok=True)
+        self.caminho_diario = os.path.join(pasta, ARQUIVO_DIARIO)
+        self.caminho_antigo = os.path.join(pasta, ARQUIVO_DIARIO_ANTIGO)
+        self.caminho_snapshot = os.path.join(pasta, ARQUIVO_SNAPSHOT)
+
+        self.cond = threading.Condition()
+        self.lock_arquivo = threading.Lock()  # Gravação vs. rotação do arquivo
+        self.pendentes = []
+        self.seq = 0           # Último número de sequência atribuído
+        self.seq_duravel = 0   # Último número já gravado em disco (fsync)
+        self.registros_desde_checkpoint = 0
+        self.arquivo = None
+
+    # --- Recuperação ---
+
+    def recuperar(self):
+        """Lê o snapshot e reaplica só a cauda do diário.
+        Devolve (estoque, carrinhos) onde carrinhos = {id_cliente: {produto: qtd}}."""
+        seq_snapshot, estoque, carrinhos = 0, {}, {}
+        if os.path.exists(self.caminho_snapshot):
+            with open(self.caminho_snapshot) as f:
+                dados = json.load(f)
+            seq_snapshot = dados["seq"]
+            estoque = dados["estoque"]
+            carrinhos = {int(c): itens for c, itens in dados["carrinhos"].items()}
+
+        self.seq = seq_snapshot
+        for caminho in (self.caminho_antigo, self.caminho_diario):
+            if not os.path.exists(caminho):
+                continue
+            valido = 0  # Bytes até ao fim da última linha inteira
+            with open(caminho, "rb") as f:
+                for linha in f:
+                    try:
+                        if not linha.endswith(b"\n"):
+                            raise ValueError("linha sem fim")
+                        seq, registros = json.loads(linha)
+                    except ValueError:
+                        break  # Última linha cortada por uma queda: ignora
+                    valido += len(linha)
+                    if seq <= seq_snapshot:
+                        continue
+                    for registro in registros:
+                        aplicar_registro(estoque, carrinhos, registro)
+                    self.seq = seq
+                    self.registros_desde_checkpoint += 1
+            if caminho == self.caminho_diario and valido < os.path.getsize(caminho):
+                # Corta a linha incompleta: senão a próxima seria escrita
+                # colada a ela e perdia-se na recuperação seguinte
+                with open(caminho, "r+b") as f:
+                    f.truncate(valido)
+                    if self.fsync:
+                        os.fsync(f.fileno())
+
+        self.seq_duravel = self.seq
+        if os.path.exists(self.caminho_antigo):
+            # Um checkpoint foi interrompido: termina-o agora com o estado recuperado
+            self.gravar_snapshot(self.seq, estoque, carrinhos)
+            self.registros_desde_checkpoint = 0
+        self.arquivo = open(self.caminho_diario, "ab")
+        threading.Thread(target=self._gravador_loop, daemon=True).start()
+        return estoque, carrinhos
+
+    # --- Escrita ---
+
+    def registrar(self, registros):
+        """Acrescenta uma alteração ao diário e devolve o seu número de sequência."""
+        with self.cond:
+            self.seq += 1
+            self.pendentes.append(json.dumps([self.seq, registros], separators=(",", ":")).encode() + b"\n")
+            self.registros_desde_checkpoint += 1
+            self.cond.notify_all()
+            return self.seq
+
+    def aguardar(self, seq=None):
+        """Bloqueia até a alteração 'seq' (padrão: a última) estar em disco."""
+        with self.cond:
+            if seq is None:
+                seq = self.seq
+            while self.seq_duravel < seq:
+                self.cond.wait()
+
+    def _gravar_pendentes(self):
+        """Grava o grupo pendente. Chamar com lock_arquivo adquirido."""
+        with self.cond:
+            lote, self.pendentes = self.pendentes, []
+            seq = self.seq
+        if lote:
+            self.arquivo.write(b"".join(lote))
+            self.arquivo.flush()
+            if self.fsync:
+                os.fsync(self.arquivo.fileno())
+        with self.cond:
+            self.seq_duravel = max(self.seq_duravel, seq)
+            self.cond.notify_all()
+
+    def _gravador_loop(self):
+        while True:
+            with self.cond:
+                while not self.pendentes:
+                    self.cond.wait()
+            # Enquanto este grupo vai para o disco, o próximo vai-se acumulando
+            with self.lock_arquivo:
+                self._gravar_pendentes()
+
+    # --- Checkpoint ---
+
+    def rotacionar(self):
+        """Primeira metade do checkpoint: fecha o diário atual (que passa a ser
+        o 'antigo') e abre um novo. Devolve o seq em que o snapshot deve ser
+        tirado. O chamador tem de garantir que ninguém registra nada durante
+        esta chamada e enquanto copia o estado."""
+        with self.lock_arquivo:
+            self._gravar_pendentes()
+            if os.path.exists(self.caminho_antigo):
+                return None  # Checkpoint anterior não terminou; tenta depois
+            self.arquivo.close()
+            os.replace(self.caminho_diario, self.caminho_antigo)
+            self.arquivo = open(self.caminho_diario, "ab")
+            with self.cond:
+                self.registros_desde_checkpoint = 0
+                return self.seq
+
+    def gravar_snapshot(self, seq, estoque, carrinhos):
+        """Segunda metade do checkpoint (fora dos locks do servidor)."""
+        temporario = self.caminho_snapshot + ".tmp"
+        with open(temporario, "w") as f:
+            json.dump({"seq": seq, "estoque": estoque, "carrinhos": carrinhos}, f, separators=(",", ":"))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(temporario, self.caminho_snapshot)
+        if self.fsync and hasattr(os, "O_DIRECTORY"):
+            fd = os.open(self.pasta, os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        # O snapshot já cobre tudo o que estava no diário antigo
+        os.remove(self.caminho_antigo)
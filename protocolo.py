@@ -0,0 +1,403 @@
+# protocolo.py
+# Enquadramento (framing) das mensagens do protocolo do Mercadinho.
+#
+# Cada mensagem é um objeto JSON numa única linha terminada por '\n'
+# (JSON delimitado por nova linha). O json.dumps nunca gera '\n' cru
+# dentro da mensagem, então o separador é inequívoco. Assim o TCP pode
+# juntar ou partir os segmentos à vontade, e o cliente pode enviar
+# vários comandos de uma vez (pipelining) e ler as respostas em ordem.
+import json
+import random
+import secrets
+import socket
+import struct
+from collections import deque
+
+SEPARADOR = b"\n"
+TAMANHO_MAXIMO = 64 * 1024 * 1024  # 64 MiB por mensagem
+TAMANHO_RECV = 65536
+
+
+class MensagemMuitoGrande(Exception):
+    pass
+
+
+def codificar(mensagem):
+    """Converte um dicionário numa mensagem pronta para o socket (bytes)."""
+    return json.dumps(mensagem).encode() + SEPARADOR
+
+
+class LeitorMensagens:
+    """Leitor com buffer que separa o fluxo TCP em mensagens completas."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.bytes_recebidos = 0
+        self.com_prazos = False
+
+    def definir_prazos(self, ocioso, leitura):
+        """Segundos à espera do início da próxima mensagem (buffer vazio) e
+        para acabar de receber uma mensagem já começada. Esgotado o prazo,
+        a leitura levanta TimeoutError."""
+        self.tempo_ocioso = ocioso
+        self.tempo_leitura = leitura
+        self.com_prazos = True
+
+    def _receber(self):
+        if self.com_prazos:
+            self.sock.settimeout(self.tempo_leitura if self.buffer else self.tempo_ocioso)
+        dados = self.sock.recv(TAMANHO_RECV)
+        if not dados:
+            return False
+        self.bytes_recebidos += len(dados)
+        self.buffer += dados
+        return True
+
+    def _verificar_tamanho_linha(self):
+        if len(self.buffer) > TAMANHO_MAXIMO:
+            raise MensagemMuitoGrande("Mensagem excede o tamanho máximo permitido.")
+
+    def ler_linha(self):
+        """Devolve a próxima mensagem (bytes, sem o '\\n') ou None se a ligação fechou."""
+        while True:
+            fim = self.buffer.find(SEPARADOR)
+            if fim >= 0:
+                linha = bytes(self.buffer[:fim])
+                del self.buffer[:fim + 1]
+                return linha
+            self._verificar_tamanho_linha()
+            if not self._receber():
+                return None
+
+    def ler_linhas(self):
+        """Devolve TODAS as mensagens completas já disponíveis (pelo menos uma),
+        ou None se a ligação fechou. Usado pelo servidor para atender pedidos em pipeline."""
+        while SEPARADOR not in self.buffer:
+            self._verificar_tamanho_linha()
+            if not self._receber():
+                return None
+        *linhas, resto = bytes(self.buffer).split(SEPARADOR)
+        self.buffer = bytearray(resto)
+        return linhas
+
+    def ler(self):
+        """Devolve a próxima mensagem já decodificada (dict) ou None se a ligação fechou."""
+        linha = self.ler_linha()
+        if linha is None:
+            return None
+        return json.loads(linha)
+
+    def ler_quadro(self):
+        """Devolve o próximo quadro binário (tipo, corpo) ou None se a ligação fechou."""
+        while True:
+            resultado = ler_quadro_de(self.buffer)
+            if resultado is not None:
+                return resultado
+            if len(self.buffer) >= CABECALHO.size and CABECALHO.unpack_from(self.buffer)[0] > TAMANHO_MAXIMO:
+                raise MensagemMuitoGrande("Mensagem excede o tamanho máximo permitido.")
+            if not self._receber():
+                return None
+
+    def ler_quadros(self):
+        """Como ler_linhas, mas para quadros binários."""
+        primeiro = self.ler_quadro()
+        if primeiro is None:
+            return None
+        quadros = [primeiro]
+        while True:
+            seguinte = ler_quadro_de(self.buffer)
+            if seguinte is None:
+                return quadros
+            quadros.append(seguinte)
+
+
+# --- (CODIFICAÇÃO BINÁRIA) ---
+# Alternativa ao JSON, negociada no início da ligação: o cliente envia
+#   {"tipo": "HELLO", "payload": {"codificacao": "binaria"}}
+# e, depois do HELLO_OK, os dois lados passam a trocar quadros binários:
+#   tamanho do corpo (u32) + tipo (u8) + corpo
+# Os produtos viajam como IDs numéricos (o servidor envia o nome de cada
+# ID uma única vez por ligação) e os resultados como códigos numéricos;
+# o texto da mensagem é montado do lado do cliente. Qualquer comando sem
+# forma binária própria vai como JSON dentro de um quadro B_JSON.
+# O JSON continua a ser o padrão (é o que se lê no Wireshark).
+CABECALHO = struct.Struct("!IB")
+_ID_QTD = struct.Struct("!Iq")
+_ID_NOME = struct.Struct("!IH")
+_ESTOQUE = struct.Struct("!qBII")  # versao, completo, n_nomes, n_itens
+PEDIDO_ITEM = struct.Struct("!II")  # id, quantidade (+ id_pedido, opcional, até ao fim do corpo)
+RESULTADO = struct.Struct("!Bq")  # código, valor
+INTEIRO = struct.Struct("!q")
+
+# Pedidos
+B_GET_ESTOQUE = 1
+B_GET_MINHAS_RESERVAS = 2
+B_RESERVAR = 3
+B_CANCELAR_RESERVA = 4
+B_SET_ESTOQUE = 5
+B_SAIR = 6
+# Respostas
+B_ESTOQUE = 0x81
+B_RESERVAS = 0x82
+B_RESULTADO = 0x83
+B_BYE = 0x86
+# Qualquer outra mensagem, em JSON
+B_JSON = 0x7F
+
+# Códigos de resultado (RESERVAR / CANCELAR_RESERVA / SET_ESTOQUE)
+OK = 0
+PEDIDO_INVALIDO = 1
+PRODUTO_INEXISTENTE = 2
+ESTOQUE_INSUFICIENTE = 3
+RESERVA_INSUFICIENTE = 4
+
+_TIPOS_RESPOSTA = {"RESERVAR": "RESPOSTA_RESERVA", "CANCELAR_RESERVA": "RESPOSTA_CANCELAMENTO", "SET_ESTOQUE": "RESPOSTA_ADMIN"}
+
+
+def mensagem_resultado(comando, codigo, produto, quantidade, valor):
+    """Texto legível de um código de resultado ('valor' depende do código)."""
+    if comando == "RESERVAR":
+        if codigo == OK:
+            return f"Reserva de {quantidade} '{produto}' efetuada com sucesso!"
+        if codigo == PRODUTO_INEXISTENTE:
+            return f"Produto '{produto}' não existe."
+        if codigo == ESTOQUE_INSUFICIENTE:
+            return f"Estoque insuficiente. Temos apenas {valor} '{produto}'."
+        return "Pedido inválido."
+    if comando == "CANCELAR_RESERVA":
+        if codigo == OK:
+            return f"Cancelamento de {quantidade} '{produto}' efetuado. Estoque agora: {valor}"
+        if codigo == RESERVA_INSUFICIENTE:
+            return f"Cancelamento falhou. Você só tem {valor} '{produto}' reservados."
+        return "Pedido de cancelamento inválido."
+    if comando == "SET_ESTOQUE":
+        if codigo == OK:
+            return f"Estoque disponível de '{produto}' definido para {valor}."
+        if codigo == RESERVA_INSUFICIENTE:
+            return f"Já há {valor} '{produto}' reservados; o total não pode ser menor."
+        return "Pedido admin inválido."
+    return ""
+
+
+def resposta_resultado(comando, codigo, produto, quantidade, valor):
+    """Monta a resposta JSON equivalente a um código de resultado."""
+    status = "SUCESSO" if codigo == OK else "ERRO"
+    mensagem = mensagem_resultado(comando, codigo, produto, quantidade, valor)
+    return {"tipo": _TIPOS_RESPOSTA[comando], "payload": {"status": status, "mensagem": mensagem}}
+
+
+def quadro(tipo, corpo=b""):
+    return CABECALHO.pack(len(corpo), tipo) + corpo
+
+
+def quadro_json(mensagem):
+    return quadro(B_JSON, json.dumps(mensagem).encode())
+
+
+def codificar_itens(itens):
+    """Só a parte [(id, qtd)] de uma tabela, para reaproveitar em várias respostas."""
+    return b"".join([_ID_QTD.pack(id_produto, qtd) for id_produto, qtd in itens])
+
+
+def codificar_tabela(itens, nomes_novos, versao=None, completo=True):
+    """Corpo de B_ESTOQUE (com versao) ou B_RESERVAS (sem versao).
+    'itens' = [(id, qtd)] ou o resultado de codificar_itens,
+    'nomes_novos' = [(id, nome)] ainda não enviados."""
+    n_itens = len(itens) // _ID_QTD.size if isinstance(itens, bytes) else len(itens)
+    partes = []
+    if versao is not None:
+        partes.append(_ESTOQUE.pack(versao, completo, len(nomes_novos), n_itens))
+    else:
+        partes.append(struct.pack("!II", len(nomes_novos), n_itens))
+    for id_produto, nome in nomes_novos:
+        nome_bytes = nome.encode()
+        partes.append(_ID_NOME.pack(id_produto, len(nome_bytes)) + nome_bytes)
+    if isinstance(itens, bytes):
+        partes.append(itens)
+    else:
+        partes.extend(_ID_QTD.pack(id_produto, qtd) for id_produto, qtd in itens)
+    return b"".join(partes)
+
+
+def ler_quadro_de(buffer):
+    """Tira um quadro completo do início do bytearray (ou devolve None)."""
+    if len(buffer) < CABECALHO.size:
+        return None
+    tamanho, tipo = CABECALHO.unpack_from(buffer)
+    fim = CABECALHO.size + tamanho
+    if len(buffer) < fim:
+        return None
+    corpo = bytes(buffer[CABECALHO.size:fim])
+    del buffer[:fim]
+    return tipo, corpo
+
+
+def _ler_tabela(corpo, com_versao):
+    """Inverso de codificar_tabela. Devolve (versao, completo, nomes, itens)."""
+    if com_versao:
+        versao, completo, n_nomes, n_itens = _ESTOQUE.unpack_from(corpo)
+        pos = _ESTOQUE.size
+    else:
+        versao, completo = None, True
+        n_nomes, n_itens = struct.unpack_from("!II", corpo)
+        pos = 8
+    nomes = {}
+    for _ in range(n_nomes):
+        id_produto, tamanho = _ID_NOME.unpack_from(corpo, pos)
+        pos += _ID_NOME.size
+        nomes[id_produto] = corpo[pos:pos + tamanho].decode()
+        pos += tamanho
+    itens = [_ID_QTD.unpack_from(corpo, pos + i * _ID_QTD.size) for i in range(n_itens)]
+    return versao, bool(completo), nomes, itens
+
+
+# Mensagens que o servidor envia sem pedido (só a quem fez SUBSCRIBE)
+MENSAGENS_NAO_SOLICITADAS = ("EVENTO_ESTOQUE", "RESERVAS_EXPIRADAS")
+# Partes de uma resposta que chega em várias mensagens (só a última,
+# ex. EXPORT_FIM, termina o pedido)
+MENSAGENS_PARCIAIS = ("EXPORT_PARTE",)
+
+
+class CodecBinario:
+    """Lado do cliente da codificação binária. Converte os mesmos dicionários
+    usados no modo JSON de/para quadros, para que o resto do cliente não mude."""
+
+    def __init__(self):
+        self.nomes = {}  # id -> nome do produto
+        self.ids = {}    # nome -> id
+        # Comandos à espera de resposta (as respostas chegam pela mesma ordem)
+        self.pendentes = deque()
+
+    def codificar(self, comando):
+        tipo = comando.get("tipo")
+        payload = comando.get("payload", {})
+        dados = None
+        if tipo == "GET_ESTOQUE":
+            versao = payload.get("desde_versao")
+            dados = quadro(B_GET_ESTOQUE, INTEIRO.pack(versao) if isinstance(versao, int) else b"")
+        elif tipo == "GET_MINHAS_RESERVAS":
+            dados = quadro(B_GET_MINHAS_RESERVAS)
+        elif tipo in ("RESERVAR", "CANCELAR_RESERVA"):
+            id_produto = self.ids.get(str(payload.get("produto", "")).lower())
+            quantidade = payload.get("quantidade")
+            id_pedido = comando.get("id_pedido", "")
+            # Produto que ainda não conhecemos ou quantidade estranha: vai em JSON
+            if id_produto is not None and isinstance(quantidade, int) and 0 <= quantidade < 2**32 and isinstance(id_pedido, str):
+                codigo = B_RESERVAR if tipo == "RESERVAR" else B_CANCELAR_RESERVA
+                dados = quadro(codigo, PEDIDO_ITEM.pack(id_produto, quantidade) + id_pedido.encode())
+        elif tipo == "SET_ESTOQUE":
+            quantidade = payload.get("quantidade")
+            # A opção "total" e o id_pedido não têm forma binária: vão em JSON
+            if isinstance(quantidade, int) and payload.get("produto") and not payload.get("total") and "id_pedido" not in comando:
+                dados = quadro(B_SET_ESTOQUE, INTEIRO.pack(quantidade) + str(payload["produto"]).encode())
+        elif tipo == "SAIR":
+            dados = quadro(B_SAIR)
+        if dados is None:
+            dados = quadro_json(comando)
+        self.pendentes.append(comando)
+        return dados
+
+    def _aprender(self, nomes):
+        for id_produto, nome in nomes.items():
+            self.nomes[id_produto] = nome
+            self.ids[nome] = id_produto
+
+    def decodificar(self, tipo, corpo):
+        if tipo == B_JSON:
+            mensagem = json.loads(corpo)
+            if mensagem.get("tipo") not in MENSAGENS_NAO_SOLICITADAS + MENSAGENS_PARCIAIS:
+                self.pendentes.popleft()
+            return mensagem
+
+        comando = self.pendentes.popleft()
+        if tipo in (B_ESTOQUE, B_RESERVAS):
+            versao, completo, nomes, itens = _ler_tabela(corpo, tipo == B_ESTOQUE)
+            self._aprender(nomes)
+            tabela = {self.nomes[id_produto]: qtd for id_produto, qtd in itens}
+            if tipo == B_RESERVAS:
+                return {"tipo": "MINHAS_RESERVAS", "payload": tabela}
+            return {"tipo": "ESTOQUE_ATUAL" if completo else "ESTOQUE_DELTA", "versao": versao, "payload": tabela}
+        if tipo == B_RESULTADO:
+            codigo, valor = RESULTADO.unpack(corpo)
+            payload = comando.get("payload", {})
+            produto = str(payload.get("produto", "")).lower()
+            return resposta_resultado(comando["tipo"], codigo, produto, payload.get("quantidade"), valor)
+        if tipo == B_BYE:
+            return {"tipo": "BYE"}
+        return {"tipo": "RESPOSTA_ERRO", "payload": {"mensagem": f"Quadro binário desconhecido: {tipo}."}}
+
+
+def negociar_binario(sock, leitor):
+    """Pede ao servidor para mudar para a codificação binária.
+    Devolve um CodecBinario, ou None se o servidor preferir ficar no JSON."""
+    sock.sendall(codificar({"tipo": "HELLO", "payload": {"codificacao": "binaria"}}))
+    resposta = leitor.ler()
+    if resposta and resposta.get("tipo") == "HELLO_OK" and resposta.get("payload", {}).get("codificacao") == "binaria":
+        return CodecBinario()
+    return None
+
+
+# --- (VÁRIOS SERVIDORES) ---
+# Com réplicas (ou um cluster), o cliente recebe uma lista de endereços
+# "host[:porta]" separados por vírgulas.
+PORTA_PADRAO = 5050
+# Leituras que podem ir para uma réplica (as restantes vão para o primário)
+LEITURAS_REPLICA = ("GET_ESTOQUE", "BUSCAR_ESTOQUE", "EXPORT_ESTOQUE")
+
+
+def ler_endereco(texto, porta_padrao=PORTA_PADRAO):
+    """'host:porta' (ou só 'host') -> (host, porta)."""
+    host, separador, porta = texto.strip().rpartition(":")
+    if not separador:
+        return porta, porta_padrao
+    return host, int(porta)
+
+
+def ler_enderecos(texto, porta_padrao=PORTA_PADRAO):
+    return [ler_endereco(parte, porta_padrao) for parte in texto.split(",") if parte.strip()]
+
+
+# --- (PEDIDOS REPETIDOS) ---
+# As alterações aceitam um "id_pedido" (ao lado de "tipo" e "payload")
+# gerado pelo cliente. O servidor guarda a resposta na sessão e, se o mesmo
+# id_pedido voltar, devolve-a sem executar o comando outra vez: um cliente
+# que não recebeu a resposta a tempo pode repetir o pedido sem reservar
+# duas vezes.
+COMANDOS_COM_ID_PEDIDO = ("RESERVAR", "CANCELAR_RESERVA", "RESERVAR_LOTE", "CANCELAR_LOTE", "SET_ESTOQUE", "BULK_SET")
+TAMANHO_ID_PEDIDO = 64  # caracteres
+
+
+def com_id_pedido(comando):
+    """O comando com um id_pedido novo, se for uma alteração que o aceita e ainda não o tiver."""
+    if comando.get("tipo") not in COMANDOS_COM_ID_PEDIDO or "id_pedido" in comando:
+        return comando
+    return dict(comando, id_pedido=secrets.token_hex(8))
+
+
+def espera_repeticao(tentativa, base=0.1, maximo=2.0):
+    """Segundos a esperar antes da repetição número 'tentativa' (0, 1, ...):
+    ao acaso entre 0 e base * 2^tentativa, para que os clientes que
+    falharam ao mesmo tempo não repitam todos ao mesmo tempo."""
+    return random.uniform(0, min(maximo, base * 2 ** tentativa))
+
+
+def descobrir_papeis(enderecos, timeout=2.0):
+    """Pergunta GET_REPLICACAO a cada servidor. Devolve (endereço do
+    primário ou None, [endereços das réplicas]). Um servidor sem
+    replicação conta como primário; um que não responde fica de fora."""
+    primario, replicas = None, []
+    for endereco in enderecos:
+        try:
+            with socket.create_connection(endereco, timeout=timeout) as sock:
+                sock.sendall(codificar({"tipo": "GET_REPLICACAO"}) + codificar({"tipo": "SAIR"}))
+                resposta = LeitorMensagens(sock).ler()
+        except (OSError, ValueError):
+            continue
+        if resposta is None or resposta.get("tipo") == "SOBRECARGA":
+            continue
+        if resposta.get("payload", {}).get("papel") == "replica":
+            replicas.append(endereco)
+        elif primario is None:
+            primario = endereco
+    return primario, replicas
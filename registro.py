@@ -0,0 +1,81 @@
+# registro.py
+# Registo (log) do servidor, em vez de print().
+#
+# - Com níveis: as mensagens por pedido são DEBUG e ficam desligadas por
+#   omissão, sem sequer montar o texto (argumentos no estilo %s).
+# - Assíncrono: quem regista só põe a mensagem numa fila limitada; uma
+#   thread à parte é que escreve no terminal. Se a fila encher, a mensagem
+#   é descartada em vez de atrasar o pedido.
+# - Com limite de taxa: acima de N mensagens/s as restantes são descartadas
+#   (menos os erros) e a próxima mensagem diz quantas se perderam.
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+NOME = "mercadinho"
+log = logging.getLogger(NOME)
+
+
+class LimiteTaxa(logging.Filter):
+    """Balde de fichas: até 'por_segundo' mensagens/s, com rajadas até 'rajada'."""
+
+    def __init__(self, por_segundo, rajada=None, ao_suprimir=None):
+        super().__init__()
+        self.por_segundo = por_segundo
+        self.rajada = rajada or por_segundo
+        self.fichas = self.rajada
+        self.ultimo = time.monotonic()
+        self.suprimidas = 0
+        self.ao_suprimir = ao_suprimir
+        self.lock = threading.Lock()
+
+    def filter(self, registro):
+        with self.lock:
+            agora = time.monotonic()
+            self.fichas = min(self.rajada, self.fichas + (agora - self.ultimo) * self.por_segundo)
+            self.ultimo = agora
+            if self.fichas < 1 and registro.levelno < logging.ERROR:
+                self.suprimidas += 1
+                if self.ao_suprimir:
+                    self.ao_suprimir()
+                return False
+            self.fichas -= 1
+            suprimidas, self.suprimidas = self.suprimidas, 0
+        if suprimidas:
+            registro.msg = f"({suprimidas} mensagens suprimidas) {registro.getMessage()}"
+            registro.args = None
+        return True
+
+
+class _FilaSemBloqueio(logging.handlers.QueueHandler):
+    def __init__(self, fila, ao_descartar=None):
+        super().__init__(fila)
+        self.ao_descartar = ao_descartar
+
+    def enqueue(self, registro):
+        try:
+            self.queue.put_nowait(registro)
+        except queue.Full:
+            if self.ao_descartar:
+                self.ao_descartar()
+
+
+def configurar(nivel="INFO", por_segundo=200, tamanho_fila=10000, ao_descartar=None):
+    """Liga o registo assíncrono. 'ao_descartar' é chamado por cada mensagem perdida."""
+    fila = queue.Queue(tamanho_fila)
+    manipulador = _FilaSemBloqueio(fila, ao_descartar)
+    if por_segundo:
+        manipulador.addFilter(LimiteTaxa(por_segundo, ao_suprimir=ao_descartar))
+
+    saida = logging.StreamHandler(sys.stdout)
+    saida.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(message)s", "%H:%M:%S"))
+    escritor = logging.handlers.QueueListener(fila, saida)
+    escritor.start()
+
+    log.handlers[:] = [manipulador]
+    log.setLevel(nivel)
+    log.propagate = False
+    return escritor
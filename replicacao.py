@@ -0,0 +1,157 @@
+# replicacao.py
+# Replicação do estado do primário para réplicas (só de leitura).
+#
+# O primário numera cada alteração (os mesmos registos de valores
+# absolutos do diário, ver persistencia.py, mais ["S", id_cliente, token]
+# antes de cada registo de carrinho) e guarda as mais recentes num log em
+# memória. Uma réplica liga-se como um cliente, envia REPLICAR e recebe
+# primeiro uma fotografia do estado e depois as alterações, pela ordem.
+# Sem alterações, o primário envia um "pulso" (uma mensagem sem registos)
+# a cada INTERVALO_PULSO: cada mensagem diz até onde ia o primário ("ate"),
+# por isso a réplica sabe até quando esteve em dia e, daí, o seu atraso.
+#
+# Se a ligação cair, a réplica volta a ligar-se e pede só o que falta
+# (desde o último seq aplicado, na mesma "época" do log); se o primário
+# já não tiver essas alterações, recebe uma fotografia nova.
+import secrets
+import socket
+import threading
+import time
+from collections import deque
+
+from protocolo import LeitorMensagens, codificar, ler_endereco
+from registro import log
+
+TAMANHO_LOG_REPLICACAO = 100000
+INTERVALO_PULSO = 0.2      # segundos
+REGISTOS_POR_MENSAGEM = 1000
+ITENS_POR_PARTE = 10000    # produtos/carrinhos por mensagem da fotografia
+TEMPO_SEM_PRIMARIO = 2.0   # sem nenhuma mensagem durante isto, a réplica religa-se
+
+
+class LogReplicacao:
+    def __init__(self, tamanho=TAMANHO_LOG_REPLICACAO):
+        self.epoca = secrets.token_hex(8)  # Muda a cada arranque do primário
+        self.seq = 0
+        self.log = deque(maxlen=tamanho)   # (seq, registos)
+        self.cond = threading.Condition()
+
+    def registrar(self, registros):
+        with self.cond:
+            self.seq += 1
+            self.log.append((self.seq, registros))
+            self.cond.notify_all()
+            return self.seq
+
+    def cobre(self, seq):
+        """True se ainda há no log todas as alterações depois de 'seq'."""
+        with self.cond:
+            return seq == self.seq or (seq < self.seq and bool(self.log) and self.log[0][0] <= seq + 1)
+
+    def desde(self, seq, espera=INTERVALO_PULSO, maximo=REGISTOS_POR_MENSAGEM):
+        """Espera até 'espera' segundos por alterações depois de 'seq'.
+        Devolve ([(seq, registos)] (lista vazia = pulso), seq atual), ou
+        None se o log já não as tem."""
+        with self.cond:
+            if self.seq == seq:
+                self.cond.wait(espera)
+            if seq > self.seq or (seq < self.seq and (not self.log or self.log[0][0] > seq + 1)):
+                return None
+            novos = []
+            for entrada in reversed(self.log):
+                if entrada[0] <= seq:
+                    break
+                novos.append(entrada)
+            novos.reverse()
+            return novos[:maximo], self.seq
+
+
+class Seguidor:
+    """Lado da réplica: uma thread segue o primário e entrega o que recebe
+    a 'ao_fotografia(estoque, carrinhos, tokens)' e 'ao_registos(registos)'."""
+
+    def __init__(self, primario, ao_fotografia, ao_registos):
+        self.primario = primario  # "host:porta"
+        self.ao_fotografia = ao_fotografia
+        self.ao_registos = ao_registos
+        self.seq = 0
+        self.epoca = None
+        self.em_dia_em = None     # time.monotonic() da última vez que estava em dia
+        self.parado = False
+        self.sock = None
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+
+    def iniciar(self):
+        self.thread.start()
+
+    def atraso(self):
+        """Segundos desde a última vez que a réplica estava em dia (inf = nunca)."""
+        if self.em_dia_em is None:
+            return float("inf")
+        return time.monotonic() - self.em_dia_em
+
+    def seguir(self, primario):
+        """Passa a seguir outro primário (ex.: depois de uma promoção)."""
+        self.primario = primario
+        self.epoca = None  # Outro log: começa por uma fotografia
+        self._fechar()
+
+    def parar(self):
+        self.parado = True
+        self._fechar()
+        self.thread.join(timeout=5)
+
+    def _fechar(self):
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _loop(self):
+        espera = 0.1
+        while not self.parado:
+            try:
+                self._seguir()
+                espera = 0.1
+            except (OSError, ValueError) as e:
+                if self.parado:
+                    break
+                log.warning("[REPLICA] Sem ligação ao primário %s (%s); nova tentativa em %.1f s.", self.primario, e, espera)
+                time.sleep(espera)
+                espera = min(espera * 2, 2.0)
+
+    def _seguir(self):
+        primario = self.primario
+        self.sock = sock = socket.create_connection(ler_endereco(primario), timeout=TEMPO_SEM_PRIMARIO)
+        try:
+            leitor = LeitorMensagens(sock)
+            sock.sendall(codificar({"tipo": "REPLICAR", "payload": {"desde": self.seq, "epoca": self.epoca}}))
+            estoque, carrinhos = {}, {}
+            while not self.parado and self.primario == primario:
+                mensagem = leitor.ler()
+                if mensagem is None:
+                    raise ConnectionError("o primário fechou a ligação")
+                tipo, payload = mensagem.get("tipo"), mensagem.get("payload", {})
+                if tipo == "REPLICA_FOTO_PARTE":
+                    estoque.update(payload.get("estoque", {}))
+                    carrinhos.update((int(c), itens) for c, itens in payload.get("carrinhos", {}).items())
+                    continue
+                if tipo == "REPLICA_FOTO":
+                    tokens = {int(c): token for c, token in payload.get("tokens", {}).items()}
+                    self.ao_fotografia(estoque, carrinhos, tokens)
+                    estoque, carrinhos = {}, {}
+                    self.seq, self.epoca = payload["seq"], payload["epoca"]
+                    log.info("[REPLICA] Fotografia de %s recebida (seq %d).", primario, self.seq)
+                elif tipo == "REPLICA_REGISTOS":
+                    for seq, registros in payload.get("registos", []):
+                        self.ao_registos(registros)
+                        self.seq = seq
+                else:
+                    raise ValueError(f"resposta inesperada do primário: {tipo}")
+                if self.seq >= payload.get("ate", 0):
+                    self.em_dia_em = time.monotonic()
+        finally:
+            self.sock = None
+            sock.close()
@@ -2,201 +2,1561 @@
 import socket
 import threading
 import json
+import asyncio
+import argparse
+import os
+import secrets
+import select
+import signal
+import struct
+import sys
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from protocolo import LeitorMensagens, SEPARADOR, TAMANHO_MAXIMO, LEITURAS_REPLICA, codificar
+from protocolo import COMANDOS_COM_ID_PEDIDO, TAMANHO_ID_PEDIDO
+from protocolo import (
+    CABECALHO, INTEIRO, PEDIDO_ITEM, RESULTADO, quadro, quadro_json, codificar_itens, codificar_tabela, resposta_resultado,
+    B_GET_ESTOQUE, B_GET_MINHAS_RESERVAS, B_RESERVAR, B_CANCELAR_RESERVA, B_SET_ESTOQUE, B_SAIR,
+    B_ESTOQUE, B_RESERVAS, B_RESULTADO, B_BYE, B_JSON,
+    OK, PEDIDO_INVALIDO, PRODUTO_INEXISTENTE, ESTOQUE_INSUFICIENTE, RESERVA_INSUFICIENTE,
+)
+from persistencia import Diario, aplicar_registro
+from temporizadores import RodaTemporizadores
+from catalogo import IndiceCatalogo, LIMITE_PAGINA, LIMITE_PAGINA_MAXIMO
+from cluster import AnelConsistente, PoolConexoes
+from replicacao import LogReplicacao, Seguidor, ITENS_POR_PARTE
+from movimentos import LivroMovimentos, RESERVA, CANCELAMENTO, DEVOLUCAO, AJUSTE
+from metricas import Metricas, LockMedido
+import registro
+from registro import log
+from estoque_compacto import EstoqueCompacto, Carrinho
+from memoria_compartilhada import EstoqueCompartilhado, LogAlteracoesCompartilhado, TotaisCompartilhados, contexto as contexto_mp
 
 # --- (ESTRUTURA DE DADOS PRINCIPAL) ---
 # O estoque agora está dividido em dois:
-estoque_disponivel = {
+# (EstoqueCompacto: dicionário nome -> quantidade guardado num array indexado
+# pelo ID de cada produto; ver estoque_compacto.py)
+estoque_disponivel = EstoqueCompacto({
     "banana": 10,
     "uva": 20,
     "leite": 5,
     "pao": 15
+})
+# --- (SESSÕES) ---
+# O "carrinho" de cada cliente pertence a uma sessão, identificada por um
+# token, e não ao socket: um cliente que perdeu a ligação pode voltar a
+# ligar-se, enviar SESSAO com o seu token e recuperar o carrinho.
+# Com 100k+ clientes ligados, cada byte por sessão conta: __slots__ tira o
+# dicionário de atributos de cada Sessao e o carrinho guarda IDs de produtos.
+class Sessao:
+    __slots__ = ("token", "id_cliente", "carrinho", "conn", "prazo", "temporizador",
+                 "fichas", "fichas_em", "nos_remotos", "respostas")
+
+    def __init__(self, token, id_cliente):
+        self.token = token
+        self.id_cliente = id_cliente  # Identifica o carrinho no diário
+        self.carrinho = Carrinho(estoque_disponivel)  # produto -> quantidade reservada
+        self.conn = None              # Conexão atual (None = cliente desligado)
+        self.prazo = None             # Instante (time.monotonic) em que as reservas expiram
+        self.temporizador = None
+        self.fichas = None            # Balde de fichas dos comandos que alteram (None = cheio)
+        self.fichas_em = 0.0
+        self.nos_remotos = None       # Modo cluster: nós onde esta sessão tem reservas
+        self.respostas = None         # RespostasRecentes (None = nenhum pedido com id_pedido)
+
+sessoes = {}            # token -> Sessao
+sessao_da_conexao = {}  # conn -> Sessao
+proximo_id_cliente = 1
+
+# --- (ÍNDICE DE RESERVAS) ---
+# As reservas ficam em dois índices mantidos juntos: por cliente (o
+# carrinho de cada sessão) e por produto (total reservado e quem o
+# reservou). Assim "quanto há de X reservado, e por quem" não obriga a
+# percorrer todas as sessões. Todas as alterações a carrinhos passam por
+# alterar(), com o lock da fatia do produto já adquirido.
+class IndiceReservas:
+    def __init__(self):
+        self.totais = {}       # produto -> quantidade reservada (por todos)
+        self.por_produto = {}  # produto -> {id_cliente: quantidade}
+
+    def alterar(self, sessao, produto, delta):
+        """Soma 'delta' (pode ser negativo) à reserva de 'produto' na sessão."""
+        quantidade = sessao.carrinho.somar(produto, delta)
+        clientes = self.por_produto.setdefault(produto, {})
+        if quantidade:
+            clientes[sessao.id_cliente] = quantidade
+        else:
+            clientes.pop(sessao.id_cliente, None)
+            if not clientes:
+                del self.por_produto[produto]
+        total = self.totais.get(produto, 0) + delta
+        if total:
+            self.totais[produto] = total
+        else:
+            self.totais.pop(produto, None)
+
+    def total(self, produto):
+        return self.totais.get(produto, 0)
+
+    def clientes(self, produto):
+        return dict(self.por_produto.get(produto, {}))
+
+# No modo com vários processos os totais passam para memória partilhada
+# (os clientes de cada produto continuam por processo)
+reservas = IndiceReservas()
+
+# --- (MÉTRICAS) ---
+# Contadores e histogramas de latência (ver metricas.py), consultados com
+# GET_METRICS ou, com --porta-metricas, em http://host:porta/metrics.
+metricas = Metricas()
+
+# --- (LOCKS POR PRODUTO) ---
+# Em vez de um único lock global, o estoque é dividido em "fatias":
+# cada produto pertence a uma fatia (pelo hash do nome) e só trava
+# o lock dela. Assim um RESERVAR de "banana" não espera um RESERVAR
+# de "leite". Operações com vários produtos travam as fatias sempre
+# em ordem crescente, o que evita deadlock.
+N_FATIAS = 64
+# Cada lock mede o tempo de espera e de posse (lock_espera/lock_posse)
+locks_fatias = [LockMedido(threading.Lock(), metricas) for _ in range(N_FATIAS)]
+
+# Protege apenas os dicionários de sessões (entrada/saída de clientes) e
+# os prazos. O conteúdo de cada carrinho é alterado sob o lock da fatia
+# do produto correspondente.
+lock_clientes = threading.Lock()
+
+def configurar_fatias(n):
+    """Redefine o número de fatias (n=1 equivale ao antigo lock global)."""
+    global N_FATIAS, locks_fatias
+    N_FATIAS = n
+    locks_fatias = [LockMedido(threading.Lock(), metricas) for _ in range(n)]
+
+def lock_do_produto(produto):
+    return locks_fatias[hash(produto) % N_FATIAS]
+
+@contextmanager
+def travar_produtos(produtos):
+    """Trava as fatias de todos os produtos dados, em ordem crescente."""
+    fatias = sorted({hash(p) % N_FATIAS for p in produtos})
+    travados = [locks_fatias[i] for i in fatias]
+    for l in travados:
+        l.acquire()
+    try:
+        yield
+    finally:
+        for l in reversed(travados):
+            l.release()
+
+@contextmanager
+def travar_tudo():
+    """Trava todas as fatias: usado para leituras consistentes do catálogo inteiro."""
+    travados = list(locks_fatias)
+    for l in travados:
+        l.acquire()
+    try:
+        yield
+    finally:
+        for l in reversed(travados):
+            l.release()
+
+# --- (VERSÃO DO ESTOQUE) ---
+# Cada alteração no estoque disponível incrementa a versão do estoque e
+# fica registada num log limitado. Um cliente que já tem a versão N
+# pede só o que mudou desde N, em vez do catálogo inteiro.
+TAMANHO_LOG_ALTERACOES = 10000
+
+class LogAlteracoes:
+    def __init__(self, tamanho=TAMANHO_LOG_ALTERACOES):
+        self.versao = 0
+        self.log = deque(maxlen=tamanho)  # (versao, produto)
+        self.lock = threading.Lock()
+
+    def registrar(self, produto):
+        with self.lock:
+            self.versao += 1
+            self.log.append((self.versao, produto))
+            return self.versao
+
+    def atual(self):
+        return self.versao
+
+    def desde(self, versao):
+        """(versao_atual, {produtos alterados depois de 'versao'}) ou None
+        se o log já não cobre esse intervalo."""
+        with self.lock:
+            atual = self.versao
+            if versao > atual:
+                return None  # Versão desconhecida (ex.: servidor reiniciou)
+            if versao < atual and (not self.log or self.log[0][0] > versao + 1):
+                return None  # O cliente ficou para trás demais
+            produtos = set()
+            for v, produto in reversed(self.log):
+                if v <= versao:
+                    break
+                produtos.add(produto)
+            return atual, produtos
+
+# No modo com vários processos é trocado por um LogAlteracoesCompartilhado
+log_alteracoes = LogAlteracoes()
+
+def registrar_alteracao(produto, sessao=None, tipo=None, delta=0):
+    """Chamar com o lock da fatia do produto já adquirido, logo após alterá-lo
+    (e ao carrinho da sessão, se a alteração mexeu num carrinho). Com 'tipo'
+    (RESERVA, CANCELAMENTO, ...), o movimento vai para o livro de movimentos."""
+    log_alteracoes.registrar(produto)
+    if tipo is not None:
+        registrar_movimento(produto, tipo, delta)
+
+    if diario is not None or log_replicacao is not None:
+        registros = [["E", produto, estoque_disponivel.get(produto, 0)]]
+        if sessao is not None:
+            registros.append(["C", sessao.id_cliente, produto, sessao.carrinho.get(produto, 0)])
+        if diario is not None:
+            contexto_diario.seq = diario.registrar(registros)
+        if log_replicacao is not None:
+            if sessao is not None:
+                # Com o token, o cliente recupera o carrinho se a réplica for promovida
+                registros = [["S", sessao.id_cliente, sessao.token]] + registros
+            log_replicacao.registrar(registros)
+
+# --- (PERSISTÊNCIA) ---
+# Com --dados, todas as alterações vão para um diário em disco (ver
+# persistencia.py). A resposta a um comando que alterou o estoque só é
+# enviada depois de a alteração estar gravada (group commit).
+diario = None
+CHECKPOINT_A_CADA = 100000  # registos no diário entre snapshots
+contexto_diario = threading.local()  # Último seq registado pela thread atual
+
+def seq_pendente():
+    """Devolve (e zera) o seq da última alteração feita pela thread atual."""
+    seq = getattr(contexto_diario, "seq", 0)
+    contexto_diario.seq = 0
+    return seq
+
+def aguardar_durabilidade():
+    seq = seq_pendente()
+    if diario is not None and seq:
+        diario.aguardar(seq)
+
+def carregar_estado(pasta):
+    """Recupera o estado do disco. Os carrinhos de antes do reinício
+    pertenciam a ligações que já não existem, então voltam ao estoque."""
+    global diario, proximo_id_cliente
+    diario = Diario(pasta)
+    estoque, carrinhos = diario.recuperar()
+
+    if diario.seq == 0:
+        # Diário novo: grava o estoque inicial
+        for produto, qtd in estoque_disponivel.items():
+            diario.registrar([["E", produto, qtd]])
+    else:
+        estoque_disponivel.clear()
+        estoque_disponivel.update(estoque)
+        log.info("[PERSISTENCIA] Estado recuperado de '%s' (%d produtos).", pasta, len(estoque))
+
+    for id_cliente, carrinho in carrinhos.items():
+        for produto, quantidade in carrinho.items():
+            estoque_disponivel[produto] = estoque_disponivel.get(produto, 0) + quantidade
+            diario.registrar([["E", produto, estoque_disponivel[produto]], ["C", id_cliente, produto, 0]])
+            registrar_movimento(produto, DEVOLUCAO, quantidade)
+        log.info("[PERSISTENCIA] Carrinho do cliente %s devolvido ao estoque: %s", id_cliente, carrinho)
+    proximo_id_cliente = max(carrinhos, default=0) + 1
+    diario.aguardar()
+
+    threading.Thread(target=checkpoint_loop, daemon=True).start()
+
+def checkpoint():
+    """Grava um snapshot compacto para que o arranque só reaplique a cauda do diário."""
+    with travar_tudo():
+        with lock_clientes:
+            seq = diario.rotacionar()
+            if seq is None:
+                return
+            estoque = estoque_disponivel.copy()
+            carrinhos = {s.id_cliente: s.carrinho.copy() for s in sessoes.values() if s.carrinho}
+    diario.gravar_snapshot(seq, estoque, carrinhos)
+
+def checkpoint_loop():
+    while True:
+        time.sleep(1.0)
+        if diario.registros_desde_checkpoint >= CHECKPOINT_A_CADA:
+            try:
+                checkpoint()
+            except OSError as e:
+                log.error("*** ERRO NO CHECKPOINT: %s ***", e)
+
+# --- (LIVRO DE MOVIMENTOS) ---
+# Cada movimento do estoque disponível (reserva, cancelamento, devolução,
+# ajuste do admin) vai para o livro de movimentos (ver movimentos.py), que
+# mantém totais por minuto e os intervalos em que cada produto esgotou.
+# GET_TOP_RESERVADOS, GET_DEMANDA e GET_RUPTURAS respondem só a partir
+# desses totais. Com --movimentos (ou --dados), os movimentos também são
+# gravados em segmentos nessa pasta e sobrevivem a um reinício.
+livro_movimentos = LivroMovimentos(estoque_disponivel)  # None no modo --workers
+TOP_PADRAO = 10
+ULTIMOS_PADRAO = 3600.0  # segundos consultados quando o pedido não diz
+
+def registrar_movimento(produto, tipo, delta):
+    """Chamar com o lock da fatia do produto, logo após a alteração."""
+    if livro_movimentos is not None:
+        livro_movimentos.registrar(produto, tipo, delta, estoque_disponivel.get(produto, 0))
+
+def abrir_movimentos(pasta):
+    eventos = livro_movimentos.abrir(pasta)
+    livro_movimentos.iniciar()
+    log.info("[MOVIMENTOS] %d movimentos recuperados de '%s'.", eventos, pasta)
+
+def fechar_movimentos():
+    """Grava o segmento que ainda está em memória (ao desligar)."""
+    if livro_movimentos is not None:
+        livro_movimentos.rodar()
+
+def intervalo_consulta(payload):
+    """(inicio, fim) em segundos desde a época: "inicio"/"fim", ou os
+    "ultimos" N segundos até agora (padrão: a última hora)."""
+    fim = float(payload.get("fim", time.time()))
+    if "inicio" in payload:
+        return float(payload["inicio"]), fim
+    return fim - float(payload.get("ultimos", ULTIMOS_PADRAO)), fim
+
+def consultar_movimentos(cmd_tipo, payload):
+    if livro_movimentos is None:
+        return {"tipo": "RESPOSTA_ERRO", "payload": {"mensagem": "O livro de movimentos não funciona com --workers."}}
+    try:
+        inicio, fim = intervalo_consulta(payload)
+        n = min(max(int(payload.get("n", TOP_PADRAO)), 1), LIMITE_PAGINA_MAXIMO)
+        passo = max(int(payload.get("passo", 3600)) // 60 * 60, 60)
+    except (TypeError, ValueError):
+        return {"tipo": "RESPOSTA_ERRO", "payload": {"mensagem": "Intervalo inválido."}}
+    produto = payload.get("produto")
+    produto = produto.lower() if isinstance(produto, str) and produto else None
+
+    if cmd_tipo == "GET_TOP_RESERVADOS":
+        itens = [{"produto": p, "reservado": r, "cancelado": c, "devolvido": d}
+                 for p, r, c, d in livro_movimentos.mais_reservados(inicio, fim, n)]
+        return {"tipo": "TOP_RESERVADOS", "payload": {"inicio": inicio, "fim": fim, "itens": itens}}
+
+    if cmd_tipo == "GET_DEMANDA":
+        if produto is None:
+            return {"tipo": "RESPOSTA_ERRO", "payload": {"mensagem": "Indique o produto."}}
+        janelas = [{"inicio": t, "reservado": r, "cancelado": c, "devolvido": d, "ajustado": a}
+                   for t, r, c, d, a in livro_movimentos.demanda(produto, inicio, fim, passo)]
+        return {"tipo": "DEMANDA", "payload": {"produto": produto, "passo": passo, "janelas": janelas}}
+
+    agora = time.time()
+    intervalos = [{"produto": p, "inicio": comeco, "fim": acabou,
+                   "segundos": round(min(acabou or agora, fim) - max(comeco, inicio), 3)}
+                  for p, comeco, acabou in livro_movimentos.rupturas_entre(inicio, fim, produto)]
+    return {"tipo": "RUPTURAS", "payload": {"inicio": inicio, "fim": fim, "intervalos": intervalos}}
+
+# --- (FOTOGRAFIAS DO ESTOQUE) ---
+# Há muito mais leituras do catálogo inteiro (GET_ESTOQUE, SUBSCRIBE) do
+# que alterações. Em vez de cada leitura travar todas as fatias, copiar o
+# estoque e serializá-lo, guarda-se uma "fotografia" imutável do estoque
+# numa versão, junto com as respostas já serializadas. Ler é só pegar na
+# referência atual (sem lock) e, se a versão ainda for a atual, enviar os
+# mesmos bytes: N clientes a pedir um catálogo que não mudou custam uma
+# serialização. Quando o estoque muda, a primeira leitura monta a
+# fotografia nova a partir da anterior (cópia + alterações do log), e as
+# fatias só ficam travadas o tempo de ler os produtos alterados.
+class FotoEstoque:
+    def __init__(self, versao, estoque):
+        self.versao = versao
+        self.estoque = estoque  # Partilhado por todas as leituras: não alterar
+        self._json = {}         # tipo da resposta -> bytes (com o separador)
+        self._itens_binarios = None
+
+    def resposta_json(self, tipo="ESTOQUE_ATUAL"):
+        # Duas threads podem montar a mesma resposta ao mesmo tempo; o
+        # resultado é igual, só se perde o trabalho de uma delas
+        dados = self._json.get(tipo)
+        if dados is None:
+            resp = {"tipo": tipo, "versao": self.versao, "payload": self.estoque}
+            dados = self._json[tipo] = json.dumps(resp).encode() + SEPARADOR
+        return dados
+
+    def itens_binarios(self):
+        """Os pares (id, qtd) já codificados para B_ESTOQUE."""
+        if self._itens_binarios is None:
+            self._itens_binarios = codificar_itens([(id_do_produto(p), q) for p, q in self.estoque.items()])
+        return self._itens_binarios
+
+foto_estoque = None
+lock_foto = threading.Lock()  # Só uma thread de cada vez monta a fotografia nova
+
+def foto_atual():
+    global foto_estoque
+    foto = foto_estoque
+    versao = log_alteracoes.atual()
+    if foto is not None and foto.versao >= versao:
+        metricas.contar("foto_estoque_total", "reaproveitada")
+        return foto
+    with lock_foto:
+        # Quem esperou pelo lock aproveita a fotografia que outra thread acabou de montar
+        foto = foto_estoque
+        if foto is None or foto.versao < versao:
+            foto = foto_estoque = _nova_foto(foto)
+    return foto
+
+def _nova_foto(anterior):
+    if anterior is not None:
+        estoque = anterior.estoque.copy()  # Fora dos locks
+        with travar_tudo():
+            delta = log_alteracoes.desde(anterior.versao)
+            if delta is not None:
+                versao, produtos = delta
+                alterados = {produto: estoque_disponivel.get(produto) for produto in produtos}
+        if delta is not None:
+            for produto, quantidade in alterados.items():
+                if quantidade is None:
+                    estoque.pop(produto, None)
+                else:
+                    estoque[produto] = quantidade
+            metricas.contar("foto_estoque_total", "incremental")
+            return FotoEstoque(versao, estoque)
+    # Primeira fotografia, ou o log já não cobre o intervalo
+    with travar_tudo():
+        versao, estoque = log_alteracoes.atual(), estoque_disponivel.copy()
+    metricas.contar("foto_estoque_total", "completa")
+    return FotoEstoque(versao, estoque)
+
+def snapshot_estoque():
+    """Cópia consistente do estoque (nenhuma reserva pela metade) e a sua
+    versão. O dicionário é o da fotografia atual: não o alterar."""
+    foto = foto_atual()
+    return foto.versao, foto.estoque
+
+def alteracoes_desde(versao):
+    """Devolve (versao_atual, {produto: qtd}) com os produtos alterados depois
+    de 'versao', ou None se o log já não cobre esse intervalo."""
+    resultado = log_alteracoes.desde(versao)
+    if resultado is None:
+        return None
+    atual, produtos = resultado
+    # Os valores lidos podem ser mais novos que 'atual'; como enviamos
+    # quantidades absolutas, o cliente só os recebe de novo na próxima vez.
+    return atual, {produto: estoque_disponivel.get(produto, 0) for produto in produtos}
+
+# --- (ÍNDICE DO CATÁLOGO) ---
+# Pesquisa e paginação (BUSCAR_ESTOQUE) sem copiar o catálogo inteiro.
+# O índice segue o log de alterações: cada consulta aplica primeiro o que
+# mudou desde a anterior, e as reservas não pagam nada por ele existir.
+indice_catalogo = IndiceCatalogo()
+
+def sincronizar_catalogo():
+    """Chamar com indice_catalogo.lock adquirido."""
+    delta = None
+    if indice_catalogo.versao is not None:
+        delta = alteracoes_desde(indice_catalogo.versao)
+    if delta is None:
+        # Primeira consulta, ou o log já não cobre o intervalo: reconstrói
+        versao, estoque = snapshot_estoque()
+        indice_catalogo.reconstruir(estoque, versao)
+        return
+    versao, alteracoes = delta
+    for produto, quantidade in alteracoes.items():
+        indice_catalogo.atualizar(produto, quantidade)
+    indice_catalogo.versao = versao
+
+def _ler_limite(payload):
+    try:
+        return min(max(int(payload.get("limite", LIMITE_PAGINA)), 1), LIMITE_PAGINA_MAXIMO)
+    except (TypeError, ValueError):
+        return LIMITE_PAGINA
+
+def buscar_estoque(payload):
+    prefixo = str(payload.get("prefixo") or "").lower()
+    contem = str(payload.get("contem") or "").lower()
+    cursor = payload.get("cursor")
+    limite = _ler_limite(payload)
+    with indice_catalogo.lock:
+        sincronizar_catalogo()
+        versao = indice_catalogo.versao
+        nomes, proximo = indice_catalogo.buscar(prefixo, contem, bool(payload.get("so_disponiveis")),
+                                                cursor if isinstance(cursor, str) else None, limite)
+    # Lista de pares (a ordem importa); quantidades lidas agora, por isso
+    # podem ser mais novas que 'versao'
+    itens = [[nome, estoque_disponivel.get(nome, 0)] for nome in nomes]
+    return {"tipo": "ESTOQUE_PAGINA", "versao": versao, "payload": {"itens": itens, "proximo_cursor": proximo}}
+
+# --- (ASSINATURAS / PUSH) ---
+# Um cliente que envia SUBSCRIBE deixa de precisar de fazer polling:
+# o notificador junta as alterações de estoque de uma "janela" de tempo
+# e envia-lhe um único EVENTO_ESTOQUE com tudo o que mudou.
+# O notificador é um só para todos os assinantes, por isso nunca espera
+# por nenhum: se a ligação de um assinante não aceita o evento já (o
+# cliente não está a ler), o evento fica por enviar e as alterações
+# juntam-se no evento seguinte. Cada assinante tem no máximo um evento
+# pendente, por mais lento que seja, e o que fica mais de TEMPO_ESCRITA
+# sem aceitar eventos é desligado.
+JANELA_PUSH = 0.5  # segundos (padrão; o cliente pode pedir outra)
+INTERVALO_NOTIFICADOR = 0.05
+LIMITE_BUFFER_ASSINANTE = 1024 * 1024  # bytes à espera no transporte (modo asyncio)
+
+# conn -> CanalEnvio (ou CanalEnvioAsync) dessa conexão: os eventos
+# entram entre as respostas normais sem misturar os bytes.
+canais_envio = {}
+assinantes = {}  # conn -> Assinatura
+lock_assinantes = threading.Lock()
+
+def _enviar_sem_esperar(conn, dados):
+    """Envia o que o socket aceitar neste momento; devolve quantos bytes."""
+    if conn.fileno() < 0:
+        raise OSError("ligação fechada")
+    sondagem = select.poll()
+    sondagem.register(conn, select.POLLOUT)
+    if not sondagem.poll(0):
+        return 0
+    try:
+        return conn.send(dados, socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        return 0
+
+def _sem_espera_ao_fechar(sock):
+    """Ao fechar, descarta o que o cliente não leu (RST) em vez de deixar o
+    kernel a tentar entregá-lo."""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+    except OSError:
+        pass
+
+class CanalEnvio:
+    """Saída de uma ligação no modo threads, partilhada pela thread da
+    ligação (respostas, que podem esperar) e pelo notificador (eventos,
+    que nunca esperam). Um evento que o socket só aceitou em parte fica
+    em 'resto' e sai antes de qualquer outra coisa."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.resto = b""
+
+    def tentar_enviar(self, dados):
+        """Envia 'dados' (ou começa a enviar) se der já; False se nada foi
+        enviado, porque a ligação está ocupada ou o cliente não lê."""
+        if not self.lock.acquire(blocking=False):
+            return False  # A thread da ligação está a responder
+        try:
+            if self.resto:
+                self.resto = self.resto[_enviar_sem_esperar(self.conn, self.resto):]
+                if self.resto:
+                    return False
+            enviados = _enviar_sem_esperar(self.conn, dados)
+            if not enviados:
+                return False
+            self.resto = dados[enviados:]
+        finally:
+            self.lock.release()
+        metricas.contar("bytes_enviados_total", valor=len(dados))
+        return True
+
+    def despejar(self):
+        """Com o lock: acaba de enviar um evento que ficou a meio."""
+        if self.resto:
+            self.conn.sendall(self.resto)
+            self.resto = b""
+
+    def fechar(self):
+        """Desliga o cliente; a thread da ligação acorda e faz a limpeza."""
+        _sem_espera_ao_fechar(self.conn)
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class CanalEnvioAsync:
+    """O mesmo para o modo asyncio: o evento vai para o event loop, mas só
+    se o anterior já foi escrito e o transporte não tem mais que
+    LIMITE_BUFFER_ASSINANTE bytes à espera de sair."""
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.pendente = None  # Evento entregue ao event loop e ainda não escrito
+
+    def tentar_enviar(self, dados):
+        if self.writer.is_closing():
+            raise OSError("ligação fechada")
+        if self.pendente is not None or self.writer.transport.get_write_buffer_size() > LIMITE_BUFFER_ASSINANTE:
+            return False
+        self.pendente = dados
+        self.loop.call_soon_threadsafe(self._escrever)
+        metricas.contar("bytes_enviados_total", valor=len(dados))
+        return True
+
+    def _escrever(self):
+        dados, self.pendente = self.pendente, None
+        if not self.writer.is_closing():
+            self.writer.write(dados)
+
+    def fechar(self):
+        _sem_espera_ao_fechar(self.writer.get_extra_info("socket"))
+        self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+class Assinatura:
+    def __init__(self, canal, versao, janela, binaria):
+        self.canal = canal
+        self.binaria = binaria
+        self.versao = versao  # Última versão que o cliente já conhece
+        self.janela = janela
+        self.proximo_envio = 0.0
+        self.adiada_desde = None  # Desde quando o cliente não aceita eventos
+
+def assinar(conn, versao, janela):
+    with lock_assinantes:
+        assinantes[conn] = Assinatura(canais_envio[conn], versao, janela, conn in sessoes_binarias)
+    _manter_viva(conn.get_extra_info("socket") if isinstance(conn, asyncio.StreamWriter) else conn)
+
+def _manter_viva(sock):
+    """Um assinante pode nunca mais enviar nada, por isso não tem prazo de
+    inatividade (ver TEMPO_OCIOSO): o TCP keepalive é que dá por um cliente
+    que desapareceu sem fechar a ligação."""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 6)
+    except (OSError, AttributeError):
+        pass
+
+def cancelar_assinatura(conn):
+    with lock_assinantes:
+        assinantes.pop(conn, None)
+
+def _montar_evento(versao, binaria):
+    """Evento com tudo o que mudou desde 'versao' (ou o estoque completo)."""
+    delta = alteracoes_desde(versao)
+    if delta is None:
+        atual, estoque = snapshot_estoque()
+        evento = {"tipo": "EVENTO_ESTOQUE", "versao": atual, "completo": True, "payload": estoque}
+    else:
+        atual, alteracoes = delta
+        evento = {"tipo": "EVENTO_ESTOQUE", "versao": atual, "completo": False, "payload": alteracoes}
+    return (quadro_json(evento) if binaria else codificar(evento)), atual
+
+def notificador_loop():
+    while True:
+        time.sleep(INTERVALO_NOTIFICADOR)
+        atual = log_alteracoes.atual()
+        agora = time.monotonic()
+        with lock_assinantes:
+            lista = list(assinantes.items())
+
+        # Assinantes na mesma versão recebem os mesmos bytes: serializa uma vez só
+        eventos = {}
+        for conn, assinatura in lista:
+            if assinatura.versao >= atual or agora < assinatura.proximo_envio:
+                continue
+            chave = (assinatura.versao, assinatura.binaria)
+            if chave not in eventos:
+                eventos[chave] = _montar_evento(*chave)
+            dados, nova_versao = eventos[chave]
+            try:
+                enviado = assinatura.canal.tentar_enviar(dados)
+            except OSError:
+                cancelar_assinatura(conn)
+                continue
+            if not enviado:
+                # Cliente lento: fica na versão que tem e recebe tudo junto depois
+                if assinatura.adiada_desde is None:
+                    assinatura.adiada_desde = agora
+                elif agora - assinatura.adiada_desde > TEMPO_ESCRITA:
+                    # Não lê há demasiado tempo: desliga-o (o carrinho fica
+                    # guardado como numa queda)
+                    cancelar_assinatura(conn)
+                    assinatura.canal.fechar()
+                    metricas.contar("assinantes_lentos_total")
+                    log.info("Assinante sem ler há %.0f s: a fechar a ligação.", agora - assinatura.adiada_desde)
+                    continue
+                metricas.contar("eventos_adiados_total")
+                continue
+            assinatura.adiada_desde = None
+            assinatura.versao = nova_versao
+            assinatura.proximo_envio = agora + assinatura.janela
+
+def iniciar_notificador():
+    threading.Thread(target=notificador_loop, daemon=True).start()
+
+# --- (CODIFICAÇÃO BINÁRIA) ---
+# Conexões que negociaram "binaria" no HELLO (ver protocolo.py). Os nomes
+# dos produtos são trocados uma única vez por IDs numéricos: os mesmos IDs
+# do estoque (estoque_disponivel.nomes é a tabela id -> nome).
+sessoes_binarias = {}  # conn -> SessaoBinaria
+
+def id_do_produto(produto):
+    return estoque_disponivel.id_do_produto(produto, criar=True)
+
+class SessaoBinaria:
+    def __init__(self):
+        self.ids_enviados = 0  # IDs 0..ids_enviados-1 já têm nome do lado do cliente
+
+    def tabela(self, itens, versao=None, completo=True):
+        """Corpo de B_ESTOQUE/B_RESERVAS, com os nomes que o cliente ainda não conhece.
+        'itens' é um dicionário produto -> qtd ou pares já codificados."""
+        if isinstance(itens, bytes):
+            pares = itens
+        else:
+            pares = [(id_do_produto(produto), qtd) for produto, qtd in itens.items()]
+        nomes = estoque_disponivel.nomes
+        total = len(nomes)
+        nomes_novos = [(i, nomes[i]) for i in range(self.ids_enviados, total)]
+        self.ids_enviados = total
+        return codificar_tabela(pares, nomes_novos, versao, completo)
+
+NOMES_QUADROS = {
+    B_GET_ESTOQUE: "GET_ESTOQUE", B_GET_MINHAS_RESERVAS: "GET_MINHAS_RESERVAS", B_RESERVAR: "RESERVAR",
+    B_CANCELAR_RESERVA: "CANCELAR_RESERVA", B_SET_ESTOQUE: "SET_ESTOQUE", B_SAIR: "SAIR",
 }
-# Dicionário para rastrear o "carrinho" de cada cliente (conexão)
-reservas_por_cliente = {}
 
-lock = threading.Lock()  # O lock agora protege AMBAS as estruturas
+def processar_quadro(tipo, corpo, conn):
+    """Equivalente binário de process_json_command: devolve o quadro de resposta."""
+    if tipo == B_JSON:
+        # Medido dentro de process_json_command
+        resposta = process_json_command(corpo.decode(), conn)
+        if isinstance(resposta, RespostaEmPartes):
+            return (quadro(B_JSON, parte.encode()) for parte in resposta.partes)
+        if isinstance(resposta, bytes):
+            return quadro(B_JSON, resposta[:-len(SEPARADOR)])
+        return quadro(B_JSON, resposta.encode())
+    if NOMES_QUADROS.get(tipo) in COMANDOS_LIMITADOS:
+        espera = consumir_ficha(conn)
+        if espera:
+            return quadro_json(resposta_sobrecarga("limite_taxa", espera))
+    inicio = time.perf_counter()
+    try:
+        return executar_quadro(tipo, corpo, conn)
+    finally:
+        medir_comando(NOMES_QUADROS.get(tipo), inicio)
+
+def executar_quadro(tipo, corpo, conn):
+    sessao = sessoes_binarias[conn]
+
+    if tipo == B_GET_ESTOQUE:
+        delta = alteracoes_desde(INTEIRO.unpack(corpo)[0]) if corpo else None
+        if delta is not None:
+            versao, alteracoes = delta
+            return quadro(B_ESTOQUE, sessao.tabela(alteracoes, versao, completo=False))
+        foto = foto_atual()
+        return quadro(B_ESTOQUE, sessao.tabela(foto.itens_binarios(), foto.versao))
+
+    elif tipo == B_GET_MINHAS_RESERVAS:
+        return quadro(B_RESERVAS, sessao.tabela(sessao_da_conexao[conn].carrinho.copy()))
+
+    elif tipo in (B_RESERVAR, B_CANCELAR_RESERVA):
+        id_produto, quantidade = PEDIDO_ITEM.unpack_from(corpo)
+        id_pedido = corpo[PEDIDO_ITEM.size:]
+        if id_pedido:
+            def executar():
+                codigo, valor = reservar_por_id(tipo, id_produto, quantidade, conn)
+                nomes = estoque_disponivel.nomes
+                produto = nomes[id_produto] if id_produto < len(nomes) else ""
+                return (NOMES_QUADROS[tipo], codigo, produto, quantidade, valor)
+            return resposta_quadro(executar_uma_vez(conn, id_pedido.decode(errors="replace"), executar))
+        return quadro(B_RESULTADO, RESULTADO.pack(*reservar_por_id(tipo, id_produto, quantidade, conn)))
+
+    elif tipo == B_SET_ESTOQUE:
+        quantidade = INTEIRO.unpack_from(corpo)[0]
+        produto = corpo[INTEIRO.size:].decode()
+        codigo, valor = definir_estoque(produto, quantidade)
+        return quadro(B_RESULTADO, RESULTADO.pack(codigo, valor))
+
+    elif tipo == B_SAIR:
+        return quadro(B_BYE)
+
+    return quadro_json({"tipo": "RESPOSTA_ERRO", "payload": {"mensagem": "Tipo de quadro desconhecido."}})
+
+def reservar_por_id(tipo, id_produto, quantidade, conn):
+    """(codigo, valor) de B_RESERVAR/B_CANCELAR_RESERVA."""
+    if id_produto >= len(estoque_disponivel.nomes):
+        return PRODUTO_INEXISTENTE, 0
+    produto = estoque_disponivel.nomes[id_produto]
+    if tipo == B_RESERVAR:
+        return reservar(conn, produto, quantidade)
+    return cancelar_reserva(conn, produto, quantidade)
 
 HOST = "0.0.0.0"
 PORT = 5050
 
+# --- (CONTROLO DE ADMISSÃO) ---
+# Sem limites, uma rajada de conexões (ou clientes lentos/mortos que nunca
+# fecham) acaba com as threads e a memória do servidor. Por isso:
+# - no máximo MAXIMO_CONEXOES abertas (por processo); acima disso a conexão
+#   nova recebe SOBRECARGA e é fechada, e as que esperam ser aceites ficam
+#   numa fila limitada (o backlog do listen);
+# - uma conexão sem mensagens durante TEMPO_OCIOSO, ou que demora mais de
+#   TEMPO_LEITURA a acabar de enviar uma mensagem, é fechada (o carrinho
+#   fica guardado como numa queda); uma conexão com SUBSCRIBE só recebe,
+#   por isso não tem prazo de inatividade;
+# - o mesmo para um cliente que não lê: uma resposta que não sai em
+#   TEMPO_ESCRITA, ou um assinante que não aceita eventos durante
+#   TEMPO_ESCRITA, fecha a conexão;
+# - com LIMITE_PEDIDOS, cada cliente tem um balde de fichas para os
+#   comandos que alteram o estoque; sem fichas recebe SOBRECARGA com o
+#   tempo de espera, em vez de atrasar os outros.
+MAXIMO_CONEXOES = 10000   # 0 = sem limite
+FILA_ACEITACAO = 4096     # backlog do listen
+TEMPO_OCIOSO = 300.0      # segundos
+TEMPO_LEITURA = 30.0      # segundos
+TEMPO_ESCRITA = 30.0      # segundos
+LIMITE_PEDIDOS = 0.0      # comandos que alteram, por segundo e por cliente (0 = sem limite)
+RAJADA_PEDIDOS = 0        # tamanho do balde (0 = igual a LIMITE_PEDIDOS)
+COMANDOS_LIMITADOS = frozenset({
+    "RESERVAR", "CANCELAR_RESERVA", "RESERVAR_LOTE", "CANCELAR_LOTE", "RENOVAR",
+    "SET_ESTOQUE", "BULK_SET",
+})
+
+conexoes_abertas = 0
+lock_admissao = threading.Lock()
+
+def resposta_sobrecarga(motivo, tentar_em):
+    mensagens = {
+        "conexoes": "Servidor cheio: tente ligar-se de novo daqui a pouco.",
+        "limite_taxa": "Demasiados pedidos: aguarde um pouco antes de tentar de novo.",
+    }
+    metricas.contar("sobrecarga_total", motivo)
+    return {"tipo": "SOBRECARGA", "payload": {"motivo": motivo, "mensagem": mensagens[motivo],
+                                              "tentar_em": round(tentar_em, 3)}}
+
+def admitir_conexao():
+    """Reserva o lugar de uma conexão nova; False se o servidor está cheio."""
+    global conexoes_abertas
+    with lock_admissao:
+        if MAXIMO_CONEXOES and conexoes_abertas >= MAXIMO_CONEXOES:
+            return False
+        conexoes_abertas += 1
+        return True
+
+def libertar_conexao():
+    global conexoes_abertas
+    with lock_admissao:
+        conexoes_abertas -= 1
+
+def consumir_ficha(conn):
+    """Devolve 0 se o cliente pode fazer mais um comando que altera, ou os
+    segundos que faltam até ter uma ficha. Só a thread (ou tarefa) da
+    conexão mexe no balde da sua sessão, por isso não precisa de lock."""
+    sessao = sessao_da_conexao.get(conn)
+    if not LIMITE_PEDIDOS or sessao is None:
+        return 0
+    rajada = RAJADA_PEDIDOS or LIMITE_PEDIDOS
+    agora = time.monotonic()
+    if sessao.fichas is None:
+        sessao.fichas = rajada
+    else:
+        sessao.fichas = min(rajada, sessao.fichas + (agora - sessao.fichas_em) * LIMITE_PEDIDOS)
+    sessao.fichas_em = agora
+    if sessao.fichas < 1:
+        return (1 - sessao.fichas) / LIMITE_PEDIDOS
+    sessao.fichas -= 1
+    return 0
+
+def recusar_conexao(conn):
+    """Chamada no lugar de handle_client quando o servidor está cheio."""
+    try:
+        conn.settimeout(1.0)
+        conn.sendall(codificar(resposta_sobrecarga("conexoes", 1.0)))
+    except OSError:
+        pass
+    conn.close()
+
 def handle_client(conn, addr):
-    print(f"[NOVA CONEXAO] {addr} conectado.")
+    log.info("[NOVA CONEXAO] %s conectado.", addr)
+    metricas.contar("conexoes_total")
+    metricas.contar("conexoes_ativas")
     
     # --- (NOVO) ---
-    # Cria um "carrinho" vazio para este cliente
-    with lock:
-        reservas_por_cliente[conn] = {}
+    # Cria uma sessão com um "carrinho" vazio para este cliente
+    registrar_cliente(conn)
+
+    # Canal de envio partilhado com o notificador de eventos
+    canal = CanalEnvio(conn)
+    canais_envio[conn] = canal
         
+    leitor = LeitorMensagens(conn)
+    binaria = False
+    sair = False
+    bytes_contados = 0
     try:
         while True:
-            data = conn.recv(1024).decode().strip()
-            if not data:
-                break 
+            leitor.definir_prazos(None if conn in assinantes else TEMPO_OCIOSO, TEMPO_LEITURA)
+            # Lê todas as mensagens completas que já chegaram (pipelining)
+            mensagens = leitor.ler_quadros() if binaria else leitor.ler_linhas()
+            metricas.contar("bytes_recebidos_total", valor=leitor.bytes_recebidos - bytes_contados)
+            bytes_contados = leitor.bytes_recebidos
+            if mensagens is None:
+                break
 
-            print(f"[{addr}] Enviou: {data}")
+            # O lock de envio fica com a thread durante o lote inteiro: assim
+            # um evento nunca chega ao cliente antes da resposta ao SUBSCRIBE.
+            with canal.lock:
+                respostas = []
+                sair = False
+                for mensagem in mensagens:
+                    if binaria:
+                        resposta, sair = atender_quadro(mensagem, conn, addr)
+                        respostas.append(resposta)
+                    else:
+                        resposta, sair = atender_mensagem(mensagem, conn, addr)
+                        respostas.append(resposta)
+                        if conn in sessoes_binarias:
+                            # Depois do HELLO_OK o cliente só envia quadros binários
+                            binaria = True
+                            break
+                    if sair:
+                        break
 
-            try:
-                # --- (MUDANÇA) ---
-                # Passamos 'conn' para que a função saiba QUEM está pedindo
-                response_json = process_json_command(data, conn) 
-            except Exception as e:
-                print(f"*** ERRO NO SERVIDOR: {e} ***")
-                response_data = {"tipo": "ERRO_GERAL", "payload": {"mensagem": "Erro interno no servidor."}}
-                response_json = json.dumps(response_data)
-            
-            conn.sendall(response_json.encode())
-            
-            try:
-                if json.loads(data).get("tipo") == "SAIR":
-                    break
-            except Exception:
-                pass
+                # Só responde depois de as alterações estarem em disco
+                aguardar_durabilidade()
+                conn.settimeout(TEMPO_ESCRITA)  # O leitor repõe o prazo de leitura
+                canal.despejar()
+                # Uma única escrita para todas as respostas do lote
+                enviar_respostas(conn, respostas)
+            if sair:
+                break
 
     except ConnectionResetError:
-        print(f"[{addr}] Ligação perdida abruptamente.")
+        log.info("[%s] Ligação perdida abruptamente.", addr)
+    except TimeoutError:
+        metricas.contar("conexoes_expiradas_total")
+        log.info("[%s] Sem atividade (ou mensagem lenta demais, a enviar ou a ler): a fechar a ligação.", addr)
+        _sem_espera_ao_fechar(conn)
     except Exception as e:
-        print(f"[{addr}] Erro de rede: {e}")
+        log.warning("[%s] Erro de rede: %s", addr, e)
     finally:
         # --- (NOVO E CRÍTICO) ---
-        # Bloco de limpeza: Se o cliente desconectar,
-        # devolve todos os seus itens reservados ao estoque.
-        with lock:
-            carrinho_abandonado = reservas_por_cliente.pop(conn, {}) # Pega o carrinho e remove da lista
-            if carrinho_abandonado:
-                print(f"[{addr}] Desconectado. Devolvendo itens ao estoque...")
-                for produto, quantidade in carrinho_abandonado.items():
-                    if produto in estoque_disponivel:
-                        estoque_disponivel[produto] += quantidade
-                    else:
-                        # Caso o admin tenha removido o produto enquanto estava reservado
-                        estoque_disponivel[produto] = quantidade 
-                print(f"[{addr}] Itens devolvidos: {carrinho_abandonado}")
+        # Bloco de limpeza: Se o cliente desconectar, os seus itens
+        # reservados voltam ao estoque (já, ou quando o prazo acabar).
+        cancelar_assinatura(conn)
+        canais_envio.pop(conn, None)
+        sessoes_binarias.pop(conn, None)
+        desligar_sessao(conn, addr, sair)
+        metricas.contar("conexoes_ativas", valor=-1)
+        libertar_conexao()
         
         conn.close()
-        print(f"[DESCONECTADO] {addr}")
+        log.info("[DESCONECTADO] %s", addr)
+
+def enviar_respostas(conn, respostas):
+    """Envia as respostas do lote juntas; uma resposta em partes (gerador de
+    bytes) é enviada parte a parte, sem a montar inteira em memória."""
+    pendentes = []
+    for resposta in respostas:
+        if isinstance(resposta, bytes):
+            pendentes.append(resposta)
+            continue
+        if pendentes:
+            _enviar_contando(conn, b"".join(pendentes))
+            pendentes = []
+        for parte in resposta:
+            _enviar_contando(conn, parte)
+    if pendentes:
+        _enviar_contando(conn, b"".join(pendentes))
+
+def _enviar_contando(conn, dados):
+    conn.sendall(dados)
+    metricas.contar("bytes_enviados_total", valor=len(dados))
+
+def atender_mensagem(linha, conn, addr):
+    """Processa uma mensagem já enquadrada.
+    Devolve (resposta em bytes com o separador, se o cliente pediu SAIR)."""
+    data = linha.decode().strip()
+    log.debug("[%s] Enviou: %s", addr, data)
+
+    try:
+        # --- (MUDANÇA) ---
+        # Passamos 'conn' para que a função saiba QUEM está pedindo
+        response_json = process_json_command(data, conn)
+    except Exception as e:
+        log.exception("*** ERRO NO SERVIDOR: %s ***", e)
+        response_data = {"tipo": "ERRO_GERAL", "payload": {"mensagem": "Erro interno no servidor."}}
+        response_json = json.dumps(response_data)
+
+    try:
+        sair = json.loads(data).get("tipo") == "SAIR"
+    except Exception:
+        sair = False
+
+    if isinstance(response_json, RespostaEmPartes):
+        partes = (parte.encode() + SEPARADOR for parte in response_json.partes)
+        return RespostaEmPartes(partes, response_json.bloqueante), sair
+    if isinstance(response_json, bytes):
+        return response_json, sair  # Já serializada (ver FotoEstoque)
+    return response_json.encode() + SEPARADOR, sair
+
+def atender_quadro(mensagem, conn, addr):
+    """Como atender_mensagem, para um quadro binário (tipo, corpo)."""
+    tipo, corpo = mensagem
+    log.debug("[%s] Enviou quadro %s (%d bytes)", addr, tipo, len(corpo))
+
+    try:
+        resposta = processar_quadro(tipo, corpo, conn)
+    except Exception as e:
+        log.exception("*** ERRO NO SERVIDOR: %s ***", e)
+        resposta = quadro_json({"tipo": "ERRO_GERAL", "payload": {"mensagem": "Erro interno no servidor."}})
+
+    return resposta, tipo == B_SAIR
+
+def registrar_cliente(conn):
+    """Cria uma sessão nova (carrinho vazio) para a conexão."""
+    global proximo_id_cliente
+    with lock_clientes:
+        sessao = Sessao(secrets.token_hex(16), proximo_id_cliente)
+        proximo_id_cliente += 1
+        sessao.conn = conn
+        sessoes[sessao.token] = sessao
+        sessao_da_conexao[conn] = sessao
+    return sessao
+
+def retomar_sessao(conn, token):
+    """SESSAO com um token: a conexão passa a usar a sessão (e o carrinho)
+    desse token. Devolve (sessão da conexão, se retomou)."""
+    with lock_clientes:
+        atual = sessao_da_conexao[conn]
+        antiga = sessoes.get(token) if isinstance(token, str) else None
+        if antiga is None or antiga is atual or atual.carrinho or atual.nos_remotos:
+            # Token desconhecido/expirado, ou esta conexão já reservou algo
+            return atual, False
+        if antiga.conn is not None:
+            # A ligação antiga ainda não deu por si (meio aberta): perde a sessão
+            sessao_da_conexao.pop(antiga.conn, None)
+        antiga.conn = conn
+        sessao_da_conexao[conn] = antiga
+        del sessoes[atual.token]
+    if antiga.carrinho:
+        renovar_prazo(antiga)
+    return antiga, True
+
+def desligar_sessao(conn, addr, sair):
+    """Chamada quando a conexão termina. Com SAIR o carrinho volta logo ao
+    estoque; numa queda fica guardado até TEMPO_RETOMAR (ou até o prazo
+    das reservas, se for antes) para o cliente o poder recuperar."""
+    with lock_clientes:
+        sessao = sessao_da_conexao.pop(conn, None)
+        if sessao is None:
+            return  # A sessão foi retomada por outra conexão
+        sessao.conn = None
+        # Sem reservas, a sessão só fica à espera do cliente se este pode
+        # ainda repetir um pedido cuja resposta não recebeu
+        if not sessao.carrinho and not sessao.nos_remotos and (sair or sessao.respostas is None):
+            sessoes.pop(sessao.token, None)
+            return
+    if sair:
+        devolvido = esvaziar_carrinho(sessao)
+        if sessao.nos_remotos:
+            devolvido.update(libertar_remotos(sessao))
+        with lock_clientes:
+            sessoes.pop(sessao.token, None)
+        if devolvido:
+            log.info("[%s] Desconectado. Itens devolvidos ao estoque: %s", addr, devolvido)
+    else:
+        definir_prazo(sessao, time.monotonic() + TEMPO_RETOMAR, so_antecipar=True)
+        log.info("[%s] Ligação perdida. Carrinho guardado por %.0f s: %s", addr, TEMPO_RETOMAR, sessao.carrinho)
+
+def esvaziar_carrinho(sessao, so_se_expirou=False):
+    """Devolve ao estoque os itens reservados na sessão; devolve o que foi devolvido."""
+    # Travar as fatias antes de tirar os itens do carrinho garante que ninguém
+    # (ex.: o checkpoint) os vê fora do carrinho e fora do estoque.
+    produtos = list(sessao.carrinho)
+    devolvido = {}
+    with travar_produtos(produtos):
+        if so_se_expirou and (sessao.prazo is None or sessao.prazo > time.monotonic()):
+            return devolvido  # Renovada entretanto
+        for produto in produtos:
+            quantidade = sessao.carrinho.get(produto, 0)
+            if not quantidade:
+                continue
+            reservas.alterar(sessao, produto, -quantidade)
+            # .get: o admin pode ter removido o produto enquanto estava reservado
+            estoque_disponivel[produto] = estoque_disponivel.get(produto, 0) + quantidade
+            devolvido[produto] = quantidade
+            registrar_alteracao(produto, sessao, DEVOLUCAO, quantidade)
+    aguardar_durabilidade()
+    return devolvido
+
+# --- (EXPIRAÇÃO DAS RESERVAS) ---
+# Cada carrinho com itens tem um prazo. Reservar ou enviar RENOVAR adia
+# o prazo para daqui a TTL_RESERVA; quando ele chega, os itens voltam ao
+# estoque, mesmo que a ligação esteja meio aberta e nunca chegue a fechar.
+# Os prazos ficam numa roda de temporizadores (ver temporizadores.py).
+TTL_RESERVA = 900.0    # segundos
+TEMPO_RETOMAR = 60.0   # segundos que um carrinho espera por um cliente que caiu
+roda_expiracao = RodaTemporizadores(time.monotonic())
+
+def definir_prazo(sessao, prazo, so_antecipar=False):
+    with lock_clientes:
+        if so_antecipar and sessao.prazo is not None and sessao.prazo <= prazo:
+            return
+        sessao.prazo = prazo
+        # Adiar o prazo não mexe na roda: quando o temporizador disparar,
+        # o expirador vê o prazo novo e volta a agendá-lo. Só um prazo mais
+        # cedo precisa de um temporizador novo.
+        temporizador = sessao.temporizador
+        if temporizador is None or temporizador.prazo > prazo:
+            if temporizador is not None:
+                roda_expiracao.cancelar(temporizador)
+            sessao.temporizador = roda_expiracao.agendar(prazo, sessao)
+
+def renovar_prazo(sessao):
+    definir_prazo(sessao, time.monotonic() + TTL_RESERVA)
+
+def expirar(temporizador):
+    sessao = temporizador.dado
+    with lock_clientes:
+        if temporizador is not sessao.temporizador:
+            return  # Substituído por um prazo mais cedo
+        if sessao.prazo > time.monotonic():
+            sessao.temporizador = roda_expiracao.agendar(sessao.prazo, sessao)
+            return
+        sessao.temporizador = None
+
+    devolvido = esvaziar_carrinho(sessao, so_se_expirou=True)
+    with lock_clientes:
+        desligada = sessao.conn is None
+    if desligada and sessao.nos_remotos and sessao.prazo <= time.monotonic():
+        # O cliente não voltou: as reservas nos outros nós também são devolvidas
+        devolvido.update(libertar_remotos(sessao))
+    with lock_clientes:
+        if desligada and not sessao.carrinho:
+            sessoes.pop(sessao.token, None)
+        assinatura = assinantes.get(sessao.conn)
+    if devolvido:
+        log.info("[SESSAO %s] Reservas expiradas, devolvidas ao estoque: %s", sessao.id_cliente, devolvido)
+        if assinatura is not None:
+            # Só quem assinou espera mensagens que não pediu
+            aviso = {"tipo": "RESERVAS_EXPIRADAS", "payload": devolvido}
+            try:
+                assinatura.canal.tentar_enviar(quadro_json(aviso) if assinatura.binaria else codificar(aviso))
+            except OSError:
+                pass
+
+def expirador_loop():
+    while True:
+        time.sleep(roda_expiracao.tick)
+        for temporizador in roda_expiracao.avancar(time.monotonic()):
+            try:
+                expirar(temporizador)
+            except Exception as e:
+                log.exception("*** ERRO AO EXPIRAR RESERVAS: %s ***", e)
+
+def iniciar_expirador():
+    threading.Thread(target=expirador_loop, daemon=True).start()
+
+# --- (PEDIDOS REPETIDOS) ---
+# Um cliente que não recebeu a resposta a tempo volta a enviar o comando
+# com o mesmo "id_pedido" (ver protocolo.py). Cada sessão guarda as
+# respostas dos seus últimos MAXIMO_RESPOSTAS pedidos com id_pedido: um
+# pedido repetido até TTL_RESPOSTAS depois recebe a resposta guardada em
+# vez de ser executado outra vez. Um cliente só repete o pedido em curso,
+# por isso bastam poucas respostas por sessão (podem ser 100k+ sessões);
+# as respostas vão-se com a sessão.
+# As respostas só existem na memória deste processo: o SESSAO_OK diz a
+# "instancia", e o cliente só repete uma alteração se, depois de voltar a
+# ligar, retomou a sessão na mesma instância.
+# A repetição pode chegar noutra codificação (um cliente binário que volta
+# a ligar repete o pedido em JSON, até reaprender os IDs): guarda-se a
+# resposta JSON (string) ou, para B_RESERVAR/B_CANCELAR_RESERVA, o
+# resultado (comando, codigo, produto, quantidade, valor), e cada ligação
+# codifica-o à sua maneira (resposta_json / resposta_quadro).
+# Só se guardam resultados definitivos (aplicado ou recusado): uma falha
+# passageira (um nó do cluster que não respondeu, SOBRECARGA de outro nó)
+# não é guardada e a repetição volta a executar. Uma resposta guardada só
+# é repetida depois de a alteração original estar em disco.
+MAXIMO_RESPOSTAS = 8
+TTL_RESPOSTAS = 120.0  # segundos
+INSTANCIA = secrets.token_hex(8)  # Muda a cada arranque
+TIPOS_TRANSITORIOS = frozenset({"SOBRECARGA", "NAO_PRIMARIO", "REPLICA_ATRASADA"})
+contexto_pedido = threading.local()  # .transitoria: a resposta em curso não é definitiva
+
+def marcar_transitoria():
+    """A resposta que a thread atual está a montar depende de uma falha
+    passageira: executar_uma_vez não a guarda."""
+    contexto_pedido.transitoria = True
+
+class RespostasRecentes:
+    __slots__ = ("lock", "respostas")
+
+    def __init__(self):
+        # O lock fica preso enquanto o comando executa: uma repetição que
+        # chegue por outra ligação espera pela resposta do original
+        self.lock = threading.Lock()
+        self.respostas = OrderedDict()  # id_pedido -> (instante, resposta), do mais antigo ao mais recente
+
+def executar_uma_vez(conn, id_pedido, executar):
+    """Resposta de 'executar()', guardada na sessão de 'conn' com o
+    id_pedido; se esse id_pedido já foi executado, a resposta guardada."""
+    if not isinstance(id_pedido, str) or not 0 < len(id_pedido) <= TAMANHO_ID_PEDIDO:
+        return json.dumps({"tipo": "RESPOSTA_ERRO", "payload": {"mensagem": "id_pedido inválido."}})
+    sessao = sessao_da_conexao.get(conn)
+    if sessao is None:
+        return executar()
+    recentes = sessao.respostas
+    if recentes is None:
+        with lock_clientes:
+            if sessao.respostas is None:
+                sessao.respostas = RespostasRecentes()
+            recentes = sessao.respostas
+    with recentes.lock:
+        respostas = recentes.respostas
+        guardada = respostas.get(id_pedido)
+        agora = time.monotonic()
+        if guardada is not None:
+            instante, resposta, seq = guardada
+            if agora - instante < TTL_RESPOSTAS:
+                metricas.contar("pedidos_repetidos_total")
+                # O original pode ainda estar à espera do diário noutra
+                # ligação: esta thread também espera por ele antes de responder
+                if seq > getattr(contexto_diario, "seq", 0):
+                    contexto_diario.seq = seq
+                return resposta
+            del respostas[id_pedido]  # Expirada: o pedido conta como novo
+        contexto_pedido.transitoria = False
+        resposta = executar()
+        if contexto_pedido.transitoria:
+            return resposta
+        respostas[id_pedido] = (agora, resposta, getattr(contexto_diario, "seq", 0))
+        if len(respostas) > MAXIMO_RESPOSTAS:
+            respostas.popitem(last=False)
+        return resposta
+
+def resposta_json(resposta):
+    """Resposta de executar_uma_vez para uma ligação JSON."""
+    if isinstance(resposta, tuple):
+        return json.dumps(resposta_resultado(*resposta))
+    return resposta
+
+def resposta_quadro(resposta):
+    """Resposta de executar_uma_vez para uma ligação binária."""
+    if isinstance(resposta, tuple):
+        _, codigo, _, _, valor = resposta
+        return quadro(B_RESULTADO, RESULTADO.pack(codigo, valor))
+    return quadro(B_JSON, resposta.encode())
+
+# --- (MODO ASYNCIO) ---
+# Alternativa ao modelo "uma thread por conexão": todas as conexões
+# são atendidas por um único event loop. O protocolo e a lógica
+# (process_json_command) são exatamente os mesmos.
+# Os comandos usam os locks das fatias (que o checkpoint pode segurar
+# durante um fsync) e esperam pelo diário, por isso não correm no event
+# loop: vão para um pool de THREADS_COMANDOS threads, e o loop só lê e
+# escreve nos sockets.
+THREADS_COMANDOS = 64
+
+def atender_e_gravar(atender, mensagem, conn, addr):
+    """Numa thread do pool: atende a mensagem e espera que as alterações
+    estejam em disco (o seq pendente é da thread que as fez)."""
+    resposta, sair = atender(mensagem, conn, addr)
+    aguardar_durabilidade()
+    return resposta, sair
+
+async def handle_client_async(reader, writer):
+    addr = writer.get_extra_info("peername")
+    if not admitir_conexao():
+        writer.write(codificar(resposta_sobrecarga("conexoes", 1.0)))
+        writer.close()
+        return
+    log.info("[NOVA CONEXAO] %s conectado.", addr)
+    metricas.contar("conexoes_total")
+    metricas.contar("conexoes_ativas")
+
+    # O 'writer' faz o papel do 'conn' como chave da sessão
+    await asyncio.to_thread(registrar_cliente, writer)
+
+    # O notificador corre noutra thread: entrega os eventos ao event loop
+    canais_envio[writer] = CanalEnvioAsync(asyncio.get_running_loop(), writer)
+
+    sair = False
+    try:
+        while True:
+            try:
+                # O primeiro byte pode demorar até TEMPO_OCIOSO; o resto da
+                # mensagem tem de chegar em TEMPO_LEITURA
+                ocioso = None if writer in assinantes else TEMPO_OCIOSO
+                if writer in sessoes_binarias:
+                    cabecalho = await asyncio.wait_for(reader.readexactly(1), ocioso)
+                    cabecalho += await asyncio.wait_for(reader.readexactly(CABECALHO.size - 1), TEMPO_LEITURA)
+                    tamanho, tipo = CABECALHO.unpack(cabecalho)
+                    corpo = await asyncio.wait_for(reader.readexactly(tamanho), TEMPO_LEITURA)
+                else:
+                    linha = await asyncio.wait_for(reader.readexactly(1), ocioso)
+                    if linha != SEPARADOR:
+                        linha += await asyncio.wait_for(reader.readuntil(SEPARADOR), TEMPO_LEITURA)
+            except asyncio.IncompleteReadError:
+                break  # Ligação fechada
+
+            # Só responde depois de a alteração estar em disco, sem bloquear o event loop
+            if writer in sessoes_binarias:
+                metricas.contar("bytes_recebidos_total", valor=CABECALHO.size + len(corpo))
+                resposta, sair = await asyncio.to_thread(atender_e_gravar, atender_quadro, (tipo, corpo), writer, addr)
+            else:
+                metricas.contar("bytes_recebidos_total", valor=len(linha))
+                resposta, sair = await asyncio.to_thread(atender_e_gravar, atender_mensagem, linha[:-1], writer, addr)
+            if isinstance(resposta, bytes):
+                writer.write(resposta)
+                metricas.contar("bytes_enviados_total", valor=len(resposta))
+            elif getattr(resposta, "bloqueante", False):
+                # Cada parte pode esperar por alterações (REPLICAR): espera numa thread
+                partes = iter(resposta)
+                while (parte := await asyncio.to_thread(next, partes, None)) is not None:
+                    writer.write(parte)
+                    metricas.contar("bytes_enviados_total", valor=len(parte))
+                    await asyncio.wait_for(writer.drain(), TEMPO_ESCRITA)
+            else:
+                # Resposta em partes: espera cada parte sair antes de gerar a próxima
+                for parte in resposta:
+                    writer.write(parte)
+                    metricas.contar("bytes_enviados_total", valor=len(parte))
+                    await asyncio.wait_for(writer.drain(), TEMPO_ESCRITA)
+            await asyncio.wait_for(writer.drain(), TEMPO_ESCRITA)
+            if sair:
+                break
+
+    except ConnectionResetError:
+        log.info("[%s] Ligação perdida abruptamente.", addr)
+    except asyncio.TimeoutError:
+        metricas.contar("conexoes_expiradas_total")
+        log.info("[%s] Sem atividade (ou mensagem lenta demais, a enviar ou a ler): a fechar a ligação.", addr)
+        # Não espera que o cliente leia o que ficou por enviar
+        _sem_espera_ao_fechar(writer.get_extra_info("socket"))
+        writer.transport.abort()
+    except Exception as e:
+        log.warning("[%s] Erro de rede: %s", addr, e)
+    finally:
+        cancelar_assinatura(writer)
+        canais_envio.pop(writer, None)
+        sessoes_binarias.pop(writer, None)
+        # Com SAIR, devolver o carrinho trava fatias e espera pelo diário
+        await asyncio.to_thread(desligar_sessao, writer, addr, sair)
+        metricas.contar("conexoes_ativas", valor=-1)
+        libertar_conexao()
+
+        writer.close()
+        log.info("[DESCONECTADO] %s", addr)
 
 # --- (MUDANÇA) ---
 # A função agora recebe 'conn' para saber qual "carrinho" usar
 def process_json_command(json_string, conn):
-    """Processa um comando JSON e retorna uma resposta JSON (string)."""
+    """Processa um comando JSON e retorna a resposta: uma string JSON, bytes já
+    serializados (com o separador) ou uma RespostaEmPartes."""
     
     try:
         msg = json.loads(json_string)
         cmd_tipo = msg.get("tipo")
         payload = msg.get("payload", {})
     except json.JSONDecodeError:
+        metricas.contar("comandos_total", "JSON_INVALIDO")
         resp = {"tipo": "RESPOSTA_ERRO", "payload": {"mensagem": "Comando JSON inválido."}}
         return json.dumps(resp)
 
+    if seguidor is not None:
+        resposta = recusar_na_replica(cmd_tipo)
+        if resposta is not None:
+            return json.dumps(resposta)
+
+    if cmd_tipo in COMANDOS_LIMITADOS:
+        espera = consumir_ficha(conn)
+        if espera:
+            return json.dumps(resposta_sobrecarga("limite_taxa", espera))
+
+    inicio = time.perf_counter()
+    try:
+        if "id_pedido" in msg and cmd_tipo in COMANDOS_COM_ID_PEDIDO:
+            return resposta_json(executar_uma_vez(conn, msg["id_pedido"], lambda: executar_json(cmd_tipo, payload, conn)))
+        return executar_json(cmd_tipo, payload, conn)
+    finally:
+        medir_comando(cmd_tipo, inicio)
+
+def executar_json(cmd_tipo, payload, conn):
+    if anel is not None and cmd_tipo in COMANDOS_CLUSTER:
+        return executar_no_cluster(cmd_tipo, payload, conn)
+    return executar_comando(cmd_tipo, payload, conn)
+
+# Comandos conhecidos; qualquer outro tipo conta como "DESCONHECIDO" nas
+# métricas (o cliente não pode criar séries novas à vontade)
+COMANDOS = (
+    "GET_ESTOQUE", "BUSCAR_ESTOQUE", "GET_MINHAS_RESERVAS", "SESSAO", "RENOVAR", "RESERVAR", "CANCELAR_RESERVA",
+    "RESERVAR_LOTE", "CANCELAR_LOTE", "SET_ESTOQUE", "GET_RESERVADO", "BULK_SET", "EXPORT_ESTOQUE", "HELLO", "SUBSCRIBE", "UNSUBSCRIBE",
+    "GET_METRICS", "ENCAMINHADO", "REPLICAR", "GET_REPLICACAO", "PROMOVER", "SEGUIR",
+    "GET_TOP_RESERVADOS", "GET_DEMANDA", "GET_RUPTURAS", "SAIR",
+)
+
+def medir_comando(cmd_tipo, inicio):
+    rotulo = cmd_tipo if cmd_tipo in COMANDOS else "DESCONHECIDO"
+    metricas.observar("comando_segundos", time.perf_counter() - inicio, rotulo)
+    metricas.contar("comandos_total", rotulo)
+
+def executar_comando(cmd_tipo, payload, conn):
     # --- (LÓGICA DOS COMANDOS) ---
 
     if cmd_tipo == "GET_ESTOQUE":
-        with lock:
-            # Retorna o estoque DISPONÍVEL
-            resp = {"tipo": "ESTOQUE_ATUAL", "payload": estoque_disponivel.copy()}
-        return json.dumps(resp)
+        # Com "desde_versao", devolve só os produtos alterados desde essa versão
+        desde_versao = payload.get("desde_versao")
+        if isinstance(desde_versao, int):
+            delta = alteracoes_desde(desde_versao)
+            if delta is not None:
+                versao, alteracoes = delta
+                resp = {"tipo": "ESTOQUE_DELTA", "versao": versao, "payload": alteracoes}
+                return json.dumps(resp)
+
+        # Retorna o estoque DISPONÍVEL (já serializado na fotografia atual)
+        return foto_atual().resposta_json()
+
+    # --- (NOVO COMANDO) Pesquisa paginada: prefixo/substring, só disponíveis, cursor ---
+    elif cmd_tipo == "BUSCAR_ESTOQUE":
+        return json.dumps(buscar_estoque(payload))
 
     # --- (NOVO COMANDO) ---
     elif cmd_tipo == "GET_MINHAS_RESERVAS":
-        with lock:
-            # Retorna o carrinho do cliente específico
-            carrinho_cliente = reservas_por_cliente.get(conn, {})
-            resp = {"tipo": "MINHAS_RESERVAS", "payload": carrinho_cliente.copy()}
+        # Retorna o carrinho do cliente específico.
+        carrinho_cliente = sessao_da_conexao[conn].carrinho
+        resp = {"tipo": "MINHAS_RESERVAS", "payload": carrinho_cliente.copy()}
         return json.dumps(resp)
 
-    elif cmd_tipo == "RESERVAR":
-        produto = payload.get("produto")
-        try:
-            quantidade = int(payload.get("quantidade", 0))
-        except ValueError:
-            quantidade = 0
+    # --- (NOVO COMANDO) Sessão: token para recuperar o carrinho noutra ligação ---
+    elif cmd_tipo == "SESSAO":
+        sessao, retomada = retomar_sessao(conn, payload.get("token"))
+        resp = {"tipo": "SESSAO_OK", "payload": {
+            "token": sessao.token, "retomada": retomada, "ttl": TTL_RESERVA, "instancia": INSTANCIA,
+            "carrinho": sessao.carrinho.copy(),
+        }}
+        return json.dumps(resp)
 
-        if not produto or quantidade <= 0:
-            resp = {"tipo": "RESPOSTA_RESERVA", "payload": {"status": "ERRO", "mensagem": "Pedido inválido."}}
+    elif cmd_tipo == "RENOVAR":
+        # Adia o prazo das reservas do carrinho
+        sessao = sessao_da_conexao[conn]
+        if not sessao.carrinho:
+            resp = {"tipo": "RESPOSTA_RENOVAR", "payload": {"status": "ERRO", "mensagem": "Não há reservas para renovar."}}
             return json.dumps(resp)
+        renovar_prazo(sessao)
+        resp = {"tipo": "RESPOSTA_RENOVAR", "payload": {
+            "status": "SUCESSO", "mensagem": f"Reservas renovadas por {TTL_RESERVA:.0f} s.", "expira_em": TTL_RESERVA,
+        }}
+        return json.dumps(resp)
 
-        with lock:
-            produto = produto.lower() 
-            if produto not in estoque_disponivel:
-                resp = {"tipo": "RESPOSTA_RESERVA", "payload": {"status": "ERRO", "mensagem": f"Produto '{produto}' não existe."}}
-            
-            elif estoque_disponivel[produto] < quantidade:
-                msg_erro = f"Estoque insuficiente. Temos apenas {estoque_disponivel[produto]} '{produto}'."
-                resp = {"tipo": "RESPOSTA_RESERVA", "payload": {"status": "ERRO", "mensagem": msg_erro}}
-            
-            else:
-                # --- (LÓGICA ATUALIZADA) ---
-                # 1. Tira do estoque disponível
-                estoque_disponivel[produto] -= quantidade
-                # 2. Adiciona ao carrinho do cliente
-                carrinho_cliente = reservas_por_cliente[conn]
-                carrinho_cliente[produto] = carrinho_cliente.get(produto, 0) + quantidade
-                
-                msg_sucesso = f"Reserva de {quantidade} '{produto}' efetuada com sucesso!"
-                resp = {"tipo": "RESPOSTA_RESERVA", "payload": {"status": "SUCESSO", "mensagem": msg_sucesso}}
-        
+    elif cmd_tipo in ("RESERVAR", "CANCELAR_RESERVA"):
+        produto, quantidade = _ler_produto_quantidade(payload)
+        if cmd_tipo == "RESERVAR":
+            codigo, valor = reservar(conn, produto, quantidade)
+        else:
+            codigo, valor = cancelar_reserva(conn, produto, quantidade)
+        resp = resposta_resultado(cmd_tipo, codigo, produto and produto.lower(), quantidade, valor)
         return json.dumps(resp)
+    
+    # --- (NOVO COMANDO) Lotes: vários itens numa só mensagem ---
+    elif cmd_tipo in ("RESERVAR_LOTE", "CANCELAR_LOTE"):
+        return json.dumps(processar_lote(cmd_tipo, payload, conn))
 
-    elif cmd_tipo == "CANCELAR_RESERVA":
+    elif cmd_tipo == "SET_ESTOQUE":
+        produto, quantidade = _ler_produto_quantidade(payload)
+        total = bool(payload.get("total"))
+        codigo, valor = definir_estoque(produto, quantidade, total)
+        resp = resposta_resultado(cmd_tipo, codigo, produto and produto.lower(), quantidade, valor)
+        if total and codigo == OK:
+            resp["payload"]["mensagem"] = resp["payload"]["mensagem"].rstrip(".") + f" (total {quantidade}, {quantidade - valor} reservados)."
+        return json.dumps(resp)
+
+    # --- (NOVO COMANDO) Reservas por produto (admin) ---
+    elif cmd_tipo == "GET_RESERVADO":
         produto = payload.get("produto")
+        if isinstance(produto, str) and produto:
+            return json.dumps({"tipo": "RESERVADO", "payload": consultar_reservado(produto.lower())})
+        # Sem produto: o total reservado de cada produto com reservas
+        return json.dumps({"tipo": "RESERVADO", "payload": {"totais": dict(reservas.totais.items())}})
+
+    # --- (NOVO COMANDO) Negociação da codificação ---
+    elif cmd_tipo == "HELLO":
+        # No modo cluster os comandos binários não são encaminhados, e uma
+        # réplica só serve leituras em JSON: fica em JSON
+        if payload.get("codificacao") == "binaria" and anel is None and seguidor is None:
+            # A partir da próxima mensagem esta conexão passa a usar quadros binários
+            sessoes_binarias[conn] = SessaoBinaria()
+            return json.dumps({"tipo": "HELLO_OK", "payload": {"codificacao": "binaria"}})
+        return json.dumps({"tipo": "HELLO_OK", "payload": {"codificacao": "json"}})
+
+    elif cmd_tipo == "SUBSCRIBE":
+        # A resposta traz o estoque completo; daí em diante só chegam EVENTO_ESTOQUE.
+        # Com "snapshot": false só traz a versão (o cliente pagina com BUSCAR_ESTOQUE).
         try:
-            quantidade = int(payload.get("quantidade", 0))
-        except ValueError:
-            quantidade = 0
+            janela = float(payload.get("janela", JANELA_PUSH))
+        except (TypeError, ValueError):
+            janela = JANELA_PUSH
+        if payload.get("snapshot", True):
+            foto = foto_atual()
+            assinar(conn, foto.versao, max(janela, 0.0))
+            return foto.resposta_json("ASSINATURA_OK")
+        versao = log_alteracoes.atual()
+        assinar(conn, versao, max(janela, 0.0))
+        resp = {"tipo": "ASSINATURA_OK", "versao": versao, "payload": {}}
+        if anel is not None:
+            # Os eventos só trazem os produtos deste nó: o cliente continua
+            # a pedir o GET_ESTOQUE (que pergunta a todos os nós)
+            resp["cluster"] = True
+        return json.dumps(resp)
+
+    elif cmd_tipo == "UNSUBSCRIBE":
+        cancelar_assinatura(conn)
+        return json.dumps({"tipo": "ASSINATURA_CANCELADA"})
 
-        if not produto or quantidade <= 0:
-            resp = {"tipo": "RESPOSTA_CANCELAMENTO", "payload": {"status": "ERRO", "mensagem": "Pedido de cancelamento inválido."}}
+    # --- (NOVO COMANDO) Importação/exportação em massa (admin) ---
+    elif cmd_tipo == "BULK_SET":
+        itens = payload.get("itens")
+        if not isinstance(itens, list):
+            resp = {"tipo": "RESPOSTA_BULK", "payload": {"status": "ERRO", "mensagem": "Bloco inválido.", "aplicados": 0, "erros": []}}
             return json.dumps(resp)
-        
-        with lock:
-            produto = produto.lower()
-            carrinho_cliente = reservas_por_cliente[conn]
-            quantidade_reservada = carrinho_cliente.get(produto, 0)
-
-            # --- (VALIDAÇÃO PRINCIPAL) ---
-            # O cliente tem o que quer cancelar?
-            if quantidade > quantidade_reservada:
-                msg_erro = f"Cancelamento falhou. Você só tem {quantidade_reservada} '{produto}' reservados."
-                resp = {"tipo": "RESPOSTA_CANCELAMENTO", "payload": {"status": "ERRO", "mensagem": msg_erro}}
-            
-            else:
-                # --- (LÓGICA ATUALIZADA) ---
-                # 1. Tira do carrinho do cliente
-                carrinho_cliente[produto] -= quantidade
-                if carrinho_cliente[produto] == 0:
-                    del carrinho_cliente[produto] # Limpa o carrinho se zerar
-                
-                # 2. Devolve ao estoque disponível
-                estoque_disponivel[produto] += quantidade
-                
-                msg_sucesso = f"Cancelamento de {quantidade} '{produto}' efetuado. Estoque agora: {estoque_disponivel[produto]}"
-                resp = {"tipo": "RESPOSTA_CANCELAMENTO", "payload": {"status": "SUCESSO", "mensagem": msg_sucesso}}
-        
-        return json.dumps(resp)
-    
-    elif cmd_tipo == "SET_ESTOQUE":
-        produto = payload.get("produto")
+        return json.dumps(resposta_bulk(*definir_estoque_em_bloco(itens)))
+
+    elif cmd_tipo == "EXPORT_ESTOQUE":
         try:
-            quantidade = int(payload.get("quantidade", 0))
-        except ValueError:
-            quantidade = 0
+            tamanho_bloco = min(max(int(payload.get("bloco", TAMANHO_BLOCO_EXPORTACAO)), 1), LIMITE_PAGINA_MAXIMO * 10)
+        except (TypeError, ValueError):
+            tamanho_bloco = TAMANHO_BLOCO_EXPORTACAO
+        if anel is not None:
+            return RespostaEmPartes(exportar_do_cluster(tamanho_bloco))
+        return RespostaEmPartes(exportar_estoque(tamanho_bloco))
 
-        if not produto or quantidade < 0:
-            resp = {"tipo": "RESPOSTA_ADMIN", "payload": {"status": "ERRO", "mensagem": "Pedido admin inválido."}}
+    # --- (NOVO COMANDO) Métricas do servidor (admin) ---
+    elif cmd_tipo == "GET_METRICS":
+        if payload.get("formato") == "prometheus":
+            return json.dumps({"tipo": "METRICAS", "payload": {"texto": metricas.prometheus()}})
+        return json.dumps({"tipo": "METRICAS", "payload": metricas.coletar()})
+
+    # --- (NOVO COMANDO) Livro de movimentos: procura e rupturas (admin) ---
+    elif cmd_tipo in ("GET_TOP_RESERVADOS", "GET_DEMANDA", "GET_RUPTURAS"):
+        return json.dumps(consultar_movimentos(cmd_tipo, payload))
+
+    # --- (NOVO COMANDO) Modo cluster: comando recebido por outro nó ---
+    elif cmd_tipo == "ENCAMINHADO":
+        return executar_encaminhado(payload, conn)
+
+    # --- (NOVO COMANDO) Replicação: uma réplica a seguir este servidor ---
+    elif cmd_tipo == "REPLICAR":
+        if isinstance(estoque_disponivel, EstoqueCompartilhado):
+            resp = {"tipo": "RESPOSTA_ERRO", "payload": {"mensagem": "A replicação não funciona com --workers."}}
             return json.dumps(resp)
+        return RespostaEmPartes(transmitir_replicacao(payload, conn), bloqueante=True)
 
-        with lock:
-            produto = produto.lower() 
-            # Admin agora mexe no ESTOQUE DISPONÍVEL
-            estoque_disponivel[produto] = quantidade
-            mensagem = f"Estoque disponível de '{produto}' definido para {quantidade}."
-            
-            if produto not in estoque_disponivel:
-                 mensagem = f"Novo produto '{produto}' criado com {quantidade} unidades."
-            
-            resp = {"tipo": "RESPOSTA_ADMIN", "payload": {"status": "SUCESSO", "mensagem": mensagem}}
-            
-        return json.dumps(resp)
+    elif cmd_tipo == "GET_REPLICACAO":
+        return json.dumps({"tipo": "REPLICACAO", "payload": estado_replicacao()})
+
+    elif cmd_tipo == "PROMOVER":
+        restauradas = promover()
+        if restauradas is None:
+            resp = {"tipo": "RESPOSTA_ERRO", "payload": {"mensagem": "Este servidor já é o primário."}}
+            return json.dumps(resp)
+        return json.dumps({"tipo": "PROMOVIDO", "payload": {"sessoes": restauradas}})
+
+    elif cmd_tipo == "SEGUIR":
+        primario = payload.get("primario")
+        if seguidor is None or not isinstance(primario, str) or ":" not in primario:
+            resp = {"tipo": "RESPOSTA_ERRO", "payload": {"mensagem": "Só uma réplica segue outro servidor (indique 'host:porta')."}}
+            return json.dumps(resp)
+        seguidor.seguir(primario)
+        log.info("[REPLICA] A seguir %s.", primario)
+        return json.dumps({"tipo": "SEGUINDO", "payload": {"primario": primario}})
 
     elif cmd_tipo == "SAIR":
         return json.dumps({"tipo": "BYE"})
@@ -205,30 +1565,952 @@ def process_json_command(json_string, conn):
         resp = {"tipo": "RESPOSTA_ERRO", "payload": {"mensagem": "Tipo de comando desconhecido."}}
         return json.dumps(resp)
 
-def start():
+# --- (LÓGICA DOS COMANDOS DE ESTOQUE) ---
+# Usada tanto pelo JSON como pela codificação binária. Cada função devolve
+# (código, valor), e o texto da mensagem só é montado no modo JSON.
+
+def _ler_produto_quantidade(payload):
+    produto = payload.get("produto")
+    try:
+        quantidade = int(payload.get("quantidade", 0))
+    except (TypeError, ValueError):
+        quantidade = 0
+    return produto, quantidade
+
+def reservar(conn, produto, quantidade):
+    """Devolve (OK, 0), (PRODUTO_INEXISTENTE, 0) ou (ESTOQUE_INSUFICIENTE, disponível)."""
+    if not produto or quantidade <= 0:
+        return PEDIDO_INVALIDO, 0
+
+    produto = produto.lower()
+    with lock_do_produto(produto): 
+        disponivel = estoque_disponivel.get(produto)
+        if disponivel is None:
+            return PRODUTO_INEXISTENTE, 0
+        if disponivel < quantidade:
+            return ESTOQUE_INSUFICIENTE, disponivel
+
+        # --- (LÓGICA ATUALIZADA) ---
+        # 1. Tira do estoque disponível
+        estoque_disponivel[produto] = disponivel - quantidade
+        # 2. Adiciona ao carrinho do cliente (e adia o prazo das reservas)
+        sessao = sessao_da_conexao[conn]
+        reservas.alterar(sessao, produto, quantidade)
+        registrar_alteracao(produto, sessao, RESERVA, -quantidade)
+        renovar_prazo(sessao)
+        return OK, 0
+
+def cancelar_reserva(conn, produto, quantidade):
+    """Devolve (OK, estoque agora) ou (RESERVA_INSUFICIENTE, quantidade reservada)."""
+    if not produto or quantidade <= 0:
+        return PEDIDO_INVALIDO, 0
+
+    produto = produto.lower()
+    with lock_do_produto(produto):
+        sessao = sessao_da_conexao[conn]
+        carrinho_cliente = sessao.carrinho
+        quantidade_reservada = carrinho_cliente.get(produto, 0)
+
+        # --- (VALIDAÇÃO PRINCIPAL) ---
+        # O cliente tem o que quer cancelar?
+        if quantidade > quantidade_reservada:
+            return RESERVA_INSUFICIENTE, quantidade_reservada
+
+        # --- (LÓGICA ATUALIZADA) ---
+        # 1. Tira do carrinho do cliente (limpa o carrinho se zerar)
+        reservas.alterar(sessao, produto, -quantidade)
+
+        # 2. Devolve ao estoque disponível
+        # (.get: o admin pode ter removido o produto enquanto estava reservado)
+        disponivel = estoque_disponivel.get(produto, 0) + quantidade
+        estoque_disponivel[produto] = disponivel
+        registrar_alteracao(produto, sessao, CANCELAMENTO, quantidade)
+        return OK, disponivel
+
+def definir_estoque(produto, quantidade, total=False):
+    """Devolve (OK, disponível agora). Com total=True, 'quantidade' é o total
+    em loja (disponível + reservado): (RESERVA_INSUFICIENTE, reservado) se
+    for menor do que o que já está reservado."""
+    if not produto or quantidade < 0:
+        return PEDIDO_INVALIDO, 0
+
+    produto = produto.lower()
+    with lock_do_produto(produto): 
+        if total:
+            reservado = reservas.total(produto)
+            if quantidade < reservado:
+                return RESERVA_INSUFICIENTE, reservado
+            quantidade -= reservado
+        # Admin agora mexe no ESTOQUE DISPONÍVEL
+        anterior = estoque_disponivel.get(produto, 0)
+        estoque_disponivel[produto] = quantidade
+        registrar_alteracao(produto, None, AJUSTE, quantidade - anterior)
+    return OK, quantidade
+
+def consultar_reservado(produto):
+    """GET_RESERVADO de um produto: disponível, reservado e por quem."""
+    with lock_do_produto(produto):
+        disponivel = estoque_disponivel.get(produto)
+        reservado = reservas.total(produto)
+        clientes = reservas.clientes(produto)
+    return {
+        "produto": produto, "existe": disponivel is not None,
+        "disponivel": disponivel or 0, "reservado": reservado, "total": (disponivel or 0) + reservado,
+        # Chaves em texto por causa do JSON; no modo --workers só os clientes deste processo
+        "clientes": {str(id_cliente): qtd for id_cliente, qtd in clientes.items()},
+    }
+
+def definir_estoque_em_bloco(itens):
+    """BULK_SET: aplica um bloco de linhas [produto, quantidade] travando as
+    fatias uma única vez para o bloco inteiro. Linhas inválidas são
+    recusadas e as restantes aplicadas. Devolve (aplicadas, erros)."""
+    validos, erros = {}, []
+    for i, item in enumerate(itens):
+        try:
+            produto, quantidade = item
+            produto = str(produto).strip().lower()
+            quantidade = int(quantidade)
+        except (TypeError, ValueError):
+            erros.append({"indice": i, "mensagem": "Linha inválida."})
+            continue
+        if not produto or quantidade < 0:
+            erros.append({"indice": i, "mensagem": "Produto vazio ou quantidade negativa."})
+            continue
+        validos[produto] = quantidade  # Repetido no bloco: vale a última linha
+
+    with travar_produtos(list(validos)):
+        for produto, quantidade in validos.items():
+            anterior = estoque_disponivel.get(produto, 0)
+            estoque_disponivel[produto] = quantidade
+            log_alteracoes.registrar(produto)
+            registrar_movimento(produto, AJUSTE, quantidade - anterior)
+        if validos and (diario is not None or log_replicacao is not None):
+            # Um único registo (no diário e para as réplicas) para o bloco inteiro
+            registros = [["E", produto, qtd] for produto, qtd in validos.items()]
+            if diario is not None:
+                contexto_diario.seq = diario.registrar(registros)
+            if log_replicacao is not None:
+                log_replicacao.registrar(registros)
+    return len(validos), erros
+
+def resposta_bulk(aplicados, erros):
+    mensagem = f"{aplicados} produtos atualizados" + (f", {len(erros)} linhas recusadas." if erros else ".")
+    return {"tipo": "RESPOSTA_BULK", "payload": {
+        "status": "ERRO" if erros else "SUCESSO", "mensagem": mensagem, "aplicados": aplicados, "erros": erros,
+    }}
+
+class RespostaEmPartes:
+    """Resposta grande enviada aos poucos: 'partes' é um iterável de strings
+    JSON, cada uma uma mensagem, geradas só quando vão ser enviadas.
+    'bloqueante': gerar uma parte pode ficar à espera (ex.: REPLICAR), por
+    isso o modo asyncio gera-as fora do event loop."""
+    def __init__(self, partes, bloqueante=False):
+        self.partes = partes
+        self.bloqueante = bloqueante
+
+    def __iter__(self):
+        return iter(self.partes)
+
+TAMANHO_BLOCO_EXPORTACAO = 1000
+
+def exportar_estoque(tamanho_bloco):
+    """EXPORT_ESTOQUE: o catálogo por ordem de nome em mensagens EXPORT_PARTE
+    de 'tamanho_bloco' produtos, e no fim um EXPORT_FIM com o total. Cada
+    bloco é lido na altura de ser enviado (não é uma fotografia instantânea)."""
+    cursor, total = None, 0
+    while True:
+        with indice_catalogo.lock:
+            sincronizar_catalogo()
+            nomes, cursor = indice_catalogo.buscar(cursor=cursor, limite=tamanho_bloco)
+        itens = [[nome, estoque_disponivel.get(nome, 0)] for nome in nomes]
+        total += len(itens)
+        if itens:
+            yield json.dumps({"tipo": "EXPORT_PARTE", "payload": {"itens": itens}})
+        if cursor is None:
+            break
+    yield json.dumps({"tipo": "EXPORT_FIM", "versao": log_alteracoes.atual(), "payload": {"total": total}})
+
+def processar_lote(cmd_tipo, payload, conn):
+    """RESERVAR_LOTE / CANCELAR_LOTE: tudo ou nada, numa única seção crítica.
+    Devolve o resultado de cada item na mesma ordem do pedido."""
+    reservar = cmd_tipo == "RESERVAR_LOTE"
+    itens = payload.get("itens")
+    if not isinstance(itens, list) or not itens:
+        return {"tipo": "RESPOSTA_LOTE", "payload": {"status": "ERRO", "mensagem": "Lote inválido.", "itens": []}}
+
+    pedidos = []
+    for item in itens:
+        try:
+            produto = str(item["produto"]).lower()
+            quantidade = int(item.get("quantidade", 0))
+        except (TypeError, KeyError, ValueError, AttributeError):
+            produto, quantidade = None, 0
+        pedidos.append((produto, quantidade))
+
+    resultados = []
+    with travar_produtos([p for p, _ in pedidos if p]):
+        sessao = sessao_da_conexao[conn]
+        carrinho_cliente = sessao.carrinho
+        # Valida tudo antes de mexer em qualquer coisa. 'usado' acumula
+        # produtos repetidos no mesmo lote.
+        usado = {}
+        for produto, quantidade in pedidos:
+            if not produto or quantidade <= 0:
+                resultados.append({"status": "ERRO", "mensagem": "Item inválido."})
+                continue
+            total = usado.get(produto, 0) + quantidade
+            if reservar:
+                if produto not in estoque_disponivel:
+                    resultados.append({"status": "ERRO", "mensagem": "Produto não existe."})
+                    continue
+                if estoque_disponivel[produto] < total:
+                    resultados.append({"status": "ERRO", "mensagem": "Estoque insuficiente.", "disponivel": estoque_disponivel[produto]})
+                    continue
+            elif carrinho_cliente.get(produto, 0) < total:
+                resultados.append({"status": "ERRO", "mensagem": "Quantidade maior que a reservada.", "reservado": carrinho_cliente.get(produto, 0)})
+                continue
+            usado[produto] = total
+            resultados.append({"status": "SUCESSO"})
+
+        ok = all(r["status"] == "SUCESSO" for r in resultados)
+        if ok:
+            for produto, quantidade in usado.items():
+                if reservar:
+                    estoque_disponivel[produto] -= quantidade
+                    reservas.alterar(sessao, produto, quantidade)
+                    registrar_alteracao(produto, sessao, RESERVA, -quantidade)
+                else:
+                    reservas.alterar(sessao, produto, -quantidade)
+                    estoque_disponivel[produto] = estoque_disponivel.get(produto, 0) + quantidade
+                    registrar_alteracao(produto, sessao, CANCELAMENTO, quantidade)
+            if reservar:
+                renovar_prazo(sessao)
+
+    return resposta_lote(ok, resultados)
+
+def resposta_lote(ok, resultados):
+    if ok:
+        mensagem = f"Lote de {len(resultados)} itens processado com sucesso."
+    else:
+        mensagem = "Lote recusado: nenhum item foi alterado."
+    return {"tipo": "RESPOSTA_LOTE", "payload": {"status": "SUCESSO" if ok else "ERRO", "mensagem": mensagem, "itens": resultados}}
+
+# --- (MODO CLUSTER) ---
+# Com --cluster, vários nós dividem os produtos entre si por hashing
+# consistente (ver cluster.py): cada nó só guarda o estoque e as reservas
+# dos produtos de que é dono. O nó onde o cliente está ligado (nó de
+# entrada) executa o comando no dono do produto, embrulhado num
+# ENCAMINHADO com o token da sessão. O dono guarda essas reservas numa
+# sessão "remota" desse token, por isso os totais por produto, o
+# GET_RESERVADO e o prazo das reservas funcionam lá como para um cliente
+# ligado a ele. As leituras do catálogo inteiro são pedidas a todos os nós
+# ao mesmo tempo (scatter-gather) e juntadas no nó de entrada.
+anel = None       # AnelConsistente (None = sem cluster)
+NO_LOCAL = None   # "host:porta" deste nó, como aparece em --cluster
+pools = {}        # nó -> PoolConexoes
+lock_pools = threading.Lock()
+lock_remotas = threading.Lock()
+executor_cluster = None
+
+# Comandos que o nó de entrada passa por executar_no_cluster
+COMANDOS_CLUSTER = frozenset({
+    "GET_ESTOQUE", "BUSCAR_ESTOQUE", "GET_MINHAS_RESERVAS", "RENOVAR", "RESERVAR", "CANCELAR_RESERVA",
+    "RESERVAR_LOTE", "CANCELAR_LOTE", "SET_ESTOQUE", "GET_RESERVADO", "BULK_SET",
+})
+# Comandos que um nó aceita executar em nome de outro
+COMANDOS_ENCAMINHAVEIS = COMANDOS_CLUSTER | {"SAIR"}
+
+def configurar_cluster(nos, no_local):
+    """Liga o modo cluster. Os produtos de que este nó não é dono (ex.: o
+    estoque inicial de exemplo) saem do estoque local."""
+    global anel, NO_LOCAL, executor_cluster
+    anel = AnelConsistente(nos)
+    NO_LOCAL = no_local
+    executor_cluster = ThreadPoolExecutor(max_workers=4 * len(anel.nos), thread_name_prefix="cluster")
+    for produto in list(estoque_disponivel):
+        if anel.dono(produto) != NO_LOCAL:
+            del estoque_disponivel[produto]
+    log.info("[CLUSTER] Nó %s de %s.", NO_LOCAL, ", ".join(anel.nos))
+
+def pool_do_no(no):
+    with lock_pools:
+        pool = pools.get(no)
+        if pool is None:
+            pool = pools[no] = PoolConexoes(no)
+        return pool
+
+def encaminhar(no, comandos, sessao=None):
+    """Executa os comandos no nó 'no', em nome da sessão (se houver), e
+    devolve as respostas. Levanta OSError se o nó não responder."""
+    token = sessao.token if sessao is not None else None
+    envelopes = [{"tipo": "ENCAMINHADO", "payload": {"sessao": token, "comando": c}} for c in comandos]
+    inicio = time.perf_counter()
+    try:
+        return pool_do_no(no).pedir(envelopes)
+    finally:
+        metricas.observar("encaminhado_segundos", time.perf_counter() - inicio, no)
+
+def perguntar(nos, comando, sessao=None):
+    """Executa 'comando' em vários nós ao mesmo tempo.
+    Devolve ({nó: resposta}, [nós que não responderam])."""
+    futuros = {no: executor_cluster.submit(encaminhar, no, [comando], sessao) for no in nos}
+    respostas, falharam = {}, []
+    for no, futuro in futuros.items():
+        try:
+            respostas[no] = futuro.result()[0]
+        except (OSError, ValueError) as e:
+            metricas.contar("no_indisponivel_total", no)
+            marcar_transitoria()
+            log.warning("[CLUSTER] Nó %s não respondeu: %s", no, e)
+            falharam.append(no)
+    return respostas, falharam
+
+def outros_nos():
+    return [no for no in anel.nos if no != NO_LOCAL]
+
+def _no_do_produto(produto):
+    return anel.dono(produto.lower()) if isinstance(produto, str) and produto else NO_LOCAL
+
+def _encaminhar_da_sessao(no, comando, conn):
+    """Comando de carrinho para o dono do produto. O nó fica registado na
+    sessão antes do envio, para as reservas serem devolvidas no SAIR."""
+    sessao = sessao_da_conexao[conn]
+    if sessao.nos_remotos is None:
+        sessao.nos_remotos = set()
+    sessao.nos_remotos.add(no)
+    try:
+        resposta = encaminhar(no, [comando], sessao)[0]
+    except (OSError, ValueError) as e:
+        metricas.contar("no_indisponivel_total", no)
+        marcar_transitoria()
+        log.warning("[CLUSTER] Nó %s não respondeu: %s", no, e)
+        return {"tipo": "RESPOSTA_ERRO", "payload": {"status": "ERRO", "mensagem": f"Nó {no} indisponível."}}
+    if resposta.get("tipo") in TIPOS_TRANSITORIOS:
+        marcar_transitoria()
+    return resposta
+
+def executar_no_cluster(cmd_tipo, payload, conn):
+    """Nó de entrada: executa o comando aqui, no dono do produto ou em todos os nós."""
+    if cmd_tipo in ("RESERVAR", "CANCELAR_RESERVA", "SET_ESTOQUE", "GET_RESERVADO"):
+        produto = payload.get("produto")
+        if cmd_tipo == "GET_RESERVADO" and not produto:
+            respostas, _ = perguntar(outros_nos(), {"tipo": cmd_tipo})
+            totais = dict(reservas.totais.items())
+            for resposta in respostas.values():
+                totais.update(resposta.get("payload", {}).get("totais", {}))
+            return json.dumps({"tipo": "RESERVADO", "payload": {"totais": totais}})
+        no = _no_do_produto(produto)
+        if no == NO_LOCAL:
+            return executar_comando(cmd_tipo, payload, conn)
+        comando = {"tipo": cmd_tipo, "payload": payload}
+        if cmd_tipo in ("RESERVAR", "CANCELAR_RESERVA"):
+            return json.dumps(_encaminhar_da_sessao(no, comando, conn))
+        try:
+            resposta = encaminhar(no, [comando])[0]
+        except (OSError, ValueError):
+            metricas.contar("no_indisponivel_total", no)
+            marcar_transitoria()
+            return json.dumps({"tipo": "RESPOSTA_ERRO", "payload": {"mensagem": f"Nó {no} indisponível."}})
+        if resposta.get("tipo") in TIPOS_TRANSITORIOS:
+            marcar_transitoria()
+        return json.dumps(resposta)
+
+    if cmd_tipo == "GET_ESTOQUE":
+        # Sem versões entre nós: responde sempre com o estoque completo
+        respostas, falharam = perguntar(outros_nos(), {"tipo": "GET_ESTOQUE"})
+        estoque = dict(snapshot_estoque()[1])
+        for resposta in respostas.values():
+            estoque.update(resposta.get("payload", {}))
+        resp = {"tipo": "ESTOQUE_ATUAL", "versao": None, "payload": estoque}
+        if falharam:
+            resp["nos_indisponiveis"] = falharam
+        return json.dumps(resp)
+
+    if cmd_tipo == "BUSCAR_ESTOQUE":
+        return json.dumps(buscar_no_cluster(payload))
+
+    sessao = sessao_da_conexao[conn]
+    if cmd_tipo == "GET_MINHAS_RESERVAS":
+        respostas, _ = perguntar(sessao.nos_remotos or (), {"tipo": cmd_tipo}, sessao)
+        carrinho = sessao.carrinho.copy()
+        for resposta in respostas.values():
+            carrinho.update(resposta.get("payload", {}))
+        return json.dumps({"tipo": "MINHAS_RESERVAS", "payload": carrinho})
+
+    if cmd_tipo == "RENOVAR":
+        # Cada nó conta o prazo das reservas dos seus produtos
+        resposta_local = executar_comando(cmd_tipo, payload, conn)
+        respostas, _ = perguntar(sessao.nos_remotos or (), {"tipo": cmd_tipo}, sessao)
+        if sessao.carrinho:
+            return resposta_local
+        for resposta in respostas.values():
+            if resposta.get("payload", {}).get("status") == "SUCESSO":
+                return json.dumps(resposta)
+        return resposta_local
+
+    if cmd_tipo in ("RESERVAR_LOTE", "CANCELAR_LOTE"):
+        return json.dumps(lote_no_cluster(cmd_tipo, payload, conn))
+
+    if cmd_tipo == "BULK_SET":
+        return json.dumps(bulk_no_cluster(payload, conn))
+
+    return executar_comando(cmd_tipo, payload, conn)
+
+def buscar_no_cluster(payload):
+    """BUSCAR_ESTOQUE em todos os nós: junta as páginas por ordem de nome.
+    Um nó que parou no cursor C pode ter mais nomes depois de C, por isso
+    só os nomes até ao menor desses cursores estão completos."""
+    respostas, falharam = perguntar(outros_nos(), {"tipo": "BUSCAR_ESTOQUE", "payload": payload})
+    paginas = [buscar_estoque(payload)["payload"]] + [r.get("payload", {}) for r in respostas.values()]
+    fronteira = min((p["proximo_cursor"] for p in paginas if p.get("proximo_cursor") is not None), default=None)
+    itens = sorted(item for p in paginas for item in p.get("itens", []))
+    if fronteira is not None:
+        itens = [item for item in itens if item[0] <= fronteira]
+    proximo = fronteira
+    limite = _ler_limite(payload)
+    if len(itens) > limite:
+        itens = itens[:limite]
+        proximo = itens[-1][0]
+    resp = {"tipo": "ESTOQUE_PAGINA", "versao": None, "payload": {"itens": itens, "proximo_cursor": proximo}}
+    if falharam:
+        resp["nos_indisponiveis"] = falharam
+    return resp
+
+def exportar_do_cluster(tamanho_bloco):
+    """EXPORT_ESTOQUE no cluster: as páginas de todos os nós juntas por
+    ordem de nome (ver buscar_no_cluster), no máximo LIMITE_PAGINA_MAXIMO
+    produtos por parte. Um nó que não responde fica de fora e vem no
+    EXPORT_FIM."""
+    cursor, total, faltam = None, 0, set()
+    while True:
+        pagina = buscar_no_cluster({"cursor": cursor, "limite": tamanho_bloco})
+        faltam.update(pagina.get("nos_indisponiveis", ()))
+        itens = pagina["payload"]["itens"]
+        total += len(itens)
+        if itens:
+            yield json.dumps({"tipo": "EXPORT_PARTE", "payload": {"itens": itens}})
+        cursor = pagina["payload"]["proximo_cursor"]
+        if cursor is None:
+            break
+    fim = {"tipo": "EXPORT_FIM", "versao": None, "payload": {"total": total}}
+    if faltam:
+        fim["nos_indisponiveis"] = sorted(faltam)
+    yield json.dumps(fim)
+
+def lote_no_cluster(cmd_tipo, payload, conn):
+    """RESERVAR_LOTE / CANCELAR_LOTE com produtos de vários nós: aplica a
+    parte de cada nó (cada uma tudo ou nada) e, se alguma for recusada,
+    desfaz as que já tinham sido aplicadas. Entretanto outros clientes
+    podem ver o lote aplicado só em parte."""
+    itens = payload.get("itens")
+    if not isinstance(itens, list) or not itens:
+        return processar_lote(cmd_tipo, payload, conn)
+    grupos = {}  # nó -> índices dos itens
+    for i, item in enumerate(itens):
+        grupos.setdefault(_no_do_produto(item.get("produto") if isinstance(item, dict) else None), []).append(i)
+
+    def aplicar(no, tipo, parte):
+        if no == NO_LOCAL:
+            return processar_lote(tipo, {"itens": parte}, conn)
+        return _encaminhar_da_sessao(no, {"tipo": tipo, "payload": {"itens": parte}}, conn)
+
+    if len(grupos) == 1:
+        return aplicar(next(iter(grupos)), cmd_tipo, itens)
+
+    resultados = [None] * len(itens)
+    aplicados = []
+    for no, indices in grupos.items():
+        parte = [itens[i] for i in indices]
+        resposta = aplicar(no, cmd_tipo, parte)
+        for i, resultado in zip(indices, resposta.get("payload", {}).get("itens", [])):
+            resultados[i] = resultado
+        if resposta.get("payload", {}).get("status") != "SUCESSO":
+            break
+        aplicados.append((no, parte))
+    else:
+        return resposta_lote(True, resultados)
+
+    inverso = "CANCELAR_LOTE" if cmd_tipo == "RESERVAR_LOTE" else "RESERVAR_LOTE"
+    for no, parte in aplicados:
+        desfeito = aplicar(no, inverso, parte)
+        if desfeito.get("payload", {}).get("status") != "SUCESSO":
+            log.warning("[CLUSTER] Não foi possível desfazer a parte do lote no nó %s: %s", no, desfeito)
+    for i, resultado in enumerate(resultados):
+        if resultado is None:
+            resultados[i] = {"status": "ERRO", "mensagem": "Não verificado: o lote foi recusado noutro nó."}
+    return resposta_lote(False, resultados)
+
+def bulk_no_cluster(payload, conn):
+    """BULK_SET: cada nó aplica as linhas dos seus produtos, ao mesmo tempo."""
+    itens = payload.get("itens")
+    if not isinstance(itens, list):
+        return json.loads(executar_comando("BULK_SET", payload, conn))
+    grupos = {}
+    for i, item in enumerate(itens):
+        try:
+            no = _no_do_produto(str(item[0]).strip())
+        except (TypeError, KeyError, IndexError):
+            no = NO_LOCAL  # Linha inválida: recusada aqui
+        grupos.setdefault(no, []).append(i)
+
+    futuros = {no: executor_cluster.submit(encaminhar, no, [{"tipo": "BULK_SET", "payload": {"itens": [itens[i] for i in indices]}}])
+               for no, indices in grupos.items() if no != NO_LOCAL}
+    aplicados, erros = 0, []
+    if NO_LOCAL in grupos:
+        indices = grupos[NO_LOCAL]
+        aplicados, erros_locais = definir_estoque_em_bloco([itens[i] for i in indices])
+        erros.extend({**erro, "indice": indices[erro["indice"]]} for erro in erros_locais)
+    for no, futuro in futuros.items():
+        indices = grupos[no]
+        try:
+            resposta = futuro.result()[0].get("payload", {})
+        except (OSError, ValueError):
+            metricas.contar("no_indisponivel_total", no)
+            marcar_transitoria()
+            erros.extend({"indice": i, "mensagem": f"Nó {no} indisponível."} for i in indices)
+            continue
+        aplicados += resposta.get("aplicados", 0)
+        erros.extend({**erro, "indice": indices[erro["indice"]]} for erro in resposta.get("erros", []))
+    erros.sort(key=lambda erro: erro["indice"])
+    return resposta_bulk(aplicados, erros)
+
+def executar_encaminhado(payload, conn):
+    """Dono do produto: executa o comando que outro nó recebeu, na sessão
+    remota do token do cliente (ou, sem token, na da própria ligação)."""
+    comando = payload.get("comando")
+    if not isinstance(comando, dict) or comando.get("tipo") not in COMANDOS_ENCAMINHAVEIS:
+        return json.dumps({"tipo": "RESPOSTA_ERRO", "payload": {"mensagem": "Comando não pode ser encaminhado."}})
+    token = payload.get("sessao")
+    cmd_tipo, cmd_payload = comando["tipo"], comando.get("payload") or {}
+    if not isinstance(token, str):
+        return executar_comando(cmd_tipo, cmd_payload, conn)
+
+    chave = ("remota", token)
+    with lock_remotas:
+        sessao = sessao_da_conexao.get(chave) or registrar_cliente(chave)
+    if cmd_tipo == "SAIR":
+        resposta = json.dumps({"tipo": "BYE", "payload": esvaziar_carrinho(sessao)})
+    else:
+        resposta = executar_comando(cmd_tipo, cmd_payload, chave)
+    if not sessao.carrinho:
+        # Sessão remota vazia: não fica a ocupar memória
+        with lock_remotas:
+            desligar_sessao(chave, token, sair=False)
+    return resposta
+
+def libertar_remotos(sessao):
+    """Devolve ao estoque as reservas da sessão nos outros nós (SAIR, ou o
+    cliente não voltou a tempo). Um nó que não responda devolve-as quando
+    o prazo delas acabar."""
+    nos, sessao.nos_remotos = sessao.nos_remotos, None
+    respostas, _ = perguntar(nos, {"tipo": "SAIR"}, sessao)
+    devolvido = {}
+    for resposta in respostas.values():
+        devolvido.update(resposta.get("payload") or {})
+    return devolvido
+
+# --- (REPLICAÇÃO) ---
+# Um servidor pode ter réplicas só de leitura: cada réplica envia REPLICAR
+# e recebe uma fotografia do estado e depois, pela ordem, cada alteração
+# do estoque e dos carrinhos (ver replicacao.py). As réplicas servem as
+# leituras do catálogo (GET_ESTOQUE, BUSCAR_ESTOQUE, EXPORT_ESTOQUE,
+# SUBSCRIBE); aos outros comandos respondem NAO_PRIMARIO, com o endereço
+# do primário. Uma réplica que não está em dia há mais de ATRASO_MAXIMO
+# segundos responde REPLICA_ATRASADA e o cliente lê do primário.
+# Se o primário cair, PROMOVER transforma uma réplica em primário: os
+# carrinhos replicados passam a sessões desligadas, que os clientes
+# recuperam com o token (SESSAO) dentro de TEMPO_RETOMAR.
+log_replicacao = None  # Primário: LogReplicacao, criado no primeiro REPLICAR
+seguidor = None        # Réplica: Seguidor do primário (None = não é réplica)
+ATRASO_MAXIMO = 1.0    # segundos
+carrinhos_replica = {}  # Réplica: id_cliente (no primário) -> {produto: qtd}
+tokens_replica = {}     # Réplica: id_cliente (no primário) -> token da sessão
+replicas_ligadas = {}   # Primário: conexão -> último seq enviado
+
+# O que uma réplica responde (o resto vai para o primário)
+COMANDOS_REPLICA = frozenset(LEITURAS_REPLICA) | {
+    "SUBSCRIBE", "UNSUBSCRIBE", "HELLO", "GET_METRICS", "GET_REPLICACAO", "PROMOVER", "SEGUIR", "SAIR",
+}
+
+def recusar_na_replica(cmd_tipo):
+    """Resposta de uma réplica a um comando que ela não serve agora, ou None."""
+    if cmd_tipo not in COMANDOS_REPLICA:
+        metricas.contar("replica_recusados_total", "nao_primario")
+        return {"tipo": "NAO_PRIMARIO", "payload": {
+            "mensagem": "Este servidor é uma réplica só de leitura.", "primario": seguidor.primario,
+        }}
+    if cmd_tipo in LEITURAS_REPLICA and seguidor.atraso() > ATRASO_MAXIMO:
+        metricas.contar("replica_recusados_total", "atrasada")
+        return {"tipo": "REPLICA_ATRASADA", "payload": {
+            "mensagem": "Réplica desatualizada: leia do primário.", "primario": seguidor.primario,
+        }}
+    return None
+
+def _fotografia_replicacao():
+    """Partes da fotografia do estado para uma réplica; devolve o seq dela."""
+    global log_replicacao
+    with travar_tudo():
+        with lock_clientes:
+            if log_replicacao is None:
+                # Daqui em diante cada alteração também vai para o log (ver registrar_alteracao)
+                log_replicacao = LogReplicacao()
+            seq = log_replicacao.seq
+            estoque = list(estoque_disponivel.items())
+            com_carrinho = [s for s in sessoes.values() if s.carrinho]
+            carrinhos = [(s.id_cliente, s.carrinho.copy()) for s in com_carrinho]
+            tokens = {s.id_cliente: s.token for s in com_carrinho}
+    metricas.contar("replicacao_fotografias_total")
+    for i in range(0, len(estoque), ITENS_POR_PARTE):
+        yield json.dumps({"tipo": "REPLICA_FOTO_PARTE", "payload": {"estoque": dict(estoque[i:i + ITENS_POR_PARTE])}})
+    for i in range(0, len(carrinhos), ITENS_POR_PARTE):
+        yield json.dumps({"tipo": "REPLICA_FOTO_PARTE", "payload": {"carrinhos": dict(carrinhos[i:i + ITENS_POR_PARTE])}})
+    yield json.dumps({"tipo": "REPLICA_FOTO", "payload": {
+        "seq": seq, "epoca": log_replicacao.epoca, "tokens": tokens, "ate": seq,
+    }})
+    return seq
+
+def transmitir_replicacao(payload, conn):
+    """REPLICAR: envia à réplica o que lhe falta (só as alterações, se o
+    log ainda as tiver; senão uma fotografia) e depois, sem fim, as
+    alterações novas ou um pulso a cada INTERVALO_PULSO."""
+    desde = payload.get("desde")
+    if (log_replicacao is None or payload.get("epoca") != log_replicacao.epoca
+            or not isinstance(desde, int) or not log_replicacao.cobre(desde)):
+        desde = yield from _fotografia_replicacao()
+    log.info("[REPLICACAO] Réplica %s ligada (seq %d).", _nome_da_conexao(conn), desde)
+    metricas.contar("replicas_ligadas")
+    try:
+        while True:
+            replicas_ligadas[conn] = desde
+            novos = log_replicacao.desde(desde)
+            if novos is None:
+                # A réplica ficou para trás mais do que o log guarda
+                desde = yield from _fotografia_replicacao()
+                continue
+            registos, ate = novos
+            if registos:
+                desde = registos[-1][0]
+                metricas.contar("replicacao_registos_total", valor=len(registos))
+            yield json.dumps({"tipo": "REPLICA_REGISTOS", "payload": {"registos": registos, "ate": ate}})
+    finally:
+        replicas_ligadas.pop(conn, None)
+        metricas.contar("replicas_ligadas", valor=-1)
+
+def _nome_da_conexao(conn):
+    try:
+        endereco = conn.get_extra_info("peername") if isinstance(conn, asyncio.StreamWriter) else conn.getpeername()
+        return f"{endereco[0]}:{endereco[1]}"
+    except (OSError, TypeError):
+        return "?"
+
+def aplicar_fotografia_replica(estoque, carrinhos, tokens):
+    """Réplica: troca o estado inteiro pelo da fotografia do primário."""
+    with travar_tudo():
+        alterados = [p for p in set(estoque_disponivel) | set(estoque) if estoque_disponivel.get(p) != estoque.get(p)]
+        estoque_disponivel.clear()
+        estoque_disponivel.update(estoque)
+        for produto in alterados:
+            log_alteracoes.registrar(produto)
+        carrinhos_replica.clear()
+        carrinhos_replica.update(carrinhos)
+        tokens_replica.clear()
+        tokens_replica.update(tokens)
+
+def aplicar_registos_replica(registros):
+    """Réplica: aplica uma alteração do primário. Só a thread do Seguidor
+    escreve nos carrinhos replicados; o estoque é lido por todas."""
+    for registro in registros:
+        if registro[0] == "S":
+            _, id_cliente, token = registro
+            tokens_replica[id_cliente] = token
+            continue
+        produto = registro[1] if registro[0] == "E" else registro[2]
+        with lock_do_produto(produto):
+            aplicar_registro(estoque_disponivel, carrinhos_replica, registro)
+            if registro[0] == "E":
+                log_alteracoes.registrar(produto)
+        if registro[0] == "C" and registro[1] not in carrinhos_replica:
+            tokens_replica.pop(registro[1], None)
+
+def iniciar_replica(primario):
+    global seguidor
+    seguidor = Seguidor(primario, aplicar_fotografia_replica, aplicar_registos_replica)
+    seguidor.iniciar()
+    log.info("[REPLICA] Réplica de %s (leituras com até %.1f s de atraso).", primario, ATRASO_MAXIMO)
+
+def promover():
+    """PROMOVER: a réplica deixa de seguir o primário e passa a aceitar
+    alterações. Devolve o número de carrinhos recuperados (None se já era
+    o primário). Os ids das sessões são novos, para não colidirem com os
+    das ligações que esta réplica já atendeu; os tokens são os mesmos."""
+    global seguidor, proximo_id_cliente
+    antigo = seguidor
+    if antigo is None:
+        return None
+    antigo.parar()
+    restauradas = []
+    with travar_tudo():
+        with lock_clientes:
+            for id_cliente, carrinho in carrinhos_replica.items():
+                sessao = Sessao(tokens_replica.get(id_cliente) or secrets.token_hex(16), proximo_id_cliente)
+                proximo_id_cliente += 1
+                for produto, quantidade in carrinho.items():
+                    reservas.alterar(sessao, produto, quantidade)
+                sessoes[sessao.token] = sessao
+                restauradas.append(sessao)
+            carrinhos_replica.clear()
+            tokens_replica.clear()
+            seguidor = None
+    for sessao in restauradas:
+        definir_prazo(sessao, time.monotonic() + TEMPO_RETOMAR)
+    log.info("[REPLICA] Promovida a primário (era réplica de %s); %d carrinhos à espera dos clientes.",
+             antigo.primario, len(restauradas))
+    return len(restauradas)
+
+def estado_replicacao():
+    """GET_REPLICACAO: o papel deste servidor e quão em dia está."""
+    if seguidor is not None:
+        atraso = seguidor.atraso()
+        return {"papel": "replica", "primario": seguidor.primario, "seq": seguidor.seq,
+                "atraso": None if atraso == float("inf") else round(atraso, 3)}
+    estado = {"papel": "primario", "seq": 0, "epoca": None, "replicas": {}}
+    if log_replicacao is not None:
+        estado.update(seq=log_replicacao.seq, epoca=log_replicacao.epoca,
+                      replicas={_nome_da_conexao(conn): seq for conn, seq in list(replicas_ligadas.items())})
+    return estado
+
+def start(reuse_port=False):
+    iniciar_notificador()
+    iniciar_expirador()
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Permite reiniciar logo a seguir a uma queda (portas em TIME_WAIT)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Vários processos a aceitar na mesma porta; o kernel reparte as conexões
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server.settimeout(1.0) 
     
     server.bind((HOST, PORT))
-    server.listen()
-    print(f"[SERVIDOR] Mercadinho rodando em {HOST}:{PORT}")
+    server.listen(FILA_ACEITACAO)
+    log.info("[SERVIDOR] Mercadinho rodando em %s:%s", HOST, PORT)
 
     try:
         while True:
             try:
                 conn, addr = server.accept()
-                thread = threading.Thread(target=handle_client, args=(conn, addr))
+                if not admitir_conexao():
+                    # Cheio: responde logo, sem gastar uma thread com a conexão
+                    recusar_conexao(conn)
+                    continue
+                # daemon: ao desligar, as conexões abertas não seguram o processo
+                thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
                 thread.start()
             
             except socket.timeout:
                 pass 
             
     except KeyboardInterrupt:
-        print("\n[DESLIGANDO] Recebido Ctrl+C. A desligar...")
+        log.info("[DESLIGANDO] Recebido Ctrl+C (ou SIGTERM). A desligar...")
         
     finally:
         server.close()
-        print("[SERVIDOR DESLIGADO]")
+        fechar_movimentos()
+        log.info("[SERVIDOR DESLIGADO]")
+
+async def _servir_async(reuse_port=False):
+    # asyncio.to_thread usa o executor padrão do loop
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=THREADS_COMANDOS, thread_name_prefix="comandos"))
+    iniciar_notificador()
+    iniciar_expirador()
+    server = await asyncio.start_server(handle_client_async, HOST, PORT, backlog=FILA_ACEITACAO,
+                                        limit=TAMANHO_MAXIMO, reuse_port=reuse_port or None)
+    log.info("[SERVIDOR] Mercadinho (asyncio) rodando em %s:%s", HOST, PORT)
+    async with server:
+        await server.serve_forever()
+
+def start_async(reuse_port=False):
+    try:
+        asyncio.run(_servir_async(reuse_port))
+    except KeyboardInterrupt:
+        log.info("[DESLIGANDO] Recebido Ctrl+C (ou SIGTERM). A desligar...")
+    finally:
+        fechar_movimentos()
+        log.info("[SERVIDOR DESLIGADO]")
+
+# --- (ENDPOINT DE MÉTRICAS) ---
+# Com --porta-metricas, as métricas ficam também em HTTP, no formato de
+# texto do Prometheus (GET /metrics).
+class _PedidoMetricas(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        corpo = metricas.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def log_message(self, formato, *args):
+        log.debug("[METRICAS] " + formato, *args)
+
+def configurar_registro(nivel, por_segundo):
+    registro.configurar(nivel, por_segundo, ao_descartar=lambda: metricas.contar("logs_descartados_total"))
+
+def iniciar_endpoint_metricas(porta):
+    servidor_http = ThreadingHTTPServer((HOST, porta), _PedidoMetricas)
+    threading.Thread(target=servidor_http.serve_forever, daemon=True).start()
+    log.info("[SERVIDOR] Métricas em http://%s:%s/metrics", HOST, porta)
+
+# --- (MODO MULTIPROCESSO) ---
+# Por causa do GIL, um processo só usa um núcleo. Com --workers N, N
+# processos aceitam na mesma porta (SO_REUSEPORT) e partilham o estoque,
+# a versão/log de alterações e os locks das fatias em memória partilhada.
+# Os carrinhos continuam locais: cada um pertence ao processo dono da conexão.
+CAPACIDADE_PRODUTOS = 100000
+
+def preparar_memoria_compartilhada(capacidade=CAPACIDADE_PRODUTOS):
+    global estoque_disponivel, log_alteracoes, locks_fatias, livro_movimentos
+    estoque = EstoqueCompartilhado(capacidade)
+    estoque.update(estoque_disponivel)
+    estoque_disponivel = estoque
+    log_alteracoes = LogAlteracoesCompartilhado(estoque, TAMANHO_LOG_ALTERACOES)
+    reservas.totais = TotaisCompartilhados(estoque)
+    livro_movimentos = None  # Cada processo só veria os seus movimentos
+    locks_fatias = [LockMedido(contexto_mp.Lock(), metricas) for _ in range(N_FATIAS)]
+
+def _worker(modo, opcoes_registro, porta_metricas):
+    # A thread que escreve o registo não sobrevive ao fork: liga-a de novo
+    configurar_registro(*opcoes_registro)
+    if porta_metricas:
+        iniciar_endpoint_metricas(porta_metricas)
+    if modo == "asyncio":
+        start_async(reuse_port=True)
+    else:
+        start(reuse_port=True)
+
+def start_workers(n, modo, opcoes_registro, porta_metricas=None):
+    # Tudo o que é partilhado tem de existir antes do fork
+    preparar_memoria_compartilhada()
+    # As métricas são de cada processo: o worker i responde em porta_metricas + i
+    processos = [contexto_mp.Process(target=_worker, args=(modo, opcoes_registro, porta_metricas and porta_metricas + i))
+                 for i in range(n)]
+    for processo in processos:
+        processo.start()
+    log.info("[SERVIDOR] %d processos (%s) a partilhar %s:%s", n, modo, HOST, PORT)
+
+    # 'kill' no processo principal também derruba os workers
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        for processo in processos:
+            processo.join()
+    except (KeyboardInterrupt, SystemExit):
+        for processo in processos:
+            processo.terminate()
+        for processo in processos:
+            processo.join(timeout=5)
+
+def main():
+    global HOST, PORT, JANELA_PUSH, CHECKPOINT_A_CADA, TTL_RESERVA, TEMPO_RETOMAR
+    global MAXIMO_CONEXOES, FILA_ACEITACAO, TEMPO_OCIOSO, TEMPO_LEITURA, TEMPO_ESCRITA, LIMITE_PEDIDOS, RAJADA_PEDIDOS
+    global ATRASO_MAXIMO
+    parser = argparse.ArgumentParser(description="Servidor do Mercadinho")
+    parser.add_argument("--modo", choices=["threads", "asyncio"], default="threads",
+                        help="threads: uma thread por conexão (padrão); asyncio: um único event loop")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--porta", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="número de processos a atender na mesma porta (estoque em memória partilhada)")
+    parser.add_argument("--dados", default=None,
+                        help="pasta onde gravar o diário e os snapshots (sem ela, o estoque fica só em memória)")
+    parser.add_argument("--movimentos", default=None,
+                        help="pasta dos segmentos do livro de movimentos (padrão: <dados>/movimentos)")
+    parser.add_argument("--checkpoint-a-cada", type=int, default=CHECKPOINT_A_CADA,
+                        help="número de alterações no diário entre dois snapshots")
+    parser.add_argument("--janela-push", type=float, default=JANELA_PUSH,
+                        help="janela (s) em que as alterações são agrupadas antes do push")
+    parser.add_argument("--ttl-reserva", type=float, default=TTL_RESERVA,
+                        help="segundos que as reservas duram sem serem renovadas")
+    parser.add_argument("--tempo-retomar", type=float, default=TEMPO_RETOMAR,
+                        help="segundos que o carrinho de um cliente que caiu espera que ele volte")
+    parser.add_argument("--log-nivel", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="DEBUG mostra cada comando recebido")
+    parser.add_argument("--log-por-segundo", type=float, default=200,
+                        help="máximo de mensagens de registo por segundo (0 = sem limite)")
+    parser.add_argument("--porta-metricas", type=int, default=None,
+                        help="porta HTTP para as métricas no formato Prometheus (/metrics)")
+    parser.add_argument("--max-conexoes", type=int, default=MAXIMO_CONEXOES,
+                        help="conexões abertas ao mesmo tempo, por processo (0 = sem limite)")
+    parser.add_argument("--fila-aceitacao", type=int, default=FILA_ACEITACAO,
+                        help="conexões que podem esperar para serem aceites (backlog do listen)")
+    parser.add_argument("--tempo-ocioso", type=float, default=TEMPO_OCIOSO,
+                        help="segundos sem mensagens até a conexão ser fechada")
+    parser.add_argument("--tempo-leitura", type=float, default=TEMPO_LEITURA,
+                        help="segundos para o cliente acabar de enviar uma mensagem já começada")
+    parser.add_argument("--tempo-escrita", type=float, default=TEMPO_ESCRITA,
+                        help="segundos para o cliente receber uma resposta (ou um assinante aceitar eventos)")
+    parser.add_argument("--limite-pedidos", type=float, default=LIMITE_PEDIDOS,
+                        help="comandos que alteram o estoque por segundo, por cliente (0 = sem limite)")
+    parser.add_argument("--rajada-pedidos", type=int, default=RAJADA_PEDIDOS,
+                        help="rajada permitida acima de --limite-pedidos (padrão: igual ao limite)")
+    parser.add_argument("--cluster", default=None,
+                        help="nós do cluster, separados por vírgulas (ex.: 127.0.0.1:5050,127.0.0.1:5051)")
+    parser.add_argument("--no", default=None,
+                        help="endereço deste nó tal como aparece em --cluster (padrão: host:porta)")
+    parser.add_argument("--replica-de", default=None,
+                        help="host:porta do primário: este servidor fica uma réplica só de leitura")
+    parser.add_argument("--atraso-maximo", type=float, default=ATRASO_MAXIMO,
+                        help="segundos de atraso a partir dos quais a réplica manda as leituras para o primário")
+    args = parser.parse_args()
+
+    opcoes_registro = (args.log_nivel, args.log_por_segundo)
+    configurar_registro(*opcoes_registro)
+    HOST, PORT = args.host, args.porta
+    TTL_RESERVA, TEMPO_RETOMAR = args.ttl_reserva, args.tempo_retomar
+    JANELA_PUSH = args.janela_push
+    CHECKPOINT_A_CADA = args.checkpoint_a_cada
+    MAXIMO_CONEXOES, FILA_ACEITACAO = args.max_conexoes, args.fila_aceitacao
+    TEMPO_OCIOSO, TEMPO_LEITURA, TEMPO_ESCRITA = args.tempo_ocioso, args.tempo_leitura, args.tempo_escrita
+    LIMITE_PEDIDOS, RAJADA_PEDIDOS = args.limite_pedidos, args.rajada_pedidos
+    ATRASO_MAXIMO = args.atraso_maximo
+    if args.replica_de:
+        if args.dados or args.movimentos or args.cluster or args.workers > 1:
+            parser.error("--replica-de não funciona com --dados, --movimentos, --cluster nem --workers")
+        iniciar_replica(args.replica_de)
+    if args.cluster:
+        nos = [no.strip() for no in args.cluster.split(",") if no.strip()]
+        no_local = args.no or f"{args.host}:{args.porta}"
+        if no_local not in nos:
+            parser.error(f"este nó ({no_local}) não está em --cluster; indique-o com --no")
+        if args.workers > 1 or args.modo != "threads":
+            parser.error("--cluster só funciona com --modo threads e sem --workers")
+        configurar_cluster(nos, no_local)
+    if args.workers > 1:
+        if args.dados or args.movimentos:
+            parser.error("--dados e --movimentos ainda não são suportados com --workers > 1")
+        if not hasattr(socket, "SO_REUSEPORT") or contexto_mp is None:
+            parser.error("--workers precisa de fork e SO_REUSEPORT, que este sistema não tem")
+        start_workers(args.workers, args.modo, opcoes_registro, args.porta_metricas)
+        return
+    pasta_movimentos = args.movimentos or (args.dados and os.path.join(args.dados, "movimentos"))
+    if pasta_movimentos:
+        abrir_movimentos(pasta_movimentos)
+    if args.dados:
+        carregar_estado(args.dados)
+    if args.porta_metricas:
+        iniciar_endpoint_metricas(args.porta_metricas)
+    # 'kill' desliga como o Ctrl+C: o que está em memória no livro de
+    # movimentos é gravado antes de sair
+    signal.signal(signal.SIGTERM, _interromper)
+    if args.modo == "asyncio":
+        start_async()
+    else:
+        start()
+
+def _interromper(*_):
+    raise KeyboardInterrupt
 
 if __name__ == "__main__":
-    start()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,88 @@
+# temporizadores.py
+# Roda de temporizadores hierárquica (hierarchical timer wheel), usada
+# para fazer expirar as reservas.
+#
+# O tempo anda em "ticks" de tamanho fixo. O nível 0 tem uma casa por
+# tick; cada casa do nível 1 cobre uma volta inteira do nível 0, e assim
+# por diante. Agendar é só pôr o temporizador na casa certa e expirar é
+# esvaziar a casa do tick atual: as duas coisas são O(1), seja qual for o
+# número de temporizadores. Quando o nível 0 dá uma volta, a casa seguinte
+# do nível 1 é "descida" (cada temporizador volta a ser agendado, agora
+# num nível mais baixo).
+#
+# Cancelar só marca o temporizador; ele é descartado quando a sua casa
+# for esvaziada.
+import math
+import threading
+
+
+class Temporizador:
+    __slots__ = ("prazo", "dado", "cancelado")
+
+    def __init__(self, prazo, dado):
+        self.prazo = prazo
+        self.dado = dado
+        self.cancelado = False
+
+
+class RodaTemporizadores:
+    def __init__(self, agora, tick=0.1, casas=64, niveis=4):
+        self.tick = tick
+        self.casas = casas
+        self.niveis = niveis
+        self.rodas = [[[] for _ in range(casas)] for _ in range(niveis)]
+        self.tick_atual = int(agora / tick)
+        self.lock = threading.Lock()
+
+    def agendar(self, prazo, dado):
+        """Agenda 'dado' para expirar no instante 'prazo' (nunca antes)."""
+        temporizador = Temporizador(prazo, dado)
+        with self.lock:
+            self._inserir(temporizador)
+        return temporizador
+
+    def cancelar(self, temporizador):
+        temporizador.cancelado = True
+
+    def _inserir(self, temporizador, descendo=False):
+        # Um temporizador novo vai no mínimo para o próximo tick; um que está a
+        # descer de nível ainda pode cair na casa do tick atual (esvaziada logo a seguir)
+        alvo = max(math.ceil(temporizador.prazo / self.tick), self.tick_atual + (0 if descendo else 1))
+        distancia = alvo - self.tick_atual
+        nivel, alcance = 0, self.casas
+        while distancia >= alcance and nivel < self.niveis - 1:
+            nivel += 1
+            alcance *= self.casas
+        if distancia >= alcance:
+            # Além do último nível: fica na última casa alcançável e é
+            # reagendado quando ela for descida
+            alvo = self.tick_atual + alcance - 1
+        casa = (alvo // (alcance // self.casas)) % self.casas
+        self.rodas[nivel][casa].append(temporizador)
+
+    def avancar(self, agora):
+        """Anda até ao instante 'agora' e devolve os temporizadores expirados."""
+        expirados = []
+        fim = int(agora / self.tick)
+        with self.lock:
+            while self.tick_atual < fim:
+                self.tick_atual += 1
+                self._descer(1, self.tick_atual)
+                casa = self.rodas[0][self.tick_atual % self.casas]
+                if casa:
+                    self.rodas[0][self.tick_atual % self.casas] = []
+                    expirados.extend(t for t in casa if not t.cancelado)
+        return expirados
+
+    def _descer(self, nivel, tick):
+        """No fim de cada volta do nível abaixo, redistribui a casa seguinte deste nível."""
+        if nivel >= self.niveis or tick % self.casas:
+            return
+        tick //= self.casas
+        self._descer(nivel + 1, tick)
+        casa = self.rodas[nivel][tick % self.casas]
+        if casa:
+            self.rodas[nivel][tick % self.casas] = []
+            for temporizador in casa:
+                if not temporizador.cancelado:
+                    self._inserir(temporizador, descendo=True)
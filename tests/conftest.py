@@ -0,0 +1,82 @@
+# tests/conftest.py
+# Servidor a correr numa thread do processo dos testes (como o --em-processo
+# do benchmark.py), numa porta livre.
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import servidor
+from protocolo import LeitorMensagens, codificar
+
+
+def _porta_livre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def subir_servidor(modo):
+    porta = _porta_livre()
+    servidor.HOST, servidor.PORT = "127.0.0.1", porta
+    alvo = servidor.start_async if modo == "asyncio" else servidor.start
+    threading.Thread(target=alvo, daemon=True).start()
+    return _esperar_porta(porta)
+
+
+def _esperar_porta(porta):
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", porta), timeout=0.5).close()
+            return porta
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("O servidor não subiu a tempo.")
+
+
+def subir_processo(porta, *argumentos):
+    """servidor.py noutro processo (para o cluster e as réplicas, que
+    precisam de vários servidores). Quem chama termina o processo."""
+    pasta = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    processo = subprocess.Popen(
+        [sys.executable, os.path.join(pasta, "servidor.py"), "--host", "127.0.0.1", "--porta", str(porta),
+         "--log-nivel", "WARNING", *argumentos],
+        cwd=pasta, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _esperar_porta(porta)
+    return processo
+
+
+class Cliente:
+    def __init__(self, porta):
+        self.sock = socket.create_connection(("127.0.0.1", porta), timeout=5)
+        self.leitor = LeitorMensagens(self.sock)
+
+    def enviar(self, tipo, payload=None, **extra):
+        mensagem = {"tipo": tipo, **extra}
+        if payload is not None:
+            mensagem["payload"] = payload
+        self.sock.sendall(codificar(mensagem))
+
+    def ler(self):
+        return self.leitor.ler()
+
+    def pedir(self, tipo, payload=None, **extra):
+        self.enviar(tipo, payload, **extra)
+        return self.ler()
+
+    def fechar(self):
+        self.sock.close()
+
+
+@pytest.fixture(scope="module")
+def porta_asyncio():
+    return subir_servidor("asyncio")
+
+
+@pytest.fixture(scope="module")
+def porta_threads():
+    return subir_servidor("threads")
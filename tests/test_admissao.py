@@ -0,0 +1,75 @@
+# tests/test_admissao.py
+# Controlo de admissão: prazos de inatividade e limite de pedidos.
+import threading
+import time
+
+import pytest
+
+import servidor
+from cliente_gui import NetworkClient
+from conftest import Cliente
+
+
+@pytest.fixture
+def ocioso_curto(monkeypatch):
+    monkeypatch.setattr(servidor, "TEMPO_OCIOSO", 0.5)
+
+
+@pytest.mark.parametrize("modo", ["threads", "asyncio"])
+def test_assinante_nao_expira_por_inatividade(modo, porta_threads, porta_asyncio, ocioso_curto):
+    porta = porta_threads if modo == "threads" else porta_asyncio
+    parado, assinante = Cliente(porta), Cliente(porta)
+    assert assinante.pedir("SUBSCRIBE", {"snapshot": False})["tipo"] == "ASSINATURA_OK"
+    parado.pedir("GET_METRICS")  # A ligação já leu com o prazo curto
+    time.sleep(1.5)
+    with pytest.raises(ConnectionResetError):
+        parado.ler()  # Fechada por inatividade
+    # O assinante continua ligado e a receber eventos
+    servidor.definir_estoque(f"produto_ocioso_{modo}", 3)
+    assert assinante.ler()["tipo"] == "EVENTO_ESTOQUE"
+    assert assinante.pedir("GET_METRICS")["tipo"] == "METRICAS"
+    parado.fechar()
+    assinante.fechar()
+
+
+def test_limite_de_pedidos(monkeypatch):
+    monkeypatch.setattr(servidor, "LIMITE_PEDIDOS", 2.0)
+    monkeypatch.setattr(servidor, "RAJADA_PEDIDOS", 3)
+    conn = object()
+    servidor.registrar_cliente(conn)
+    assert [servidor.consumir_ficha(conn) for _ in range(3)] == [0, 0, 0]
+    espera = servidor.consumir_ficha(conn)
+    assert 0 < espera <= 0.5
+    time.sleep(espera)
+    assert servidor.consumir_ficha(conn) == 0
+    servidor.desligar_sessao(conn, "teste", True)
+
+
+def test_cliente_volta_a_assinar_depois_de_perder_a_ligacao(porta_threads):
+    rede = NetworkClient()
+    rede.ao_erro = lambda titulo, mensagem: None
+    rede.iniciar_trabalhador(lambda funcao, *args: funcao(*args))
+    assert rede.connect_enderecos([("127.0.0.1", porta_threads)])
+    servidor.definir_estoque("produto_religar", 5)
+    resposta = rede.send_command({"tipo": "RESERVAR", "payload": {"produto": "produto_religar", "quantidade": 1}})
+    assert resposta["payload"]["status"] == "SUCESSO"
+    eventos = []
+    assert rede.assinar(eventos.append, janela=0.0, snapshot=False) is not None
+    token = rede.token
+
+    # O servidor corta a ligação (ex.: reinício de um proxy); só há um servidor
+    with servidor.lock_clientes:
+        antiga = servidor.sessoes[token].conn
+    religou = threading.Event()
+    rede.ao_religar = lambda primario: religou.set()
+    antiga.shutdown(2)
+    assert religou.wait(5)
+    assert rede.token == token  # Recuperou a sessão (e o carrinho)
+    servidor.definir_estoque("produto_religar", 9)
+    for _ in range(50):
+        if any("produto_religar" in e.get("payload", {}) for e in eventos):
+            break
+        time.sleep(0.1)
+    else:
+        pytest.fail("Sem eventos depois de voltar a ligar")
+    rede.close()
@@ -0,0 +1,58 @@
+# tests/test_assinaturas.py
+import socket
+import time
+
+import pytest
+
+import servidor
+from conftest import Cliente
+
+
+def test_alteracoes_da_janela_chegam_num_so_evento(porta_threads):
+    assinante = Cliente(porta_threads)
+    assert assinante.pedir("SUBSCRIBE", {"snapshot": False, "janela": 0.5})["tipo"] == "ASSINATURA_OK"
+    servidor.definir_estoque("janela_a", 1)
+    primeiro = assinante.ler()
+    assert primeiro["tipo"] == "EVENTO_ESTOQUE" and primeiro["payload"]["janela_a"] == 1
+
+    # Dentro da janela: várias alterações, um único evento com o valor final
+    for quantidade in range(2, 7):
+        servidor.definir_estoque("janela_a", quantidade)
+    servidor.definir_estoque("janela_b", 9)
+    segundo = assinante.ler()
+    assert segundo["payload"] == {"janela_a": 6, "janela_b": 9}
+    assert segundo["versao"] > primeiro["versao"] and not segundo["completo"]
+    assinante.sock.settimeout(0.8)
+    with pytest.raises(socket.timeout):
+        assinante.ler()
+    assinante.fechar()
+
+
+def test_assinante_que_nao_le_nao_atrasa_os_outros(porta_threads, monkeypatch):
+    monkeypatch.setattr(servidor, "TEMPO_ESCRITA", 0.5)
+    lento = socket.socket()
+    lento.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    lento.connect(("127.0.0.1", porta_threads))
+    lento.sendall(b'{"tipo": "SUBSCRIBE", "payload": {"snapshot": false, "janela": 0}}\n')
+    rapido = Cliente(porta_threads)
+    assert rapido.pedir("SUBSCRIBE", {"snapshot": False, "janela": 0})["tipo"] == "ASSINATURA_OK"
+    time.sleep(0.2)  # O lento fica assinado sem nunca ler
+    conn_lento = next(c for c in list(servidor.assinantes) if not isinstance(c, servidor.asyncio.StreamWriter)
+                      and c.getpeername() == lento.getsockname())
+
+    # Eventos grandes até encherem os buffers do lento; sem aceitar eventos
+    # durante TEMPO_ESCRITA, ele é desligado. O rápido recebe tudo a tempo.
+    nomes = [f"lento{i:05d}" for i in range(20000)]
+    for rodada in range(1, 40):
+        servidor.definir_estoque_em_bloco([[nome, rodada] for nome in nomes])
+        recebidos = {}
+        while recebidos.get(nomes[-1]) != rodada:
+            recebidos.update(rapido.ler()["payload"])
+        assert all(recebidos[nome] == rodada for nome in nomes)
+        if conn_lento not in servidor.assinantes:
+            break
+        time.sleep(0.2)
+    assert conn_lento not in servidor.assinantes
+    assert servidor.metricas.coletar()["contadores"]["assinantes_lentos_total"] >= 1
+    lento.close()
+    rapido.fechar()
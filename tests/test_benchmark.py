@@ -0,0 +1,39 @@
+# tests/test_benchmark.py
+# Gerador de carga mista do benchmark.py (python benchmark.py carga).
+import argparse
+import asyncio
+
+import pytest
+
+import benchmark
+from conftest import _porta_livre, subir_processo
+
+
+def test_ler_mix_e_percentil():
+    assert benchmark.ler_mix("get_estoque=30, RESERVAR=10,DESCONECTAR") == {
+        "GET_ESTOQUE": 30.0, "RESERVAR": 10.0, "DESCONECTAR": 1.0}
+    with pytest.raises(argparse.ArgumentTypeError):
+        benchmark.ler_mix("APAGAR_TUDO=1")
+    ordenados = list(range(1, 1001))
+    assert benchmark.percentil(ordenados, 50) == 501
+    assert benchmark.percentil(ordenados, 99.9) == 1000
+    assert benchmark.percentil([7], 99) == 7
+    assert benchmark.percentil([], 50) is None
+
+
+def test_carga_mista_conserva_o_estoque_com_quedas():
+    porta = _porta_livre()
+    processo = subir_processo(porta, "--tempo-retomar", "0.5")
+    try:
+        args = argparse.Namespace(
+            mix=benchmark.ler_mix("GET_ESTOQUE=2,RESERVAR=4,CANCELAR_RESERVA=2,SET_ESTOQUE=1,DESCONECTAR=1"),
+            produtos=5, estoque_inicial=20, clientes=8, duracao=1.0, tempo_retomar=0.5)
+        resultado = asyncio.run(benchmark._carga_mista(args, porta))
+    finally:
+        processo.terminate()
+        processo.wait()
+    assert resultado["clientes"] == 8 and resultado["desconexoes"] > 0
+    assert resultado["conservacao"]["ok"], resultado["conservacao"]
+    for tipo, medidas in resultado["comandos"].items():
+        assert medidas["n"] > 0 and medidas["erros"] == 0, tipo
+        assert medidas["p50_ms"] <= medidas["p99_ms"] <= medidas["max_ms"]
@@ -0,0 +1,58 @@
+# tests/test_binario.py
+import socket
+
+import servidor
+from protocolo import (
+    B_RESERVAR, CodecBinario, LeitorMensagens, _ler_tabela, codificar_tabela, negociar_binario,
+)
+
+
+def test_tabela_ida_e_volta():
+    corpo = codificar_tabela([(0, 5), (7, -1)], [(7, "pão de ló")], versao=42, completo=False)
+    assert _ler_tabela(corpo, True) == (42, False, {7: "pão de ló"}, [(0, 5), (7, -1)])
+    corpo = codificar_tabela([(3, 2)], [])
+    assert _ler_tabela(corpo, False) == (None, True, {}, [(3, 2)])
+
+
+class ClienteBinario:
+    def __init__(self, porta):
+        self.sock = socket.create_connection(("127.0.0.1", porta), timeout=5)
+        self.leitor = LeitorMensagens(self.sock)
+        self.codec = negociar_binario(self.sock, self.leitor)
+
+    def pedir(self, tipo, payload=None):
+        comando = {"tipo": tipo, "payload": payload or {}}
+        dados = self.codec.codificar(comando)
+        self.sock.sendall(dados)
+        return dados[4], self.codec.decodificar(*self.leitor.ler_quadro())
+
+
+def test_cliente_binario_fala_com_o_servidor(porta_threads):
+    servidor.definir_estoque("binario", 10)
+    cliente = ClienteBinario(porta_threads)
+    assert isinstance(cliente.codec, CodecBinario)
+
+    # Ainda sem o ID do produto: a reserva vai em JSON dentro de um quadro
+    tipo, resposta = cliente.pedir("RESERVAR", {"produto": "binario", "quantidade": 2})
+    assert tipo != B_RESERVAR and resposta["payload"]["status"] == "SUCESSO"
+
+    tipo, estoque = cliente.pedir("GET_ESTOQUE")
+    assert estoque["tipo"] == "ESTOQUE_ATUAL" and estoque["payload"]["binario"] == 8
+
+    # Depois do GET_ESTOQUE o cliente sabe o ID e usa o quadro binário
+    tipo, resposta = cliente.pedir("RESERVAR", {"produto": "binario", "quantidade": 3})
+    assert tipo == B_RESERVAR
+    assert resposta == {"tipo": "RESPOSTA_RESERVA", "payload": {
+        "status": "SUCESSO", "mensagem": "Reserva de 3 'binario' efetuada com sucesso!"}}
+    _, resposta = cliente.pedir("RESERVAR", {"produto": "binario", "quantidade": 99})
+    assert resposta["payload"]["mensagem"] == "Estoque insuficiente. Temos apenas 5 'binario'."
+
+    _, delta = cliente.pedir("GET_ESTOQUE", {"desde_versao": estoque["versao"]})
+    assert delta["tipo"] == "ESTOQUE_DELTA" and delta["payload"] == {"binario": 5}
+    _, reservas = cliente.pedir("GET_MINHAS_RESERVAS")
+    assert reservas == {"tipo": "MINHAS_RESERVAS", "payload": {"binario": 5}}
+    # Comandos sem forma binária continuam a funcionar (JSON num quadro)
+    _, metricas = cliente.pedir("GET_METRICS")
+    assert metricas["tipo"] == "METRICAS"
+    assert cliente.pedir("SAIR")[1] == {"tipo": "BYE"}
+    cliente.sock.close()
@@ -0,0 +1,91 @@
+# tests/test_catalogo.py
+import json
+
+import catalogo
+import servidor
+from catalogo import IndiceCatalogo
+
+
+def _todas_as_paginas(indice, limite, **filtros):
+    nomes, cursor = [], None
+    while True:
+        pagina, cursor = indice.buscar(cursor=cursor, limite=limite, **filtros)
+        nomes += pagina
+        if cursor is None:
+            return nomes
+
+
+def test_paginas_cobrem_tudo_sem_repetir():
+    indice = IndiceCatalogo()
+    estoque = {f"p{i:03d}": i % 3 for i in range(30)}
+    indice.reconstruir(estoque, 1)
+    for limite in (1, 7, 10, 30, 31):  # Incluindo páginas que acabam mesmo no último nome
+        assert _todas_as_paginas(indice, limite) == sorted(estoque)
+    assert _todas_as_paginas(indice, 4, so_disponiveis=True) == sorted(n for n, q in estoque.items() if q > 0)
+    assert indice.buscar(cursor="p029") == ([], None)
+    assert indice.buscar(cursor="zzz") == ([], None)
+
+
+def test_prefixo_e_substring():
+    indice = IndiceCatalogo()
+    indice.reconstruir({"maca": 1, "macarrao": 0, "mamao": 2, "manga": 3, "pera": 1}, 1)
+    assert indice.buscar(prefixo="mac") == (["maca", "macarrao"], None)
+    assert indice.buscar(prefixo="mac", so_disponiveis=True) == (["maca"], None)
+    # A página enche no último nome com o prefixo: o cursor segue, a página seguinte vem vazia
+    pagina, cursor = indice.buscar(prefixo="ma", limite=2)
+    assert pagina == ["maca", "macarrao"]
+    assert indice.buscar(prefixo="ma", cursor=cursor, limite=2) == (["mamao", "manga"], "manga")
+    assert indice.buscar(prefixo="ma", cursor="manga") == ([], None)
+    assert indice.buscar(prefixo="x") == ([], None)
+    assert indice.buscar(contem="a", limite=3) == (["maca", "macarrao", "mamao"], "mamao")
+    assert indice.buscar(prefixo="m", contem="ng") == (["manga"], None)
+
+
+def test_substring_rara_para_no_maximo_examinado(monkeypatch):
+    monkeypatch.setattr(catalogo, "MAXIMO_EXAMINADOS", 10)
+    indice = IndiceCatalogo()
+    indice.reconstruir({f"n{i:02d}": 1 for i in range(25)} | {"n24x": 1}, 1)
+    # Página vazia mas com cursor: o cliente continua de onde o servidor parou
+    assert indice.buscar(contem="x") == ([], "n09")
+    assert _todas_as_paginas(indice, 5, contem="x") == ["n24x"]
+
+
+def test_produto_novo_nao_faz_saltar_nem_repetir():
+    indice = IndiceCatalogo()
+    indice.reconstruir({"b": 1, "d": 1, "f": 0}, 1)
+    pagina, cursor = indice.buscar(limite=2)
+    assert (pagina, cursor) == (["b", "d"], "d")
+    indice.atualizar("a", 5)  # Antes do cursor: fica para quem recomeçar
+    indice.atualizar("e", 5)
+    indice.atualizar("d", 0)
+    assert indice.buscar(cursor=cursor, limite=2) == (["e", "f"], None)
+    assert indice.buscar(so_disponiveis=True) == (["a", "b", "e"], None)
+    indice.atualizar("f", 2)
+    assert indice.buscar(so_disponiveis=True) == (["a", "b", "e", "f"], None)
+
+
+def _buscar(payload):
+    return json.loads(servidor.process_json_command(json.dumps({"tipo": "BUSCAR_ESTOQUE", "payload": payload}),
+                                                    object()))
+
+
+def test_buscar_estoque_segue_as_alteracoes():
+    for i in range(5):
+        servidor.definir_estoque(f"catalogo{i}", i)
+    resposta = _buscar({"prefixo": "CATALOGO", "limite": 3})
+    assert resposta["tipo"] == "ESTOQUE_PAGINA"
+    assert resposta["payload"] == {"itens": [["catalogo0", 0], ["catalogo1", 1], ["catalogo2", 2]],
+                                   "proximo_cursor": "catalogo2"}
+
+    # O índice apanha as alterações feitas depois da primeira consulta
+    servidor.definir_estoque("catalogo2", 0)
+    servidor.definir_estoque("catalogo5", 5)
+    resposta = _buscar({"prefixo": "catalogo", "so_disponiveis": True})
+    assert resposta["versao"] == servidor.snapshot_estoque()[0]
+    assert [nome for nome, _ in resposta["payload"]["itens"]] == ["catalogo1", "catalogo3", "catalogo4", "catalogo5"]
+    assert resposta["payload"]["proximo_cursor"] is None
+
+    # Limites fora do intervalo e cursores inválidos não dão erro
+    assert len(_buscar({"prefixo": "catalogo", "limite": 0})["payload"]["itens"]) == 1
+    assert len(_buscar({"prefixo": "catalogo", "limite": "x"})["payload"]["itens"]) == 6
+    assert len(_buscar({"prefixo": "catalogo", "cursor": 7})["payload"]["itens"]) == 6
@@ -0,0 +1,81 @@
+# tests/test_cliente_gui.py
+# Trabalhador de rede do cliente_gui, sem janela: o "agendar" põe os
+# callbacks numa fila que o teste esvazia, como faria o root.after do Tk.
+import queue
+import threading
+
+import servidor
+from cliente_gui import NetworkClient, TrabalhadorRede
+
+
+class ThreadTk:
+    def __init__(self):
+        self.fila = queue.Queue()
+
+    def agendar(self, funcao, *args):
+        self.fila.put((funcao, args))
+
+    def correr_um(self):
+        funcao, args = self.fila.get(timeout=5)
+        funcao(*args)
+
+
+def test_tarefas_iguais_na_fila_juntam_se():
+    tk = ThreadTk()
+    trabalhador = TrabalhadorRede(tk.agendar)
+    liberta, comecou = threading.Event(), threading.Event()
+    trabalhador.executar(lambda: (comecou.set(), liberta.wait(5)))  # Ocupa a thread de rede
+    comecou.wait(5)
+
+    chamadas, resultados = [], []
+    def atualizar():
+        chamadas.append(1)
+        return len(chamadas)
+    futuros = [trabalhador.executar(atualizar, resultados.append, chave="listas") for _ in range(5)]
+    outro = trabalhador.executar(atualizar, resultados.append, chave="outra")
+    assert all(futuro is futuros[0] for futuro in futuros) and outro is not futuros[0]
+    liberta.set()
+    for _ in range(6):
+        tk.correr_um()
+    # Uma ida ao servidor para as cinco, e todos os callbacks recebem o resultado
+    assert len(chamadas) == 2 and resultados == [1, 1, 1, 1, 1, 2]
+
+
+def test_tarefa_a_correr_nao_absorve_pedidos_novos():
+    tk = ThreadTk()
+    trabalhador = TrabalhadorRede(tk.agendar)
+    liberta, comecou = threading.Event(), threading.Event()
+    primeiro = trabalhador.executar(lambda: (comecou.set(), liberta.wait(5)), chave="listas")
+    comecou.wait(5)
+    segundo = trabalhador.executar(lambda: "depois", chave="listas")
+    assert segundo is not primeiro
+    liberta.set()
+    assert segundo.result(5) == "depois"
+
+
+def test_falha_chega_ao_callback_como_none():
+    tk = ThreadTk()
+    trabalhador = TrabalhadorRede(tk.agendar)
+    resultados = []
+    trabalhador.executar(lambda: 1 / 0, resultados.append)
+    trabalhador.executar(lambda: "seguinte", resultados.append)
+    tk.correr_um()
+    tk.correr_um()
+    assert resultados == [None, "seguinte"]
+
+
+def test_pedidos_ao_servidor_fora_da_thread_tk(porta_threads):
+    servidor.definir_estoque("gui_a", 4)
+    tk = ThreadTk()
+    cliente = NetworkClient()
+    cliente.iniciar_trabalhador(tk.agendar)
+    assert cliente.connect("127.0.0.1", porta_threads)
+    respostas = []
+    cliente.pedir({"tipo": "RESERVAR", "payload": {"produto": "gui_a", "quantidade": 1}}, respostas.append)
+    cliente.pedir([{"tipo": "GET_ESTOQUE"}, {"tipo": "GET_MINHAS_RESERVAS"}], respostas.append, chave="listas")
+    tk.correr_um()
+    tk.correr_um()
+    assert respostas[0]["payload"]["status"] == "SUCESSO"
+    estoque, minhas = respostas[1]
+    assert estoque["payload"]["gui_a"] == 3 and minhas["payload"] == {"gui_a": 1}
+    cliente.close()
@@ -0,0 +1,84 @@
+from collections import Counter
+
+import pytest
+
+from cluster import AnelConsistente
+from conftest import Cliente, _porta_livre, subir_processo
+
+NOS = ["127.0.0.1:5050", "127.0.0.1:5051", "127.0.0.1:5052"]
+PRODUTOS = [f"p{i:04d}" for i in range(3000)]
+
+
+def test_anel_divide_os_produtos():
+    anel = AnelConsistente(NOS)
+    contagem = Counter(anel.dono(p) for p in PRODUTOS)
+    assert set(contagem) == set(NOS)
+    assert min(contagem.values()) > len(PRODUTOS) / len(NOS) / 2
+    # A ordem dos nós na linha de comandos não muda o dono
+    assert all(AnelConsistente(NOS[::-1]).dono(p) == anel.dono(p) for p in PRODUTOS)
+
+
+def test_novo_no_so_leva_produtos_dos_outros():
+    antes = AnelConsistente(NOS)
+    depois = AnelConsistente(NOS + ["127.0.0.1:5053"])
+    mudaram = [p for p in PRODUTOS if antes.dono(p) != depois.dono(p)]
+    assert all(depois.dono(p) == "127.0.0.1:5053" for p in mudaram)
+    assert len(mudaram) < len(PRODUTOS) / 2
+
+
+@pytest.fixture(scope="module")
+def cluster():
+    portas = [_porta_livre() for _ in range(3)]
+    nos = ",".join(f"127.0.0.1:{p}" for p in portas)
+    processos = [subir_processo(p, "--cluster", nos) for p in portas]
+    yield portas
+    for processo in processos:
+        processo.terminate()
+        processo.wait()
+
+
+def test_cluster_reserva_pagina_e_exporta(cluster):
+    admin = Cliente(cluster[0])
+    itens = [[f"c{i:03d}", 10] for i in range(200)]
+    assert admin.pedir("BULK_SET", {"itens": itens})["payload"]["aplicados"] == 200
+
+    cliente = Cliente(cluster[1])
+    cliente.pedir("SESSAO")
+    for produto in ("c001", "c002", "c150"):
+        assert cliente.pedir("RESERVAR", {"produto": produto, "quantidade": 3})["payload"]["status"] == "SUCESSO"
+    assert cliente.pedir("GET_MINHAS_RESERVAS")["payload"] == {"c001": 3, "c002": 3, "c150": 3}
+
+    estoque = admin.pedir("GET_ESTOQUE")["payload"]
+    assert estoque["c001"] == 7 and estoque["c199"] == 10
+
+    # As páginas juntam os nós por ordem de nome, sem repetir nem saltar
+    nomes, cursor = [], None
+    while True:
+        payload = {"prefixo": "c", "limite": 37}
+        if cursor:
+            payload["cursor"] = cursor
+        pagina = admin.pedir("BUSCAR_ESTOQUE", payload)["payload"]
+        nomes += [nome for nome, _ in pagina["itens"]]
+        cursor = pagina["proximo_cursor"]
+        if cursor is None:
+            break
+    assert nomes == [nome for nome, _ in itens]
+
+    admin.enviar("EXPORT_ESTOQUE", {"bloco": 64})
+    exportados = {}
+    while (resposta := admin.ler())["tipo"] == "EXPORT_PARTE":
+        exportados.update(resposta["payload"]["itens"])
+    assert resposta["tipo"] == "EXPORT_FIM"
+    assert resposta["payload"]["total"] == len(exportados) == len(estoque)
+    assert exportados == estoque
+
+    cliente.pedir("SAIR")
+    cliente.fechar()
+    admin.fechar()
+
+
+def test_assinatura_no_cluster_avisa_o_cliente(cluster):
+    cliente = Cliente(cluster[2])
+    resposta = cliente.pedir("SUBSCRIBE", {"snapshot": False})
+    assert resposta["tipo"] == "ASSINATURA_OK" and resposta["cluster"] is True
+    cliente.fechar()
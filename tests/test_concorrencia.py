@@ -0,0 +1,77 @@
+# tests/test_concorrencia.py
+# Várias threads a reservar e cancelar ao mesmo tempo, cada uma com a sua
+# sessão: nunca se reserva mais do que havia e nada se perde.
+import threading
+
+import servidor
+from protocolo import OK
+
+THREADS = 8
+
+
+def _em_threads(alvo):
+    conns = [object() for _ in range(THREADS)]
+    for conn in conns:
+        servidor.registrar_cliente(conn)
+    threads = [threading.Thread(target=alvo, args=(conn,)) for conn in conns]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return conns
+
+
+def test_nao_reserva_mais_do_que_ha():
+    servidor.definir_estoque("concorrido", 100)
+    sucessos = []
+
+    def reservar(conn):
+        sucessos.extend(1 for _ in range(50) if servidor.reservar(conn, "concorrido", 1)[0] == OK)
+
+    conns = _em_threads(reservar)
+    assert len(sucessos) == 100
+    assert servidor.estoque_disponivel["concorrido"] == 0
+    assert sum(servidor.sessao_da_conexao[c].carrinho.get("concorrido", 0) for c in conns) == 100
+    assert servidor.reservas.totais.get("concorrido") == 100
+    for conn in conns:
+        servidor.desligar_sessao(conn, "teste", True)
+    assert servidor.estoque_disponivel["concorrido"] == 100
+
+
+def test_reservas_e_cancelamentos_em_varios_produtos_conservam_o_estoque():
+    produtos = [f"fatia{i}" for i in range(16)]
+    for produto in produtos:
+        servidor.definir_estoque(produto, 1000)
+
+    def mexer(conn):
+        for i in range(400):
+            produto = produtos[i % len(produtos)]
+            if servidor.reservar(conn, produto, 3)[0] == OK and i % 3:
+                assert servidor.cancelar_reserva(conn, produto, 3)[0] == OK
+
+    conns = _em_threads(mexer)
+    for produto in produtos:
+        reservado = sum(servidor.sessao_da_conexao[c].carrinho.get(produto, 0) for c in conns)
+        assert servidor.estoque_disponivel[produto] + reservado == 1000
+    for conn in conns:
+        servidor.desligar_sessao(conn, "teste", True)
+    assert all(servidor.estoque_disponivel[p] == 1000 for p in produtos)
+
+
+def test_travar_produtos_por_qualquer_ordem_nao_bloqueia():
+    # Produtos de fatias diferentes, travados por ordens contrárias
+    a = "produto_a"
+    b = next(p for p in (f"produto_b{i}" for i in range(1000))
+             if servidor.lock_do_produto(p) is not servidor.lock_do_produto(a))
+
+    def travar(produtos):
+        for _ in range(2000):
+            with servidor.travar_produtos(produtos):
+                pass
+
+    threads = [threading.Thread(target=travar, args=(ordem,), daemon=True) for ordem in ([a, b], [b, a])]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=10)
+    assert not any(t.is_alive() for t in threads)
@@ -0,0 +1,48 @@
+# tests/test_estoque_compacto.py
+import threading
+import time
+from array import array
+
+from estoque_compacto import EstoqueCompacto
+
+
+def test_remover_e_limpar_atualizam_a_contagem():
+    estoque = EstoqueCompacto({"banana": 10, "uva": 20})
+    estoque["banana"] = 5  # Já existia: não conta outra vez
+    del estoque["uva"]
+    assert len(estoque) == 1
+    estoque["uva"] = 1
+    assert len(estoque) == 2
+    estoque.clear()
+    assert len(estoque) == 0 and "banana" not in estoque
+
+
+class ArrayComPausas(array):
+    """Cede a vez a outra thread depois de cada leitura: sem isto o GIL quase
+    nunca troca de thread entre ver que o produto não existe e contá-lo."""
+
+    def __getitem__(self, i):
+        valor = super().__getitem__(i)
+        time.sleep(0)
+        return valor
+
+
+def test_insercoes_concorrentes_contam_cada_produto_uma_vez():
+    estoque = EstoqueCompacto({})
+    estoque.quantidades = ArrayComPausas("q")
+    nomes = [f"produto{i:04d}" for i in range(2000)]
+    partida = threading.Barrier(8)
+
+    def inserir():
+        # Todas as threads criam os mesmos produtos ao mesmo tempo
+        partida.wait()
+        for nome in nomes:
+            estoque[nome] = 1
+
+    threads = [threading.Thread(target=inserir) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert estoque.existentes == len(estoque) == len(set(nomes))
+    assert sorted(estoque) == nomes
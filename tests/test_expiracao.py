@@ -0,0 +1,77 @@
+# tests/test_expiracao.py
+import random
+import time
+
+from conftest import Cliente, _porta_livre, subir_processo
+from protocolo import MENSAGENS_NAO_SOLICITADAS
+from temporizadores import RodaTemporizadores
+
+
+def test_roda_nunca_expira_antes_do_prazo():
+    rnd = random.Random(1)
+    roda = RodaTemporizadores(0.0, tick=0.1, casas=8, niveis=3)
+    # Prazos no nível 0, nos seguintes e além do alcance do último nível
+    prazos = [rnd.uniform(0, 80) for _ in range(500)] + [0.05, 6.4, 51.2, 200.0]
+    temporizadores = [roda.agendar(prazo, i) for i, prazo in enumerate(prazos)]
+    cancelados = set(rnd.sample(range(len(prazos)), 50))
+    for i in cancelados:
+        roda.cancelar(temporizadores[i])
+
+    expirados = {}
+    agora = 0.0
+    while agora < 210:
+        agora += 0.1
+        for temporizador in roda.avancar(agora):
+            expirados[temporizador.dado] = agora
+    assert set(expirados) == set(range(len(prazos))) - cancelados
+    for i, instante in expirados.items():
+        assert prazos[i] <= instante + 1e-9
+        assert instante - prazos[i] < 0.2 + 1e-9  # Com atraso de no máximo um tick
+
+
+def _pedir(cliente, tipo, payload=None):
+    """Como Cliente.pedir, saltando os eventos da assinatura."""
+    cliente.enviar(tipo, payload)
+    while (resposta := cliente.ler())["tipo"] in MENSAGENS_NAO_SOLICITADAS:
+        pass
+    return resposta
+
+
+def test_reservas_expiram_e_sessao_e_retomada():
+    porta = _porta_livre()
+    processo = subir_processo(porta, "--ttl-reserva", "1", "--tempo-retomar", "5")
+    try:
+        admin = Cliente(porta)
+        admin.pedir("SET_ESTOQUE", {"produto": "prazo", "quantidade": 10})
+        cliente = Cliente(porta)
+        token = cliente.pedir("SESSAO")["payload"]["token"]
+        assert cliente.pedir("SUBSCRIBE", {"snapshot": False})["tipo"] == "ASSINATURA_OK"
+        assert _pedir(cliente, "RESERVAR", {"produto": "prazo", "quantidade": 4})["payload"]["status"] == "SUCESSO"
+
+        # RENOVAR adia o prazo
+        time.sleep(0.6)
+        assert _pedir(cliente, "RENOVAR")["payload"]["status"] == "SUCESSO"
+        time.sleep(0.6)
+        assert admin.pedir("GET_ESTOQUE")["payload"]["prazo"] == 6
+
+        # Sem renovar, os itens voltam ao estoque e o assinante é avisado
+        cliente.sock.settimeout(3)
+        while (mensagem := cliente.ler())["tipo"] != "RESERVAS_EXPIRADAS":
+            pass
+        assert mensagem["payload"] == {"prazo": 4}
+        assert admin.pedir("GET_ESTOQUE")["payload"]["prazo"] == 10
+
+        # Um cliente que caiu recupera o carrinho pelo token noutra ligação
+        assert _pedir(cliente, "RESERVAR", {"produto": "prazo", "quantidade": 2})["payload"]["status"] == "SUCESSO"
+        cliente.fechar()
+        outro = Cliente(porta)
+        sessao = outro.pedir("SESSAO", {"token": token})["payload"]
+        assert sessao["retomada"] and sessao["carrinho"] == {"prazo": 2}
+        outro.pedir("SAIR")
+        prazo = time.monotonic() + 2
+        while admin.pedir("GET_ESTOQUE")["payload"]["prazo"] != 10:  # Devolvido depois do BYE
+            assert time.monotonic() < prazo
+            time.sleep(0.05)
+    finally:
+        processo.terminate()
+        processo.wait()
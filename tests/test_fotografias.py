@@ -0,0 +1,43 @@
+# tests/test_fotografias.py
+# Fotografias do estoque (FotoEstoque): reaproveitadas enquanto nada muda,
+# atualizadas só nos produtos alterados, e nunca alteradas depois de prontas.
+import json
+
+import servidor
+
+
+def _contagens():
+    contadores = servidor.metricas.coletar()["contadores"]
+    return {tipo: contadores.get(f"foto_estoque_total{{{tipo}}}", 0)
+            for tipo in ("reaproveitada", "incremental", "completa")}
+
+
+def _diferenca(antes):
+    return {tipo: n - antes[tipo] for tipo, n in _contagens().items()}
+
+
+def test_fotografia_reaproveitada_e_atualizada(monkeypatch):
+    monkeypatch.setattr(servidor, "foto_estoque", None)
+    servidor.definir_estoque("foto_a", 1)
+    antes = _contagens()
+    primeira = servidor.foto_atual()
+    assert servidor.foto_atual() is primeira
+    assert _diferenca(antes) == {"reaproveitada": 1, "incremental": 0, "completa": 1}
+    assert json.loads(primeira.resposta_json())["payload"]["foto_a"] == 1
+    assert primeira.resposta_json() is primeira.resposta_json()  # Serializada uma vez
+
+    # Uma alteração: a fotografia nova copia a anterior e aplica só o delta
+    servidor.definir_estoque("foto_a", 2)
+    servidor.definir_estoque("foto_b", 3)
+    segunda = servidor.foto_atual()
+    assert segunda is not primeira and segunda.versao > primeira.versao
+    assert segunda.estoque["foto_a"] == 2 and segunda.estoque["foto_b"] == 3
+    assert primeira.estoque["foto_a"] == 1 and "foto_b" not in primeira.estoque
+    assert json.loads(primeira.resposta_json())["payload"]["foto_a"] == 1
+    assert _diferenca(antes)["incremental"] == 1
+
+    # Mais alterações do que o log guarda: volta a copiar o estoque inteiro
+    servidor.definir_estoque_em_bloco([[f"foto_c{i:05d}", i] for i in range(servidor.TAMANHO_LOG_ALTERACOES + 1)])
+    terceira = servidor.foto_atual()
+    assert terceira.estoque == servidor.estoque_disponivel.copy()
+    assert _diferenca(antes) == {"reaproveitada": 1, "incremental": 1, "completa": 2}
@@ -0,0 +1,70 @@
+# tests/test_importacao.py
+# BULK_SET / EXPORT_ESTOQUE e o IMPORTAR/EXPORTAR do admin em CSV.
+import importlib.util
+import io
+import os
+import socket
+
+import servidor
+from conftest import Cliente
+
+_caminho = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "admin.py.py")
+_spec = importlib.util.spec_from_file_location("admin", _caminho)
+admin = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(admin)
+
+
+def test_linhas_invalidas_sao_recusadas_e_as_outras_aplicadas(porta_threads):
+    cliente = Cliente(porta_threads)
+    resposta = cliente.pedir("BULK_SET", {"itens": [
+        ["Bloco_A", 3], ["bloco_b", "x"], ["", 1], ["bloco_c", -1], ["bloco_d"], ["bloco_a", 7],
+    ]})["payload"]
+    assert resposta["status"] == "ERRO" and resposta["aplicados"] == 1  # bloco_a repetido: vale a última
+    assert [erro["indice"] for erro in resposta["erros"]] == [1, 2, 3, 4]
+    assert servidor.estoque_disponivel["bloco_a"] == 7 and "bloco_c" not in servidor.estoque_disponivel
+    assert cliente.pedir("BULK_SET", {"itens": "x"})["payload"]["aplicados"] == 0
+    cliente.fechar()
+
+
+def test_exportacao_em_partes_tem_o_catalogo_inteiro(porta_threads):
+    cliente = Cliente(porta_threads)
+    cliente.pedir("BULK_SET", {"itens": [[f"exp{i:03d}", i] for i in range(25)]})
+    cliente.enviar("EXPORT_ESTOQUE", {"bloco": 10})
+    partes = []
+    while (mensagem := cliente.ler())["tipo"] == "EXPORT_PARTE":
+        partes.append(mensagem["payload"]["itens"])
+    assert mensagem["tipo"] == "EXPORT_FIM"
+    assert all(len(parte) == 10 for parte in partes[:-1]) and 0 < len(partes[-1]) <= 10
+    itens = [item for parte in partes for item in parte]
+    assert mensagem["payload"]["total"] == len(itens)
+    assert [nome for nome, _ in itens] == sorted(servidor.estoque_disponivel)
+    assert dict(itens) == servidor.estoque_disponivel.copy()
+    cliente.fechar()
+
+
+def test_blocos_do_csv_saltam_o_cabecalho_e_contam_as_linhas(monkeypatch):
+    monkeypatch.setattr(admin, "LINHAS_POR_BLOCO", 2)
+    arquivo = io.StringIO("produto,quantidade\na,1\n\nb,2\nc,3,extra\nd\n")
+    assert list(admin._blocos_csv(arquivo)) == [(2, [["a", "1"], ["b", "2"]]), (5, [["c", "3"], ["d"]])]
+    # Sem cabeçalho, a primeira linha é dados
+    assert list(admin._blocos_csv(io.StringIO("a,-1\n"))) == [(1, [["a", "-1"]])]
+
+
+def test_importar_e_exportar_csv(porta_threads, monkeypatch, tmp_path, capsys):
+    monkeypatch.setattr(admin, "LINHAS_POR_BLOCO", 7)
+    monkeypatch.setattr(admin, "BLOCOS_EM_VOO", 3)  # Mais blocos do que os que ficam em voo
+    entrada = tmp_path / "entrada.csv"
+    entrada.write_text("produto,quantidade\n" + "".join(f"csv{i:03d},{i}\n" for i in range(50)) + "csv_mau,x\n",
+                       encoding="utf-8")
+    sock = socket.create_connection(("127.0.0.1", porta_threads), timeout=5)
+    admin.importar_csv(sock, str(entrada))
+    assert "51 linhas (50 produtos atualizados)" in capsys.readouterr().out
+    assert all(servidor.estoque_disponivel[f"csv{i:03d}"] == i for i in range(50))
+
+    saida = tmp_path / "saida.csv"
+    assert admin.exportar_csv(sock, str(saida))
+    linhas = saida.read_text(encoding="utf-8").splitlines()
+    assert linhas[0] == "produto,quantidade"
+    exportado = {nome: int(q) for nome, q in (linha.split(",") for linha in linhas[1:])}
+    assert exportado == servidor.estoque_disponivel.copy()
+    sock.close()
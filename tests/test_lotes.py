@@ -0,0 +1,53 @@
+# tests/test_lotes.py
+# RESERVAR_LOTE / CANCELAR_LOTE: tudo ou nada.
+import json
+
+import servidor
+
+
+def _lote(conn, tipo, itens):
+    comando = {"tipo": tipo, "payload": {"itens": [{"produto": p, "quantidade": q} for p, q in itens]}}
+    return json.loads(servidor.process_json_command(json.dumps(comando), conn))["payload"]
+
+
+def _ligar():
+    conn = object()
+    servidor.registrar_cliente(conn)
+    return conn
+
+
+def test_lote_com_um_item_recusado_nao_altera_nada():
+    servidor.definir_estoque("lote_a", 5)
+    servidor.definir_estoque("lote_b", 1)
+    conn = _ligar()
+    resposta = _lote(conn, "RESERVAR_LOTE", [("lote_a", 2), ("lote_b", 2), ("lote_inexistente", 1), ("lote_a", 0)])
+    assert resposta["status"] == "ERRO"
+    assert [item["status"] for item in resposta["itens"]] == ["SUCESSO", "ERRO", "ERRO", "ERRO"]
+    assert resposta["itens"][1]["disponivel"] == 1
+    assert servidor.estoque_disponivel["lote_a"] == 5 and servidor.estoque_disponivel["lote_b"] == 1
+    assert not servidor.sessao_da_conexao[conn].carrinho
+    servidor.desligar_sessao(conn, "teste", True)
+
+
+def test_produto_repetido_conta_o_total_do_lote():
+    servidor.definir_estoque("lote_c", 5)
+    conn = _ligar()
+    assert _lote(conn, "RESERVAR_LOTE", [("lote_c", 3), ("lote_c", 3)])["status"] == "ERRO"
+    assert _lote(conn, "RESERVAR_LOTE", [("lote_c", 3), ("LOTE_C", 2)])["status"] == "SUCESSO"
+    assert servidor.estoque_disponivel["lote_c"] == 0
+    assert servidor.sessao_da_conexao[conn].carrinho["lote_c"] == 5
+
+    # Cancelar mais do que está reservado recusa o lote inteiro
+    assert _lote(conn, "CANCELAR_LOTE", [("lote_c", 4), ("lote_c", 2)])["status"] == "ERRO"
+    assert _lote(conn, "CANCELAR_LOTE", [("lote_c", 4), ("lote_c", 1)])["status"] == "SUCESSO"
+    assert servidor.estoque_disponivel["lote_c"] == 5
+    assert not servidor.sessao_da_conexao[conn].carrinho
+    servidor.desligar_sessao(conn, "teste", True)
+
+
+def test_lote_invalido():
+    conn = _ligar()
+    comando = {"tipo": "RESERVAR_LOTE", "payload": {"itens": []}}
+    resposta = json.loads(servidor.process_json_command(json.dumps(comando), conn))
+    assert resposta["payload"]["status"] == "ERRO" and resposta["payload"]["itens"] == []
+    servidor.desligar_sessao(conn, "teste", True)
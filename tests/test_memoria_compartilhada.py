@@ -0,0 +1,59 @@
+# tests/test_memoria_compartilhada.py
+import pytest
+
+from conftest import Cliente, _porta_livre, subir_processo
+from memoria_compartilhada import CatalogoCheio, EstoqueCompartilhado, LogAlteracoesCompartilhado, contexto
+
+pytestmark = pytest.mark.skipif(contexto is None, reason="precisa de fork")
+
+
+def _filho(estoque, log):
+    estoque["do_filho"] = 7
+    estoque["banana"] -= 1
+    log.registrar("do_filho")
+
+
+def test_processo_filho_ve_e_cria_produtos():
+    estoque = EstoqueCompartilhado(capacidade=100)
+    log = LogAlteracoesCompartilhado(estoque, tamanho=8)
+    estoque["banana"] = 10
+    versao = log.registrar("banana")
+    filho = contexto.Process(target=_filho, args=(estoque, log))
+    filho.start()
+    filho.join()
+    assert filho.exitcode == 0
+    # O nome criado no filho aparece no pai ao sincronizar a tabela de nomes
+    assert estoque.copy() == {"banana": 9, "do_filho": 7}
+    assert log.desde(versao) == (versao + 1, {"do_filho"})
+
+
+def test_log_em_anel_e_catalogo_cheio():
+    estoque = EstoqueCompartilhado(capacidade=3, bytes_por_nome=4)
+    log = LogAlteracoesCompartilhado(estoque, tamanho=4)
+    for produto in ("a", "b", "a", "c", "b"):
+        log.registrar(produto)
+    assert log.desde(1) == (5, {"a", "b", "c"})
+    assert log.desde(0) is None  # Já saiu do anel
+    assert log.desde(6) is None
+    with pytest.raises(CatalogoCheio):
+        estoque["d"] = 1
+
+
+def test_servidor_com_varios_processos_conserva_o_estoque():
+    porta = _porta_livre()
+    processo = subir_processo(porta, "--workers", "2")
+    try:
+        admin = Cliente(porta)
+        assert admin.pedir("SET_ESTOQUE", {"produto": "partilhado", "quantidade": 50})["payload"]["status"] == "SUCESSO"
+        clientes = [Cliente(porta) for _ in range(6)]  # Espalhados pelos dois processos
+        for cliente in clientes:
+            for _ in range(10):
+                cliente.pedir("RESERVAR", {"produto": "partilhado", "quantidade": 1})
+        assert sum(sum(c.pedir("GET_MINHAS_RESERVAS")["payload"].values()) for c in clientes) == 50
+        assert Cliente(porta).pedir("GET_ESTOQUE")["payload"]["partilhado"] == 0
+        for cliente in clientes:
+            cliente.pedir("SAIR")
+        assert Cliente(porta).pedir("GET_ESTOQUE")["payload"]["partilhado"] == 50
+    finally:
+        processo.terminate()
+        processo.wait()
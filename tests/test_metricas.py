@@ -0,0 +1,110 @@
+# tests/test_metricas.py
+import logging
+import threading
+import urllib.request
+
+from conftest import Cliente, _esperar_porta, _porta_livre, subir_processo
+from metricas import Histograma, Metricas, N_FATIAS_METRICAS
+from registro import LimiteTaxa
+
+
+def _medir_em_threads(metricas, n_threads):
+    fatias = []
+    barreira = threading.Barrier(n_threads)
+
+    def trabalhar():
+        barreira.wait()  # Todas vivas ao mesmo tempo (ids diferentes)
+        metricas.contar("pedidos_total")
+        fatias.append(metricas._fatia())
+
+    threads = [threading.Thread(target=trabalhar) for _ in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return fatias
+
+
+def test_threads_ficam_em_fatias_diferentes():
+    metricas = Metricas()
+    fatias = _medir_em_threads(metricas, N_FATIAS_METRICAS)
+    assert len({id(f) for f in fatias}) == N_FATIAS_METRICAS
+
+
+def test_mesma_thread_usa_sempre_a_mesma_fatia():
+    metricas = Metricas()
+    assert metricas._fatia() is metricas._fatia()
+
+
+def test_soma_junta_todas_as_fatias():
+    metricas = Metricas()
+    _medir_em_threads(metricas, 8)
+    metricas.observar("latencia_segundos", 0.001)
+    resumo = metricas.coletar()
+    assert resumo["contadores"]["pedidos_total"] == 8
+    assert resumo["latencias_ms"]["latencia"]["n"] == 1
+
+
+def test_percentil_e_o_limite_do_balde():
+    histograma = Histograma()
+    for _ in range(98):
+        histograma.observar(0.0003)  # Balde até 0,5 ms
+    histograma.observar(0.02)
+    histograma.observar(9.0)         # Acima do último limite
+    assert histograma.percentil(50) == 0.0005
+    assert histograma.percentil(99) == 0.025
+    assert histograma.percentil(100) == float("inf")
+    assert Histograma().percentil(50) is None
+
+
+def test_texto_prometheus():
+    metricas = Metricas()
+    metricas.contar("comandos_total", "RESERVAR", valor=3)
+    metricas.contar("conexoes_ativas", valor=2)
+    metricas.observar("comando_segundos", 0.0003, "RESERVAR")
+    metricas.observar("comando_segundos", 7.0, "RESERVAR")
+    linhas = metricas.prometheus().splitlines()
+    assert "# TYPE mercadinho_comandos_total counter" in linhas
+    assert 'mercadinho_comandos_total{tipo="RESERVAR"} 3' in linhas
+    assert "# TYPE mercadinho_conexoes_ativas gauge" in linhas
+    assert "# TYPE mercadinho_comando_segundos histogram" in linhas
+    # Baldes acumulados, a acabar em +Inf com o total
+    assert 'mercadinho_comando_segundos_bucket{tipo="RESERVAR",le="0.0005"} 1' in linhas
+    assert 'mercadinho_comando_segundos_bucket{tipo="RESERVAR",le="5.0"} 1' in linhas
+    assert 'mercadinho_comando_segundos_bucket{tipo="RESERVAR",le="+Inf"} 2' in linhas
+    assert 'mercadinho_comando_segundos_count{tipo="RESERVAR"} 2' in linhas
+
+
+def test_limite_de_taxa_suprime_mas_deixa_passar_os_erros():
+    suprimidas = []
+    filtro = LimiteTaxa(por_segundo=0.001, rajada=2, ao_suprimir=lambda: suprimidas.append(1))
+
+    def registo(nivel, mensagem):
+        return logging.LogRecord("teste", nivel, __file__, 1, mensagem, None, None)
+    assert filtro.filter(registo(logging.INFO, "a")) and filtro.filter(registo(logging.INFO, "b"))
+    assert not filtro.filter(registo(logging.INFO, "c"))
+    assert not filtro.filter(registo(logging.WARNING, "d"))
+    erro = registo(logging.ERROR, "falhou")
+    assert filtro.filter(erro) and erro.getMessage() == "(2 mensagens suprimidas) falhou"
+    assert len(suprimidas) == 2
+
+
+def test_metricas_por_comando_e_em_http():
+    porta, porta_metricas = _porta_livre(), _porta_livre()
+    processo = subir_processo(porta, "--porta-metricas", str(porta_metricas))
+    try:
+        cliente = Cliente(porta)
+        for _ in range(3):
+            cliente.pedir("RESERVAR", {"produto": "banana", "quantidade": 1})
+        cliente.pedir("NAO_EXISTE")
+        resumo = cliente.pedir("GET_METRICS")["payload"]
+        assert resumo["contadores"]["comandos_total{RESERVAR}"] == 3
+        assert resumo["contadores"]["comandos_total{DESCONHECIDO}"] == 1
+        assert resumo["latencias_ms"]["comando{RESERVAR}"]["n"] == 3
+        _esperar_porta(porta_metricas)
+        with urllib.request.urlopen(f"http://127.0.0.1:{porta_metricas}/metrics", timeout=5) as resposta:
+            texto = resposta.read().decode()
+        assert 'mercadinho_comandos_total{tipo="RESERVAR"} 3' in texto.splitlines()
+    finally:
+        processo.terminate()
+        processo.wait()
@@ -0,0 +1,40 @@
+# tests/test_modo_asyncio.py
+import threading
+
+import servidor
+from conftest import Cliente
+
+
+def test_reservar_e_cancelar(porta_asyncio):
+    servidor.definir_estoque("produto_asyncio", 5)
+    cliente = Cliente(porta_asyncio)
+    resposta = cliente.pedir("RESERVAR", {"produto": "produto_asyncio", "quantidade": 2})
+    assert resposta["payload"]["status"] == "SUCESSO"
+    assert cliente.pedir("GET_MINHAS_RESERVAS")["payload"] == {"produto_asyncio": 2}
+    resposta = cliente.pedir("CANCELAR_RESERVA", {"produto": "produto_asyncio", "quantidade": 2})
+    assert resposta["payload"]["status"] == "SUCESSO"
+    cliente.pedir("SAIR")
+    cliente.fechar()
+
+
+def test_comando_a_espera_de_um_lock_nao_para_o_event_loop(porta_asyncio):
+    servidor.definir_estoque("produto_asyncio_lock", 5)
+    preso, largar = threading.Event(), threading.Event()
+
+    def segurar_fatias():
+        with servidor.travar_tudo():  # Como um checkpoint a meio de um fsync
+            preso.set()
+            largar.wait(10)
+
+    threading.Thread(target=segurar_fatias).start()
+    preso.wait()
+    lento, rapido = Cliente(porta_asyncio), Cliente(porta_asyncio)
+    try:
+        lento.enviar("RESERVAR", {"produto": "produto_asyncio_lock", "quantidade": 1})
+        # Outra ligação continua a ser atendida enquanto o RESERVAR espera
+        assert rapido.pedir("GET_METRICS")["tipo"] == "METRICAS"
+    finally:
+        largar.set()
+    assert lento.ler()["payload"]["status"] == "SUCESSO"
+    lento.fechar()
+    rapido.fechar()
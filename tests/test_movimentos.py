@@ -0,0 +1,78 @@
+# tests/test_movimentos.py
+import os
+import time
+
+import movimentos
+from estoque_compacto import EstoqueCompacto
+from movimentos import LivroMovimentos, RESERVA
+
+
+def _descritores():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def test_segmentos_gravados_nao_ficam_abertos(tmp_path, monkeypatch):
+    monkeypatch.setattr(movimentos, "EVENTOS_POR_SEGMENTO", 10)
+    livro = LivroMovimentos(EstoqueCompacto({"banana": 1000}))
+    livro.abrir(str(tmp_path))
+    antes = _descritores()
+    for i in range(500):
+        livro.registrar("banana", RESERVA, -1, 999 - i)
+    livro.rodar()
+    assert livro.estado()["segmentos"] == 50
+    assert _descritores() == antes
+
+
+def test_segmento_cheio_e_gravado_pela_thread_do_livro(tmp_path, monkeypatch):
+    monkeypatch.setattr(movimentos, "EVENTOS_POR_SEGMENTO", 10)
+    livro = LivroMovimentos(EstoqueCompacto({"banana": 1000}))
+    livro.abrir(str(tmp_path))
+    for i in range(25):
+        livro.registrar("banana", RESERVA, -1, 999 - i)
+    # Quem regista (com locks do estoque) não escreve em disco
+    assert os.listdir(tmp_path) == []
+    assert livro.estado()["em_memoria"] == 25
+
+    livro.iniciar()
+    for _ in range(100):
+        if livro.estado()["segmentos"] == 2:
+            break
+        time.sleep(0.02)
+    assert sorted(os.listdir(tmp_path)) == ["movimentos-00000001.seg", "movimentos-00000002.seg"]
+    assert livro.estado()["em_memoria"] == 5
+
+
+def test_segmento_novo_em_disco_antes_de_apagar_os_antigos(tmp_path, monkeypatch):
+    ordem = []
+    fsync = os.fsync
+    monkeypatch.setattr(movimentos.os, "fsync", lambda fd: (ordem.append("fsync"), fsync(fd)))
+    monkeypatch.setattr(movimentos, "_apagar", lambda caminho: (ordem.append("apagar"), os.remove(caminho)))
+    livro = LivroMovimentos(EstoqueCompacto({"banana": 10}), retencao=3600)
+    livro.abrir(str(tmp_path))
+    agora = time.time()
+    livro.registrar("banana", RESERVA, -1, 9, agora - 1800)
+    livro.rodar()
+    ordem.clear()
+    livro.retencao = 600
+    livro.registrar("banana", RESERVA, -1, 8, agora)
+    livro.rodar()
+    assert os.listdir(tmp_path) == ["movimentos-00000002.seg"]
+    # fsync do segmento e da pasta, e só depois o antigo é apagado
+    assert ordem == ["fsync", "fsync", "apagar"]
+
+
+def test_segmentos_fora_da_retencao_sao_apagados(tmp_path):
+    livro = LivroMovimentos(EstoqueCompacto({"banana": 10}), retencao=3600)
+    livro.abrir(str(tmp_path))
+    agora = time.time()
+    livro.registrar("banana", RESERVA, -1, 9, agora - 7200)
+    livro.rodar()
+    assert os.listdir(tmp_path) == []
+    livro.registrar("banana", RESERVA, -1, 8, agora)
+    livro.rodar()
+    assert os.listdir(tmp_path) == ["movimentos-00000002.seg"]
+
+    # No arranque, os resumos voltam dos segmentos que ficaram
+    outro = LivroMovimentos(EstoqueCompacto({"banana": 8}), retencao=3600)
+    assert outro.abrir(str(tmp_path)) == 1
+    assert outro.mais_reservados(agora - 60, agora + 60) == [("banana", 1, 0, 0)]
@@ -0,0 +1,114 @@
+# tests/test_pedidos_repetidos.py
+# Um pedido com id_pedido repetido noutra ligação, e noutra codificação,
+# recebe a resposta original sem voltar a ser executado.
+import json
+import threading
+
+import servidor
+from protocolo import B_JSON, B_RESERVAR, B_RESULTADO, CABECALHO, PEDIDO_ITEM, RESULTADO, OK
+
+PRODUTO = "produto_repetidos"
+
+
+def _ligar(token=None, binaria=False):
+    conn = object()
+    servidor.registrar_cliente(conn)
+    if token is not None:
+        resposta = json.loads(servidor.process_json_command(json.dumps({"tipo": "SESSAO", "payload": {"token": token}}), conn))
+        assert resposta["payload"]["retomada"]
+    if binaria:
+        servidor.sessoes_binarias[conn] = servidor.SessaoBinaria()
+    return conn
+
+
+def _cair(conn):
+    servidor.sessoes_binarias.pop(conn, None)
+    servidor.desligar_sessao(conn, "teste", False)
+
+
+def _reservar_json(conn, quantidade, id_pedido):
+    comando = {"tipo": "RESERVAR", "payload": {"produto": PRODUTO, "quantidade": quantidade}, "id_pedido": id_pedido}
+    return json.loads(servidor.process_json_command(json.dumps(comando), conn))
+
+
+def _ler_quadro(dados):
+    tamanho, tipo = CABECALHO.unpack_from(dados)
+    assert len(dados) == CABECALHO.size + tamanho
+    return tipo, dados[CABECALHO.size:]
+
+
+def test_repeticao_entre_binario_e_json():
+    servidor.definir_estoque(PRODUTO, 10)
+    id_produto = servidor.estoque_disponivel.id_do_produto(PRODUTO)
+
+    binaria = _ligar(binaria=True)
+    token = servidor.sessao_da_conexao[binaria].token
+    corpo = PEDIDO_ITEM.pack(id_produto, 3) + b"pedido-1"
+    tipo, resultado = _ler_quadro(servidor.processar_quadro(B_RESERVAR, corpo, binaria))
+    assert tipo == B_RESULTADO and RESULTADO.unpack(resultado)[0] == OK
+    assert servidor.estoque_disponivel[PRODUTO] == 7
+
+    # O cliente binário volta a ligar e, sem os IDs, repete em JSON num quadro B_JSON
+    _cair(binaria)
+    binaria = _ligar(token, binaria=True)
+    comando = {"tipo": "RESERVAR", "payload": {"produto": PRODUTO, "quantidade": 3}, "id_pedido": "pedido-1"}
+    tipo, corpo_json = _ler_quadro(servidor.processar_quadro(B_JSON, json.dumps(comando).encode(), binaria))
+    assert tipo == B_JSON and json.loads(corpo_json)["payload"]["status"] == "SUCESSO"
+
+    # ... e um cliente JSON com a mesma sessão
+    _cair(binaria)
+    texto = _ligar(token)
+    assert _reservar_json(texto, 3, "pedido-1")["payload"]["status"] == "SUCESSO"
+    assert servidor.estoque_disponivel[PRODUTO] == 7
+
+    # Ao contrário: pedido em JSON, repetição em binário
+    assert _reservar_json(texto, 2, "pedido-2")["payload"]["status"] == "SUCESSO"
+    _cair(texto)
+    binaria = _ligar(token, binaria=True)
+    corpo = PEDIDO_ITEM.pack(id_produto, 2) + b"pedido-2"
+    tipo, corpo_json = _ler_quadro(servidor.processar_quadro(B_RESERVAR, corpo, binaria))
+    assert tipo == B_JSON and json.loads(corpo_json)["tipo"] == "RESPOSTA_RESERVA"
+    assert servidor.estoque_disponivel[PRODUTO] == 5
+    assert servidor.sessao_da_conexao[binaria].carrinho[PRODUTO] == 5
+    _cair(binaria)
+
+
+def test_falha_passageira_nao_fica_guardada(monkeypatch):
+    conn = _ligar()
+    comando = {"tipo": "RESERVAR", "payload": {"produto": PRODUTO, "quantidade": 1}}
+    respostas = [OSError("sem rede"), {"tipo": "RESPOSTA_RESERVA", "payload": {"status": "SUCESSO"}}]
+
+    def encaminhar(no, comandos, sessao=None):
+        resposta = respostas.pop(0)
+        if isinstance(resposta, Exception):
+            raise resposta
+        return [resposta]
+
+    monkeypatch.setattr(servidor, "encaminhar", encaminhar)
+    executar = lambda: json.dumps(servidor._encaminhar_da_sessao("127.0.0.1:1", comando, conn))
+    primeira = json.loads(servidor.executar_uma_vez(conn, "pedido-3", executar))
+    assert "indisponível" in primeira["payload"]["mensagem"]
+    # A repetição volta a ser executada, e o resultado definitivo fica guardado
+    assert json.loads(servidor.executar_uma_vez(conn, "pedido-3", executar))["payload"]["status"] == "SUCESSO"
+    assert json.loads(servidor.executar_uma_vez(conn, "pedido-3", executar))["payload"]["status"] == "SUCESSO"
+    assert respostas == []
+    _cair(conn)
+
+
+def test_repeticao_espera_pelo_diario_do_original():
+    conn = _ligar()
+
+    def executar():
+        servidor.contexto_diario.seq = 42  # Alteração registada, ainda não em disco
+        return json.dumps({"tipo": "RESPOSTA_RESERVA", "payload": {"status": "SUCESSO"}})
+
+    servidor.executar_uma_vez(conn, "pedido-4", executar)
+    assert servidor.seq_pendente() == 42
+    # A repetição chega noutra thread (outra ligação) e espera pelo mesmo seq
+    pendente = []
+    repetir = threading.Thread(target=lambda: (servidor.executar_uma_vez(conn, "pedido-4", executar),
+                                               pendente.append(servidor.seq_pendente())))
+    repetir.start()
+    repetir.join()
+    assert pendente == [42]
+    _cair(conn)
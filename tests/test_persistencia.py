@@ -0,0 +1,94 @@
+# tests/test_persistencia.py
+import os
+import signal
+
+from conftest import Cliente, _porta_livre, subir_processo
+from persistencia import ARQUIVO_DIARIO, Diario
+
+
+def _abrir(pasta):
+    diario = Diario(str(pasta), fsync=False)
+    return diario, diario.recuperar()
+
+
+def test_reaplica_o_diario_depois_do_snapshot(tmp_path):
+    diario, _ = _abrir(tmp_path)
+    diario.registrar([["E", "banana", 10]])
+    diario.registrar([["E", "banana", 7], ["C", 1, "banana", 3]])
+    diario.aguardar()
+
+    _, (estoque, carrinhos) = _abrir(tmp_path)
+    assert estoque == {"banana": 7}
+    assert carrinhos == {1: {"banana": 3}}
+
+
+def test_checkpoint_interrompido_e_terminado_na_recuperacao(tmp_path):
+    diario, _ = _abrir(tmp_path)
+    diario.registrar([["E", "banana", 10]])
+    assert diario.rotacionar() == 1  # Queda antes de gravar o snapshot
+    diario.registrar([["E", "uva", 5]])
+    diario.aguardar()
+
+    diario, (estoque, _) = _abrir(tmp_path)
+    assert estoque == {"banana": 10, "uva": 5}
+    assert not os.path.exists(diario.caminho_antigo)
+    _, (estoque, _) = _abrir(tmp_path)
+    assert estoque == {"banana": 10, "uva": 5}
+
+
+def test_cauda_cortada_seguida_de_novas_escritas(tmp_path):
+    diario, _ = _abrir(tmp_path)
+    diario.registrar([["E", "banana", 10]])
+    diario.aguardar()
+    with open(tmp_path / ARQUIVO_DIARIO, "ab") as f:
+        f.write(b'[2,[["E","banana"')  # Queda a meio da linha
+
+    diario, (estoque, _) = _abrir(tmp_path)
+    assert estoque == {"banana": 10}
+    diario.registrar([["E", "banana", 4]])
+    diario.registrar([["E", "uva", 2]])
+    diario.aguardar()
+
+    _, (estoque, _) = _abrir(tmp_path)
+    assert estoque == {"banana": 4, "uva": 2}
+
+
+def test_ultima_linha_sem_fim_de_linha_e_descartada(tmp_path):
+    diario, _ = _abrir(tmp_path)
+    diario.registrar([["E", "banana", 10]])
+    diario.aguardar()
+    with open(tmp_path / ARQUIVO_DIARIO, "ab") as f:
+        f.write(b'[2,[["E","banana",1]]]')  # JSON inteiro, mas sem o "\n"
+
+    diario, (estoque, _) = _abrir(tmp_path)
+    assert estoque == {"banana": 10}
+    diario.registrar([["E", "uva", 2]])
+    diario.aguardar()
+    _, (estoque, _) = _abrir(tmp_path)
+    assert estoque == {"banana": 10, "uva": 2}
+
+
+def test_servidor_morto_recupera_o_estoque(tmp_path):
+    porta = _porta_livre()
+    dados = str(tmp_path / "dados")
+    processo = subir_processo(porta, "--dados", dados, "--checkpoint-a-cada", "5")
+    try:
+        admin, cliente = Cliente(porta), Cliente(porta)
+        for i in range(12):  # Passa por checkpoints e continua no diário
+            assert admin.pedir("SET_ESTOQUE", {"produto": f"disco{i}", "quantidade": 10 + i})["payload"]["status"] == "SUCESSO"
+        cliente.pedir("SESSAO")
+        assert cliente.pedir("RESERVAR", {"produto": "disco3", "quantidade": 4})["payload"]["status"] == "SUCESSO"
+        assert cliente.pedir("RESERVAR", {"produto": "disco11", "quantidade": 21})["payload"]["status"] == "SUCESSO"
+    finally:
+        processo.send_signal(signal.SIGKILL)  # Sem desligar com calma
+        processo.wait()
+
+    processo = subir_processo(porta, "--dados", dados)
+    try:
+        estoque = Cliente(porta).pedir("GET_ESTOQUE")["payload"]
+        # As respostas só saíram depois do fsync; os carrinhos voltam ao estoque
+        assert {f"disco{i}": estoque[f"disco{i}"] for i in range(12)} == {f"disco{i}": 10 + i for i in range(12)}
+        assert Cliente(porta).pedir("GET_RESERVADO")["payload"]["totais"] == {}
+    finally:
+        processo.terminate()
+        processo.wait()
@@ -0,0 +1,54 @@
+# tests/test_protocolo.py
+import socket
+
+import pytest
+
+import protocolo
+from conftest import Cliente
+from protocolo import LeitorMensagens, MensagemMuitoGrande, codificar
+
+
+def test_mensagens_partidas_e_juntas_pelo_tcp():
+    a, b = socket.socketpair()
+    leitor = LeitorMensagens(b)
+    dados = codificar({"tipo": "A", "payload": {"texto": "linha\ncom quebra"}}) + codificar({"tipo": "B"})
+    # A primeira mensagem chega aos bocados, a segunda colada ao fim dela
+    for i in range(0, len(dados), 7):
+        a.sendall(dados[i:i + 7])
+    assert leitor.ler() == {"tipo": "A", "payload": {"texto": "linha\ncom quebra"}}
+    assert leitor.ler() == {"tipo": "B"}
+    a.close()
+    assert leitor.ler() is None
+    b.close()
+
+
+def test_ler_linhas_devolve_todo_o_pipeline():
+    a, b = socket.socketpair()
+    leitor = LeitorMensagens(b)
+    a.sendall(codificar({"n": 1}) + codificar({"n": 2}) + b'{"n": 3')
+    assert leitor.ler_linhas() == [b'{"n": 1}', b'{"n": 2}']
+    a.sendall(b"}\n")
+    assert leitor.ler_linhas() == [b'{"n": 3}']
+    a.close()
+    b.close()
+
+
+def test_linha_sem_fim_grande_demais(monkeypatch):
+    monkeypatch.setattr(protocolo, "TAMANHO_MAXIMO", 1000)
+    a, b = socket.socketpair()
+    leitor = LeitorMensagens(b)
+    a.sendall(b"x" * 5000)
+    with pytest.raises(MensagemMuitoGrande):
+        leitor.ler_linha()
+    a.close()
+    b.close()
+
+
+def test_servidor_responde_ao_pipeline_por_ordem(porta_threads):
+    cliente = Cliente(porta_threads)
+    comandos = [{"tipo": "SESSAO"}, {"tipo": "GET_MINHAS_RESERVAS"}, {"tipo": "COMANDO_QUE_NAO_EXISTE"},
+                {"tipo": "GET_RESERVADO"}]
+    cliente.sock.sendall(b"".join(codificar(c) for c in comandos))
+    tipos = [cliente.ler()["tipo"] for _ in comandos]
+    assert tipos == ["SESSAO_OK", "MINHAS_RESERVAS", "RESPOSTA_ERRO", "RESERVADO"]
+    cliente.fechar()
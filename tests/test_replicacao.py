@@ -0,0 +1,74 @@
+# tests/test_replicacao.py
+# Primário e réplica em processos separados: leituras, recusas e failover.
+import time
+
+from conftest import Cliente, _porta_livre, subir_processo
+from replicacao import LogReplicacao
+
+
+def test_log_so_cobre_o_que_ainda_guarda():
+    log = LogReplicacao(tamanho=3)
+    assert log.cobre(0) and log.desde(0, espera=0) == ([], 0)  # Só pulso
+    for i in range(1, 6):
+        log.registrar([("S", f"p{i}", i)])
+    assert log.desde(2, espera=0) == ([(3, [("S", "p3", 3)]), (4, [("S", "p4", 4)]), (5, [("S", "p5", 5)])], 5)
+    assert log.desde(4, espera=0, maximo=1) == ([(5, [("S", "p5", 5)])], 5)
+    # Atrás do início do log, ou à frente do primário: a réplica precisa de uma fotografia
+    assert not log.cobre(1) and log.desde(1, espera=0) is None
+    assert not log.cobre(6) and log.desde(6, espera=0) is None
+
+
+def _esperar(condicao, segundos=5):
+    prazo = time.monotonic() + segundos
+    while not condicao():
+        assert time.monotonic() < prazo
+        time.sleep(0.05)
+
+
+def _meus(resposta):
+    return {nome: q for nome, q in resposta["payload"].items() if nome.startswith("repl_")}
+
+
+def test_replica_serve_leituras_e_assume_depois_de_promovida():
+    porta_primario, porta_replica = _porta_livre(), _porta_livre()
+    primario = subir_processo(porta_primario)
+    replica = None
+    try:
+        admin = Cliente(porta_primario)
+        admin.pedir("BULK_SET", {"itens": [["repl_a", 10], ["repl_b", 3]]})
+        replica = subir_processo(porta_replica, "--replica-de", f"127.0.0.1:{porta_primario}",
+                                 "--atraso-maximo", "0.5")
+        leitor = Cliente(porta_replica)
+        cliente = Cliente(porta_primario)
+        token = cliente.pedir("SESSAO")["payload"]["token"]
+        assert cliente.pedir("RESERVAR", {"produto": "repl_a", "quantidade": 4})["payload"]["status"] == "SUCESSO"
+
+        # A réplica apanha a fotografia e depois as alterações, pela ordem
+        _esperar(lambda: _meus(leitor.pedir("GET_ESTOQUE")) == {"repl_a": 6, "repl_b": 3})
+        estado = leitor.pedir("GET_REPLICACAO")["payload"]
+        assert estado["papel"] == "replica" and estado["primario"] == f"127.0.0.1:{porta_primario}"
+        recusa = leitor.pedir("RESERVAR", {"produto": "repl_b", "quantidade": 1})
+        assert recusa["tipo"] == "NAO_PRIMARIO" and recusa["payload"]["primario"] == f"127.0.0.1:{porta_primario}"
+
+        # Sem o primário, a réplica deixa de estar em dia e manda as leituras para ele
+        primario.kill()
+        primario.wait()
+        _esperar(lambda: leitor.pedir("GET_ESTOQUE")["tipo"] == "REPLICA_ATRASADA")
+
+        # Promovida, aceita alterações e o cliente recupera o carrinho pelo token
+        promovido = leitor.pedir("PROMOVER")
+        assert promovido == {"tipo": "PROMOVIDO", "payload": {"sessoes": 1}}
+        assert leitor.pedir("PROMOVER")["tipo"] == "RESPOSTA_ERRO"
+        assert leitor.pedir("GET_REPLICACAO")["payload"]["papel"] == "primario"
+        assert _meus(leitor.pedir("GET_ESTOQUE")) == {"repl_a": 6, "repl_b": 3}
+        novo = Cliente(porta_replica)
+        sessao = novo.pedir("SESSAO", {"token": token})["payload"]
+        assert sessao["retomada"] and sessao["carrinho"] == {"repl_a": 4}
+        assert novo.pedir("RESERVAR", {"produto": "repl_b", "quantidade": 3})["payload"]["status"] == "SUCESSO"
+        assert novo.pedir("CANCELAR_RESERVA", {"produto": "repl_a", "quantidade": 4})["payload"]["status"] == "SUCESSO"
+        assert _meus(leitor.pedir("GET_ESTOQUE")) == {"repl_a": 10, "repl_b": 0}
+    finally:
+        for processo in (primario, replica):
+            if processo is not None:
+                processo.terminate()
+                processo.wait()
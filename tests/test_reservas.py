@@ -0,0 +1,60 @@
+# tests/test_reservas.py
+# Índice de reservas por produto: GET_RESERVADO, SET_ESTOQUE total e saídas.
+import json
+
+import servidor
+
+
+def _pedir(conn, tipo, payload):
+    return json.loads(servidor.process_json_command(json.dumps({"tipo": tipo, "payload": payload}), conn))["payload"]
+
+
+def _ligar():
+    conn = object()
+    servidor.registrar_cliente(conn)
+    return conn
+
+
+def test_reservado_por_cliente_e_devolvido_ao_sair():
+    servidor.definir_estoque("indice_a", 10)
+    servidor.definir_estoque("indice_b", 5)
+    ana, rui = _ligar(), _ligar()
+    _pedir(ana, "RESERVAR", {"produto": "indice_a", "quantidade": 3})
+    _pedir(ana, "RESERVAR", {"produto": "indice_b", "quantidade": 1})
+    _pedir(rui, "RESERVAR", {"produto": "INDICE_A", "quantidade": 2})
+    id_ana, id_rui = (str(servidor.sessao_da_conexao[c].id_cliente) for c in (ana, rui))
+
+    consulta = _pedir(rui, "GET_RESERVADO", {"produto": "Indice_A"})
+    assert consulta == {"produto": "indice_a", "existe": True, "disponivel": 5, "reservado": 5, "total": 10,
+                        "clientes": {id_ana: 3, id_rui: 2}}
+    totais = _pedir(rui, "GET_RESERVADO", {})["totais"]
+    assert totais["indice_a"] == 5 and totais["indice_b"] == 1
+
+    # Cancelar tudo tira o cliente do índice
+    _pedir(rui, "CANCELAR_RESERVA", {"produto": "indice_a", "quantidade": 2})
+    assert _pedir(rui, "GET_RESERVADO", {"produto": "indice_a"})["clientes"] == {id_ana: 3}
+
+    # Sair devolve só o carrinho de quem sai e limpa os totais a zero
+    servidor.desligar_sessao(ana, "teste", True)
+    assert servidor.estoque_disponivel["indice_a"] == 10 and servidor.estoque_disponivel["indice_b"] == 5
+    totais = _pedir(rui, "GET_RESERVADO", {})["totais"]
+    assert "indice_a" not in totais and "indice_b" not in totais
+    assert not servidor.reservas.clientes("indice_a") and servidor.reservas.total("indice_b") == 0
+    assert _pedir(rui, "GET_RESERVADO", {"produto": "indice_nenhum"})["existe"] is False
+    servidor.desligar_sessao(rui, "teste", True)
+
+
+def test_set_estoque_total_conta_com_as_reservas():
+    servidor.definir_estoque("indice_c", 10)
+    conn = _ligar()
+    _pedir(conn, "RESERVAR", {"produto": "indice_c", "quantidade": 4})
+    recusa = _pedir(conn, "SET_ESTOQUE", {"produto": "indice_c", "quantidade": 3, "total": True})
+    assert recusa["status"] == "ERRO" and servidor.estoque_disponivel["indice_c"] == 6
+    resposta = _pedir(conn, "SET_ESTOQUE", {"produto": "indice_c", "quantidade": 4, "total": True})
+    assert resposta["status"] == "SUCESSO" and "(total 4, 4 reservados)" in resposta["mensagem"]
+    assert servidor.estoque_disponivel["indice_c"] == 0
+    # Sem 'total' a quantidade é só a disponível
+    _pedir(conn, "SET_ESTOQUE", {"produto": "indice_c", "quantidade": 7})
+    assert _pedir(conn, "GET_RESERVADO", {"produto": "indice_c"})["total"] == 11
+    servidor.desligar_sessao(conn, "teste", True)
+    assert servidor.estoque_disponivel["indice_c"] == 11
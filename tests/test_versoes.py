@@ -0,0 +1,41 @@
+# tests/test_versoes.py
+import json
+
+import servidor
+from servidor import LogAlteracoes
+
+
+def test_log_devolve_os_produtos_alterados_depois_da_versao():
+    log = LogAlteracoes(tamanho=4)
+    for produto in ("a", "b", "a", "c"):
+        log.registrar(produto)
+    assert log.desde(4) == (4, set())
+    assert log.desde(2) == (4, {"a", "c"})
+    assert log.desde(0) == (4, {"a", "b", "c"})
+    # Versão do futuro (o servidor reiniciou) ou já fora do log
+    assert log.desde(5) is None
+    log.registrar("d")
+    assert log.desde(0) is None
+    assert log.desde(1) == (5, {"a", "b", "c", "d"})
+
+
+def _get_estoque(payload=None):
+    conn = object()
+    comando = {"tipo": "GET_ESTOQUE", "payload": payload or {}}
+    return json.loads(servidor.process_json_command(json.dumps(comando), conn))
+
+
+def test_get_estoque_so_com_o_que_mudou():
+    servidor.definir_estoque("versionado", 5)
+    completo = _get_estoque()
+    assert completo["tipo"] == "ESTOQUE_ATUAL" and completo["payload"]["versionado"] == 5
+    versao = completo["versao"]
+
+    servidor.definir_estoque("versionado", 7)
+    delta = _get_estoque({"desde_versao": versao})
+    assert delta["tipo"] == "ESTOQUE_DELTA"
+    assert delta["payload"] == {"versionado": 7} and delta["versao"] > versao
+    assert _get_estoque({"desde_versao": delta["versao"]})["payload"] == {}
+
+    # Uma versão que o servidor não conhece recebe o estoque completo
+    assert _get_estoque({"desde_versao": delta["versao"] + 1000})["tipo"] == "ESTOQUE_ATUAL"